@@ -1,126 +1,678 @@
+"""
+Layout 分析工具
+===============
+
+以 Detectron2（PubLayNet）偵測詳情頁的版面區塊並裁切。
+
+推論後端
+--------
+* detectron2：layoutparser 的 Detectron2LayoutModel，`--device cuda|cpu`（auto：有 CUDA 才用 GPU）
+* onnx：以 `--export-onnx` 匯出的 ONNX 圖，onnxruntime 在 CPU 上執行
+* stub：不需任何模型的替身（二值化 + 連通元件），方便在沒有 torch 的環境驗證流程
+
+長圖分塊
+--------
+高寬比超過 `TILE_MIN_ASPECT` 的長圖不再整張縮到最長邊 2000px（文字會縮到只剩幾 px 高），
+而是維持原解析度切成互相重疊的 tile（高約為寬的 `TILE_ASPECT` 倍，剛好不觸發 Detectron2
+內部的再縮小），整批送進偵測器，再把跨 tile 的框接合並做 NMS。`--no-tile` 恢復舊行為。
+
+方向預判
+--------
+不再以四個方向 × 兩種門檻反覆跑偵測器（最多 8 次）。偵測器每個方向只跑一次（門檻下限），
+再於輸出端依一般門檻過濾（沒有框才採用低分框）。`estimate_orientation` 以字元大小的連通元件
+分別做水平/垂直膨脹，數連成的文字行；只有直向文字行夠多、夠大且明顯多於橫向時，才另外
+跑兩個 90° 方向，框分數明顯較高才採用（照片紋理常被誤認為直條，不能只靠預判就旋轉）。
+原方向完全沒有框時沿用舊的做法依序試其他方向。框座標一律轉回原方向。
+
+常駐 worker
+-----------
+`--files` / `--dir` 批次模式會啟動一個 LayoutWorker 行程：模型只載入一次並先 warm-up，
+之後從本機佇列收請求，湊滿 `--batch-size` 張（或等 `--batch-wait` 秒）就一起推論。
+
+使用範例
+--------
+$ python Layout-Parser.py --file page.jpg
+$ python Layout-Parser.py --dir products/WWW_Collection/product_321/images --device cpu --batch-size 4
+$ python Layout-Parser.py --export-onnx models/publaynet.onnx --device cpu
+$ python Layout-Parser.py --dir images --backend onnx --onnx models/publaynet.onnx
+"""
+
 import argparse
 import cv2
-import layoutparser as lp
+import json
 import os
+import pickle
+import queue
+import threading
+import multiprocessing as mp
+from concurrent.futures import Future
+from dataclasses import dataclass
 from pathlib import Path
-import torch
 import logging
 import numpy as np
 import time
 import sys
 from typing import List, Dict, Any, Optional, Tuple
 
+try:
+    import torch
+except ImportError:  # 選用相依：只有 detectron2 後端與匯出 ONNX 需要
+    torch = None
+
+try:
+    import layoutparser as lp
+except ImportError:  # 選用相依
+    lp = None
+
+try:
+    import onnxruntime as ort
+except ImportError:  # 選用相依：onnx 後端
+    ort = None
+
 # 設定日誌
 logging.basicConfig(
     level=logging.INFO,
     format='%(asctime)s - %(levelname)s - %(message)s'
 )
 
-# 驗證 GPU
-if not torch.cuda.is_available():
-    logging.error("CUDA 未啟用！請確認 PyTorch 安裝正確版本")
-    logging.error("建議執行：pip install torch torchvision torchaudio --index-url https://download.pytorch.org/whl/cu118")
-    logging.error("然後：pip install detectron2 -f https://dl.fbaipublicfiles.com/detectron2/wheels/cu118/torch2.2/index.html")
-    exit(1)
-
-logging.info(f"使用 GPU: {torch.cuda.get_device_name(0)}")
+MODEL_NAME = "lp://PubLayNet/mask_rcnn_R_50_FPN_3x/config"
+MODEL_PATH = os.path.expanduser("~/.cache/layoutparser/publaynet_R50.pth")
+LABEL_MAP = {0: "Text", 1: "Title", 2: "List", 3: "Table", 4: "Figure"}
+SCORE_THRESH = 0.1        # 一般的分數門檻
+RETRY_SCORE_THRESH = 0.05  # 無框時重試的門檻（模型本身以此為下限，較高門檻在輸出端過濾）
+BATCH_SIZE = 4            # worker 每批最多張數
+BATCH_WAIT = 0.05         # worker 湊批次最多等待秒數
+WORKER_START_TIMEOUT = 600  # 等待 worker 載入模型 + warm-up 的秒數
+WORKER_POLL = 1.0         # 讀回應的輪詢間隔：逾時就檢查 worker 行程是否還活著
+REQUEST_TIMEOUT = 600     # detect() 等待單一請求結果的秒數上限
+TILE_MIN_ASPECT = 2.5     # 高/寬超過此值才分塊
+TILE_ASPECT = 1.5         # tile 高 = 寬 × 此值（Detectron2 短邊 800、長邊 1333 以內不會再縮）
+TILE_OVERLAP = 0.2        # 相鄰 tile 重疊比例（相對 tile 高）
+TILE_EDGE = 4             # 框距 tile 切邊在此 px 內視為被切斷
+NMS_IOU = 0.5             # 跨 tile NMS 的 IoU 門檻
+NMS_IOS = 0.8             # 小框被大框覆蓋此比例以上也視為重複
+ORIENT_SHORT = 800        # 方向預判時短邊縮到此值以下
+ORIENT_MIN_CHARS = 40     # 字元大小的連通元件少於此數（照片、純圖）就維持原方向
+ORIENT_MARGIN = 0.5       # 文字行分數低於 -此值才視為可能直排
+ORIENT_MIN_LINES = 5      # 至少要有這麼多條直向文字行（紋理、條紋常只有零星幾條）
+ORIENT_MIN_FILL = 0.005   # 直向文字行面積至少佔全圖此比例
+ORIENT_GAIN = 1.5         # 旋轉後的框分數總和須為原方向的此倍數以上才採用（誤轉比漏轉代價高）
 
 def debug_print(msg: str):
     """立即輸出調試訊息"""
     print(msg, flush=True)
     sys.stdout.flush()
 
+# ───────────────────────────── 偵測結果
+
+@dataclass
+class Block:
+    """偵測到的版面區塊（座標為輸入圖片的像素）"""
+    x1: float
+    y1: float
+    x2: float
+    y2: float
+    type: str
+    score: float = 1.0
+
+    @property
+    def coordinates(self) -> Tuple[float, float, float, float]:
+        return (self.x1, self.y1, self.x2, self.y2)
+
+
+def tile_spans(h: int, w: int, aspect: float = TILE_ASPECT,
+               overlap: float = TILE_OVERLAP) -> List[Tuple[int, int]]:
+    """長圖的 tile 列範圍 [(y0, y1), ...]，相鄰 tile 重疊 overlap × tile 高，最後一塊對齊底部"""
+    tile_h = max(1, int(round(w * aspect)))
+    if h <= tile_h:
+        return [(0, h)]
+    stride = max(1, int(tile_h * (1 - overlap)))
+    starts = list(range(0, h - tile_h, stride)) + [h - tile_h]
+    return [(y0, y0 + tile_h) for y0 in starts]
+
+
+def _iou_ios(box: np.ndarray, others: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """box 與 others 的 IoU 及「交集 / 較小框面積」"""
+    ix = np.clip(np.minimum(box[2], others[:, 2]) - np.maximum(box[0], others[:, 0]), 0, None)
+    iy = np.clip(np.minimum(box[3], others[:, 3]) - np.maximum(box[1], others[:, 1]), 0, None)
+    inter = ix * iy
+    area = (box[2] - box[0]) * (box[3] - box[1])
+    areas = (others[:, 2] - others[:, 0]) * (others[:, 3] - others[:, 1])
+    iou = inter / np.maximum(area + areas - inter, 1e-6)
+    ios = inter / np.maximum(np.minimum(area, areas), 1e-6)
+    return iou, ios
+
+
+def merge_tiles(tile_blocks: List[List[Block]], spans: List[Tuple[int, int]]) -> List[Block]:
+    """
+    把各 tile 的框平移回原圖座標並合併：
+    1. 相鄰 tile 中同類型、水平大致重疊、垂直有交集的一對框，只要其中一個被兩者之間的
+       切邊截斷、另一個涵蓋它在重疊帶內的部分，就接成一個（聯集，取較高分數）；
+       從重疊帶內開始的框因此不會被上一個 tile 的截斷碎片吃掉；
+    2. 再以 IoU / 覆蓋率做跨 tile NMS，保留高分框。
+    """
+    items = []   # (Block, 碰到上切邊, 碰到下切邊, tile 序號)
+    last = len(spans) - 1
+    for i, ((y0, y1), blocks) in enumerate(zip(spans, tile_blocks)):
+        for b in blocks:
+            g = Block(b.x1, b.y1 + y0, b.x2, b.y2 + y0, b.type, b.score)
+            items.append([g, i > 0 and b.y1 <= TILE_EDGE, i < last and b.y2 >= (y1 - y0) - TILE_EDGE, i])
+
+    def _joins(a: list, b: list) -> bool:
+        """a 在 tile i、b 在 tile i+1：是否為同一個被切邊截斷的區塊"""
+        A, B = a[0], b[0]
+        ix = min(A.x2, B.x2) - max(A.x1, B.x1)
+        if ix <= 0.5 * min(A.x2 - A.x1, B.x2 - B.x1) or min(A.y2, B.y2) <= max(A.y1, B.y1):
+            return False
+        seam_top, seam_bottom = spans[b[3]][0], spans[a[3]][1]     # 兩個 tile 的重疊帶
+        # a 的下緣被切：b 須從 a 在重疊帶內的起點（或更上面）開始
+        if a[2] and B.y1 <= max(A.y1, seam_top) + TILE_EDGE:
+            return True
+        # b 的上緣被切：a 須延伸到 b 在重疊帶內的終點（或更下面）
+        return b[1] and A.y2 >= min(B.y2, seam_bottom) - TILE_EDGE
+
+    # 1. 接合被切斷的框
+    merged = True
+    while merged:
+        merged = False
+        for a in items:
+            for b in items:
+                if a is b or b[3] != a[3] + 1 or a[0].type != b[0].type or not _joins(a, b):
+                    continue
+                A, B = a[0], b[0]
+                a[0] = Block(min(A.x1, B.x1), min(A.y1, B.y1), max(A.x2, B.x2), max(A.y2, B.y2),
+                             A.type, max(A.score, B.score))
+                a[2], a[3] = b[2], b[3]
+                items.remove(b)
+                merged = True
+                break
+            if merged:
+                break
+
+    # 2. 跨 tile NMS（不分類型：重疊區的同一塊可能被判成不同類型）
+    blocks = sorted((it[0] for it in items), key=lambda b: -b.score)
+    kept: List[Block] = []
+    for b in blocks:
+        if kept:
+            iou, ios = _iou_ios(np.array(b.coordinates), np.array([k.coordinates for k in kept]))
+            if (iou > NMS_IOU).any() or (ios > NMS_IOS).any():
+                continue
+        kept.append(b)
+    return kept
+
+
+def estimate_orientation(image: np.ndarray) -> Tuple[Tuple[int, ...], float]:
+    """
+    以文字行方向預判是否可能需要旋轉，回傳 (值得與原方向比較的旋轉代碼, 分數)。
+    文字行 = 依字高膨脹後連成的長條：長邊 ≥ 4 個字、短邊不超過約兩個字高（照片紋理膨脹後
+    多半是粗塊或零星細條）。分數 = (橫向文字行面積 − 直向文字行面積) / 兩者和，> 0 為橫排。
+    直向文字行夠多（ORIENT_MIN_LINES）、夠大（ORIENT_MIN_FILL）且分數低於 -ORIENT_MARGIN
+    時回傳兩個 90° 方向，由偵測器結果決定（直排看不出該順時針還是逆時針轉）；否則回傳空 tuple。
+    上下顛倒（180°）在中韓英混排的頁面上沒有可靠的訊號，不做判斷。
+    """
+    gray = cv2.cvtColor(image, cv2.COLOR_RGB2GRAY) if image.ndim == 3 else image
+    h, w = gray.shape
+    scale = min(1.0, ORIENT_SHORT / min(h, w))
+    if scale < 1:
+        gray = cv2.resize(gray, (max(1, int(w * scale)), max(1, int(h * scale))), interpolation=cv2.INTER_AREA)
+    mask = cv2.adaptiveThreshold(gray, 1, cv2.ADAPTIVE_THRESH_MEAN_C, cv2.THRESH_BINARY_INV, 15, 10)
+
+    # 只留字元大小的元件
+    n, labels, stats, _ = cv2.connectedComponentsWithStats(mask)
+    cw, ch = stats[1:, cv2.CC_STAT_WIDTH], stats[1:, cv2.CC_STAT_HEIGHT]
+    is_char = (ch >= 4) & (ch <= 60) & (cw >= 2) & (cw <= 60)
+    if is_char.sum() < ORIENT_MIN_CHARS:
+        return (), 0.0
+    keep = np.zeros(n, np.uint8)
+    keep[1:][is_char] = 1
+    chars = keep[labels]
+
+    # 依字高膨脹，看哪個方向連成文字行
+    k = int(np.median(np.maximum(ch[is_char], cw[is_char])) * 1.2) + 1
+
+    def _lines(kernel: np.ndarray, horizontal: bool) -> Tuple[int, int]:
+        """(文字行總面積, 條數)"""
+        _, _, s, _ = cv2.connectedComponentsWithStats(cv2.dilate(chars, kernel))
+        s = s[1:]
+        long_side, short_side = (s[:, 2], s[:, 3]) if horizontal else (s[:, 3], s[:, 2])
+        line = (long_side > 3 * short_side) & (long_side >= 4 * k) & (short_side <= 2.5 * k)
+        return int(s[line, cv2.CC_STAT_AREA].sum()), int(line.sum())
+
+    horiz, _ = _lines(np.ones((1, k), np.uint8), True)
+    vert, vert_lines = _lines(np.ones((k, 1), np.uint8), False)
+    score = (horiz - vert) / max(horiz + vert, 1)
+    if score < -ORIENT_MARGIN and vert_lines >= ORIENT_MIN_LINES and vert >= ORIENT_MIN_FILL * gray.size:
+        return (cv2.ROTATE_90_CLOCKWISE, cv2.ROTATE_90_COUNTERCLOCKWISE), float(score)
+    return (), float(score)
+
+
+def unrotate_blocks(blocks: List[Block], rot: Optional[int], shape: Tuple[int, ...]) -> List[Block]:
+    """把旋轉後圖上的框轉回原圖座標（shape 為原圖形狀）"""
+    if rot is None:
+        return blocks
+    h, w = shape[:2]
+    out = []
+    for b in blocks:
+        if rot == cv2.ROTATE_90_CLOCKWISE:          # 原 (x, y) → (h − y, x)
+            box = (b.y1, h - b.x2, b.y2, h - b.x1)
+        elif rot == cv2.ROTATE_90_COUNTERCLOCKWISE:  # 原 (x, y) → (y, w − x)
+            box = (w - b.y2, b.x1, w - b.y1, b.x2)
+        else:                                        # 180°
+            box = (w - b.x2, h - b.y2, w - b.x1, h - b.y1)
+        out.append(Block(*box, b.type, b.score))
+    return out
+
+
+def draw_blocks(image: np.ndarray, blocks: List[Block], box_width: int = 3) -> np.ndarray:
+    """在 RGB 圖上畫出區塊框與類型（取代 lp.draw_box，不需 layoutparser）"""
+    viz = image.copy()
+    for b in blocks:
+        p1, p2 = (int(b.x1), int(b.y1)), (int(b.x2), int(b.y2))
+        cv2.rectangle(viz, p1, p2, (255, 0, 0), box_width)
+        cv2.putText(viz, b.type, (p1[0], max(p1[1] - 4, 12)), cv2.FONT_HERSHEY_SIMPLEX, 0.6, (255, 0, 0), 2)
+    return viz
+
+# ───────────────────────────── 推論後端
+
+@dataclass
+class BackendSpec:
+    """可 pickle 的後端描述，交給 worker 行程自行建立模型"""
+    kind: str = "detectron2"              # detectron2 | onnx | stub
+    device: str = "auto"                  # auto | cuda | cpu（detectron2）
+    model_name: str = MODEL_NAME
+    model_path: str = MODEL_PATH
+    onnx_path: Optional[str] = None
+
+
+def resolve_device(device: str) -> str:
+    if device == "auto":
+        return "cuda" if torch is not None and torch.cuda.is_available() else "cpu"
+    if device == "cuda" and (torch is None or not torch.cuda.is_available()):
+        logging.warning("CUDA 未啟用，改用 CPU 推論")
+        return "cpu"
+    return device
+
+
+class Detectron2Backend:
+    """layoutparser 的 Detectron2 模型；多張圖一次送進 GeneralizedRCNN"""
+
+    def __init__(self, spec: BackendSpec):
+        if lp is None or torch is None:
+            raise RuntimeError("detectron2 後端需要 layoutparser 與 torch")
+        if not Path(spec.model_path).exists():
+            raise FileNotFoundError(
+                f"權重檔案不存在: {spec.model_path}，請先下載："
+                "https://huggingface.co/layoutparser/detectron2/resolve/main/PubLayNet/mask_rcnn_R_50_FPN_3x/model_final.pth")
+        self.device = resolve_device(spec.device)
+        if self.device == "cuda":
+            gpu_memory = torch.cuda.get_device_properties(0).total_memory / 1024**3
+            logging.info(f"使用 GPU: {torch.cuda.get_device_name(0)}（{gpu_memory:.1f} GB）")
+        else:
+            torch.set_num_threads(os.cpu_count() or 1)
+            logging.info(f"使用 CPU 推論（{torch.get_num_threads()} threads）")
+        logging.info(f"layoutparser 版本: {lp.__version__}，模型: {spec.model_name}")
+
+        self.lp_model = lp.Detectron2LayoutModel(
+            config_path=spec.model_name,   # 只決定網路結構 & label_map
+            model_path=spec.model_path,    # 手動下載的權重檔案
+            device=self.device,
+            extra_config=[
+                "MODEL.ROI_HEADS.SCORE_THRESH_TEST", RETRY_SCORE_THRESH,  # 門檻下限；各呼叫的門檻在輸出端過濾
+                "MODEL.ROI_HEADS.NMS_THRESH_TEST", 0.5,    # 調整 NMS
+                "MODEL.RPN.PRE_NMS_TOPK_TEST", 1000,       # 增加候選框
+                "MODEL.RPN.POST_NMS_TOPK_TEST", 1000,      # 增加候選框
+                "MODEL.RPN.MIN_SIZE", 8,                   # 降低最小尺寸
+                "MODEL.RPN.ANCHOR_SCALES", [4, 8, 16, 32, 64]  # 調整錨點尺寸
+            ]
+        )
+        self.predictor = self.lp_model.model        # detectron2 DefaultPredictor
+        self.label_map = getattr(self.lp_model, "label_map", None) or LABEL_MAP
+
+    def _inputs(self, images: List[np.ndarray]) -> List[Dict[str, Any]]:
+        """與 DefaultPredictor.__call__ 相同的前處理，但保留成批次"""
+        batch = []
+        for img in images:
+            if self.predictor.input_format == "RGB":
+                img = img[:, :, ::-1]
+            h, w = img.shape[:2]
+            t = self.predictor.aug.get_transform(img).apply_image(img)
+            batch.append({"image": torch.as_tensor(t.astype("float32").transpose(2, 0, 1)),
+                          "height": h, "width": w})
+        return batch
+
+    def detect(self, images: List[np.ndarray], score_thresh: float = SCORE_THRESH) -> List[List[Block]]:
+        with torch.no_grad():
+            outputs = self.predictor.model(self._inputs(images))
+        results = []
+        for out in outputs:
+            inst = out["instances"].to("cpu")
+            boxes = inst.pred_boxes.tensor.numpy()
+            scores = inst.scores.numpy()
+            classes = inst.pred_classes.numpy()
+            results.append([Block(*map(float, box), self.label_map.get(int(c), str(int(c))), float(s))
+                            for box, s, c in zip(boxes, scores, classes) if s >= score_thresh])
+        return results
+
+
+class OnnxBackend:
+    """以 export_onnx 匯出的圖在 onnxruntime 上推論（CPU）；前處理參數讀自同名 .json"""
+
+    def __init__(self, spec: BackendSpec):
+        if ort is None:
+            raise RuntimeError("onnx 後端需要 onnxruntime")
+        if not spec.onnx_path or not Path(spec.onnx_path).exists():
+            raise FileNotFoundError(f"找不到 ONNX 模型: {spec.onnx_path}（先以 --export-onnx 匯出）")
+        meta = json.loads(Path(spec.onnx_path).with_suffix(".json").read_text(encoding="utf-8"))
+        self.min_size, self.max_size = meta["min_size"], meta["max_size"]
+        self.input_format = meta["input_format"]
+        self.outputs = meta["outputs"]
+        self.label_map = {int(k): v for k, v in meta["label_map"].items()}
+        opts = ort.SessionOptions()
+        opts.intra_op_num_threads = os.cpu_count() or 1
+        self.session = ort.InferenceSession(spec.onnx_path, opts, providers=["CPUExecutionProvider"])
+        self.input_name = self.session.get_inputs()[0].name
+        logging.info(f"ONNX 模型: {spec.onnx_path}")
+
+    def _resize(self, img: np.ndarray) -> Tuple[np.ndarray, float]:
+        """同 detectron2 ResizeShortestEdge（測試時）"""
+        h, w = img.shape[:2]
+        scale = self.min_size / min(h, w)
+        if max(h, w) * scale > self.max_size:
+            scale = self.max_size / max(h, w)
+        new_w, new_h = int(w * scale + 0.5), int(h * scale + 0.5)
+        return cv2.resize(img, (new_w, new_h), interpolation=cv2.INTER_LINEAR), scale
+
+    def detect(self, images: List[np.ndarray], score_thresh: float = SCORE_THRESH) -> List[List[Block]]:
+        results = []
+        for img in images:
+            if self.input_format == "RGB":
+                img = img[:, :, ::-1]
+            resized, scale = self._resize(img)
+            tensor = np.ascontiguousarray(resized.transpose(2, 0, 1), dtype=np.float32)
+            out = dict(zip(self.outputs, self.session.run(None, {self.input_name: tensor})))
+            boxes = out["pred_boxes"] / scale
+            results.append([Block(*map(float, box), self.label_map.get(int(c), str(int(c))), float(s))
+                            for box, s, c in zip(boxes, out["scores"], out["pred_classes"])
+                            if s >= score_thresh])
+        return results
+
+
+class StubBackend:
+    """
+    不需任何模型的替身：二值化、膨脹後取連通元件當作區塊。
+    寬扁的元件視為 Text，其餘為 Figure；分數固定 1.0。只用來驗證批次與 worker 流程。
+    """
+
+    def __init__(self, spec: Optional[BackendSpec] = None):
+        pass
+
+    def detect(self, images: List[np.ndarray], score_thresh: float = SCORE_THRESH) -> List[List[Block]]:
+        results = []
+        for img in images:
+            gray = cv2.cvtColor(img, cv2.COLOR_RGB2GRAY) if img.ndim == 3 else img
+            mask = cv2.adaptiveThreshold(gray, 255, cv2.ADAPTIVE_THRESH_MEAN_C, cv2.THRESH_BINARY_INV, 25, 10)
+            mask = cv2.dilate(mask, cv2.getStructuringElement(cv2.MORPH_RECT, (25, 9)))
+            n, _, stats, _ = cv2.connectedComponentsWithStats(mask)
+            min_area = 0.001 * gray.size
+            blocks = []
+            for x, y, w, h, area in stats[1:n]:
+                if area < min_area:
+                    continue
+                kind = "Text" if w > 3 * h else "Figure"
+                blocks.append(Block(float(x), float(y), float(x + w), float(y + h), kind, 1.0))
+            results.append(blocks)
+        return results
+
+
+BACKENDS = {"detectron2": Detectron2Backend, "onnx": OnnxBackend, "stub": StubBackend}
+
+
+def build_backend(spec: BackendSpec):
+    if spec.kind not in BACKENDS:
+        raise ValueError(f"未知的後端: {spec.kind}（可用: {', '.join(BACKENDS)}）")
+    return BACKENDS[spec.kind](spec)
+
+
+def export_onnx(spec: BackendSpec, out_path: Path, sample: Optional[np.ndarray] = None) -> Path:
+    """
+    把 Detectron2 模型以 TracingAdapter 匯出成 ONNX（不含後處理，框座標為縮放後的圖），
+    前處理參數與輸出名稱另存成同名 .json 給 OnnxBackend 使用。
+    """
+    from detectron2.export import TracingAdapter
+
+    backend = Detectron2Backend(BackendSpec("detectron2", "cpu", spec.model_name, spec.model_path))
+    predictor = backend.predictor
+    if sample is None:
+        sample = np.full((1200, 800, 3), 255, np.uint8)
+    inputs = backend._inputs([sample])[:1]
+    inputs = [{"image": inputs[0]["image"]}]
+
+    def inference(model, inputs):
+        inst = model.inference(inputs, do_postprocess=False)[0]
+        return [{"instances": inst}]
+
+    adapter = TracingAdapter(predictor.model.eval(), inputs, inference)
+    with torch.no_grad():
+        fields = sorted(inference(predictor.model, inputs)[0]["instances"].get_fields())
+    out_path = Path(out_path)
+    out_path.parent.mkdir(parents=True, exist_ok=True)
+    torch.onnx.export(adapter, adapter.flattened_inputs, str(out_path), opset_version=16,
+                      input_names=["image"], output_names=fields,
+                      dynamic_axes={"image": {1: "height", 2: "width"}})
+    aug = predictor.aug
+    meta = {"min_size": int(aug.short_edge_length[0]), "max_size": int(aug.max_size),
+            "input_format": predictor.input_format, "outputs": fields,
+            "label_map": {str(k): v for k, v in backend.label_map.items()}}
+    out_path.with_suffix(".json").write_text(json.dumps(meta, ensure_ascii=False, indent=2), encoding="utf-8")
+    logging.info(f"已匯出 ONNX: {out_path}（輸出: {', '.join(fields)}）")
+    return out_path
+
+# ───────────────────────────── 常駐 worker
+
+def _worker_main(spec: BackendSpec, requests: mp.Queue, responses: mp.Queue,
+                 batch_size: int, batch_wait: float) -> None:
+    """worker 行程：載入模型一次、warm-up，之後湊批次推論直到收到 None"""
+    try:
+        backend = build_backend(spec)
+        t0 = time.perf_counter()
+        backend.detect([np.full((800, 600, 3), 255, np.uint8)])
+        responses.put(("ready", round(time.perf_counter() - t0, 3)))
+    except Exception as e:
+        responses.put(("failed", f"{type(e).__name__}: {e}"))
+        return
+
+    stop = False
+    while not stop:
+        req = requests.get()
+        if req is None:
+            break
+        batch = [req]
+        deadline = time.perf_counter() + batch_wait
+        while len(batch) < batch_size:
+            try:
+                req = requests.get(timeout=max(0.0, deadline - time.perf_counter()))
+            except queue.Empty:
+                break
+            if req is None:
+                stop = True
+                break
+            batch.append(req)
+
+        # 以批次中最低的門檻推論一次，再依各請求自己的門檻過濾
+        thresh = min(r[2] for r in batch)
+        try:
+            results = backend.detect([r[1] for r in batch], score_thresh=thresh)
+        except Exception as e:
+            results = [RuntimeError(f"{type(e).__name__}: {e}")] * len(batch)
+        for (req_id, _, th), blocks in zip(batch, results):
+            result = blocks if isinstance(blocks, Exception) else [b for b in blocks if b.score >= th]
+            # mp.Queue 在背景執行緒才 pickle，失敗只會印錯誤、請求永遠等不到回應；先在這裡檢查
+            try:
+                pickle.dumps(result)
+            except Exception as e:
+                result = RuntimeError(f"結果無法序列化: {type(e).__name__}: {e}")
+            responses.put((req_id, result))
+    responses.put(("stopped", None))
+
+
+class LayoutWorker:
+    """常駐的模型 worker（獨立行程），以 submit / detect 送出請求"""
+
+    def __init__(self, spec: BackendSpec, batch_size: int = BATCH_SIZE, batch_wait: float = BATCH_WAIT,
+                 start_timeout: float = WORKER_START_TIMEOUT, request_timeout: float = REQUEST_TIMEOUT):
+        self.request_timeout = request_timeout
+        self.requests: mp.Queue = mp.Queue()
+        self.responses: mp.Queue = mp.Queue()
+        self.process = mp.Process(target=_worker_main, daemon=True,
+                                  args=(spec, self.requests, self.responses, batch_size, batch_wait))
+        self.process.start()
+        status, info = self._startup_status(start_timeout)
+        if status != "ready":
+            self.process.join()
+            raise RuntimeError(f"layout worker 啟動失敗: {info}")
+        logging.info(f"layout worker 就緒（{spec.kind}，warm-up {info:.2f} 秒，batch {batch_size}）")
+        self._pending: Dict[int, Future] = {}
+        self._closed: Optional[str] = None     # 不再接受請求的原因
+        self._lock = threading.Lock()
+        self._next_id = 0
+        self._reader = threading.Thread(target=self._read_responses, daemon=True)
+        self._reader.start()
+
+    def _startup_status(self, timeout: float) -> Tuple[str, Any]:
+        """等待 ready / failed；worker 在載入途中結束（OOM、segfault）時不必等到逾時"""
+        deadline = time.monotonic() + timeout
+        while True:
+            try:
+                return self.responses.get(timeout=min(WORKER_POLL, max(0.0, deadline - time.monotonic())))
+            except queue.Empty:
+                if not self.process.is_alive():
+                    return "failed", f"worker 行程已結束（exit code {self.process.exitcode}）"
+                if time.monotonic() >= deadline:
+                    self.process.terminate()
+                    return "failed", f"{timeout:.0f} 秒內未就緒"
+
+    def _read_responses(self) -> None:
+        reason = "layout worker 已停止"
+        while True:
+            try:
+                req_id, result = self.responses.get(timeout=WORKER_POLL)
+            except queue.Empty:
+                if self.process.is_alive():
+                    continue
+                reason = f"layout worker 意外結束（exit code {self.process.exitcode}）"
+                logging.error(reason)
+                break
+            if req_id == "stopped":
+                break
+            with self._lock:
+                fut = self._pending.pop(req_id, None)
+            if fut is None:
+                continue
+            if isinstance(result, Exception):
+                fut.set_exception(result)
+            else:
+                fut.set_result(result)
+        with self._lock:
+            self._closed = reason
+            for fut in self._pending.values():
+                fut.set_exception(RuntimeError(reason))
+            self._pending.clear()
+
+    def submit(self, image: np.ndarray, score_thresh: float = SCORE_THRESH) -> Future:
+        fut: Future = Future()
+        with self._lock:
+            if self._closed:
+                fut.set_exception(RuntimeError(self._closed))
+                return fut
+            req_id = self._next_id
+            self._next_id += 1
+            self._pending[req_id] = fut
+        self.requests.put((req_id, image, score_thresh))
+        return fut
+
+    def detect(self, images: List[np.ndarray], score_thresh: float = SCORE_THRESH) -> List[List[Block]]:
+        """與後端相同的介面：送出整批並等待結果；worker 結束或逾時時拋出例外"""
+        futures = [self.submit(img, score_thresh) for img in images]
+        return [f.result(timeout=self.request_timeout) for f in futures]
+
+    def close(self) -> None:
+        if self.process.is_alive():
+            self.requests.put(None)
+        self._reader.join()
+        self.process.join()
+
+    def __enter__(self) -> "LayoutWorker":
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.close()
+
+# ───────────────────────────── 分析器
+
 class LayoutAnalyzer:
-    def __init__(self, model_name: str = "lp://PubLayNet/mask_rcnn_R_50_FPN_3x/config"):
-        """初始化 Layout 分析器"""
+    def __init__(self, model_name: str = MODEL_NAME, backend: str = "detectron2", device: str = "auto",
+                 onnx_path: Optional[str] = None, detector=None, tile: bool = True):
+        """
+        初始化 Layout 分析器。
+        detector 可傳入已建立的後端或 LayoutWorker（批次模式共用同一個常駐模型）；
+        否則在本行程依 backend / device 載入。tile=True 時長圖以原解析度分塊偵測。
+        """
         self.model_name = model_name
-        self.model = self._load_model(model_name)
+        self.tile = tile
+        self.spec = BackendSpec(backend, device, model_name, MODEL_PATH, onnx_path)
+        self.model = detector if detector is not None else self._load_model(self.spec)
         self.target_types = {"Text", "Title", "List", "Table", "Figure"}
-        
+
         # 圖片處理參數（根據 Detectron2 建議）
         self.max_long = 2000   # 最長邊上限（考慮 VRAM）
         self.min_short = 800   # 最短邊下限（避免 anchor 不覆蓋）
-    
-    def _load_model(self, model_name: str) -> Optional[lp.AutoLayoutModel]:
+
+    def _load_model(self, spec: BackendSpec):
         """載入 layout 分析模型"""
         try:
             logging.info("開始載入模型...")
-            logging.info(f"使用模型: {model_name}")
-            
-            # 檢查 CUDA 是否可用
-            if not torch.cuda.is_available():
-                logging.error("CUDA 不可用，請確認 GPU 驅動程式是否正確安裝")
-                return None
-            
-            # 檢查 GPU 記憶體
-            gpu_memory = torch.cuda.get_device_properties(0).total_memory / 1024**3
-            logging.info(f"GPU 記憶體: {gpu_memory:.1f} GB")
-            
-            # 檢查 layoutparser 版本
-            import layoutparser
-            logging.info(f"layoutparser 版本: {layoutparser.__version__}")
-            
-            # 檢查權重檔案
-            model_path = os.path.expanduser("~/.cache/layoutparser/publaynet_R50.pth")
-            if not Path(model_path).exists():
-                logging.error(f"權重檔案不存在: {model_path}")
-                logging.error("請先下載權重檔案：")
-                logging.error("https://huggingface.co/layoutparser/detectron2/resolve/main/PubLayNet/mask_rcnn_R_50_FPN_3x/model_final.pth")
-                return None
-            
-            # 載入模型
-            model = lp.Detectron2LayoutModel(
-                config_path=model_name,  # 只決定網路結構 & label_map
-                model_path=model_path,   # 手動下載的權重檔案
-                device="cuda",
-                extra_config=[
-                    "MODEL.ROI_HEADS.SCORE_THRESH_TEST", 0.05,  # 降低閾值以提高召回率
-                    "MODEL.ROI_HEADS.NMS_THRESH_TEST", 0.5,    # 調整 NMS
-                    "MODEL.RPN.PRE_NMS_TOPK_TEST", 1000,       # 增加候選框
-                    "MODEL.RPN.POST_NMS_TOPK_TEST", 1000,      # 增加候選框
-                    "MODEL.RPN.MIN_SIZE", 8,                   # 降低最小尺寸
-                    "MODEL.RPN.ANCHOR_SCALES", [4, 8, 16, 32, 64]  # 調整錨點尺寸
-                ]
-            )
-            
-            # 驗證模型是否正確載入
-            if not hasattr(model, 'model') or model.model is None:
-                logging.error("模型載入失敗：model.model 為 None")
-                return None
-            
+            logging.info(f"使用後端: {spec.kind}，模型: {spec.model_name}")
+            model = build_backend(spec)
             logging.info("模型載入成功")
             return model
-            
+
         except Exception as e:
             logging.error(f"模型載入失敗: {str(e)}")
             import traceback
             logging.error(traceback.format_exc())
             return None
-    
+
+    def is_tall(self, image: np.ndarray) -> bool:
+        h, w = image.shape[:2]
+        return self.tile and h > TILE_MIN_ASPECT * w
+
     def preprocess_image(self, image: np.ndarray) -> np.ndarray:
-        """預處理圖片（確保尺寸在安全範圍內）"""
+        """預處理圖片（確保尺寸在安全範圍內；分塊的長圖維持原解析度）"""
         h, w = image.shape[:2]
         logging.info(f"原始圖片尺寸: {image.shape}")
-        
+
         # 計算安全縮放比例
         # 1. 先確保最短邊 >= 800px
         scale = self.min_short / min(h, w)
+        if self.is_tall(image):
+            # 分塊：只在寬度不足時放大，不為了長邊縮小
+            scale = max(scale, 1.0)
         # 2. 如果最長邊超過 2000px，取較小的縮放比例
-        if max(h, w) * scale > self.max_long:
+        elif max(h, w) * scale > self.max_long:
             scale = self.max_long / max(h, w)
-        
+
         if scale != 1:
             new_w = round(w * scale)
             new_h = round(h * scale)
             image = cv2.resize(image, (new_w, new_h), cv2.INTER_AREA)
             logging.info(f"縮放比例: {scale:.3f}")
             logging.info(f"resize  →  {image.shape}")
-        
+
         # 確保圖片格式正確
         if image.dtype != np.uint8:
             image = (image * 255).astype(np.uint8)
             logging.info(f"轉換圖片格式: {image.dtype}")
-        
+
         # 確保色彩空間正確
         if image.shape[2] == 4:
             image = cv2.cvtColor(image, cv2.COLOR_BGRA2RGB)
@@ -128,115 +680,79 @@ class LayoutAnalyzer:
         elif image.shape[2] == 3:
             image = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
             logging.info("轉換 BGR 到 RGB")
-            
+
         return image
-    
-    def analyze_image(self, image: np.ndarray, debug: bool = False) -> Optional[lp.Layout]:
-        """分析圖片並返回結果"""
+
+    def detect(self, image: np.ndarray, score_thresh: float = SCORE_THRESH) -> List[Block]:
+        """單次偵測；長圖切成重疊 tile 整批送進偵測器，再合併成原圖座標"""
+        if not self.is_tall(image):
+            return self.model.detect([image], score_thresh=score_thresh)[0]
+        spans = tile_spans(*image.shape[:2])
+        tiles = [image[y0:y1] for y0, y1 in spans]
+        debug_print(f"[DEBUG] 分塊偵測: {len(tiles)} 個 tile，高 {spans[0][1] - spans[0][0]}px")
+        return merge_tiles(self.model.detect(tiles, score_thresh=score_thresh), spans)
+
+    def _detect_oriented(self, image: np.ndarray, rot: Optional[int], score_thresh: float,
+                         fallback_thresh: float) -> Tuple[np.ndarray, List[Block]]:
+        """在 rot 方向跑一次偵測（門檻 fallback_thresh），依 score_thresh 過濾；沒有框時才採用低分框"""
+        label = "原始方向" if rot is None else f"旋轉 {rot}"
+        img = image if rot is None else cv2.rotate(image, rot)
+        debug_print(f"[DEBUG] 準備呼叫 detect，{label}")
+        debug_print(f"[DEBUG] 圖片尺寸: {img.shape}")
+        debug_print(f"[DEBUG] 圖片類型: {img.dtype}")
+
+        candidates = self.detect(img, score_thresh=min(score_thresh, fallback_thresh))
+        layout = [b for b in candidates if b.score >= score_thresh]
+        debug_print(f"[DEBUG] 檢測結果: {len(layout)} 個框（門檻 {score_thresh}）")
+        if not layout and candidates:
+            layout = candidates
+            debug_print(f"[DEBUG] 無框，改用門檻 {fallback_thresh} 的 {len(layout)} 個框")
+        debug_print(f"[DEBUG] {label} layout=")
+        debug_print(str(layout))
+        return img, layout
+
+    def analyze_image(self, image: np.ndarray, debug: bool = False, score_thresh: float = SCORE_THRESH,
+                      fallback_thresh: float = RETRY_SCORE_THRESH) -> Optional[List[Block]]:
+        """
+        分析圖片並返回結果（框座標為輸入圖片座標）。
+        先以原方向偵測一次；方向預判有明確的直排文字行時，再比較兩個 90° 方向，
+        框分數總和達原方向 ORIENT_GAIN 倍以上才改用。原方向完全沒有框時，照舊依序試其他三個方向。
+        門檻隨呼叫傳入，不改動模型狀態。
+        """
         logging.info("開始分析圖片...")
-        
+
         # 檢查模型
         if self.model is None:
             logging.error("模型未正確載入")
             return None
-        
-        if not hasattr(self.model, 'model') or self.model.model is None:
-            logging.error("模型物件無效")
-            return None
-        
+
         try:
-            best_layout = None
-            max_blocks = 0
-            
-            # 先嘗試原始方向
-            try:
-                debug_print(f"[DEBUG] 準備呼叫 detect，原始方向")
-                debug_print(f"[DEBUG] 圖片尺寸: {image.shape}")
-                debug_print(f"[DEBUG] 圖片類型: {image.dtype}")
-                
-                # 第一次嘗試
-                layout = self.model.detect(image)
-                debug_print(f"[DEBUG] 第一次檢測結果: {len(layout)} 個框")
-                
-                # 如果沒有框，降低閾值再試一次
-                if len(layout) == 0:
-                    debug_print("[DEBUG] 第一次檢測無框，降低閾值重試")
-                    self.model.model.roi_heads.score_thresh = 0.05
-                    layout = self.model.detect(image)
-                    debug_print(f"[DEBUG] 降低閾值後檢測結果: {len(layout)} 個框")
-                    # 恢復原始閾值
-                    self.model.model.roi_heads.score_thresh = 0.1
-                
-                debug_print(f"[DEBUG] 原始方向 layout=")
-                debug_print(str(layout))
-                
-                if debug:
-                    viz = lp.draw_box(image, layout, box_width=3)
-                    debug_path = "debug_layout_original.jpg"
-                    cv2.imwrite(debug_path, cv2.cvtColor(viz, cv2.COLOR_RGB2BGR))
-                    logging.info(f"已儲存調試圖片: {debug_path}")
-                
-                if len(layout) > max_blocks:
-                    max_blocks = len(layout)
-                    best_layout = layout
-                    
-            except Exception as e:
-                debug_print(f"[DEBUG] 原始方向分析失敗: {str(e)}")
-                import traceback
-                debug_print(f"[DEBUG] 錯誤堆疊: {traceback.format_exc()}")
-                logging.error(f"原始方向分析失敗: {str(e)}")
-            
-            # 如果原始方向失敗，嘗試旋轉
-            if best_layout is None:
-                for rot in [cv2.ROTATE_90_CLOCKWISE, cv2.ROTATE_180, cv2.ROTATE_90_COUNTERCLOCKWISE]:
-                    try:
-                        img2 = cv2.rotate(image, rot)
-                        debug_print(f"[DEBUG] 準備呼叫 detect，旋轉 {rot}")
-                        debug_print(f"[DEBUG] 圖片尺寸: {img2.shape}")
-                        debug_print(f"[DEBUG] 圖片類型: {img2.dtype}")
-                        
-                        # 第一次嘗試
-                        layout = self.model.detect(img2)
-                        debug_print(f"[DEBUG] 第一次檢測結果: {len(layout)} 個框")
-                        
-                        # 如果沒有框，降低閾值再試一次
-                        if len(layout) == 0:
-                            debug_print("[DEBUG] 第一次檢測無框，降低閾值重試")
-                            self.model.model.roi_heads.score_thresh = 0.05
-                            layout = self.model.detect(img2)
-                            debug_print(f"[DEBUG] 降低閾值後檢測結果: {len(layout)} 個框")
-                            # 恢復原始閾值
-                            self.model.model.roi_heads.score_thresh = 0.1
-                        
-                        debug_print(f"[DEBUG] 旋轉 {rot} layout=")
-                        debug_print(str(layout))
-                        
-                        if debug:
-                            viz = lp.draw_box(img2, layout, box_width=3)
-                            debug_path = f"debug_layout_{rot}.jpg"
-                            cv2.imwrite(debug_path, cv2.cvtColor(viz, cv2.COLOR_RGB2BGR))
-                            logging.info(f"已儲存調試圖片: {debug_path}")
-                        
-                        if len(layout) > max_blocks:
-                            max_blocks = len(layout)
-                            best_layout = layout
-                            
-                    except Exception as e:
-                        debug_print(f"[DEBUG] 旋轉 {rot} 分析失敗: {str(e)}")
-                        import traceback
-                        debug_print(f"[DEBUG] 錯誤堆疊: {traceback.format_exc()}")
-                        logging.error(f"旋轉 {rot} 分析失敗: {str(e)}")
-                        continue
-            
-            if best_layout is None:
-                logging.error("所有方向都分析失敗")
-                return None
-                
-            logging.info(f"分析完成，找到 {len(best_layout)} 個區塊")
+            rotations, orient_score = estimate_orientation(image)
+            logging.info(f"方向預判: {'可能直排' if rotations else '原始方向'}（分數 {orient_score:+.2f}）")
+
+            rot = None
+            img, layout = self._detect_oriented(image, None, score_thresh, fallback_thresh)
+            if not layout:
+                rotations = (cv2.ROTATE_90_CLOCKWISE, cv2.ROTATE_180, cv2.ROTATE_90_COUNTERCLOCKWISE)
+            for r in rotations:
+                r_img, r_layout = self._detect_oriented(image, r, score_thresh, fallback_thresh)
+                if sum(b.score for b in r_layout) > ORIENT_GAIN * sum(b.score for b in layout):
+                    rot, img, layout = r, r_img, r_layout
+            if rot is not None:
+                logging.info(f"採用旋轉 {rot} 的偵測結果")
+
+            if debug:
+                viz = draw_blocks(img, layout, box_width=3)
+                debug_path = "debug_layout_original.jpg" if rot is None else f"debug_layout_{rot}.jpg"
+                cv2.imwrite(debug_path, cv2.cvtColor(viz, cv2.COLOR_RGB2BGR))
+                logging.info(f"已儲存調試圖片: {debug_path}")
+
+            layout = unrotate_blocks(layout, rot, image.shape)
+            logging.info(f"分析完成，找到 {len(layout)} 個區塊")
             if debug:
-                logging.info(f"檢測到的區塊類型: {set(b.type for b in best_layout)}")
-            return best_layout
-            
+                logging.info(f"檢測到的區塊類型: {set(b.type for b in layout)}")
+            return layout
+
         except Exception as e:
             debug_print(f"[DEBUG] 分析過程發生錯誤: {str(e)}")
             import traceback
@@ -244,56 +760,56 @@ class LayoutAnalyzer:
             logging.error(f"分析過程發生錯誤: {str(e)}")
             logging.error(traceback.format_exc())
             return None
-    
+
     def process_image(self, image_path: Path, output_dir: Optional[Path] = None, debug: bool = False) -> Dict[str, Any]:
         """處理單張圖片"""
         if not image_path.exists():
             logging.error(f"錯誤：找不到圖片 {image_path}")
             return {"success": False, "error": "找不到圖片"}
-        
+
         # 設定輸出目錄
         if output_dir is None:
             output_dir = image_path.parent
         crop_dir = output_dir / "layout_crops"
         crop_dir.mkdir(exist_ok=True)
-        
+
         # 讀取圖片
         logging.info(f"讀取圖片: {image_path}")
         image = cv2.imread(str(image_path))
         if image is None:
             logging.error(f"錯誤：無法讀取圖片 {image_path}")
             return {"success": False, "error": "無法讀取圖片"}
-        
+
         logging.info(f"原始圖片尺寸: {image.shape}")
-        
+
         # 預處理圖片
         image = self.preprocess_image(image)
         logging.info(f"預處理後圖片尺寸: {image.shape}")
-        
+
         # 分析圖片
         layout = self.analyze_image(image, debug)
         if layout is None:
             return {"success": False, "error": "圖片分析失敗"}
-        
+
         if len(layout) == 0:
             logging.warning("未找到任何區塊")
             return {"success": False, "error": "未找到任何區塊"}
-        
+
         # 過濾並排序區塊
-        filtered_layout = lp.Layout(sorted(
+        filtered_layout = sorted(
             [b for b in layout if b.type in self.target_types],
             key=lambda b: b.coordinates[1]
-        ))
-        
+        )
+
         if len(filtered_layout) == 0:
             logging.warning("過濾後沒有符合的區塊，使用所有區塊")
             filtered_layout = layout
-        
+
         # 生成視覺化結果
-        viz = lp.draw_box(image, filtered_layout, box_width=3)
+        viz = draw_blocks(image, filtered_layout, box_width=3)
         viz_path = output_dir / f"{image_path.stem}_layout.jpg"
         cv2.imwrite(str(viz_path), cv2.cvtColor(viz, cv2.COLOR_RGB2BGR))
-        
+
         # 裁切並儲存區塊
         crops = []
         for i, block in enumerate(filtered_layout):
@@ -304,11 +820,12 @@ class LayoutAnalyzer:
             crops.append({
                 "path": str(crop_path),
                 "type": block.type,
+                "score": round(block.score, 4),
                 "coordinates": [x1, y1, x2, y2],
                 "size": [x2-x1, y2-y1]
             })
             logging.info(f"已裁切儲存: {crop_path} ({x2-x1}x{y2-y1})")
-        
+
         return {
             "success": True,
             "image_path": str(image_path),
@@ -316,24 +833,66 @@ class LayoutAnalyzer:
             "crops": crops
         }
 
+# ───────────────────────────── CLI
+
+IMG_EXTS = (".jpg", ".jpeg", ".png", ".webp")
+
+def _collect_files(args: argparse.Namespace) -> List[Path]:
+    files = [Path(f) for f in (args.files or [])]
+    if args.file:
+        files.insert(0, Path(args.file))
+    if args.dir:
+        import image_inventory
+        files.extend(p for p in image_inventory.scan(Path(args.dir), IMG_EXTS, crops=False)
+                     if "layout_crops" not in p.parts)
+    return files
+
 def main():
     parser = argparse.ArgumentParser(description="Layout 分析工具")
     parser.add_argument("--file", type=str, help="要處理的圖片路徑")
+    parser.add_argument("--files", nargs="+", help="多張圖片（經由常駐 worker 批次推論）")
+    parser.add_argument("--dir", type=str, help="處理目錄下所有原圖（經由常駐 worker 批次推論）")
+    parser.add_argument("--backend", choices=sorted(BACKENDS), default="detectron2", help="推論後端")
+    parser.add_argument("--device", choices=["auto", "cuda", "cpu"], default="auto",
+                        help="detectron2 後端的裝置（auto：有 CUDA 才用 GPU）")
+    parser.add_argument("--onnx", type=str, help="onnx 後端使用的模型檔")
+    parser.add_argument("--export-onnx", type=str, metavar="PATH", help="匯出 ONNX 模型後結束")
+    parser.add_argument("--batch-size", type=int, default=BATCH_SIZE, help="worker 每批最多張數")
+    parser.add_argument("--batch-wait", type=float, default=BATCH_WAIT, help="worker 湊批次的最長等待秒數")
+    parser.add_argument("--no-tile", action="store_true", help="長圖不分塊，整張縮到最長邊 2000px（舊行為）")
     parser.add_argument("--debug", action="store_true", help="啟用調試模式")
     args = parser.parse_args()
-    
-    if not args.file:
+
+    spec = BackendSpec(args.backend, args.device, MODEL_NAME, MODEL_PATH, args.onnx)
+    if args.export_onnx:
+        export_onnx(spec, Path(args.export_onnx))
+        return
+
+    files = _collect_files(args)
+    if not files:
         parser.print_help()
         return
-        
-    analyzer = LayoutAnalyzer()
-    result = analyzer.process_image(Path(args.file), debug=args.debug)
-    
-    if result["success"]:
-        logging.info(f"處理完成: {result['image_path']}")
-        logging.info(f"裁切結果: {len(result['crops'])} 個區塊")
+
+    if len(files) == 1 and not (args.files or args.dir):
+        analyzer = LayoutAnalyzer(backend=args.backend, device=args.device, onnx_path=args.onnx,
+                                  tile=not args.no_tile)
+        results = [analyzer.process_image(files[0], debug=args.debug)]
     else:
-        logging.error(f"處理失敗: {result.get('error', '未知錯誤')}")
+        # 模型只在 worker 載入一次；多個 thread 同時送請求，worker 才湊得成批次
+        from concurrent.futures import ThreadPoolExecutor
+        with LayoutWorker(spec, args.batch_size, args.batch_wait) as worker:
+            analyzer = LayoutAnalyzer(detector=worker, tile=not args.no_tile)
+            t0 = time.perf_counter()
+            with ThreadPoolExecutor(max(1, args.batch_size)) as pool:
+                results = list(pool.map(lambda p: analyzer.process_image(p, debug=args.debug), files))
+            logging.info(f"批次完成: {len(files)} 張 / {time.perf_counter() - t0:.2f} 秒")
+
+    for result in results:
+        if result["success"]:
+            logging.info(f"處理完成: {result['image_path']}")
+            logging.info(f"裁切結果: {len(result['crops'])} 個區塊")
+        else:
+            logging.error(f"處理失敗: {result.get('error', '未知錯誤')}")
 
 if __name__ == "__main__":
     main()
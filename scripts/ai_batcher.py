@@ -0,0 +1,292 @@
+#!/usr/bin/env python3
+"""
+AI 多圖請求的自適應批次
+======================
+
+batch_images 一律六張一批：六張長裁片容易超時、在 max_tokens=4096 下被截斷成不完整的 JSON，
+六張小圖示又浪費一次往返。`AdaptiveBatcher` 依每張裁片的估算成本裝箱：
+
+* 輸入 vision tokens：依供應商的計價方式（OpenAI 512px 切塊、Gemini 每張固定）；
+* 預期輸出 tokens：基本量 + 與面積成正比的文字量，再乘上從實際回應學到的修正係數；
+* 像素總量與張數上限。
+
+每次請求結束後以實際耗時與回應長度更新該供應商的延遲模型
+（耗時 ≈ 固定開銷 + 每輸出 token 秒數 × 輸出 tokens，指數遺忘的線上最小平方法），
+輸出預算取「設定上限」與「目標延遲內可產生的 tokens」兩者較小者；回應被截斷
+（供應商以 `TruncatedReply` 回報：回應停在輸出上限）才調高輸出估計；JSON 格式錯誤、
+網路錯誤、逾時等其他失敗只記次數。學到的參數存在 results/ai_batch_stats.json，下次執行沿用。
+
+使用範例
+--------
+>>> batcher = AdaptiveBatcher("openai")
+>>> batches = batcher.pack(crop_paths, inventory.dimensions(crop_paths))
+>>> dispatcher = Dispatcher(batcher.wrap(request_batch_openai), ...)
+>>> batcher.save()
+"""
+
+import json
+import logging
+import math
+import threading
+import time
+from dataclasses import asdict, dataclass, field
+from pathlib import Path
+from typing import Any, Callable, Dict, List, Mapping, Optional, Sequence, Tuple
+
+log = logging.getLogger("ai_batcher")
+
+BASE_DIR = Path(__file__).resolve().parent.parent
+STATS_PATH = BASE_DIR / "results" / "ai_batch_stats.json"
+
+DEFAULT_SIZE = (750, 1000)      # 沒有尺寸資訊時的假設
+OUTPUT_BASE = 80                # 每張圖的固定輸出（分類、摘要、JSON 結構）
+OUTPUT_PER_MPIX = 400           # 每百萬像素預期的文字區塊輸出
+DECAY = 0.95                    # 延遲模型每次觀測的遺忘係數
+MIN_SAMPLES = 5                 # 延遲模型開始生效前需要的觀測數
+SCALE_ALPHA = 0.2               # 輸出修正係數的 EMA 權重
+SCALE_RANGE = (0.3, 4.0)
+TRUNCATION_PENALTY = 1.25       # 回應被截斷時輸出修正係數的放大倍數
+
+
+class TruncatedReply(Exception):
+    """供應商回應停在輸出上限而被截斷；`headers` 為回應標頭。"""
+
+    def __init__(self, message: str = "", headers: Optional[Mapping[str, str]] = None):
+        super().__init__(message or "truncated reply")
+        self.headers = dict(headers or {})
+
+
+@dataclass
+class BatchBudget:
+    """單一請求的預算上限"""
+    max_images: int = 12
+    max_input_tokens: int = 24000
+    max_output_tokens: int = 3000       # 對 max_tokens=4096 留約 25% 餘裕，避免 JSON 被截斷
+    max_pixels: int = 24_000_000
+    target_latency: float = 60.0        # 預期單次請求耗時上限（秒）
+
+
+@dataclass
+class ImageCost:
+    input_tokens: int
+    output_tokens: int
+    pixels: int
+
+
+# ───────────────────────────── 成本估算
+
+def openai_vision_tokens(width: int, height: int) -> int:
+    """OpenAI high detail：縮進 2048 方框、短邊縮到 768，每 512px 方塊 170 tokens + 85"""
+    scale = min(1.0, 2048 / max(width, height))
+    w, h = width * scale, height * scale
+    scale = min(1.0, 768 / min(w, h))
+    w, h = w * scale, h * scale
+    return 85 + 170 * math.ceil(w / 512) * math.ceil(h / 512)
+
+
+def gemini_vision_tokens(width: int, height: int) -> int:
+    """Gemini 1.5：每張圖固定 258 tokens"""
+    return 258
+
+
+VISION_TOKENS: Dict[str, Callable[[int, int], int]] = {
+    "openai": openai_vision_tokens,
+    "standin": openai_vision_tokens,   # 替身 API 走 OpenAI 格式
+    "google": gemini_vision_tokens,
+}
+
+
+def text_tokens(text: str) -> int:
+    """粗估文字 tokens：中日韓字元約 1 token，其餘約 4 字元 1 token"""
+    cjk = sum(1 for ch in text if ord(ch) >= 0x2E80)
+    return cjk + (len(text) - cjk + 3) // 4
+
+
+# ───────────────────────────── 學習狀態
+
+@dataclass
+class LatencyModel:
+    """耗時 ≈ overhead + slope × 輸出 tokens；以指數遺忘的加權和做線上最小平方法"""
+    sw: float = 0.0
+    sx: float = 0.0
+    sy: float = 0.0
+    sxx: float = 0.0
+    sxy: float = 0.0
+    n: int = 0
+
+    def observe(self, tokens: float, seconds: float) -> None:
+        self.sw = self.sw * DECAY + 1.0
+        self.sx = self.sx * DECAY + tokens
+        self.sy = self.sy * DECAY + seconds
+        self.sxx = self.sxx * DECAY + tokens * tokens
+        self.sxy = self.sxy * DECAY + tokens * seconds
+        self.n += 1
+
+    def fit(self) -> Optional[Tuple[float, float]]:
+        """回傳 (overhead 秒, 每 token 秒)；樣本不足或 tokens 沒有變化時回 None"""
+        if self.n < MIN_SAMPLES:
+            return None
+        var = self.sw * self.sxx - self.sx * self.sx
+        if var <= 1e-9 * max(1.0, self.sxx):
+            return None
+        slope = (self.sw * self.sxy - self.sx * self.sy) / var
+        overhead = (self.sy - slope * self.sx) / self.sw
+        if slope <= 0:
+            return None
+        return max(0.0, overhead), slope
+
+
+@dataclass
+class ProviderStats:
+    latency: LatencyModel = field(default_factory=LatencyModel)
+    output_scale: float = 1.0       # 實際輸出 / 估算輸出
+    calls: int = 0
+    failures: int = 0
+
+    @classmethod
+    def from_dict(cls, d: Mapping[str, Any]) -> "ProviderStats":
+        return cls(LatencyModel(**d.get("latency", {})), d.get("output_scale", 1.0),
+                   d.get("calls", 0), d.get("failures", 0))
+
+
+# ───────────────────────────── 批次器
+
+class AdaptiveBatcher:
+    """依 token / 像素預算裝箱，並從實際呼叫學習輸出量與延遲"""
+
+    def __init__(self, provider: str, budget: Optional[BatchBudget] = None,
+                 stats_path: Optional[Path] = STATS_PATH,
+                 sizes: Optional[Dict[str, Tuple[int, int]]] = None):
+        self.provider = provider
+        self.budget = budget or BatchBudget()
+        self.stats_path = Path(stats_path) if stats_path else None
+        self.vision_tokens = VISION_TOKENS.get(provider, openai_vision_tokens)
+        self.lock = threading.Lock()
+        # 路徑 -> pack 時的尺寸；多供應商路由時由負責裝箱的批次器共用給其他供應商
+        self.sizes: Dict[str, Tuple[int, int]] = {} if sizes is None else sizes
+        self.stats = ProviderStats()
+        if self.stats_path and self.stats_path.exists():
+            try:
+                with open(self.stats_path, encoding="utf-8") as f:
+                    saved = json.load(f).get(provider)
+                if saved:
+                    self.stats = ProviderStats.from_dict(saved)
+            except (OSError, ValueError, TypeError) as e:
+                log.warning(f"無法讀取批次統計 {self.stats_path.name}: {e}")
+
+    # ── 估算
+
+    def cost(self, size: Optional[Tuple[int, int]]) -> ImageCost:
+        w, h = size or DEFAULT_SIZE
+        out = (OUTPUT_BASE + OUTPUT_PER_MPIX * w * h / 1e6) * self.stats.output_scale
+        return ImageCost(self.vision_tokens(w, h), int(math.ceil(out)), w * h)
+
+    def output_limit(self) -> int:
+        """本次可用的輸出預算：設定上限與延遲模型在 target_latency 內可產生的量取小"""
+        limit = self.budget.max_output_tokens
+        fitted = self.stats.latency.fit()
+        if fitted:
+            overhead, slope = fitted
+            limit = min(limit, int((self.budget.target_latency - overhead) / slope))
+        return max(1, limit)
+
+    # ── 裝箱
+
+    def pack(self, paths: Sequence[Path], dims: Optional[Mapping[Path, Tuple[int, int]]] = None) -> List[List[Path]]:
+        """依原順序貪婪裝箱；任一預算超過就開新批次，單張超過預算的圖自成一批"""
+        dims = dims or {}
+        out_limit = self.output_limit()
+        batches: List[List[Path]] = []
+        current: List[Path] = []
+        used_in = used_out = used_px = 0
+        for path in paths:
+            size = dims.get(path)
+            with self.lock:
+                self.sizes[str(path)] = size or DEFAULT_SIZE
+            c = self.cost(size)
+            if current and (len(current) >= self.budget.max_images
+                            or used_in + c.input_tokens > self.budget.max_input_tokens
+                            or used_out + c.output_tokens > out_limit
+                            or used_px + c.pixels > self.budget.max_pixels):
+                batches.append(current)
+                current, used_in, used_out, used_px = [], 0, 0, 0
+            current.append(path)
+            used_in += c.input_tokens
+            used_out += c.output_tokens
+            used_px += c.pixels
+        if current:
+            batches.append(current)
+        return batches
+
+    def input_tokens(self, image_batch: Sequence[Path]) -> int:
+        """已裝箱批次的 vision tokens 合計（尺寸取自 pack 時的紀錄）"""
+        with self.lock:
+            sizes = [self.sizes.get(str(p)) for p in image_batch]
+        return sum(self.cost(size).input_tokens for size in sizes)
+
+    # ── 學習
+
+    def observe(self, image_batch: Sequence[Path], result: Optional[Mapping[str, Any]], seconds: float,
+                truncated: bool = False) -> None:
+        """
+        以一次呼叫的結果更新輸出修正係數與延遲模型。
+        truncated 時放大輸出修正係數；其他失敗（result 為空）只記次數，與輸出量無關。
+        """
+        with self.lock:
+            expected = sum(self.cost(self.sizes.get(str(p))).output_tokens for p in image_batch)
+            stats = self.stats
+            stats.calls += 1
+            if truncated:
+                stats.failures += 1
+                stats.output_scale = min(SCALE_RANGE[1], stats.output_scale * TRUNCATION_PENALTY)
+                return
+            if not result:
+                stats.failures += 1
+                return
+            actual = text_tokens(json.dumps(result, ensure_ascii=False))
+            if expected > 0:
+                # expected 已含目前的修正係數，換算回「未修正的估算」再做 EMA
+                ratio = actual / (expected / stats.output_scale)
+                scale = (1 - SCALE_ALPHA) * stats.output_scale + SCALE_ALPHA * ratio
+                stats.output_scale = min(SCALE_RANGE[1], max(SCALE_RANGE[0], scale))
+            stats.latency.observe(actual, seconds)
+
+    def wrap(self, request: Callable[..., Tuple[Any, Any]]) -> Callable[..., Tuple[Any, Any]]:
+        """
+        包裝供應商呼叫 request(product_name, image_batch)，在工作執行緒內計時並回饋；
+        request 拋出的 TruncatedReply 在此轉成 (None, 標頭)，與其他失敗一樣交回派送器。
+        """
+        def call(product_name, image_batch):
+            start = time.monotonic()
+            try:
+                result, headers = request(product_name, image_batch)
+            except TruncatedReply as e:
+                log.warning(f"{self.provider}: {e}（{len(image_batch)} 張），調高輸出估計")
+                self.observe(image_batch, None, time.monotonic() - start, truncated=True)
+                return None, e.headers
+            self.observe(image_batch, result, time.monotonic() - start)
+            return result, headers
+        return call
+
+    def describe(self) -> str:
+        fitted = self.stats.latency.fit()
+        latency = f"{fitted[0]:.1f}s + {fitted[1] * 1000:.1f}ms/token" if fitted else "樣本不足"
+        return (f"{self.provider}: 輸出修正 ×{self.stats.output_scale:.2f}，延遲 {latency}，"
+                f"輸出預算 {self.output_limit()} tokens，{self.stats.calls} 次呼叫 / {self.stats.failures} 次失敗")
+
+    def save(self) -> None:
+        """寫回學到的統計（保留其他供應商的紀錄）"""
+        if not self.stats_path:
+            return
+        data: Dict[str, Any] = {}
+        if self.stats_path.exists():
+            try:
+                with open(self.stats_path, encoding="utf-8") as f:
+                    data = json.load(f)
+            except (OSError, ValueError):
+                data = {}
+        with self.lock:
+            data[self.provider] = asdict(self.stats)
+        self.stats_path.parent.mkdir(parents=True, exist_ok=True)
+        with open(self.stats_path, "w", encoding="utf-8") as f:
+            json.dump(data, f, ensure_ascii=False, indent=2)
@@ -0,0 +1,210 @@
+#!/usr/bin/env python3
+"""
+AI 回應快取（內容定址）
+======================
+
+update_json_with_crops / gpt_crop / create_ai_review_report 每次重跑都會把已經分析過的
+圖片再送一次，當機或改 JSON 結構後只能靠 salvage_from_log / rebuild_analysis_from_log
+從日誌撈回答案。本模組把「解析後的每張圖結果」存進 SQLite，鍵為：
+
+    (圖片內容雜湊, prompt 雜湊, 模型, 參數雜湊)
+
+* 內容雜湊與 image_inventory 相同（blake2b-128），改檔名或搬目錄仍命中；
+* prompt 以「實際送出的文字」計算，改了 prompt 模板或產品名稱就自然失效；
+* 參數（max_tokens、temperature…）以排序後的 JSON 計算雜湊。
+
+只有成功解析的結果才寫入；重跑時命中的圖片不再送出，也不佔用派送器的限流額度。
+
+使用範例
+--------
+>>> with AICache() as cache:
+...     hits, misses = cache.lookup(batch, prompt, "gpt-4-turbo", {"max_tokens": 4096})
+...     ...
+...     cache.store(misses, batch_result, prompt, "gpt-4-turbo", {"max_tokens": 4096})
+
+$ python ai_cache.py                       # 各模型的快取筆數
+$ python ai_cache.py --drop-model gpt-4o
+"""
+
+import argparse
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from collections import Counter
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Any, Dict, List, Mapping, Optional, Sequence, Tuple
+
+from image_inventory import file_hash
+
+log = logging.getLogger("ai_cache")
+
+BASE_DIR = Path(__file__).resolve().parent.parent
+CACHE_PATH = BASE_DIR / "results" / "ai_cache.sqlite"
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS responses (
+    content_hash TEXT NOT NULL,     -- 圖片內容 blake2b-128
+    prompt_hash  TEXT NOT NULL,     -- 實際送出的 prompt 文字
+    model        TEXT NOT NULL,
+    params_hash  TEXT NOT NULL,     -- 排序後的參數 JSON
+    result       TEXT NOT NULL,     -- 解析後的單張圖結果（JSON）
+    source       TEXT,              -- 寫入時的檔名，僅供除錯
+    created      REAL NOT NULL,
+    PRIMARY KEY (content_hash, prompt_hash, model, params_hash)
+);
+CREATE INDEX IF NOT EXISTS responses_model ON responses(model);
+"""
+
+
+@dataclass(frozen=True)
+class CacheKey:
+    content_hash: str
+    prompt_hash: str
+    model: str
+    params_hash: str
+
+
+# ───────────────────────────── 雜湊
+
+def text_hash(text: str) -> str:
+    return hashlib.blake2b(text.encode("utf-8"), digest_size=16).hexdigest()
+
+
+def params_hash(params: Optional[Mapping[str, Any]]) -> str:
+    return text_hash(json.dumps(params or {}, sort_keys=True, ensure_ascii=False, default=str))
+
+
+# ───────────────────────────── 快取
+
+class AICache:
+    """SQLite 回應快取；可跨執行緒共用（派送器的工作執行緒也能直接查寫）"""
+
+    def __init__(self, db_path: Path = CACHE_PATH):
+        self.db_path = Path(db_path)
+        self.db_path.parent.mkdir(parents=True, exist_ok=True)
+        self.conn = sqlite3.connect(str(self.db_path), timeout=30, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.executescript(SCHEMA)
+        self.lock = threading.Lock()
+        self.stats = Counter()
+        self._hashes: Dict[Tuple[str, int, int], str] = {}
+
+    def close(self) -> None:
+        self.conn.close()
+
+    def __enter__(self) -> "AICache":
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.close()
+
+    # ── 鍵
+
+    def content_hash(self, image_path: Path) -> str:
+        """圖片內容雜湊；同一個檔案 (size, mtime) 未變時不重算"""
+        st = os.stat(image_path)
+        memo = (str(image_path), st.st_size, st.st_mtime_ns)
+        digest = self._hashes.get(memo)
+        if digest is None:
+            digest = self._hashes[memo] = file_hash(Path(image_path))
+        return digest
+
+    def key(self, image_path: Path, prompt: str, model: str,
+            params: Optional[Mapping[str, Any]] = None) -> CacheKey:
+        return CacheKey(self.content_hash(image_path), text_hash(prompt), model, params_hash(params))
+
+    # ── 單筆
+
+    def get(self, key: CacheKey) -> Optional[Any]:
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT result FROM responses WHERE content_hash=? AND prompt_hash=? AND model=? AND params_hash=?",
+                (key.content_hash, key.prompt_hash, key.model, key.params_hash)).fetchone()
+        self.stats["hits" if row else "misses"] += 1
+        return json.loads(row[0]) if row else None
+
+    def put(self, key: CacheKey, result: Any, source: str = "") -> None:
+        with self.lock, self.conn:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (key.content_hash, key.prompt_hash, key.model, key.params_hash,
+                 json.dumps(result, ensure_ascii=False), source, time.time()))
+        self.stats["stored"] += 1
+
+    # ── 批次（以檔名對應，與 AI 回傳的 {檔名: 結果} 格式一致）
+
+    def lookup(self, image_paths: Sequence[Path], prompt: str, model: str,
+               params: Optional[Mapping[str, Any]] = None) -> Tuple[Dict[str, Any], List[Path]]:
+        """回傳 ({檔名: 快取結果}, 未命中的路徑)；讀不到的檔案視為未命中"""
+        hits: Dict[str, Any] = {}
+        misses: List[Path] = []
+        for path in image_paths:
+            try:
+                result = self.get(self.key(path, prompt, model, params))
+            except OSError:
+                result = None
+            if result is None:
+                misses.append(path)
+            else:
+                hits[Path(path).name] = result
+        return hits, misses
+
+    def store(self, image_paths: Sequence[Path], results: Mapping[str, Any], prompt: str, model: str,
+              params: Optional[Mapping[str, Any]] = None) -> int:
+        """把 {檔名: 結果} 中有對應圖片的項目寫入；回傳寫入筆數"""
+        stored = 0
+        for path in image_paths:
+            result = results.get(Path(path).name)
+            if not result:
+                continue
+            try:
+                self.put(self.key(path, prompt, model, params), result, source=Path(path).name)
+                stored += 1
+            except OSError as e:
+                log.warning(f"無法寫入快取 {Path(path).name}: {e}")
+        return stored
+
+
+_default: Optional[AICache] = None
+_default_lock = threading.Lock()
+
+
+def default_cache() -> AICache:
+    """行程內共用的預設快取（CACHE_PATH），第一次呼叫時開啟"""
+    global _default
+    with _default_lock:
+        if _default is None:
+            _default = AICache()
+        return _default
+
+
+# ───────────────────────────── CLI
+
+def main():
+    ap = argparse.ArgumentParser(description="查詢或清理 AI 回應快取")
+    ap.add_argument("--db", type=Path, default=CACHE_PATH)
+    ap.add_argument("--drop-model", type=str, default=None, help="刪除指定模型的所有快取")
+    args = ap.parse_args()
+    logging.basicConfig(level=logging.INFO, format="%(levelname)s %(message)s")
+
+    with AICache(args.db) as cache:
+        if args.drop_model:
+            with cache.conn:
+                n = cache.conn.execute("DELETE FROM responses WHERE model=?", (args.drop_model,)).rowcount
+            log.info(f"已刪除 {args.drop_model} 的 {n} 筆快取")
+        rows = cache.conn.execute(
+            "SELECT model, COUNT(*), COUNT(DISTINCT content_hash), COUNT(DISTINCT prompt_hash) "
+            "FROM responses GROUP BY model ORDER BY model").fetchall()
+        for model, n, images, prompts in rows:
+            log.info(f"{model}: {n} 筆（{images} 張圖、{prompts} 種 prompt）")
+        if not rows:
+            log.info(f"快取是空的：{args.db}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,271 @@
+#!/usr/bin/env python3
+"""
+AI 請求並行派送器
+================
+
+update_json_with_crops 原本一批一批依序送出、每批之間固定睡 10 秒，產品也逐一處理，
+整輪時間大多在空等。`Dispatcher` 以 asyncio 讓最多 N 個請求同時在途（跨產品），
+並依供應商回報的配額調整送出節奏：
+
+* 每次回應的 `x-ratelimit-remaining-*` / `x-ratelimit-reset-*` 標頭更新剩餘額度，
+  額度用完就等到重置時間才放行下一個請求；
+* 可另外指定本地 RPM / TPM 上限（60 秒滑動視窗），供應商不回標頭時仍能節流；
+* 遇到 429（`RateLimited`）時依 `retry-after` 與指數退避 + 隨機抖動暫停
+  「所有」工作者後重試，避免同時醒來再撞一次限流。
+
+供應商呼叫本身是同步函式 `call(*args) -> (result, headers)`，在派送器自己的
+執行緒池中執行；429 請以 `RateLimited` 拋出，其他錯誤由呼叫端自行處理。
+
+使用範例
+--------
+>>> dispatcher = Dispatcher(request_batch_openai, concurrency=4, rpm=60)
+>>> results = asyncio.run(asyncio.gather(
+...     *(dispatcher.submit(name, batch, tokens=5000) for batch in batches)))
+>>> dispatcher.close()
+"""
+
+import asyncio
+import logging
+import random
+import re
+import time
+from collections import Counter, deque
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from typing import Any, Callable, Mapping, Optional, Tuple
+
+log = logging.getLogger("ai_dispatch")
+
+DEFAULT_CONCURRENCY = 4
+MAX_RETRIES = 6
+BACKOFF_BASE = 2.0      # 第 n 次重試的退避上限為 BACKOFF_BASE * 2**n 秒
+BACKOFF_CAP = 60.0
+WINDOW = 60.0           # 本地 RPM / TPM 的滑動視窗（秒）
+
+_DURATION_RE = re.compile(r"(\d+(?:\.\d+)?)(ms|h|m|s)")
+_UNIT = {"ms": 0.001, "s": 1.0, "m": 60.0, "h": 3600.0}
+
+
+class RateLimited(Exception):
+    """供應商回 429 或同等的配額錯誤；`retry_after` 為建議等待秒數。"""
+
+    def __init__(self, message: str = "", retry_after: Optional[float] = None,
+                 headers: Optional[Mapping[str, str]] = None):
+        super().__init__(message or "rate limited")
+        self.retry_after = retry_after
+        self.headers = dict(headers or {})
+
+
+# ───────────────────────────── 標頭解析
+
+def parse_duration(value) -> Optional[float]:
+    """解析 "1s"、"6m0s"、"20ms"、"0.5" 這類重置時間為秒數；無法解析回 None。"""
+    if value is None:
+        return None
+    text = str(value).strip()
+    try:
+        return float(text)
+    except ValueError:
+        pass
+    parts = _DURATION_RE.findall(text)
+    if not parts:
+        return None
+    return sum(float(num) * _UNIT[unit] for num, unit in parts)
+
+
+def retry_after_from(headers: Optional[Mapping[str, str]]) -> Optional[float]:
+    """從 `retry-after-ms` / `retry-after` 標頭取出建議等待秒數。"""
+    if not headers:
+        return None
+    h = {k.lower(): v for k, v in headers.items()}
+    if "retry-after-ms" in h:
+        ms = parse_duration(h["retry-after-ms"])
+        if ms is not None:
+            return ms / 1000.0
+    return parse_duration(h.get("retry-after"))
+
+
+def _int_or_none(value) -> Optional[int]:
+    try:
+        return int(float(value))
+    except (TypeError, ValueError):
+        return None
+
+
+# ───────────────────────────── 配額狀態
+
+@dataclass
+class LimitState:
+    """供應商回報的剩餘配額；重置時間以 time.monotonic() 表示。"""
+    remaining_requests: Optional[int] = None
+    remaining_tokens: Optional[int] = None
+    requests_reset_at: float = 0.0
+    tokens_reset_at: float = 0.0
+
+    def update(self, headers: Optional[Mapping[str, str]], now: float) -> None:
+        if not headers:
+            return
+        h = {k.lower(): v for k, v in headers.items()}
+        req = _int_or_none(h.get("x-ratelimit-remaining-requests"))
+        if req is not None:
+            self.remaining_requests = req
+            reset = parse_duration(h.get("x-ratelimit-reset-requests"))
+            self.requests_reset_at = now + (reset if reset is not None else WINDOW)
+        tok = _int_or_none(h.get("x-ratelimit-remaining-tokens"))
+        if tok is not None:
+            self.remaining_tokens = tok
+            reset = parse_duration(h.get("x-ratelimit-reset-tokens"))
+            self.tokens_reset_at = now + (reset if reset is not None else WINDOW)
+
+    def wait_time(self, now: float, tokens: int = 0) -> float:
+        """送出一個約 `tokens` 的請求前還需等待的秒數；重置時間已過的額度視為未知。"""
+        if self.remaining_requests is not None and now >= self.requests_reset_at:
+            self.remaining_requests = None
+        if self.remaining_tokens is not None and now >= self.tokens_reset_at:
+            self.remaining_tokens = None
+        wait = 0.0
+        if self.remaining_requests is not None and self.remaining_requests <= 0:
+            wait = max(wait, self.requests_reset_at - now)
+        if self.remaining_tokens is not None and tokens and self.remaining_tokens < tokens:
+            wait = max(wait, self.tokens_reset_at - now)
+        return wait
+
+    def consume(self, tokens: int = 0) -> None:
+        """樂觀扣除：在途請求的回應回來之前，先假設它已用掉額度。"""
+        if self.remaining_requests is not None:
+            self.remaining_requests -= 1
+        if self.remaining_tokens is not None:
+            self.remaining_tokens -= tokens
+
+
+# ───────────────────────────── 派送器
+
+class Dispatcher:
+    """讓最多 `concurrency` 個供應商請求同時在途，並遵守 RPM / TPM 與 429 退避。"""
+
+    def __init__(self, call: Callable[..., Tuple[Any, Optional[Mapping[str, str]]]],
+                 concurrency: int = DEFAULT_CONCURRENCY,
+                 rpm: Optional[int] = None, tpm: Optional[int] = None,
+                 max_retries: int = MAX_RETRIES,
+                 backoff_base: float = BACKOFF_BASE, backoff_cap: float = BACKOFF_CAP,
+                 name: str = "ai"):
+        self.call = call
+        self.concurrency = max(1, int(concurrency))
+        self.rpm = rpm
+        self.tpm = tpm
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_cap = backoff_cap
+        self.name = name
+        self.state = LimitState()
+        self.stats = Counter()
+        self._executor = ThreadPoolExecutor(self.concurrency, thread_name_prefix=f"{name}-call")
+        self._slots = asyncio.Semaphore(self.concurrency)
+        self._gate = asyncio.Lock()
+        self._window = deque()          # (送出時間, tokens)
+        self._paused_until = 0.0
+
+    def _window_wait(self, now: float, tokens: int) -> float:
+        while self._window and now - self._window[0][0] >= WINDOW:
+            self._window.popleft()
+        wait = 0.0
+        if self.rpm and len(self._window) >= self.rpm:
+            wait = self._window[len(self._window) - self.rpm][0] + WINDOW - now
+        if self.tpm and tokens:
+            used = sum(t for _, t in self._window)
+            # 從最舊的開始釋放，直到剩餘額度容得下這次請求
+            for sent, t in self._window:
+                if used + tokens <= self.tpm:
+                    break
+                used -= t
+                wait = max(wait, sent + WINDOW - now)
+        return wait
+
+    async def _admit(self, tokens: int) -> None:
+        """依序放行：暫停期、供應商額度、本地視窗都允許時才送出。"""
+        async with self._gate:
+            while True:
+                now = time.monotonic()
+                wait = max(self._paused_until - now,
+                           self.state.wait_time(now, tokens),
+                           self._window_wait(now, tokens))
+                if wait <= 0:
+                    break
+                self.stats["throttled"] += 1
+                await asyncio.sleep(wait)
+            self._window.append((now, tokens))
+            self.state.consume(tokens)
+
+    def backoff(self, attempt: int, retry_after: Optional[float] = None) -> float:
+        """指數退避 + 完全抖動；供應商給了 retry-after 時至少等那麼久。"""
+        delay = random.uniform(0, min(self.backoff_cap, self.backoff_base * 2 ** attempt))
+        if retry_after is not None:
+            delay = max(delay, retry_after + random.uniform(0, self.backoff_base))
+        return delay
+
+    async def submit(self, *args, tokens: int = 0, on_start: Optional[Callable[[], None]] = None) -> Any:
+        """
+        送出一個請求並等待結果；重試用盡或發生非 429 錯誤時回傳 None。
+        on_start 在每次實際送出（通過限流、開始呼叫）前被呼叫，可用來排除排隊時間。
+        等待中被取消（例如對沖的落敗者）時，執行緒裡的呼叫無法中止、仍在計費，
+        因此它的並行名額要等呼叫真正結束才歸還（stats["orphaned"] 記錄次數）。
+        """
+        loop = asyncio.get_running_loop()
+        await self._slots.acquire()
+        release = True
+        try:
+            for attempt in range(self.max_retries + 1):
+                await self._admit(tokens)
+                if on_start is not None:
+                    on_start()
+                call = self._executor.submit(self.call, *args)
+                try:
+                    result, headers = await asyncio.wrap_future(call)
+                except asyncio.CancelledError:
+                    if not call.done():
+                        release = False
+                        self.stats["orphaned"] += 1
+                        call.add_done_callback(lambda _: self._release_from_thread(loop))
+                    raise
+                except RateLimited as e:
+                    now = time.monotonic()
+                    self.stats["rate_limited"] += 1
+                    self.state.update(e.headers, now)
+                    delay = self.backoff(attempt, e.retry_after or retry_after_from(e.headers))
+                    # 429 代表整個帳號的額度，所有工作者一起暫停
+                    self._paused_until = max(self._paused_until, now + delay)
+                    log.warning(f"{self.name}: 遭到限流 (第 {attempt + 1} 次)，{delay:.1f} 秒後重試")
+                    continue
+                except Exception as e:
+                    self.stats["failed"] += 1
+                    log.error(f"{self.name}: 請求失敗: {e}")
+                    return None
+                self.state.update(headers, time.monotonic())
+                self.stats["ok"] += 1
+                return result
+        finally:
+            if release:
+                self._slots.release()
+        self.stats["gave_up"] += 1
+        log.error(f"{self.name}: 重試 {self.max_retries} 次後仍遭限流，放棄此請求")
+        return None
+
+    def _release_from_thread(self, loop: asyncio.AbstractEventLoop) -> None:
+        """被遺棄的呼叫在執行緒裡結束後，回到事件迴圈歸還並行名額"""
+        try:
+            loop.call_soon_threadsafe(self._slots.release)
+        except RuntimeError:
+            pass    # 事件迴圈已結束，名額也不再需要
+
+    async def submit_routed(self, *args, tokens: int = 0) -> Tuple[str, Any]:
+        """與 submit 相同，另回傳處理的供應商名稱（與 ai_router.Router 介面一致）。"""
+        return self.name, await self.submit(*args, tokens=tokens)
+
+    def close(self) -> None:
+        self._executor.shutdown(wait=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
@@ -0,0 +1,136 @@
+#!/usr/bin/env python3
+"""
+AI 分析批次日誌（可恢復）
+========================
+
+update_product_json 原本要等一個產品的所有批次都回來才寫 analysis.json，中途中斷就會
+丟掉已付費的結果，只好用 salvage_from_log / rebuild_analysis_from_log 從日誌撈回。
+本模組提供：
+
+* `BatchJournal`：每個批次結果一回來就以一行 JSON 附加到產品目錄下的
+  `analysis.journal.jsonl`，並立即 fsync；重啟時 `replay()` 讀回所有完整的行
+  （最後一行寫到一半會被略過，下次附加前也會先截掉，不會和新紀錄黏成一行）；
+* `atomic_write_json`：先寫同目錄暫存檔並 fsync，再以 os.replace 取代目標檔，
+  analysis.json 不會出現寫一半的狀態。
+
+合併流程：checkpoint 時把目前所有結果原子地寫入 analysis.json，成功後才清空日誌；
+中間當機時，analysis.json 仍是上一個 checkpoint，日誌則保有之後的每個批次。
+"""
+
+import json
+import logging
+import os
+import time
+from pathlib import Path
+from typing import Any, Dict, List
+
+log = logging.getLogger("ai_journal")
+
+JOURNAL_NAME = "analysis.journal.jsonl"
+
+
+# ───────────────────────────── 檔案層工具
+
+def _fsync_dir(path: Path) -> None:
+    """讓目錄項目（新檔、改名）落盤；Windows 無法對目錄 fsync，直接略過"""
+    if not hasattr(os, "O_DIRECTORY"):
+        return
+    fd = os.open(str(path), os.O_RDONLY | os.O_DIRECTORY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def atomic_write_json(path: Path, data: Any, **dump_kwargs) -> None:
+    """寫同目錄暫存檔 → fsync → os.replace；任何時間點目標檔都是完整的舊版或新版"""
+    path = Path(path)
+    tmp = path.with_name(f".{path.name}.{os.getpid()}.tmp")
+    try:
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(data, f, **dump_kwargs)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, path)
+    finally:
+        if tmp.exists():
+            tmp.unlink()
+    _fsync_dir(path.parent)
+
+
+# ───────────────────────────── 日誌
+
+class BatchJournal:
+    """一個產品的批次結果日誌（JSON Lines，每行寫入後 fsync）"""
+
+    def __init__(self, path: Path):
+        self.path = Path(path)
+        self._file = None
+
+    def _drop_torn_tail(self) -> None:
+        """上次寫到一半就中斷的最後一行（沒有換行結尾）截掉，否則下一筆會接在它後面一起壞掉"""
+        with open(self.path, "rb+") as f:
+            size = f.seek(0, os.SEEK_END)
+            end = size
+            while end > 0:
+                start = max(0, end - 4096)
+                f.seek(start)
+                newline = f.read(end - start).rfind(b"\n")
+                if newline >= 0:
+                    end = start + newline + 1
+                    break
+                end = start
+            if end == size:
+                return
+            f.truncate(end)
+            f.flush()
+            os.fsync(f.fileno())
+        log.warning(f"{self.path.name} 最後一行不完整（{size - end} bytes），已截掉")
+
+    def append(self, parent: str, results: Dict[str, Any], **extra) -> None:
+        """附加一個批次的 {裁片檔名: 結果}；回傳時資料已落盤"""
+        record = {"ts": time.time(), "parent": parent, "results": results, **extra}
+        if self._file is None:
+            created = not self.path.exists()
+            if not created:
+                self._drop_torn_tail()
+            self._file = open(self.path, "a", encoding="utf-8")
+            if created:
+                _fsync_dir(self.path.parent)
+        self._file.write(json.dumps(record, ensure_ascii=False) + "\n")
+        self._file.flush()
+        os.fsync(self._file.fileno())
+
+    def replay(self) -> List[Dict[str, Any]]:
+        """讀回所有完整的紀錄；無法解析的行（通常是寫到一半的最後一行）略過"""
+        if not self.path.exists():
+            return []
+        records = []
+        with open(self.path, "r", encoding="utf-8") as f:
+            for lineno, line in enumerate(f, 1):
+                if not line.strip():
+                    continue
+                try:
+                    records.append(json.loads(line))
+                except json.JSONDecodeError:
+                    log.warning(f"{self.path.name} 第 {lineno} 行不完整，已略過")
+        return records
+
+    def replay_results(self) -> Dict[str, Any]:
+        """所有紀錄合併後的 {裁片檔名: 結果}（同名以較晚的為準）"""
+        merged: Dict[str, Any] = {}
+        for record in self.replay():
+            merged.update(record.get("results") or {})
+        return merged
+
+    def close(self) -> None:
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def reset(self) -> None:
+        """checkpoint 成功後清空日誌"""
+        self.close()
+        if self.path.exists():
+            self.path.unlink()
+            _fsync_dir(self.path.parent)
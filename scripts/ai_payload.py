@@ -0,0 +1,280 @@
+#!/usr/bin/env python3
+"""
+AI 圖片上傳內容準備（含編碼快取）
+================================
+
+原本送圖給模型的三條路徑各做各的：update_json_with_crops 把原檔整個 base64 上傳、
+一律標成 image/jpeg（PNG / WebP 也一樣）；gpt_crop 每次呼叫都以 quality 95 重新編碼；
+Gemini 路徑直接把原尺寸的 PIL 影像交給 SDK，由 SDK 每次再壓一次。本模組統一處理：
+
+* 依供應商的「有效解析度」縮圖：超過的像素模型端本來就會縮掉，上傳只是浪費頻寬與時間
+  （OpenAI high detail：縮進 2048 方框後短邊 768；Gemini：縮進 3072 方框）；
+* 原檔已在有效解析度內、格式也是供應商接受的，就原封不動上傳（不再多壓一次失真）；
+  需要縮圖或格式不支援時，不透明圖以 JPEG（profile 的 quality）、有透明度的以 PNG 編碼；
+* MIME 類型依實際格式填寫；
+* 編碼結果以 (內容雜湊, profile) 為鍵存在 SQLite（results/ai_payloads.sqlite），並在
+  記憶體保留最近使用的 MEMORY_BYTES；重試、備援供應商與其他腳本都直接取用。
+
+使用範例
+--------
+>>> payload = ai_payload.prepare(crop_path, "openai")
+>>> {"type": "image_url", "image_url": {"url": payload.data_url()}}
+>>> model.generate_content([prompt, ai_payload.prepare(crop_path, "google").gemini_part()])
+
+$ python ai_payload.py                  # 各 profile 的快取筆數與大小
+$ python ai_payload.py --clear
+"""
+
+import argparse
+import base64
+import logging
+import os
+import sqlite3
+import threading
+import time
+from collections import Counter, OrderedDict
+from dataclasses import dataclass
+from io import BytesIO
+from pathlib import Path
+from typing import Dict, FrozenSet, Optional, Tuple
+
+from PIL import Image
+
+from image_inventory import file_hash
+
+log = logging.getLogger("ai_payload")
+
+BASE_DIR = Path(__file__).resolve().parent.parent
+PAYLOAD_PATH = BASE_DIR / "results" / "ai_payloads.sqlite"
+MEMORY_BYTES = 128 << 20        # 記憶體中保留的編碼結果上限
+
+MIME = {"JPEG": "image/jpeg", "PNG": "image/png", "WEBP": "image/webp", "GIF": "image/gif"}
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS payloads (
+    content_hash TEXT NOT NULL,     -- 原圖內容 blake2b-128
+    profile      TEXT NOT NULL,     -- PayloadProfile.key
+    mime         TEXT NOT NULL,
+    width        INTEGER NOT NULL,
+    height       INTEGER NOT NULL,
+    source_width  INTEGER NOT NULL,
+    source_height INTEGER NOT NULL,
+    data         BLOB NOT NULL,
+    created      REAL NOT NULL,
+    PRIMARY KEY (content_hash, profile)
+);
+"""
+
+
+@dataclass(frozen=True)
+class PayloadProfile:
+    """一個供應商的上傳規格"""
+    name: str
+    max_side: int                       # 先縮進 max_side × max_side 方框
+    short_side: Optional[int] = None    # 再把短邊縮到此值以下（None 不限）
+    quality: int = 85                   # 需要重新編碼時的 JPEG 品質
+    formats: FrozenSet[str] = frozenset({"JPEG", "PNG", "WEBP"})   # 可原檔上傳的格式
+
+    @property
+    def key(self) -> str:
+        """快取鍵：任何會改變輸出的設定都在內，改了設定舊快取自然失效"""
+        return f"{self.name}:{self.max_side}:{self.short_side}:{self.quality}:{','.join(sorted(self.formats))}"
+
+    def target_size(self, width: int, height: int) -> Tuple[int, int]:
+        scale = min(1.0, self.max_side / max(width, height))
+        if self.short_side:
+            scale = min(scale, self.short_side / min(width, height))
+        if scale >= 1.0:
+            return width, height
+        return max(1, round(width * scale)), max(1, round(height * scale))
+
+
+PROFILES: Dict[str, PayloadProfile] = {
+    "openai": PayloadProfile("openai", 2048, 768, 85),
+    "standin": PayloadProfile("openai", 2048, 768, 85),     # 替身 API 走 OpenAI 格式，共用編碼結果
+    "google": PayloadProfile("google", 3072, None, 85),
+}
+
+
+@dataclass
+class Payload:
+    data: bytes
+    mime_type: str
+    size: Tuple[int, int]               # 上傳的寬高
+    source_size: Tuple[int, int]        # 原圖寬高
+    encoded: bool                       # False：原檔原封不動
+
+    def base64(self) -> str:
+        return base64.b64encode(self.data).decode("ascii")
+
+    def data_url(self) -> str:
+        """OpenAI image_url 用的 data URL"""
+        return f"data:{self.mime_type};base64,{self.base64()}"
+
+    def gemini_part(self) -> Dict[str, object]:
+        """Gemini generate_content 的 inline blob"""
+        return {"mime_type": self.mime_type, "data": self.data}
+
+
+# ───────────────────────────── 編碼
+
+def encode(path: Path, profile: PayloadProfile) -> Payload:
+    """依 profile 產生上傳內容；不需要縮圖且格式可接受時直接回傳原檔"""
+    with Image.open(path) as img:
+        fmt, source = img.format, img.size
+        target = profile.target_size(*source)
+        if target == source and fmt in profile.formats and not getattr(img, "is_animated", False):
+            return Payload(Path(path).read_bytes(), MIME[fmt], source, source, False)
+
+        if fmt == "JPEG" and target != source:
+            img.draft("RGB", target)       # JPEG 以 1/2、1/4、1/8 縮小解碼，仍不小於目標尺寸
+        transparent = img.mode in ("RGBA", "LA", "PA") or (img.mode == "P" and "transparency" in img.info)
+        out = img.convert("RGBA" if transparent else "RGB")
+    if out.size != target:
+        out = out.resize(target, Image.Resampling.LANCZOS)
+    buffer = BytesIO()
+    if transparent:
+        out.save(buffer, format="PNG")
+        mime = MIME["PNG"]
+    else:
+        out.save(buffer, format="JPEG", quality=profile.quality, optimize=True)
+        mime = MIME["JPEG"]
+    return Payload(buffer.getvalue(), mime, target, source, True)
+
+
+# ───────────────────────────── 快取
+
+class PayloadCache:
+    """編碼結果快取：記憶體 LRU + SQLite；可跨執行緒共用"""
+
+    def __init__(self, db_path: Optional[Path] = PAYLOAD_PATH, memory_bytes: int = MEMORY_BYTES):
+        self.conn = None
+        if db_path is not None:
+            self.db_path = Path(db_path)
+            self.db_path.parent.mkdir(parents=True, exist_ok=True)
+            self.conn = sqlite3.connect(str(self.db_path), timeout=30, check_same_thread=False)
+            self.conn.execute("PRAGMA journal_mode=WAL")
+            self.conn.executescript(SCHEMA)
+        self.memory_bytes = memory_bytes
+        self.lock = threading.Lock()
+        self.stats = Counter()
+        self._memory: "OrderedDict[Tuple[str, str], Payload]" = OrderedDict()
+        self._memory_used = 0
+        self._hashes: Dict[Tuple[str, int, int], str] = {}
+
+    def close(self) -> None:
+        if self.conn is not None:
+            self.conn.close()
+
+    def __enter__(self) -> "PayloadCache":
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.close()
+
+    def content_hash(self, image_path: Path) -> str:
+        """圖片內容雜湊；同一個檔案 (size, mtime) 未變時不重算"""
+        st = os.stat(image_path)
+        memo = (str(image_path), st.st_size, st.st_mtime_ns)
+        digest = self._hashes.get(memo)
+        if digest is None:
+            digest = self._hashes[memo] = file_hash(Path(image_path))
+        return digest
+
+    def _remember(self, key: Tuple[str, str], payload: Payload) -> None:
+        with self.lock:
+            if key in self._memory:
+                return
+            self._memory[key] = payload
+            self._memory_used += len(payload.data)
+            while self._memory_used > self.memory_bytes and len(self._memory) > 1:
+                _, old = self._memory.popitem(last=False)
+                self._memory_used -= len(old.data)
+
+    def get(self, image_path: Path, profile: PayloadProfile) -> Payload:
+        """取得上傳內容：記憶體 → SQLite → 重新編碼（編碼結果寫回 SQLite）"""
+        key = (self.content_hash(image_path), profile.key)
+        with self.lock:
+            payload = self._memory.get(key)
+            if payload is not None:
+                self._memory.move_to_end(key)
+        if payload is not None:
+            self.stats["memory"] += 1
+            return payload
+
+        row = None
+        if self.conn is not None:
+            with self.lock:
+                row = self.conn.execute(
+                    "SELECT mime, width, height, source_width, source_height, data FROM payloads WHERE content_hash=? AND profile=?",
+                    key).fetchone()
+        if row is not None:
+            mime, w, h, sw, sh, data = row
+            payload = Payload(bytes(data), mime, (w, h), (sw, sh), True)
+            self.stats["disk"] += 1
+        else:
+            payload = encode(Path(image_path), profile)
+            self.stats["encoded" if payload.encoded else "passthrough"] += 1
+            self.stats["source_bytes"] += os.path.getsize(image_path)
+            self.stats["upload_bytes"] += len(payload.data)
+            # 原檔上傳的不必另存，下次直接讀原檔即可
+            if payload.encoded and self.conn is not None:
+                with self.lock, self.conn:
+                    self.conn.execute("INSERT OR REPLACE INTO payloads VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                                      (*key, payload.mime_type, *payload.size, *payload.source_size,
+                                       payload.data, time.time()))
+        self._remember(key, payload)
+        return payload
+
+    def describe(self) -> str:
+        s = self.stats
+        saved = ""
+        if s["source_bytes"]:
+            saved = f"，新準備的 {s['source_bytes'] / 1e6:.1f} MB 原檔上傳 {s['upload_bytes'] / 1e6:.1f} MB"
+        return (f"重新編碼 {s['encoded']} 張、原檔 {s['passthrough']} 張、"
+                f"快取命中 {s['memory'] + s['disk']} 次（記憶體 {s['memory']} / 磁碟 {s['disk']}）{saved}")
+
+
+_default: Optional[PayloadCache] = None
+_default_lock = threading.Lock()
+
+
+def default_payloads() -> PayloadCache:
+    """行程內共用的預設快取（PAYLOAD_PATH），第一次呼叫時開啟"""
+    global _default
+    with _default_lock:
+        if _default is None:
+            _default = PayloadCache()
+        return _default
+
+
+def prepare(image_path: Path, provider: str = "openai") -> Payload:
+    """以該供應商的 profile 取得上傳內容（經預設快取）"""
+    return default_payloads().get(Path(image_path), PROFILES.get(provider, PROFILES["openai"]))
+
+
+# ───────────────────────────── CLI
+
+def main():
+    ap = argparse.ArgumentParser(description="查詢或清理 AI 圖片上傳內容快取")
+    ap.add_argument("--db", type=Path, default=PAYLOAD_PATH)
+    ap.add_argument("--clear", action="store_true", help="刪除所有快取的編碼結果")
+    args = ap.parse_args()
+    logging.basicConfig(level=logging.INFO, format="%(levelname)s %(message)s")
+
+    with PayloadCache(args.db) as cache:
+        if args.clear:
+            with cache.conn:
+                n = cache.conn.execute("DELETE FROM payloads").rowcount
+            cache.conn.execute("VACUUM")
+            log.info(f"已刪除 {n} 筆編碼結果")
+        rows = cache.conn.execute(
+            "SELECT profile, COUNT(*), SUM(LENGTH(data)) FROM payloads GROUP BY profile ORDER BY profile").fetchall()
+        for profile, n, size in rows:
+            log.info(f"{profile}: {n} 筆，{size / 1e6:.1f} MB")
+        if not rows:
+            log.info(f"快取是空的：{args.db}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,216 @@
+#!/usr/bin/env python3
+"""
+多供應商路由：故障轉移與對沖請求
+================================
+
+update_json_with_crops 原本要在啟動時以 --model 選定 Google 或 OpenAI；該供應商變慢或
+出錯時，整輪就卡住或留下一堆 None。`Router` 把多個 `ai_dispatch.Dispatcher`（各自保有
+自己的並行數與限流狀態）組成一個派送器：
+
+* 每個供應商記錄最近 WINDOW 次呼叫的耗時與成敗，以「預期成功所需時間」
+  （平均耗時 ÷ 成功率）排序，每個批次先送往目前較健康的一家；
+* 連續失敗 TRIP_AFTER 次即熔斷 COOLDOWN 秒，期間只在其他供應商都失敗時才使用；
+* 主要請求失敗（回傳 None）時立刻轉送下一家；
+* 開啟對沖時，主要請求超過其 p95 耗時仍未回來，就把同一批次另外送給下一家，
+  先回來的有效結果勝出，另一個請求的結果捨棄（已送出的請求仍會計費）。被取消的一方
+  以已等待的時間記一筆慢樣本；它在執行緒裡的呼叫會跑完，期間仍佔用該派送器的並行名額。
+
+尚無樣本的供應商排在有樣本的之後（依使用者指定的順序），只在故障轉移或對沖時才被量測。
+
+使用範例
+--------
+>>> router = Router({"google": Dispatcher(call_google, name="google"),
+...                  "openai": Dispatcher(call_openai, name="openai")}, hedge=True)
+>>> provider, result = await router.submit_routed(product_name, batch, tokens=5000)
+>>> router.close()
+"""
+
+import asyncio
+import logging
+import math
+import time
+from collections import Counter, deque
+from typing import Any, Dict, List, Optional, Tuple
+
+from ai_dispatch import Dispatcher
+
+log = logging.getLogger("ai_router")
+
+WINDOW = 50             # 每個供應商保留的最近呼叫數
+MIN_SAMPLES = 5         # 少於此數視為尚未量測
+TRIP_AFTER = 3          # 連續失敗幾次後熔斷
+COOLDOWN = 120.0        # 熔斷秒數
+HEDGE_QUANTILE = 0.95
+HEDGE_MIN_DELAY = 5.0   # 對沖等待的下限（秒），避免樣本少時過早重複送出
+HEDGE_DEFAULT_DELAY = 90.0  # 尚無樣本時的對沖等待
+
+
+class ProviderHealth:
+    """單一供應商的滾動統計與熔斷狀態"""
+
+    def __init__(self, window: int = WINDOW):
+        self.calls = deque(maxlen=window)   # (耗時秒, 是否成功)
+        self.consecutive_failures = 0
+        self.open_until = 0.0
+
+    def record(self, seconds: float, ok: bool) -> None:
+        self.calls.append((seconds, ok))
+        if ok:
+            self.consecutive_failures = 0
+        else:
+            self.consecutive_failures += 1
+            if self.consecutive_failures >= TRIP_AFTER:
+                self.open_until = time.monotonic() + COOLDOWN
+
+    def record_slow(self, seconds: float) -> None:
+        """被對沖取消的請求：實際耗時至少 seconds，當作一筆（偏低的）成功耗時，不影響熔斷"""
+        self.calls.append((seconds, True))
+
+    @property
+    def samples(self) -> int:
+        return len(self.calls)
+
+    def is_open(self) -> bool:
+        return time.monotonic() < self.open_until
+
+    def error_rate(self) -> float:
+        return sum(1 for _, ok in self.calls if not ok) / len(self.calls) if self.calls else 0.0
+
+    def latency_quantile(self, q: float) -> Optional[float]:
+        """成功呼叫耗時的分位數；沒有成功樣本時回 None"""
+        ok = sorted(s for s, good in self.calls if good)
+        if not ok:
+            return None
+        return ok[min(len(ok) - 1, int(math.ceil(q * len(ok))) - 1)]
+
+    def expected_cost(self) -> float:
+        """預期拿到一個成功結果所需的時間：平均耗時 ÷ 成功率"""
+        if not self.calls:
+            return math.inf
+        mean = sum(s for s, _ in self.calls) / len(self.calls)
+        return mean / max(0.05, 1.0 - self.error_rate())
+
+    def describe(self) -> str:
+        p95 = self.latency_quantile(HEDGE_QUANTILE)
+        return (f"{self.samples} 次，錯誤率 {self.error_rate():.0%}，"
+                f"p95 {p95:.1f}s" if p95 is not None else f"{self.samples} 次，錯誤率 {self.error_rate():.0%}")
+
+
+class Router:
+    """依健康狀態在多個 Dispatcher 之間路由、故障轉移，並可對沖慢請求"""
+
+    def __init__(self, dispatchers: Dict[str, Dispatcher], hedge: bool = False,
+                 hedge_quantile: float = HEDGE_QUANTILE, hedge_min_delay: float = HEDGE_MIN_DELAY):
+        if not dispatchers:
+            raise ValueError("Router 至少需要一個供應商")
+        self.dispatchers = dict(dispatchers)     # 插入順序即使用者偏好順序
+        self.providers = list(self.dispatchers)
+        self.hedge = hedge
+        self.hedge_quantile = hedge_quantile
+        self.hedge_min_delay = hedge_min_delay
+        self.health = {name: ProviderHealth() for name in self.providers}
+        self.stats = Counter()
+
+    def ranked(self) -> List[str]:
+        """目前的嘗試順序：未熔斷優先 → 已量測者依預期成本 → 使用者偏好順序"""
+        def key(item):
+            index, name = item
+            h = self.health[name]
+            cost = h.expected_cost() if h.samples >= MIN_SAMPLES else math.inf
+            return (h.is_open(), cost, index)
+        return [name for _, name in sorted(enumerate(self.providers), key=key)]
+
+    def hedge_delay(self, name: str) -> float:
+        q = self.health[name].latency_quantile(self.hedge_quantile)
+        if q is None or self.health[name].samples < MIN_SAMPLES:
+            return HEDGE_DEFAULT_DELAY
+        return max(self.hedge_min_delay, q)
+
+    async def _attempt(self, name: str, args: Tuple[Any, ...], tokens: int,
+                       starts: Dict[str, float], started: Optional[asyncio.Event] = None) -> Any:
+        """經該供應商的派送器送出；耗時從實際送出開始計（不含排隊與限流等待）"""
+        def mark():
+            starts[name] = time.monotonic()
+            if started is not None:
+                started.set()
+
+        try:
+            result = await self.dispatchers[name].submit(*args, tokens=tokens, on_start=mark)
+        except asyncio.CancelledError:
+            # 對沖落敗被取消：不記錄的話慢樣本會消失，p95 與預期成本都被低估
+            if name in starts:
+                self.health[name].record_slow(time.monotonic() - starts[name])
+                self.stats[f"cancelled_{name}"] += 1
+            raise
+        if name in starts:
+            self.health[name].record(time.monotonic() - starts[name], result is not None)
+        if result is None:
+            log.warning(f"{name} 請求失敗（{self.health[name].describe()}）")
+        return result
+
+    async def submit_routed(self, *args, tokens: int = 0) -> Tuple[Optional[str], Any]:
+        """送出一個請求；回傳 (提供結果的供應商, 結果)，所有供應商都失敗時回傳 (None, None)"""
+        remaining = self.ranked()
+        running: Dict[asyncio.Future, str] = {}
+        starts: Dict[str, float] = {}
+        hedged = False
+
+        def launch(name: str, started: Optional[asyncio.Event] = None) -> None:
+            running[asyncio.ensure_future(self._attempt(name, args, tokens, starts, started))] = name
+
+        primary = remaining.pop(0)
+        started = asyncio.Event()
+        launch(primary, started)
+        try:
+            if self.hedge and remaining:
+                # 對沖計時從主要請求真正送出開始，先等它離開排隊（或直接完成）
+                waiter = asyncio.ensure_future(started.wait())
+                await asyncio.wait([waiter, *running], return_when=asyncio.FIRST_COMPLETED)
+                waiter.cancel()
+            while running:
+                timeout = None
+                delay = self.hedge_delay(primary)
+                if self.hedge and not hedged and remaining and len(running) == 1 and primary in starts:
+                    timeout = max(0.0, starts[primary] + delay - time.monotonic())
+                done, _ = await asyncio.wait(running, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+                if not done:
+                    hedged = True
+                    backup = remaining.pop(0)
+                    self.stats["hedged"] += 1
+                    log.info(f"{primary} 超過 p{int(self.hedge_quantile * 100)} ({delay:.1f}s) 未回應，對沖送往 {backup}")
+                    launch(backup)
+                    continue
+                for task in done:
+                    name = running.pop(task)
+                    result = task.result()
+                    if result is not None:
+                        self.stats[f"ok_{name}"] += 1
+                        if hedged:
+                            self.stats["hedge_won" if name != primary else "hedge_lost"] += 1
+                        return name, result
+                if not running and remaining:
+                    backup = remaining.pop(0)
+                    self.stats["failover"] += 1
+                    log.warning(f"轉送至 {backup}")
+                    launch(backup)
+        finally:
+            for task in running:
+                task.cancel()
+        self.stats["failed"] += 1
+        return None, None
+
+    async def submit(self, *args, tokens: int = 0) -> Any:
+        return (await self.submit_routed(*args, tokens=tokens))[1]
+
+    def describe(self) -> str:
+        return "；".join(f"{name}: {self.health[name].describe()}" for name in self.providers)
+
+    def close(self) -> None:
+        for dispatcher in self.dispatchers.values():
+            dispatcher.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
@@ -0,0 +1,241 @@
+#!/usr/bin/env python3
+"""
+本機 AI 替身 API
+================
+
+OpenAI 相容的 `POST /v1/chat/completions`，只用標準函式庫，讓派送器、重試與
+限流邏輯可以在不花錢、不連網的情況下整輪演練：
+
+* 依訊息中的「檔名: xxx」為每張圖回傳固定（依檔名雜湊）的分類與摘要；
+* 以 60 秒滑動視窗模擬 RPM / TPM 上限，超過時回 429 與 `retry-after`；
+* 每個回應都帶 `x-ratelimit-*` 標頭，格式與 OpenAI 相同；
+* `--latency` 模擬回應延遲，`--error-rate` 隨機插入 429；
+* `GET /stats` 回傳請求數、429 數與最大同時在途數。
+
+使用範例
+--------
+$ python ai_standin.py --port 8765 --rpm 30 --latency 2
+$ python update_json_with_crops.py --model standin --standin-url http://127.0.0.1:8765/v1
+
+>>> with ai_standin.running(rpm=30) as url:
+...     ...
+"""
+
+import argparse
+import json
+import logging
+import math
+import random
+import re
+import threading
+import time
+import zlib
+from collections import deque
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+log = logging.getLogger("ai_standin")
+
+DEFAULT_PORT = 8765
+WINDOW = 60.0
+IMAGE_TOKENS = 800          # 每張圖估算的 token 數
+CATEGORIES = ("use_case", "selling_point", "spec_image")
+
+_NAME_RE = re.compile(r"檔名:\s*(\S+)")
+
+
+class StandinState:
+    """替身伺服器的設定與統計（多執行緒共用）。"""
+
+    def __init__(self, rpm=None, tpm=None, latency=0.0, error_rate=0.0, seed=None):
+        self.rpm = rpm
+        self.tpm = tpm
+        self.latency = latency
+        self.error_rate = error_rate
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.window = deque()       # (時間, tokens)
+        self.requests = 0
+        self.rate_limited = 0
+        self.in_flight = 0
+        self.max_in_flight = 0
+
+    def _expire(self, now):
+        while self.window and now - self.window[0][0] >= WINDOW:
+            self.window.popleft()
+
+    def admit(self, tokens):
+        """登記一個請求；回傳 (是否放行, 回應標頭)。"""
+        with self.lock:
+            now = time.monotonic()
+            self._expire(now)
+            self.requests += 1
+            used = sum(t for _, t in self.window)
+            over_rpm = self.rpm and len(self.window) >= self.rpm
+            over_tpm = self.tpm and used + tokens > self.tpm
+            injected = self.error_rate and self.random.random() < self.error_rate
+            ok = not (over_rpm or over_tpm or injected)
+            if ok:
+                self.window.append((now, tokens))
+                used += tokens
+            reset = (self.window[0][0] + WINDOW - now) if self.window else 0.0
+            headers = {}
+            if self.rpm:
+                headers["x-ratelimit-limit-requests"] = str(self.rpm)
+                headers["x-ratelimit-remaining-requests"] = str(max(0, self.rpm - len(self.window)))
+                headers["x-ratelimit-reset-requests"] = f"{reset:.3f}s"
+            if self.tpm:
+                headers["x-ratelimit-limit-tokens"] = str(self.tpm)
+                headers["x-ratelimit-remaining-tokens"] = str(max(0, self.tpm - used))
+                headers["x-ratelimit-reset-tokens"] = f"{reset:.3f}s"
+            if not ok:
+                self.rate_limited += 1
+                headers["retry-after"] = str(max(1, math.ceil(reset)) if (over_rpm or over_tpm) else 1)
+            return ok, headers
+
+    def enter(self):
+        with self.lock:
+            self.in_flight += 1
+            self.max_in_flight = max(self.max_in_flight, self.in_flight)
+
+    def leave(self):
+        with self.lock:
+            self.in_flight -= 1
+
+    def snapshot(self):
+        with self.lock:
+            return {"requests": self.requests, "rate_limited": self.rate_limited,
+                    "in_flight": self.in_flight, "max_in_flight": self.max_in_flight}
+
+
+def fake_analysis(name):
+    """依檔名決定的固定分析結果。"""
+    category = CATEGORIES[zlib.crc32(name.encode("utf-8")) % len(CATEGORIES)]
+    return {"category": category, "summary": f"替身分析：{name}", "text_blocks": []}
+
+
+def _request_parts(body):
+    """取出訊息中的文字段與圖片數。"""
+    texts, images = [], 0
+    for message in body.get("messages", []):
+        content = message.get("content")
+        if isinstance(content, str):
+            texts.append(content)
+            continue
+        for part in content or []:
+            if part.get("type") == "text":
+                texts.append(part.get("text", ""))
+            elif part.get("type") == "image_url":
+                images += 1
+    return texts, images
+
+
+class StandinHandler(BaseHTTPRequestHandler):
+    server_version = "ai-standin/1.0"
+
+    def log_message(self, fmt, *args):
+        log.debug(fmt % args)
+
+    def _send(self, status, payload, headers=None):
+        data = json.dumps(payload, ensure_ascii=False).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json; charset=utf-8")
+        self.send_header("Content-Length", str(len(data)))
+        for k, v in (headers or {}).items():
+            self.send_header(k, v)
+        self.end_headers()
+        try:
+            self.wfile.write(data)
+        except (BrokenPipeError, ConnectionResetError):
+            log.debug("用戶端已中斷連線")
+
+    def do_GET(self):
+        if self.path.rstrip("/").endswith("/stats"):
+            self._send(200, self.server.state.snapshot())
+        else:
+            self._send(404, {"error": {"message": "not found"}})
+
+    def do_POST(self):
+        if not self.path.rstrip("/").endswith("/chat/completions"):
+            self._send(404, {"error": {"message": "not found"}})
+            return
+        state = self.server.state
+        try:
+            body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+        except json.JSONDecodeError:
+            self._send(400, {"error": {"message": "invalid json"}})
+            return
+
+        texts, images = _request_parts(body)
+        tokens = sum(len(t) for t in texts) // 2 + IMAGE_TOKENS * images + int(body.get("max_tokens") or 0)
+        ok, headers = state.admit(tokens)
+        if not ok:
+            self._send(429, {"error": {"type": "rate_limit_exceeded", "message": "Rate limit reached"}}, headers)
+            return
+
+        state.enter()
+        try:
+            if state.latency:
+                time.sleep(state.latency)
+            names = [m for t in texts for m in _NAME_RE.findall(t)]
+            content = json.dumps({name: fake_analysis(name) for name in names}, ensure_ascii=False)
+            self._send(200, {
+                "id": f"standin-{state.requests}",
+                "object": "chat.completion",
+                "model": body.get("model", "standin"),
+                "choices": [{"index": 0, "finish_reason": "stop",
+                             "message": {"role": "assistant", "content": content}}],
+                "usage": {"prompt_tokens": tokens, "completion_tokens": len(content) // 2},
+            }, headers)
+        finally:
+            state.leave()
+
+
+def serve(host="127.0.0.1", port=DEFAULT_PORT, **kwargs):
+    """在背景執行緒啟動替身伺服器；port=0 由系統挑選。回傳 server（.state 為統計）。"""
+    server = ThreadingHTTPServer((host, port), StandinHandler)
+    server.daemon_threads = True
+    server.state = StandinState(**kwargs)
+    threading.Thread(target=server.serve_forever, name="ai-standin", daemon=True).start()
+    return server
+
+
+@contextmanager
+def running(**kwargs):
+    """`with running(rpm=30) as url:`，url 為 OpenAI 相容的 base URL（含 /v1）。"""
+    server = serve(port=0, **kwargs)
+    host, port = server.server_address[:2]
+    try:
+        yield f"http://{host}:{port}/v1"
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="本機 OpenAI 相容替身 API，用於演練派送與限流。")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=DEFAULT_PORT)
+    parser.add_argument("--rpm", type=int, default=None, help="每分鐘請求上限")
+    parser.add_argument("--tpm", type=int, default=None, help="每分鐘 token 上限")
+    parser.add_argument("--latency", type=float, default=0.0, help="每個請求的回應延遲（秒）")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="隨機回 429 的機率")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
+    server = ThreadingHTTPServer((args.host, args.port), StandinHandler)
+    server.daemon_threads = True
+    server.state = StandinState(rpm=args.rpm, tpm=args.tpm, latency=args.latency,
+                                error_rate=args.error_rate)
+    log.info(f"替身 API 已啟動：http://{args.host}:{args.port}/v1")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        log.info(f"統計：{server.state.snapshot()}")
+        server.server_close()
+
+
+if __name__ == "__main__":
+    main()
@@ -1,5 +1,7 @@
 import os
 import json
+import argparse
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from pathlib import Path
 import logging
 import cv2
@@ -7,6 +9,8 @@ import numpy as np
 import re
 from PIL import Image
 
+import image_inventory
+
 # 設定日誌
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
@@ -14,7 +18,9 @@ logger = logging.getLogger(__name__)
 # 設定基礎路徑
 BASE_DIR = Path(__file__).parent.parent
 PRODUCTS_DIR = BASE_DIR / "products"
+WWW_DIR = PRODUCTS_DIR / "WWW_Collection"
 CROPPED_OUTPUT_DIR = BASE_DIR / "cropped"
+ANALYSIS_JSONL = "image_analysis.jsonl"   # 每個產品目錄下逐張寫入的分析結果
 
 class NumpyEncoder(json.JSONEncoder):
     """處理 numpy 類型的 JSON 編碼器"""
@@ -27,6 +33,28 @@ class NumpyEncoder(json.JSONEncoder):
             return float(obj)
         return super(NumpyEncoder, self).default(obj)
 
+def column_integrals(arr, ys, squares=True):
+    """
+    只在指定列取樣的積分影像：S[k, x] = arr[:ys[k], :x] 的總和（int64，可多通道），
+    Q 為平方和。ys 需遞增；記憶體只有 len(ys) × 寬，不需整張積分圖。
+    """
+    w = arr.shape[1]
+    shape = (len(ys), w + 1) + arr.shape[2:]
+    sums = np.zeros(shape, np.int64)
+    sq_sums = np.zeros(shape, np.int64) if squares else None
+    col = np.zeros((w,) + arr.shape[2:], np.int64)
+    col_sq = np.zeros_like(col)
+    prev = 0
+    for k, y in enumerate(ys):
+        band = arr[prev:y]
+        col += band.sum(axis=0, dtype=np.int64)
+        np.cumsum(col, axis=0, out=sums[k, 1:])
+        if squares:
+            col_sq += np.einsum("ij...,ij...->j...", band, band, dtype=np.int64)
+            np.cumsum(col_sq, axis=0, out=sq_sums[k, 1:])
+        prev = y
+    return sums, sq_sums
+
 class ImageAnalyzer:
     def __init__(self):
         # 支援的圖片格式
@@ -57,7 +85,13 @@ class ImageAnalyzer:
             return None
 
     def detect_content_regions(self, img):
-        """檢測圖片中的內容區域"""
+        """
+        檢測圖片中的內容區域，回傳 connectedComponentsWithStats 的 stats
+        （每列 x, y, width, height, area，不含背景）。
+
+        二值圖先填滿孔洞，每個連通元件即等同 findContours(RETR_EXTERNAL) 的外輪廓區域
+        （內部文字/線條併入外框），area 為填滿後的像素數。
+        """
         try:
             # 轉換為灰度圖
             gray = cv2.cvtColor(img, cv2.COLOR_RGB2GRAY)
@@ -67,66 +101,77 @@ class ImageAnalyzer:
                 gray, 255, cv2.ADAPTIVE_THRESH_GAUSSIAN_C, 
                 cv2.THRESH_BINARY_INV, 11, 2
             )
+            del gray
             
             # 使用形態學操作改善邊緣
             kernel = np.ones((3,3), np.uint8)
             binary = cv2.morphologyEx(binary, cv2.MORPH_CLOSE, kernel)
             
-            # 尋找輪廓
-            contours, _ = cv2.findContours(
-                binary, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE
-            )
+            # 填孔：從外框 flood fill 背景，沒被填到的 0 就是孔洞
+            flood = cv2.copyMakeBorder(binary, 1, 1, 1, 1, cv2.BORDER_CONSTANT, value=0)
+            cv2.floodFill(flood, None, (0, 0), 255)
+            holes = flood[1:-1, 1:-1]
+            np.bitwise_not(holes, out=holes)
+            np.bitwise_or(binary, holes, out=binary)
+            del flood, holes
             
-            return contours
+            # 一次取得所有元件的外框與面積
+            _, _, stats, _ = cv2.connectedComponentsWithStats(binary, connectivity=8, ltype=cv2.CV_32S)
+            return stats[1:]
         except Exception as e:
             logger.error(f"檢測內容區域失敗: {str(e)}")
-            return []
+            return np.zeros((0, 5), np.int32)
 
-    def analyze_region_features(self, img, contour):
-        """分析區域特徵"""
+    def analyze_regions(self, img, stats):
+        """
+        向量化計算所有區域的特徵：顏色平均/標準差與邊緣密度都由
+        「在區域上下緣取樣的積分影像」查表取得，不再逐區域掃描 ROI 或重跑 Canny。
+        """
         try:
-            x, y, w, h = cv2.boundingRect(contour)
-            roi = img[y:y+h, x:x+w]
-            
-            # 計算區域特徵
-            area = cv2.contourArea(contour)
-            aspect_ratio = w / h if h > 0 else 0
-            
-            # 計算區域的顏色特徵
-            if roi.size > 0:
-                mean_color = cv2.mean(roi)[:3]
-                std_color = np.std(roi, axis=(0,1))[:3]
-            else:
-                mean_color = (0, 0, 0)
-                std_color = (0, 0, 0)
-            
-            # 計算區域的邊緣強度
-            if roi.size > 0:
-                edges = cv2.Canny(roi, 100, 200)
-                edge_density = np.sum(edges > 0) / (w * h)
-            else:
-                edge_density = 0
-            
-            return {
-                "position": {
-                    "x": int(x),
-                    "y": int(y),
-                    "width": int(w),
-                    "height": int(h)
-                },
-                "features": {
-                    "area": float(area),
-                    "aspect_ratio": round(float(aspect_ratio), 2),
-                    "center": [int(x + w//2), int(y + h//2)],
-                    "area_ratio": round(float(area) / (img.shape[0] * img.shape[1]), 3),
-                    "mean_color": [float(c) for c in mean_color],
-                    "color_std": [float(c) for c in std_color],
-                    "edge_density": round(float(edge_density), 3)
-                }
-            }
+            height, width = img.shape[:2]
+            x, y, w, h, area = (stats[:, i].astype(np.int64) for i in range(5))
+            ys = np.unique(np.concatenate((y, y + h)))
+            k0, k1 = np.searchsorted(ys, y), np.searchsorted(ys, y + h)
+            x1 = x + w
+            n = w * h
+
+            def _box(integral):
+                # 矩形和 = 四個角的積分值相加減
+                return (integral[k1, x1] - integral[k0, x1]) - (integral[k1, x] - integral[k0, x])
+
+            sums, sq_sums = column_integrals(img, ys)
+            mean = _box(sums)[:, :3] / n[:, None]
+            std = np.sqrt(np.maximum(_box(sq_sums)[:, :3] / n[:, None] - mean * mean, 0.0))
+            del sums, sq_sums
+
+            # 整張只做一次 Canny（輸出 0 / 255）
+            edge_sums, _ = column_integrals(cv2.Canny(img, 100, 200), ys, squares=False)
+            edge_density = _box(edge_sums) / 255 / n
+
+            regions = []
+            for i in range(len(stats)):
+                aspect_ratio = w[i] / h[i] if h[i] > 0 else 0
+                regions.append({
+                    "position": {
+                        "x": int(x[i]),
+                        "y": int(y[i]),
+                        "width": int(w[i]),
+                        "height": int(h[i])
+                    },
+                    "features": {
+                        "area": float(area[i]),
+                        "aspect_ratio": round(float(aspect_ratio), 2),
+                        "center": [int(x[i] + w[i]//2), int(y[i] + h[i]//2)],
+                        "area_ratio": round(float(area[i]) / (height * width), 3),
+                        "mean_color": [float(c) for c in mean[i]],
+                        "color_std": [float(c) for c in std[i]],
+                        "edge_density": round(float(edge_density[i]), 3)
+                    }
+                })
+            return regions
         except Exception as e:
             logger.error(f"分析區域特徵失敗: {str(e)}")
-            return None
+            return []
 
     def find_cut_points(self, img, regions):
         """尋找合適的裁切點"""
@@ -218,27 +263,31 @@ class ImageAnalyzer:
             img = self.read_image(image_path)
             if img is None:
                 return None
+            return self.analyze_content(img)
+        except Exception as e:
+            logger.error(f"分析圖片內容失敗: {str(e)}")
+            return None
 
+    def analyze_content(self, img):
+        """分析已解碼的 RGB 陣列（analyze_image_content 的主體，方便重複使用與量測）"""
+        try:
             # 檢測內容區域
-            contours = self.detect_content_regions(img)
+            stats = self.detect_content_regions(img)
             
-            if not contours:
+            if not len(stats):
                 return None
                 
-            # 過濾小輪廓
+            # 過濾小區域
             min_area = img.shape[0] * img.shape[1] * 0.05  # 最小面積為圖片的 5%
-            valid_contours = [cnt for cnt in contours if cv2.contourArea(cnt) > min_area]
+            valid = stats[stats[:, cv2.CC_STAT_AREA] > min_area]
             
-            if not valid_contours:
+            if not len(valid):
                 return None
                 
-            # 分析每個區域
-            regions = []
-            for i, cnt in enumerate(valid_contours):
-                region_analysis = self.analyze_region_features(img, cnt)
-                if region_analysis:
-                    region_analysis["index"] = i + 1
-                    regions.append(region_analysis)
+            # 一次分析所有區域
+            regions = self.analyze_regions(img, valid)
+            for i, region_analysis in enumerate(regions):
+                region_analysis["index"] = i + 1
             
             # 找出裁切點
             cut_points = self.find_cut_points(img, regions)
@@ -261,7 +310,7 @@ class ImageAnalyzer:
             return None
 
     def analyze_image(self, image_path):
-        """分析圖片基本資訊和內容"""
+        """分析圖片基本資訊和內容（只解碼一次，metadata 與內容分析共用同一份像素）"""
         try:
             with Image.open(image_path) as img:
                 analysis = {
@@ -273,9 +322,10 @@ class ImageAnalyzer:
                     "height": int(img.height),
                     "aspect_ratio": round(float(img.width) / float(img.height), 2)
                 }
+                rgb = np.array(img if img.mode == 'RGB' else img.convert('RGB'))
                 
                 # 分析圖片內容
-                content_analysis = self.analyze_image_content(image_path)
+                content_analysis = self.analyze_content(rgb)
                 if content_analysis:
                     analysis["content_analysis"] = content_analysis
                     analysis["is_combined"] = content_analysis["is_combined"]
@@ -305,7 +355,7 @@ def read_image(image_path):
 
 def detect_cut_lines_by_projection(gray_image, threshold=10, min_gap_height=30):
     height, width = gray_image.shape
-    projection = np.sum(255 - gray_image, axis=1)
+    projection = width * 255 - gray_image.sum(axis=1, dtype=np.int64)
     cut_lines = []
     in_blank = False
     start = 0
@@ -360,43 +410,122 @@ def process_product_images(product_dir):
         "images": []
     }
     
-    # 遍歷目錄及其子目錄中的所有檔案
-    for root, dirs, files in os.walk(product_dir):
-        for filename in files:
-            if analyzer.is_supported_image(filename):
-                image_path = os.path.join(root, filename)
-                # 計算相對路徑
-                rel_path = os.path.relpath(image_path, product_dir)
-                analysis = analyzer.analyze_image(image_path)
-                if analysis:
-                    # 添加相對路徑資訊
-                    analysis["relative_path"] = rel_path
-                    product_analysis["images"].append(analysis)
-                    logger.info(f"已分析圖片: {rel_path}")
+    # 由庫存索引取得目錄及其子目錄中的所有圖片
+    for path in image_inventory.scan(Path(product_dir), analyzer.supported_formats):
+        image_path = str(path)
+        # 計算相對路徑
+        rel_path = os.path.relpath(image_path, product_dir)
+        analysis = analyzer.analyze_image(image_path)
+        if analysis:
+            # 添加相對路徑資訊
+            analysis["relative_path"] = rel_path
+            product_analysis["images"].append(analysis)
+            logger.info(f"已分析圖片: {rel_path}")
     
     return product_analysis
 
-def process_www_collection():
-    """處理 WWW_Collection 目錄下的所有產品圖片"""
-    base_dir = "4w1h-min/products/WWW_Collection"
-    
-    # 遍歷所有產品目錄
-    for product_dir in os.listdir(base_dir):
-        if product_dir.startswith("product_"):
-            product_path = os.path.join(base_dir, product_dir)
-            if os.path.isdir(product_path):
-                logger.info(f"處理產品目錄: {product_dir}")
-                
-                # 分析產品目錄中的所有圖片
-                product_analysis = process_product_images(product_path)
-                
-                # 保存分析結果
-                analysis_file = os.path.join(product_path, "image_analysis.json")
-                with open(analysis_file, 'w', encoding='utf-8') as f:
-                    json.dump(product_analysis, f, ensure_ascii=False, indent=2, cls=NumpyEncoder)
-                logger.info(f"分析結果已保存: {analysis_file}")
+_ANALYZER = None
+
+def _init_worker():
+    """每個 worker 行程：OpenCV 單執行緒（並行由行程池負責），建立自己的 ImageAnalyzer"""
+    global _ANALYZER
+    cv2.setNumThreads(1)
+    _ANALYZER = ImageAnalyzer()
+
+def _analyze_job(image_path, product_dir):
+    """worker 端：分析單張圖片，回傳 (產品目錄, 紀錄)；失敗時紀錄為 None"""
+    analyzer = _ANALYZER or ImageAnalyzer()
+    analysis = analyzer.analyze_image(str(image_path))
+    if analysis:
+        analysis["relative_path"] = os.path.relpath(image_path, product_dir)
+    return product_dir, analysis
+
+def process_www_collection(base_dir=WWW_DIR, workers=None):
+    """
+    處理 WWW_Collection 目錄下的所有產品圖片。
+    所有產品的圖片一起丟進行程池（workers=1 時在本行程依序執行），
+    每張完成就以一行 JSON 寫入該產品的 image_analysis.jsonl.tmp，
+    該產品全部完成時才取代 image_analysis.jsonl。
+    """
+    base_dir = Path(base_dir)
+    product_dirs = sorted(p for p in base_dir.iterdir()
+                          if p.is_dir() and p.name.startswith("product_"))
+    exts = ImageAnalyzer().supported_formats
+    with image_inventory.Inventory() as inv:
+        inv.refresh(base_dir, exts)
+        jobs = [(rec.path, product_dir.resolve())
+                for product_dir in product_dirs for rec in inv.images(product_dir, exts)]
+    logger.info(f"共 {len(product_dirs)} 個產品目錄、{len(jobs)} 張圖片")
+
+    # 結果先寫到 .tmp（第一筆結果出現時才開檔），該產品的圖片全部跑完才取代正式檔；
+    # 中途中斷或只跑到一部分時，尚未完成的產品保留原本的 image_analysis.jsonl
+    remaining = {product_dir.resolve(): 0 for product_dir in product_dirs}
+    for _, product_dir in jobs:
+        remaining[product_dir] += 1
+    outputs = {}
+    counts = dict.fromkeys(remaining, 0)
+
+    def _tmp_path(product_dir):
+        return product_dir / (ANALYSIS_JSONL + ".tmp")
+
+    def _commit(product_dir):
+        f = outputs.pop(product_dir, None)
+        if f is None:
+            f = open(_tmp_path(product_dir), 'w', encoding='utf-8')   # 沒有任何結果也寫出空檔
+        f.close()
+        os.replace(_tmp_path(product_dir), product_dir / ANALYSIS_JSONL)
+        logger.info(f"分析結果已保存: {product_dir / ANALYSIS_JSONL}（{counts[product_dir]} 張）")
+
+    def _done(product_dir, analysis=None):
+        if analysis:
+            analysis["product_id"] = product_dir.name
+            f = outputs.get(product_dir)
+            if f is None:
+                f = outputs[product_dir] = open(_tmp_path(product_dir), 'w', encoding='utf-8')
+            f.write(json.dumps(analysis, ensure_ascii=False, cls=NumpyEncoder) + "\n")
+            f.flush()
+            counts[product_dir] += 1
+            logger.info(f"已分析圖片: {product_dir.name}/{analysis['relative_path']}")
+        remaining[product_dir] -= 1
+        if remaining[product_dir] == 0:
+            _commit(product_dir)
+
+    try:
+        for product_dir, n in remaining.items():
+            if n == 0:
+                _commit(product_dir)
+        if workers == 1:
+            for image_path, product_dir in jobs:
+                _done(*_analyze_job(image_path, product_dir))
+        else:
+            with ProcessPoolExecutor(workers, initializer=_init_worker) as pool:
+                futures = {pool.submit(_analyze_job, image_path, product_dir): product_dir
+                           for image_path, product_dir in jobs}
+                for fut in as_completed(futures):
+                    try:
+                        result = fut.result()
+                    except Exception as e:
+                        logger.error(f"分析圖片失敗: {e}")
+                        result = (futures[fut], None)
+                    _done(*result)
+    finally:
+        for product_dir, f in outputs.items():
+            f.close()
+            logger.warning(f"{product_dir.name} 未跑完，保留原本的 {ANALYSIS_JSONL}；"
+                           f"已完成的 {counts[product_dir]} 筆在 {_tmp_path(product_dir).name}")
 
 def main():
+    parser = argparse.ArgumentParser(description="分析並裁切產品圖片")
+    parser.add_argument("--collection", action="store_true",
+                        help="改為分析 WWW_Collection 全部圖片，結果寫入各產品的 image_analysis.jsonl")
+    parser.add_argument("--workers", type=int, default=None,
+                        help="--collection 的行程數（預設 CPU 核心數，1 表示不開行程池）")
+    args = parser.parse_args()
+
+    if args.collection:
+        process_www_collection(workers=args.workers)
+        return
+
     # 處理所有產品目錄
     for product_dir in PRODUCTS_DIR.iterdir():
         if product_dir.is_dir():
@@ -10,8 +10,13 @@ $ python batch_runner.py
 
 可選參數：
   --ratio    白色區域判定比例（預設 0.03）
-  --workers  並行處理數（預設 CPU核心數×4）
+  --workers  並行處理數上限（預設 CPU核心數×4，依 CPU/RSS 自動調整）
+  --mem-budget 解碼中圖片的記憶體預算 MB（預設實體記憶體一半）
   --ext      要處理的副檔名（預設 jpg,jpeg,png）
+  --lossless JPEG 來源以 MCU 對齊的無損方式裁切（非 JPEG 仍重新編碼）
+  --plan-only 只輸出裁切計畫，不寫出裁片
+  --stream-above 高度超過此值的圖片以 strip 串流處理（--strip-height 調整 strip 高度）
+  --encode-workers / --encode-queue / --encode  編碼階段的 worker 數、佇列上限與各格式參數
 """
 
 import argparse
@@ -20,7 +25,6 @@ import logging
 import os
 import shutil
 import time
-from concurrent.futures import ThreadPoolExecutor, as_completed
 from dataclasses import asdict
 from pathlib import Path
 from typing import List, Dict, Any, Optional, Tuple
@@ -28,6 +32,15 @@ from typing import List, Dict, Any, Optional, Tuple
 import cv2
 import numpy as np
 
+import crop_engine
+import image_inventory
+from crop_engine import CropEngine, RowProfile, get_preset, looks_like_text
+from crop_plan import CropPlan, CropSpec
+from crop_writer import CropWriter, parse_encode_settings
+from jpeg_lossless import JPEG_EXTS, exif_orientation, lossless_crop, read_mcu_size
+from scheduler import FOOTPRINT_BYTES_PER_PX, MemoryBudgetScheduler, estimate_footprint
+import stream_crop
+
 # ───────────────────────────── 常數定義
 MIN_CROP_HEIGHT = 200             # 裁片最小高度（px）
 BG_THRESH = 245                   # > 此灰度視為白
@@ -59,113 +72,30 @@ def to_serializable(obj: Any) -> Any:
         return obj
 
 # ───────────────────────────── 圖片處理函數
+# 偵測邏輯已收斂到 crop_engine（preset "batch_runner"）；以下保留舊介面
+
+ENGINE = CropEngine(get_preset("batch_runner", min_crop_h=MIN_CROP_HEIGHT))
 
 def trim_border(img: np.ndarray, bg_thresh: int = BG_THRESH, consec: int = CONSEC_BORDER) -> tuple[int, int, int, int]:
     """偵測四周純白邊框，回傳 (top, bottom, left, right) 應裁掉的像素數"""
-    gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
-    h, w = gray.shape
-
-    def _scan(indices, axis: str) -> int:
-        run = 0
-        for idx in indices:
-            line = gray[idx] if axis == "row" else gray[:, idx]
-            if (line > bg_thresh).all():
-                run += 1
-                if run >= consec:
-                    continue
-            else:
-                break
-        return run
-
-    top = _scan(range(h), "row")
-    bottom = _scan(range(h - 1, -1, -1), "row")
-    left = _scan(range(w), "col")
-    right = _scan(range(w - 1, -1, -1), "col")
-    return top, bottom, left, right
+    return crop_engine.trim_border(img, bg_thresh, consec)
 
 def merge_close(lines: List[int], orig_h: int) -> List[int]:
     """合併太近的切線"""
-    if not lines:
-        return []
-    
     # 對長圖使用固定間距，避免過度合併
     min_gap = 180 if orig_h > 4000 else max(120, int(0.025 * orig_h))
-    
-    merged = []
-    for y in sorted(lines):
-        if not merged or y - merged[-1] >= min_gap:
-            merged.append(y)
-    return merged
+    return crop_engine.merge_close(lines, min_gap)
 
-# ───────────────────────────── 新的白帶偵測
 def find_white_gaps(gray: np.ndarray,
                     row_mu_th: int = 250,
                     row_std_th: int = 3,
                     min_run: int = 18) -> List[int]:
     """回傳所有「水平留白」的中心 y 座標"""
-    # 計算每行的平均亮度
-    row_means = np.mean(gray, axis=1)
-    row_stds = np.std(gray, axis=1)
-    
-    # 找出符合條件的行
-    white = (row_means > row_mu_th) & (row_stds < row_std_th)
-    
-    # 找出連續的白行
-    gaps = []
-    run_start = None
-    
-    # 連續白行 run 至少得有「任意行的 row_std < 1.5」才算真正純白
-    for y, flag in enumerate(white):
-        if flag and run_start is None:
-            run_start = y
-        elif (not flag) and run_start is not None:
-            run_len = y - run_start
-            if run_len >= min_run and (gray[run_start:y].std() < 1.5):
-                gaps.append((run_start + y - 1) // 2)
-            run_start = None
-    
-    # 處理最後一段
-    if run_start is not None:
-        run_len = len(white) - run_start
-        if run_len >= min_run and (gray[run_start:].std() < 1.5):
-            gaps.append((run_start + len(white) - 1) // 2)
-    
-    return gaps
+    return crop_engine.white_gaps(RowProfile(gray), row_mu_th, row_std_th, min_run)
 
 def long_edge_projection(gray: np.ndarray) -> List[int]:
     """偵測長圖的稀疏邊緣帶"""
-    h, w = gray.shape
-    if h <= 2000:  # 非長圖不處理
-        return []
-    
-    # 計算每行的邊緣密度
-    edges = cv2.Canny(gray, 50, 150)
-    edge_density = edges.sum(axis=1) / w
-    
-    # 找出邊緣密度特別低的行
-    threshold = edge_density.mean() * 0.3
-    sparse_rows = edge_density < threshold
-    
-    # 合併連續的稀疏行
-    lines, run_start = [], None
-    for y, is_sparse in enumerate(sparse_rows):
-        if is_sparse and run_start is None:
-            run_start = y
-        elif (not is_sparse) and run_start is not None:
-            if y - run_start >= 10:  # 至少 10 行才視為有效
-                lines.append((run_start + y - 1) // 2)
-            run_start = None
-    if run_start is not None and (h - run_start) >= 10:
-        lines.append((run_start + h - 1) // 2)
-    
-    return lines
-
-def looks_like_text(seg: np.ndarray) -> bool:
-    """判斷是否為文字區塊"""
-    gray = cv2.cvtColor(seg, cv2.COLOR_BGR2GRAY)
-    edges = cv2.Canny(gray, 50, 150)
-    ratio = edges.sum() / edges.size
-    return ratio > 0.05 and gray.std() < 15
+    return crop_engine.sparse_edges(RowProfile(gray))
 
 def small_fragment(crop: np.ndarray, orig_h: int) -> bool:
     """判斷是否為過小的片段"""
@@ -177,165 +107,42 @@ def small_fragment(crop: np.ndarray, orig_h: int) -> bool:
     too_small = h < max(min_keep, ABS_MIN, REL_MIN)
     return too_small and (not looks_like_text(crop))
 
-# ───────────────────────────── NEW: uniform_gap() 低變異度分隔帶
 def uniform_gaps(gray: np.ndarray,
                  std_th: float = 2.5,
                  mu_hi: int = 235,
                  mu_lo: int = 25,
                  min_run: int = 4) -> List[int]:
+    """找出「整行都很平」且亮度極高或極低的水平帶"""
+    return crop_engine.uniform_gaps(RowProfile(gray), std_th, mu_hi, mu_lo, min_run)
+
+def plan_crop(img: np.ndarray, align: int = 1, align_x: int = 1,
+              source: Optional[Path] = None) -> CropPlan:
+    """
+    偵測切線並回傳裁切計畫（不產生像素）
+
+    align > 1 時，所有切線與上緣去邊起點都對齊到 align 的倍數（JPEG MCU 高度），
+    左緣去邊起點則對齊 align_x（JPEG MCU 寬度），
+    計畫中的區間可直接交給 jpeg_lossless.lossless_crop。
     """
-    找出「整行都很平」且亮度極高或極低的水平帶。適用：
-      - 微灰白分隔線（row_mean≈240，std≈0）
-      - 全黑分隔線  （row_mean≈10， std≈0）
-    只要連續 ≥ min_run 行就算有效分隔。
+    return ENGINE.plan(img, source=source, align=align, align_x=align_x)
+
+def smart_crop(img: np.ndarray, align: int = 1, align_x: int = 1) -> Dict[str, Any]:
+    """
+    智慧裁切圖片（plan_crop + materialize）
+
+    crops 為原圖的 view（不相鄰的合併片段才會複製）；
+    boxes[i] 為第 i 個裁片在原圖中的 (y0, y1, x0, x1) 列表。
     """
-    h, _ = gray.shape
-    row_mu  = gray.mean(axis=1)
-    row_std = gray.std(axis=1)
-
-    flat = (row_std < std_th) & ((row_mu > mu_hi) | (row_mu < mu_lo))
-
-    gaps, run = [], None
-    for y, f in enumerate(flat):
-        if f and run is None:
-            run = y
-        elif (not f) and run is not None:
-            if y - run >= min_run:
-                gaps.append((run + y - 1) // 2)
-            run = None
-    if run is not None and h - run >= min_run:
-        gaps.append((run + h - 1) // 2)
-    return gaps
-
-def smart_crop(img: np.ndarray) -> Dict[str, Any]:
-    """智慧裁切圖片"""
     try:
-        h, w = img.shape[:2]
-        
-        # 檢查圖片是否太小
-        if max(h, w) < 120 or min(h, w) < 80:   # 高或寬 < 80 視為 icon
-            return {
-                "success": True,
-                "crops": [img],
-                "height": h,
-                "width": w
-            }
-        
-        # 先算一次，trim 之後再重算
-        if len(img.shape) == 3 and img.shape[2] == 4:  # 處理 PNG alpha
-            gray = cv2.cvtColor(img, cv2.COLOR_BGRA2GRAY)
-        else:
-            gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
-        
-        # 裁掉純白邊框
-        t, b, l, r = trim_border(img)
-        if any((t, b, l, r)):
-            img  = img[t : img.shape[0] - b, l : img.shape[1] - r]
-            gray = gray[t : gray.shape[0] - b, l : gray.shape[1] - r]
-            h, w = gray.shape
-        
-        # 根據圖片高度決定裁切策略
-        if h <= 2000:  # 短圖：直接保留
-            return {
-                "success": True,
-                "crops": [img],
-                "height": h,
-                "width": w
-            }
-        
-        # 找出所有水平白帶
-        gap_lines = find_white_gaps(gray)       # ① 純白帶
-        uniform_lines = uniform_gaps(gray) if h > 2800 else []  # ② 低變異度極亮/極暗帶（只針對長圖）
-        sparse_lines = long_edge_projection(gray) # ③ 長圖稀疏邊緣帶
-        
-        # 合併所有切線
-        cut_lines = merge_close(sorted(set(gap_lines + uniform_lines + sparse_lines)), h)
-        if not cut_lines:
-            return {
-                "success": True,
-                "crops": [img],
-                "height": h,
-                "width": w
-            }
-        
-        # 根據切線裁切
-        crops = []
-        y0 = 0
-        for y in cut_lines:
-            if y - y0 >= MIN_CROP_HEIGHT:
-                crop = img[y0:y]
-                if not small_fragment(crop, h):
-                    crops.append(crop)
-            y0 = y  # 無論是否裁切，都更新 y0
-        
-        # 處理最後一段
-        if h - y0 >= MIN_CROP_HEIGHT:
-            crop = img[y0:]
-            if not small_fragment(crop, h):
-                crops.append(crop)
-        
-        # 如果沒有裁切出任何片段，返回原圖
-        if not crops:
-            return {
-                "success": True,
-                "crops": [img],
-                "height": h,
-                "width": w
-            }
-        
-        # 檢查裁切覆蓋率
-        total_crop_h = sum(crop.shape[0] for crop in crops)
-        coverage = total_crop_h / h
-        
-        # 如果覆蓋率太低，嘗試使用原始切線（不併片）
-        if coverage < 0.8:
-            crops = []
-            y0 = 0
-            for y in sorted(set(gap_lines + uniform_lines + sparse_lines)):
-                if y - y0 >= MIN_CROP_HEIGHT:
-                    crop = img[y0:y]
-                    if not small_fragment(crop, h):
-                        crops.append(crop)
-                y0 = y
-            
-            if h - y0 >= MIN_CROP_HEIGHT:
-                crop = img[y0:]
-                if not small_fragment(crop, h):
-                    crops.append(crop)
-            
-            # 如果回退後覆蓋率仍低，強制三等分
-            total_crop_h = sum(crop.shape[0] for crop in crops)
-            if total_crop_h / h < 0.8:
-                n_slices = 3
-                slice_h = h // n_slices
-                crops = [img[i:i+slice_h] for i in range(0, h, slice_h)]
-        
-        # 檢查是否裁切過碎
-        if len(crops) > 3:
-            avg_crop_h = sum(crop.shape[0] for crop in crops) / len(crops)
-            if avg_crop_h < 950:  # 提高門檻
-                n_slices = 2 if h < 3500 else 3  # 中圖鎖在 2 片
-                slice_h = h // n_slices
-                crops = [img[i:i+slice_h] for i in range(0, h, slice_h)]
-        
-        # 合併過小的相鄰片段
-        merged_crops = []
-        i = 0
-        while i < len(crops):
-            if i < len(crops) - 1 and crops[i].shape[0] < 350:
-                # 合併當前片段和下一片段
-                merged = np.vstack((crops[i], crops[i+1]))
-                merged_crops.append(merged)
-                i += 2
-            else:
-                merged_crops.append(crops[i])
-                i += 1
-        
+        plan = plan_crop(img, align, align_x)
+        t, b, l, r = plan.params["trim"]
         return {
             "success": True,
-            "crops": merged_crops,
-            "height": h,
-            "width": w
+            "crops": list(plan.iter_crops(img)),
+            "boxes": [spec.parts for spec in plan.crops],
+            "plan": plan,
+            "height": plan.height - t - b,
+            "width": plan.width - l - r
         }
         
     except Exception as e:
@@ -376,14 +183,10 @@ def get_all_images(base_dir: Path, exts: Tuple[str, ...]) -> List[Path]:
     except Exception as e:
         logging.warning(f"清理舊目錄時發生錯誤: {e}")
     
-    image_paths = []
-    for product_dir in www_dir.iterdir():
-        if product_dir.is_dir() and product_dir.name.startswith('product_'):
-            images_dir = product_dir / "images"
-            if images_dir.exists():
-                for ext in exts:
-                    image_paths.extend(images_dir.glob(f"*{ext}"))
-                
+    # 由庫存索引取得（只重讀有變動的檔案）；範圍同原本的 product_*/images 本層
+    image_paths = [p for p in image_inventory.scan(www_dir, exts)
+                   if p.parent.name == "images" and p.parent.parent.name.startswith("product_")
+                   and p.parent.parent.parent == www_dir]
     return image_paths
 
 def save_results(results: List[Dict[str, Any]], failed: List[Dict[str, Any]], args: argparse.Namespace) -> None:
@@ -404,8 +207,118 @@ def save_results(results: List[Dict[str, Any]], failed: List[Dict[str, Any]], ar
             json.dump(to_serializable(failed), f, ensure_ascii=False, indent=2)
         logging.info(f"失敗記錄已儲存至 {failed_file}")
 
-def process_image(img_path: Path, args: argparse.Namespace) -> Dict[str, Any]:
-    """處理單張圖片"""
+def _write_crop(img_path: Path, out_path: Path, spec: CropSpec, crop: np.ndarray,
+                lossless: bool, entry: Dict[str, Any]) -> None:
+    """寫出單一裁片，結果記錄在 entry["lossless"]"""
+    done = lossless and spec.contiguous and lossless_crop(img_path, out_path, spec.parts[0])
+    if not done:
+        cv2.imwrite(str(out_path), crop)
+    entry["lossless"] = done
+
+def write_crops(plan: CropPlan, img: np.ndarray, img_path: Path, out_dir: Path,
+                lossless: bool = False, writer: Optional[CropWriter] = None) -> List[Dict[str, Any]]:
+    """
+    依裁切計畫寫出裁片；lossless 時相鄰區間的 JPEG 裁片走無損路徑。
+    有 writer 時交給編碼階段非同步寫出（lossless 欄位於寫完後才填入）。
+    """
+    crops = []
+    for i, spec in enumerate(plan.crops):
+        out_path = out_dir / f"{img_path.stem}_crop{i+1}{img_path.suffix}"
+        entry = {
+            "path": str(out_path),
+            "height": spec.height,
+            "width": spec.width,
+            "lossless": False
+        }
+        if writer is None:
+            _write_crop(img_path, out_path, spec, plan.materialize(img, i), lossless, entry)
+        elif lossless and spec.contiguous:
+            writer.submit_call(out_path, _write_crop, img_path, out_path, spec,
+                               plan.materialize(img, i), lossless, entry)
+        else:
+            writer.submit(out_path, plan.materialize(img, i))
+        crops.append(entry)
+    return crops
+
+def _header_height(img_path: Path) -> int:
+    try:
+        return stream_crop.image_size(img_path)[1]
+    except Exception:
+        return 0
+
+def _job_footprint(img_path: Path, args: argparse.Namespace,
+                   dims: Optional[Dict[Path, Tuple[int, int]]] = None) -> int:
+    """串流的超長圖只需 strip + 片段緩衝；其餘以整張解碼估計（有索引尺寸就不重開檔頭）"""
+    if dims and img_path in dims:
+        w, h = dims[img_path]
+        cost = w * h * FOOTPRINT_BYTES_PER_PX
+    else:
+        cost = estimate_footprint(img_path)
+        w = h = None
+    if args.stream_above and stream_crop.pyvips is not None:
+        if h is None:
+            try:
+                w, h = stream_crop.image_size(img_path)
+            except Exception:
+                return cost
+        if h > args.stream_above:
+            return w * (args.strip_height + stream_crop.MAX_SEGMENT) * FOOTPRINT_BYTES_PER_PX
+    return cost
+
+def process_image_streaming(img_path: Path, args: argparse.Namespace,
+                            writer: Optional[CropWriter] = None) -> Dict[str, Any]:
+    """超長圖：逐 strip 解碼與分析，片段一確定就寫出（記憶體只與 strip 高度相關）"""
+    try:
+        w, h = stream_crop.image_size(img_path)
+        plan = CropPlan.for_source(img_path, h, w, detector="batch_runner.stream_crop",
+                                   params={"strip_h": args.strip_height, "trim": [0, 0, 0, 0]})
+        out_dir = None
+        crops = []
+        segments = stream_crop.stream_crop(
+            img_path, strip_h=args.strip_height, min_crop_h=MIN_CROP_HEIGHT,
+            # 串流時不以整張高度的 10% 判斷碎片（數萬 px 的圖會把所有片段都丟掉）
+            keep=lambda seg, orig_h: not small_fragment(seg, 0))
+        for i, (y0, y1, seg) in enumerate(segments):
+            plan.crops.append(CropSpec([(y0, y1, 0, w)]))
+            if getattr(args, "plan_only", False):
+                continue
+            if out_dir is None:
+                out_dir = img_path.parent / "cropped"
+                out_dir.mkdir(parents=True, exist_ok=True)
+            out_path = out_dir / f"{img_path.stem}_crop{i+1}{img_path.suffix}"
+            if writer is None:
+                cv2.imwrite(str(out_path), seg)
+            else:
+                writer.submit(out_path, seg)
+            crops.append({
+                "path": str(out_path),
+                "height": y1 - y0,
+                "width": w,
+                "lossless": False
+            })
+
+        record = {
+            "path": str(img_path),
+            "plan": plan.to_dict(),
+            "height": h,
+            "width": w
+        }
+        if not getattr(args, "plan_only", False):
+            record["crops"] = crops
+        return record
+
+    except Exception as e:
+        logging.error(f"串流處理圖片失敗: {img_path} - {str(e)}")
+        return {
+            "path": str(img_path),
+            "error": str(e)
+        }
+
+def process_image(img_path: Path, args: argparse.Namespace,
+                  writer: Optional[CropWriter] = None) -> Dict[str, Any]:
+    """處理單張圖片（有 writer 時只做偵測，裁片交給編碼階段）"""
+    if getattr(args, "stream_above", 0) and _header_height(img_path) > args.stream_above:
+        return process_image_streaming(img_path, args, writer)
     try:
         # 嘗試讀取圖片，最多重試3次
         img = None
@@ -422,33 +335,37 @@ def process_image(img_path: Path, args: argparse.Namespace) -> Dict[str, Any]:
         if img is None or img.size == 0:  # 使用 size 而不是 empty
             raise ValueError(f"無法讀取圖片: {img_path}")
             
-        # 建立輸出目錄
-        out_dir = img_path.parent / "cropped"
-        out_dir.mkdir(parents=True, exist_ok=True)
-        
-        # 裁切圖片
-        result = smart_crop(img)
-        
-        if not result["success"]:
-            raise ValueError(result["error"])
-        
-        # 儲存裁切後的圖片
-        crops = []
-        for i, crop in enumerate(result["crops"]):
-            out_path = out_dir / f"{img_path.stem}_crop{i+1}{img_path.suffix}"
-            cv2.imwrite(str(out_path), crop)
-            crops.append({
-                "path": str(out_path),
-                "height": crop.shape[0],
-                "width": crop.shape[1]
-            })
+        # 無損模式：JPEG 來源的切線對齊 MCU 高度
+        mcu = None
+        if getattr(args, "lossless", False) and img_path.suffix.lower() in JPEG_EXTS:
+            # cv2.imread 已依 EXIF 轉正，DCT 係數卻沒有：帶旋轉標籤的來源改走重新編碼
+            if exif_orientation(img_path) == 1:
+                mcu = read_mcu_size(img_path)
+            else:
+                logging.info(f"EXIF 旋轉標籤不為 1，不使用無損裁切: {img_path}")
+
+        # 偵測切線（只產生計畫，不複製像素）
+        if mcu:
+            plan = plan_crop(img, align=mcu[1], align_x=mcu[0], source=img_path)
+        else:
+            plan = plan_crop(img, source=img_path)
+        t, b, l, r = plan.params["trim"]
         
-        return {
+        record = {
             "path": str(img_path),
-            "crops": crops,
-            "height": result["height"],
-            "width": result["width"]
+            "plan": plan.to_dict(),
+            "height": plan.height - t - b,
+            "width": plan.width - l - r
         }
+        if getattr(args, "plan_only", False):
+            return record
+
+        # 寫出裁片
+        out_dir = img_path.parent / "cropped"
+        out_dir.mkdir(parents=True, exist_ok=True)
+        record["crops"] = write_crops(plan, img, img_path, out_dir,
+                                     lossless=mcu is not None, writer=writer)
+        return record
         
     except Exception as e:
         logging.error(f"處理圖片失敗: {img_path} - {str(e)}")
@@ -466,9 +383,25 @@ def cli() -> argparse.Namespace:
                   help="白色區域判定比例（預設 0.03）")
     p.add_argument("--workers", type=int, 
                   default=min(32, (os.cpu_count() or 4)*4),
-                  help="並行處理數（預設 CPU核心數×4）")
+                  help="並行處理數上限（預設 CPU核心數×4，實際並行數依 CPU/RSS 自動調整）")
+    p.add_argument("--mem-budget", type=int, default=None, metavar="MB",
+                  help="解碼中圖片的記憶體預算（MB，預設為實體記憶體的一半）")
     p.add_argument("--ext", default="jpg,jpeg,png",
                   help="要處理的副檔名（預設 jpg,jpeg,png）")
+    p.add_argument("--encode-workers", type=int, default=min(8, os.cpu_count() or 4),
+                  help="編碼/寫檔階段的 worker 數（預設 min(8, CPU核心數)；0 = 偵測 worker 直接寫檔）")
+    p.add_argument("--encode-queue", type=int, default=64,
+                  help="待編碼裁片的佇列上限（預設 64）")
+    p.add_argument("--encode", action="append", default=[], metavar="FMT:K=V,...",
+                  help="各格式編碼參數，可重複指定，例如 jpg:quality=92、webp:quality=90")
+    p.add_argument("--stream-above", type=int, default=0, metavar="PX",
+                  help="高度超過此值的圖片改用 strip 串流處理（預設 0 = 關閉）")
+    p.add_argument("--strip-height", type=int, default=stream_crop.STRIP_HEIGHT,
+                  help=f"串流模式每個 strip 的高度（預設 {stream_crop.STRIP_HEIGHT}）")
+    p.add_argument("--plan-only", action="store_true",
+                  help="只輸出裁切計畫（crop_meta.json 內的 plan），不寫出裁片")
+    p.add_argument("--lossless", action="store_true",
+                  help="JPEG 來源切線對齊 MCU，並以 DCT 係數無損裁切（需 PyTurboJPEG 或 jpegtran）")
     return p.parse_args()
 
 def main():
@@ -518,29 +451,43 @@ def main():
     
     logging.info(f"找到 {len(image_paths)} 張圖片需要處理")
     
-    # 使用線程池處理圖片
+    # 偵測與編碼分成兩個 worker pool：偵測端把裁片丟進有上限的編碼佇列
     results = []
     failed = []
-    with ThreadPoolExecutor(max_workers=args.workers) as executor:
-        future_map = {executor.submit(process_image, p, args): p for p in image_paths}
-        
-        for i, future in enumerate(as_completed(future_map), 1):
-            try:
-                result = future.result()
-                if "error" in result:
-                    failed.append(result)
-                else:
-                    results.append(result)
-                logging.info(f"完成處理: {future_map[future].name}")
-            except Exception as e:
-                logging.error(f"處理圖片 {future_map[future]} 時發生錯誤: {e}")
-                failed.append({
-                    "path": str(future_map[future]),
-                    "error": str(e)
-                })
+    writer = None
+    if args.encode_workers > 0:
+        writer = CropWriter(args.encode_workers, args.encode_queue, parse_encode_settings(args.encode))
+    t_detect = time.time()
+    with image_inventory.Inventory() as inv:
+        dims = inv.dimensions(image_paths)
+    scheduler = MemoryBudgetScheduler(args.mem_budget, args.workers)
+    for img_path, future in scheduler.run(process_image, image_paths, args, writer,
+                                          estimate=lambda p: _job_footprint(p, args, dims)):
+        try:
+            result = future.result()
+            if "error" in result:
+                failed.append(result)
+            else:
+                results.append(result)
+            logging.info(f"完成處理: {img_path.name}")
+        except Exception as e:
+            logging.error(f"處理圖片 {img_path} 時發生錯誤: {e}")
+            failed.append({
+                "path": str(img_path),
+                "error": str(e)
+            })
+    detect_secs = time.time() - t_detect
+    logging.info(f"偵測: {len(image_paths)} 張 / {detect_secs:.2f} 秒，"
+                 f"{len(image_paths) / detect_secs if detect_secs else 0:.1f} 張/秒")
+    if writer is not None:
+        writer.close()
+        failed.extend(writer.stats["failed"])
+        logging.info(writer.report())
     
     # 儲存結果
     save_results(results, failed, args)
+    with open(results_dir / "scheduler_metrics.json", "w", encoding="utf-8") as f:
+        json.dump(scheduler.metrics, f, ensure_ascii=False, indent=2)
     
     # 輸出統計資訊
     logging.info(f"處理完成！成功: {len(results)} 張，失敗: {len(failed)} 張")
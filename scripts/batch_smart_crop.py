@@ -3,15 +3,18 @@
 """
 批次裁切 /WWW_Collection 內所有圖片：
   1. 先用灰階投影法找水平留白，切長圖
-  2. 再用 smartcrop.py 對每一塊找「構圖最佳」的矩形
+  2. 再用 SmartCrop 評分對每一塊找「構圖最佳」的矩形
+     （fast_smartcrop：縮小副本 + 積分影像計分，結果依 strip 內容雜湊快取）
   3. 存 WebP、寫 JSON
 """
 
 import cv2, json, os, shutil, time
+import numpy as np
 from pathlib import Path
 from concurrent.futures import ThreadPoolExecutor, as_completed
 
-from smartcrop import SmartCrop
+from crop_writer import CropWriter
+from fast_smartcrop import cached_top_crop, load_cache, save_cache
 from PIL import Image
 from tqdm import tqdm
 
@@ -20,10 +23,14 @@ BASE_DIR   = Path(__file__).resolve().parent
 ROOT_DIR   = BASE_DIR.parent / "products" / "WWW_Collection"
 OUT_DIR    = BASE_DIR / "results" / "cropped"
 META_FILE  = BASE_DIR / "results" / "crop_meta.json"
+SMARTCROP_CACHE = BASE_DIR / "results" / "smartcrop_cache.json"   # strip 內容雜湊 → 最佳框
 MAX_WORKER = min(32, os.cpu_count() * 4)
 MIN_H_PX   = 300                 # 單塊高度門檻
 TARGET_W   = 1000                # smartcrop 目標寬
 TARGET_H   = 1000                # smartcrop 目標高
+ENCODE_WORKER = min(8, os.cpu_count())   # WebP 編碼/寫檔 worker
+ENCODE_QUEUE  = 64                       # 待編碼裁片上限
+WEBP_SETTINGS = {"quality": 90, "method": 6}
 # -------------------------------------
 
 def is_blank_row(row, dark_ratio_th=0.02):
@@ -51,14 +58,14 @@ def detect_cut_lines(gray, min_gap=40):
             merged.append(y)
     return merged
 
-def smart_crop_piece(pil_img):
-    crop = SmartCrop().crop(pil_img, width=TARGET_W, height=TARGET_H)
-    box  = crop["top_crop"]
-    x, y = box["x"], box["y"]
-    w, h = box["width"], box["height"]
+def smart_crop_piece(pil_img, rgb=None):
+    """rgb 為 pil_img 的 RGB 陣列（已有時傳入可省一次轉換）"""
+    if rgb is None:
+        rgb = np.asarray(pil_img.convert("RGB"))
+    x, y, w, h = cached_top_crop(rgb, TARGET_W, TARGET_H)
     return pil_img.crop((x, y, x + w, y + h))
 
-def process_one(path: Path):
+def process_one(path: Path, writer: CropWriter = None):
     try:
         img_bgr = cv2.imread(str(path))
         if img_bgr is None:
@@ -79,14 +86,18 @@ def process_one(path: Path):
 
             piece = img_bgr[y0:y1, :]
             # PIL 走 RGB
-            pil_piece = Image.fromarray(cv2.cvtColor(piece, cv2.COLOR_BGR2RGB))
-            cropped   = smart_crop_piece(pil_piece)
+            rgb_piece = cv2.cvtColor(piece, cv2.COLOR_BGR2RGB)
+            pil_piece = Image.fromarray(rgb_piece)
+            cropped   = smart_crop_piece(pil_piece, rgb_piece)
 
             rel_dir   = OUT_DIR / path.relative_to(ROOT_DIR).parent
             rel_dir.mkdir(parents=True, exist_ok=True)
             out_name  = f"{path.stem}_crop_{idx}.webp"
             out_path  = rel_dir / out_name
-            cropped.save(out_path, "webp", quality=90, method=6)
+            if writer is None:
+                cropped.save(out_path, "webp", **WEBP_SETTINGS)
+            else:
+                writer.submit(out_path, cropped, WEBP_SETTINGS)
 
             out_meta.append({
                 "path": str(out_path),
@@ -107,12 +118,23 @@ def main():
 
     img_paths = [p for p in ROOT_DIR.rglob("*") if p.suffix.lower() in (".jpg", ".jpeg", ".png", ".webp")]
     results   = []
+    n_cached  = load_cache(SMARTCROP_CACHE)
+    if n_cached:
+        print(f"載入 SmartCrop 快取 {n_cached} 筆")
 
+    # 偵測（含 smartcrop）與 WebP 編碼分屬不同 worker pool
+    writer = CropWriter(ENCODE_WORKER, ENCODE_QUEUE)
+    t_detect = time.time()
     with ThreadPoolExecutor(MAX_WORKER) as exe:
-        futures = {exe.submit(process_one, p): p for p in img_paths}
+        futures = {exe.submit(process_one, p, writer): p for p in img_paths}
         for fut in tqdm(as_completed(futures), total=len(futures), desc="Processing"):
             res = fut.result()
             if res: results.append(res)
+    detect_secs = time.time() - t_detect
+    writer.close()
+    save_cache(SMARTCROP_CACHE)
+    print(f"偵測: {len(img_paths)} 張 / {detect_secs:.1f}s")
+    print(writer.report())
 
     META_FILE.parent.mkdir(exist_ok=True)
     with META_FILE.open("w", encoding="utf-8") as f:
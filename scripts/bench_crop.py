@@ -0,0 +1,441 @@
+#!/usr/bin/env python3
+"""
+裁切效能基準測試
+================
+
+量測每個裁切引擎 / preset 在三個階段的耗時：
+
+    decode  讀檔 bytes → cv2.imdecode
+    detect  CropEngine.plan（串流模式則為整個 stream_crop，內含 strip 解碼；
+            analyze_images 為 ImageAnalyzer.analyze_content）
+    encode  每個裁片 cv2.imencode（不寫檔，只量編碼）
+
+並回報 images/s、每階段平均毫秒與峰值 RSS，結果存成 JSON，
+可與先前存下的 baseline 比較，判斷某次修改讓裁切變快或變慢。
+
+`--memory` 另以 tracemalloc 量測每張圖偵測/分析階段的配置峰值（numpy 與 cv2
+輸出陣列都會被追蹤），回報 MB 與 bytes/px，長圖最能看出暫存陣列的差異。
+
+資料集
+------
+* synthetic：產生模擬詳情頁（商品照片、白/灰分隔帶、文字區塊堆疊），
+  高度 1k ~ 40k px，同一 seed 產生的圖完全相同，快取在 `--synthetic-dir`。
+* corpus：從 products/WWW_Collection 隨機抽樣真實圖片（排除既有的 -cropNN 裁片）。
+
+使用範例
+--------
+$ python bench_crop.py --dataset synthetic --heights 1000,5000,20000,40000
+$ python bench_crop.py --dataset corpus --sample 50 --out results/bench/after.json \\
+      --baseline results/bench/before.json
+$ python bench_crop.py --heights 5000,20000,40000 --memory --engines analyze_images,cropper.sobel
+"""
+
+import argparse
+import json
+import logging
+import os
+import platform
+import random
+import re
+import threading
+import time
+import tracemalloc
+from datetime import datetime
+from pathlib import Path
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+import cv2
+import numpy as np
+
+from crop_engine import PRESETS, CropEngine
+from scheduler import current_rss
+import stream_crop
+
+log = logging.getLogger("bench_crop")
+
+BASE_DIR = Path(__file__).parent.parent
+CORPUS_DIR = BASE_DIR / "products" / "WWW_Collection"
+BENCH_DIR = BASE_DIR / "results" / "bench"
+
+SYNTH_WIDTH = 790                     # 詳情頁常見寬度
+SYNTH_HEIGHTS = (1000, 3000, 8000, 20000, 40000)
+RSS_INTERVAL = 0.01                   # 秒：RSS 取樣間隔
+ENCODE_EXT = ".webp"
+CROP_FILE_RE = re.compile(r"-crop\d+$", re.IGNORECASE)
+
+# ───────────────────────────── 合成詳情頁
+
+def _photo(rng: np.random.Generator, h: int, w: int) -> np.ndarray:
+    """模擬商品照：雙向漸層底 + 數個實心形狀 + 雜訊"""
+    c0, c1 = rng.integers(30, 226, 3), rng.integers(30, 226, 3)
+    t = np.linspace(0, 1, h, dtype=np.float32)[:, None, None]
+    s = np.linspace(0, 1, w, dtype=np.float32)[None, :, None]
+    img = (c0 * (1 - t) * (1 - s / 2) + c1 * t * (0.5 + s / 2)).astype(np.uint8)
+    for _ in range(rng.integers(2, 6)):
+        color = tuple(int(v) for v in rng.integers(0, 256, 3))
+        cx, cy = int(rng.integers(0, w)), int(rng.integers(0, h))
+        r = int(rng.integers(min(h, w) // 10 + 1, min(h, w) // 3 + 2))
+        if rng.random() < 0.5:
+            cv2.circle(img, (cx, cy), r, color, -1)
+        else:
+            cv2.rectangle(img, (cx - r, cy - r // 2), (cx + r, cy + r // 2), color, -1)
+    noise = rng.integers(-8, 9, img.shape, dtype=np.int16)
+    return np.clip(img.astype(np.int16) + noise, 0, 255).astype(np.uint8)
+
+
+def _text_block(rng: np.random.Generator, h: int, w: int) -> np.ndarray:
+    """白底黑字的說明文字區塊"""
+    img = np.full((h, w, 3), 255, np.uint8)
+    line_h = int(rng.integers(28, 48))
+    scale = line_h / 40
+    for y in range(line_h, h - 8, line_h):
+        words = "".join(chr(int(c)) for c in rng.integers(65, 91, int(rng.integers(12, 40))))
+        cv2.putText(img, words, (int(0.05 * w), y), cv2.FONT_HERSHEY_SIMPLEX, scale,
+                    (30, 30, 30), max(1, int(2 * scale)), cv2.LINE_AA)
+    return img
+
+
+def synth_detail_page(height: int, width: int = SYNTH_WIDTH, seed: int = 0) -> np.ndarray:
+    """
+    產生高度為 height 的合成詳情頁（BGR）：
+    照片 / 文字區塊交錯，中間夾白色或淺灰分隔帶，上下留白邊。
+    """
+    rng = np.random.default_rng(seed)
+    blocks: List[np.ndarray] = [np.full((int(rng.integers(0, 40)), width, 3), 255, np.uint8)]
+    total = len(blocks[0])
+    while total < height:
+        if rng.random() < 0.3:
+            block = _text_block(rng, int(rng.integers(80, 400)), width)
+        else:
+            block = _photo(rng, int(rng.integers(300, 1400)), width)
+        gap_h = int(rng.integers(6, 80))
+        gap = 255 if rng.random() < 0.7 else int(rng.integers(225, 245))
+        blocks += [block, np.full((gap_h, width, 3), gap, np.uint8)]
+        total += len(block) + gap_h
+    return np.vstack(blocks)[:height]
+
+
+def synthetic_dataset(heights: List[int], out_dir: Path, width: int = SYNTH_WIDTH,
+                      quality: int = 92) -> List[Path]:
+    """產生（或沿用快取的）合成詳情頁 JPEG，回傳路徑列表"""
+    out_dir.mkdir(parents=True, exist_ok=True)
+    paths = []
+    for i, h in enumerate(heights):
+        path = out_dir / f"synth_{width}x{h}_s{i}.jpg"
+        if not path.exists():
+            cv2.imwrite(str(path), synth_detail_page(h, width, seed=i),
+                        [cv2.IMWRITE_JPEG_QUALITY, quality])
+        paths.append(path)
+    return paths
+
+
+def corpus_sample(root: Path, n: int, seed: int = 0,
+                  exts: Tuple[str, ...] = (".jpg", ".jpeg", ".png")) -> List[Path]:
+    """從真實資料夾抽樣 n 張原圖（排除手動裁好的 -cropNN 檔）"""
+    paths = sorted(p for p in root.rglob("*")
+                   if p.suffix.lower() in exts and not CROP_FILE_RE.search(p.stem))
+    if n and n < len(paths):
+        paths = sorted(random.Random(seed).sample(paths, n))
+    return paths
+
+# ───────────────────────────── 量測工具
+
+class RssSampler:
+    """背景執行緒定期取樣 RSS，記錄區間內的峰值"""
+
+    def __init__(self, interval: float = RSS_INTERVAL):
+        self.interval = interval
+        self.start = self.peak = current_rss()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._loop, daemon=True)
+
+    def _loop(self) -> None:
+        while not self._stop.wait(self.interval):
+            self.peak = max(self.peak, current_rss())
+
+    def __enter__(self) -> "RssSampler":
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self._stop.set()
+        self._thread.join()
+        self.peak = max(self.peak, current_rss())
+
+
+def _encode(crops: List[np.ndarray]) -> int:
+    """編碼所有裁片，回傳總 bytes"""
+    total = 0
+    for crop in crops:
+        ok, buf = cv2.imencode(ENCODE_EXT, np.ascontiguousarray(crop))
+        total += len(buf) if ok else 0
+    return total
+
+# ───────────────────────────── 引擎
+
+def _engine_runner(name: str) -> Callable[[Path], Dict[str, float]]:
+    """整張模式：decode → CropEngine.plan → encode"""
+    engine = CropEngine(name)
+
+    def run(path: Path) -> Dict[str, float]:
+        t0 = time.perf_counter()
+        img = cv2.imdecode(np.fromfile(str(path), np.uint8), cv2.IMREAD_COLOR)
+        t1 = time.perf_counter()
+        plan = engine.plan(img)
+        crops = list(plan.iter_crops(img))
+        t2 = time.perf_counter()
+        size = _encode(crops)
+        t3 = time.perf_counter()
+        return {"decode": t1 - t0, "detect": t2 - t1, "encode": t3 - t2,
+                "crops": len(crops), "bytes": size, "pixels": img.shape[0] * img.shape[1]}
+    return run
+
+
+def _stream_runner(path: Path) -> Dict[str, float]:
+    """串流模式：strip 解碼與偵測交錯進行，全部計入 detect"""
+    w, h = stream_crop.image_size(path)
+    t0 = time.perf_counter()
+    crops = [crop for _, _, crop in stream_crop.stream_crop(path)]
+    t1 = time.perf_counter()
+    size = _encode(crops)
+    t2 = time.perf_counter()
+    return {"decode": 0.0, "detect": t1 - t0, "encode": t2 - t1,
+            "crops": len(crops), "bytes": size, "pixels": w * h}
+
+
+def _analyze_runner() -> Callable[[Path], Dict[str, float]]:
+    """analyze_images 的區域分析：decode → ImageAnalyzer.analyze_content（無編碼階段）"""
+    import analyze_images   # 延遲匯入：import 時會設定 logging
+    analyzer = analyze_images.ImageAnalyzer()
+
+    def run(path: Path) -> Dict[str, float]:
+        t0 = time.perf_counter()
+        img = analyzer.read_image(path)
+        t1 = time.perf_counter()
+        result = analyzer.analyze_content(img) or {}
+        t2 = time.perf_counter()
+        return {"decode": t1 - t0, "detect": t2 - t1, "encode": 0.0,
+                "crops": len(result.get("regions", [])), "bytes": 0,
+                "pixels": img.shape[0] * img.shape[1]}
+    return run
+
+
+def engines() -> Dict[str, Callable[[Path], Dict[str, float]]]:
+    """可量測時間的引擎：每個 crop_engine preset、stream_crop 與 analyze_images"""
+    available = {f"preset:{n}": _engine_runner(n) for n in PRESETS}
+    available["stream_crop"] = _stream_runner
+    available["analyze_images"] = _analyze_runner()
+    return available
+
+# ───────────────────────────── 記憶體配置
+
+def alloc_peak(fn: Callable[..., Any], *args) -> int:
+    """fn(*args) 執行期間 tracemalloc 記錄到的配置峰值（bytes）"""
+    tracemalloc.start()
+    try:
+        tracemalloc.reset_peak()
+        fn(*args)
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def _drain(it: Any) -> None:
+    for _ in it:
+        pass
+
+
+def alloc_targets() -> Dict[str, Callable[[Path], int]]:
+    """記憶體量測對象；解碼在量測之外進行（串流模式除外，strip 解碼本來就是它的一部分）"""
+    import analyze_images   # 延遲匯入：這兩個模組 import 時會設定 logging / matplotlib
+    import cropper
+
+    def _bgr(path: Path) -> np.ndarray:
+        return cv2.imdecode(np.fromfile(str(path), np.uint8), cv2.IMREAD_COLOR)
+
+    targets: Dict[str, Callable[[Path], int]] = {
+        f"preset:{n}": (lambda path, e=CropEngine(n): alloc_peak(e.plan, _bgr(path))) for n in PRESETS
+    }
+    targets["stream_crop"] = lambda path: alloc_peak(_drain, stream_crop.stream_crop(path))
+    targets["cropper.sobel"] = lambda path: alloc_peak(cropper.detect_cut_lines_sobel,
+                                                       cv2.cvtColor(_bgr(path), cv2.COLOR_BGR2GRAY))
+    analyzer = analyze_images.ImageAnalyzer()
+    targets["analyze_images"] = lambda path: alloc_peak(analyzer.analyze_content, analyzer.read_image(path))
+    return targets
+
+
+def bench_memory(paths: List[Path], names: Optional[List[str]] = None) -> Dict[str, Any]:
+    """每個對象、每張圖的配置峰值"""
+    out = {}
+    for name, measure in alloc_targets().items():
+        if names and name not in names:
+            continue
+        log.info(f"量測配置峰值 {name}（{len(paths)} 張）")
+        per_image = []
+        for path in paths:
+            w, h = stream_crop.image_size(path)
+            peak = measure(path)
+            per_image.append({"path": path.name, "mpx": round(w * h / 1e6, 2),
+                              "peak_mb": round(peak / 2**20, 2), "bytes_per_px": round(peak / (w * h), 2)})
+        out[name] = {
+            "peak_mb_max": max(r["peak_mb"] for r in per_image),
+            "bytes_per_px": round(sum(r["bytes_per_px"] for r in per_image) / len(per_image), 2),
+            "per_image": per_image,
+        }
+    return out
+
+# ───────────────────────────── 執行
+
+def bench_engine(run: Callable[[Path], Dict[str, float]], paths: List[Path],
+                 repeat: int = 1, warmup: bool = True) -> Dict[str, Any]:
+    """對一組圖片量測單一引擎，回傳彙總統計"""
+    if warmup and paths:
+        run(paths[0])
+    stages = {"decode": 0.0, "detect": 0.0, "encode": 0.0}
+    crops = size = pixels = 0
+    per_image = []
+    with RssSampler() as rss:
+        t0 = time.perf_counter()
+        for _ in range(repeat):
+            for path in paths:
+                r = run(path)
+                for k in stages:
+                    stages[k] += r[k]
+                crops += r["crops"]
+                size += r["bytes"]
+                pixels += r["pixels"]
+                per_image.append({"path": path.name, **{k: round(r[k] * 1000, 2) for k in stages}})
+        wall = time.perf_counter() - t0
+    n = len(paths) * repeat
+    return {
+        "images": n,
+        "wall_seconds": round(wall, 3),
+        "images_per_sec": round(n / wall, 3) if wall else 0.0,
+        "mpx_per_sec": round(pixels / 1e6 / wall, 2) if wall else 0.0,
+        "stage_ms": {k: round(v * 1000 / n, 2) for k, v in stages.items()} if n else {},
+        "crops": crops,
+        "encoded_mb": round(size / 2**20, 2),
+        "rss_start_mb": round(rss.start / 2**20, 1),
+        "rss_peak_mb": round(rss.peak / 2**20, 1),
+        "per_image_ms": per_image,
+    }
+
+
+def run_bench(paths: List[Path], names: Optional[List[str]] = None, repeat: int = 1,
+              dataset: str = "", memory: bool = False) -> Dict[str, Any]:
+    results = {
+        "created": datetime.now().isoformat(),
+        "dataset": dataset,
+        "images": [str(p) for p in paths],
+        "repeat": repeat,
+        "machine": {"python": platform.python_version(), "opencv": cv2.__version__,
+                    "numpy": np.__version__, "cpus": os.cpu_count(), "platform": platform.platform()},
+        "engines": {},
+    }
+    timed = engines()
+    if names:
+        known = set(timed) | (set(alloc_targets()) if memory else set())
+        unknown = [n for n in names if n not in known]
+        if unknown:
+            raise ValueError(f"未知的引擎: {unknown}（可用: {sorted(known)}）")
+    for name, run in timed.items():
+        if names and name not in names:
+            continue
+        log.info(f"量測 {name}（{len(paths)} 張 × {repeat}）")
+        results["engines"][name] = bench_engine(run, paths, repeat)
+    if memory:
+        results["memory"] = bench_memory(paths, names)
+    return results
+
+# ───────────────────────────── 報表
+
+def report(results: Dict[str, Any], baseline: Optional[Dict[str, Any]] = None) -> str:
+    """文字表格；有 baseline 時附上 images/s 與 detect 的倍率（> 1 表示變快）"""
+    header = f"{'engine':<22}{'img/s':>9}{'decode':>9}{'detect':>9}{'encode':>9}{'crops':>7}{'RSS MB':>9}"
+    if baseline:
+        header += f"{'speedup':>9}{'detect×':>9}"
+    lines = [header, "-" * len(header)]
+    for name, r in results["engines"].items():
+        st = r["stage_ms"]
+        row = (f"{name:<22}{r['images_per_sec']:>9.2f}{st['decode']:>9.1f}{st['detect']:>9.1f}"
+               f"{st['encode']:>9.1f}{r['crops']:>7}{r['rss_peak_mb']:>9.0f}")
+        base = (baseline or {}).get("engines", {}).get(name)
+        if base:
+            speed = r["images_per_sec"] / base["images_per_sec"] if base["images_per_sec"] else 0.0
+            det = base["stage_ms"]["detect"] / st["detect"] if st["detect"] else 0.0
+            row += f"{speed:>8.2f}×{det:>8.2f}×"
+            if base["crops"] != r["crops"]:
+                row += f"  (裁片數 {base['crops']} → {r['crops']})"
+        lines.append(row)
+
+    memory = results.get("memory")
+    if memory:
+        header = f"{'配置峰值':<20}{'max MB':>10}{'B/px':>9}"
+        if baseline:
+            header += f"{'基準 B/px':>11}{'減少':>8}"
+        lines += ["", header, "-" * (len(header) + 4)]
+        for name, m in memory.items():
+            row = f"{name:<24}{m['peak_mb_max']:>10.1f}{m['bytes_per_px']:>9.2f}"
+            base = (baseline or {}).get("memory", {}).get(name)
+            if base:
+                cut = 1 - m["bytes_per_px"] / base["bytes_per_px"] if base["bytes_per_px"] else 0.0
+                row += f"{base['bytes_per_px']:>11.2f}{cut:>8.0%}"
+            lines.append(row)
+    return "\n".join(lines)
+
+# ───────────────────────────── CLI
+
+def cli() -> argparse.Namespace:
+    p = argparse.ArgumentParser(description="裁切引擎效能基準測試")
+    p.add_argument("--dataset", choices=("synthetic", "corpus"), default="synthetic",
+                   help="synthetic = 合成詳情頁；corpus = 抽樣真實圖片（預設 synthetic）")
+    p.add_argument("--heights", default=",".join(map(str, SYNTH_HEIGHTS)),
+                   help=f"合成圖高度（逗號分隔，預設 {','.join(map(str, SYNTH_HEIGHTS))}）")
+    p.add_argument("--width", type=int, default=SYNTH_WIDTH, help=f"合成圖寬度（預設 {SYNTH_WIDTH}）")
+    p.add_argument("--synthetic-dir", type=Path, default=BENCH_DIR / "synthetic",
+                   help="合成圖快取資料夾")
+    p.add_argument("--corpus", type=Path, default=CORPUS_DIR, help="真實圖片根目錄")
+    p.add_argument("--sample", type=int, default=40, help="真實圖片抽樣張數（0 = 全部）")
+    p.add_argument("--seed", type=int, default=0, help="抽樣亂數種子")
+    p.add_argument("--engines", default="",
+                   help="只量測這些引擎（逗號分隔，例如 preset:batch_runner,stream_crop；"
+                        "--memory 另有 cropper.sobel）")
+    p.add_argument("--repeat", type=int, default=1, help="每張圖重複次數")
+    p.add_argument("--memory", action="store_true",
+                   help="另外量測每張圖偵測/分析階段的配置峰值（tracemalloc，較慢）")
+    p.add_argument("--out", type=Path, default=None, help="結果 JSON（預設 results/bench/<dataset>_<時間>.json）")
+    p.add_argument("--baseline", type=Path, default=None, help="與先前的結果 JSON 比較")
+    return p.parse_args()
+
+
+def main():
+    args = cli()
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
+
+    if args.dataset == "synthetic":
+        heights = [int(h) for h in args.heights.split(",") if h]
+        paths = synthetic_dataset(heights, args.synthetic_dir, args.width)
+    else:
+        paths = corpus_sample(args.corpus, args.sample, args.seed)
+    if not paths:
+        log.warning("沒有找到要量測的圖片")
+        return
+
+    names = [n for n in args.engines.split(",") if n] or None
+    results = run_bench(paths, names, args.repeat, args.dataset, args.memory)
+
+    out = args.out or BENCH_DIR / f"{args.dataset}_{datetime.now():%Y%m%d_%H%M%S}.json"
+    out.parent.mkdir(parents=True, exist_ok=True)
+    with open(out, "w", encoding="utf-8") as f:
+        json.dump(results, f, ensure_ascii=False, indent=2)
+
+    baseline = None
+    if args.baseline:
+        with open(args.baseline, "r", encoding="utf-8") as f:
+            baseline = json.load(f)
+    print(report(results, baseline))
+    log.info(f"結果已儲存: {out}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,6 +1,9 @@
+import fnmatch
 import json
 from pathlib import Path
 
+import image_inventory
+
 # --- 設定 ---
 BASE_DIR = Path(__file__).resolve().parent.parent
 WWW_DIR = BASE_DIR / "products" / "WWW_Collection"
@@ -23,6 +26,10 @@ def check_progress():
         print("在 'products/WWW_Collection' 中找不到任何 'product_*' 資料夾。")
         return
 
+    # 一次更新整個 WWW_Collection 的庫存索引，之後只查詢
+    inventory = image_inventory.Inventory()
+    inventory.refresh(WWW_DIR)
+
     for product_path in product_paths:
         if not product_path.is_dir():
             continue
@@ -35,7 +42,8 @@ def check_progress():
             continue
 
         # 1. 統計磁碟上的總裁切圖數量
-        disk_crops = list(images_dir.glob('*-crop*.jpg'))
+        disk_crops = [r for r in inventory.images(images_dir, exts=('.jpg',), crops=True, recursive=False)
+                      if fnmatch.fnmatchcase(r.path.name, image_inventory.LEGACY_CROP_GLOB)]
         disk_crop_count = len(disk_crops)
         total_disk_count += disk_crop_count
 
@@ -71,6 +79,7 @@ def check_progress():
         percentage = (total_analyzed_count / total_disk_count) * 100
         print(f"完成度: {percentage:.2f}%")
     
+    inventory.close()
     print("\n報告完畢。")
 
 
@@ -7,6 +7,9 @@ import google.generativeai as genai
 import base64
 from io import BytesIO
 
+import ai_cache
+import ai_payload
+
 # --- 設定 ---
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 
@@ -15,6 +18,7 @@ TARGET_PRODUCT_ID = "product_956"  # 指定要審查的產品
 WWW_DIR = PROJECT_ROOT / "products" / "WWW_Collection"
 PRODUCT_PATH = WWW_DIR / TARGET_PRODUCT_ID
 REPORT_FILE = PROJECT_ROOT / "scripts" / f"ai_review_report_{TARGET_PRODUCT_ID}.md"
+REVIEW_MODEL = 'gemini-1.5-flash'
 
 try:
     from config import GOOGLE_API_KEY
@@ -35,14 +39,9 @@ def image_to_base64(image_path, size=(200, 200)):
     except Exception:
         return None
 
-def analyze_single_image_with_ai(product_name, image_path):
-    """對單張圖片進行詳細分析，獲取其分類、摘要與文字區塊。"""
-    try:
-        logging.info(f"正在分析圖片：{image_path.name}")
-        model = genai.GenerativeModel('gemini-1.5-flash')
-        img = Image.open(image_path)
-        
-        prompt = f"""
+def build_review_prompt(product_name):
+    """單張圖片分析的 prompt（實際送出的文字也是 AI 回應快取鍵的一部分）。"""
+    return f"""
         你是一位頂尖的電商內容策略總監。我會提供給你一個產品「{product_name}」的一張特寫圖片。你的任務是為這張圖片，分配一個最符合其內容的『角色』(category)，並提供對應的分析。
 
         圖片角色分類如下:
@@ -60,12 +59,29 @@ def analyze_single_image_with_ai(product_name, image_path):
           "text_blocks": [{{ "type": "...", "content": "..." }}]
         }}
         """
-        
-        response = model.generate_content([prompt, f"檔名: {image_path.name}", img])
+
+def analyze_single_image_with_ai(product_name, image_path, cache=None):
+    """對單張圖片進行詳細分析，獲取其分類、摘要與文字區塊；已分析過的內容直接取用快取。"""
+    cache = cache or ai_cache.default_cache()
+    prompt = build_review_prompt(product_name)
+    try:
+        key = cache.key(image_path, prompt, REVIEW_MODEL)
+        cached = cache.get(key)
+        if cached is not None:
+            logging.info(f"AI 快取命中：{image_path.name}")
+            return cached
+
+        logging.info(f"正在分析圖片：{image_path.name}")
+        model = genai.GenerativeModel(REVIEW_MODEL)
+        image_part = ai_payload.prepare(image_path, "google").gemini_part()
+
+        response = model.generate_content([prompt, f"檔名: {image_path.name}", image_part])
         response.resolve()
         
         cleaned_text = response.text.strip().lstrip('```json').rstrip('```')
-        return json.loads(cleaned_text)
+        result = json.loads(cleaned_text)
+        cache.put(key, result, source=image_path.name)
+        return result
 
     except Exception as e:
         logging.error(f"分析圖片 {image_path.name} 失敗: {e}")
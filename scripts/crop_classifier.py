@@ -0,0 +1,268 @@
+#!/usr/bin/env python3
+"""
+裁片本機預分類
+==============
+
+update_json_with_crops 把每張裁片都送一次視覺模型，連一眼就知道答案的也一樣：
+整片空白或只有幾十像素的碎片。本模組以便宜的影像特徵先判一次，只有「很有把握」的
+空白與碎片在本機標註，其餘照常送 AI；另有一條白底規格表規則，只供評估：
+
+* 白色比例、彩度（飽和像素比例）、灰階標準差、Canny 邊緣密度；
+* 細水平線（表格橫線、尺寸標示線）與長垂直線的數量：以長條結構元素做 morphology
+  open，只留下跨幅夠長的線，再量線的粗細；
+* 文字帶比例：逐條水平帶套用 crop_engine.looks_like_text（與裁切流程同一套判斷）。
+
+目前的規則與信心分數：
+
+* `generic`（空白）：標準差與邊緣密度都極低；
+* `generic`（碎片）：短邊 < TINY_SIDE 或面積 < TINY_AREA；
+* `spec_image`：白底、幾乎無彩度、有多條細橫線且橫線多於直線、含文字帶；
+  信心取各項分數的最小值，任一項不像就不判。
+
+只有白底文字而沒有表格線的裁片一律交給 AI：這類圖的分類在既有結果中並不一致，
+而且需要 AI 翻譯 text_blocks。本機標註的結果 text_blocks 為空，summary 註明來源與信心。
+
+正式流程中只有空白與碎片（LOCAL_CATEGORIES，沒有文字可擷取）會在本機標註、不送 AI。
+`spec_image` 規則只用於評估（`--evaluate`，以及 stats["spec_image_sent"] 的計數），
+從不省下任何一次 AI 呼叫：規格表依定義含文字帶，仍照常送 AI 擷取文字。
+
+使用範例
+--------
+>>> clf = LocalClassifier(threshold=0.9)
+>>> labelled, ambiguous = clf.classify_paths(crop_paths)     # {檔名: 結果}, [仍需送 AI 的路徑]
+
+$ python crop_classifier.py --evaluate            # 與既有 analysis.json 的 AI 分類比對
+"""
+
+import argparse
+import json
+import logging
+import os
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+import cv2
+import numpy as np
+
+from crop_engine import looks_like_text, runs, to_gray
+
+log = logging.getLogger("crop_classifier")
+
+THUMB_SIDE = 800            # 特徵在長邊縮到此值的縮圖上計算
+BAND = 32                   # 文字帶高度（縮圖像素），以半帶高滑動
+WHITE_LEVEL = 235           # 灰階高於此值視為白
+INK_LEVEL = 200             # 灰階低於此值視為線條 / 墨色
+SAT_LEVEL = 40              # HSV 飽和度高於此值視為有彩度
+RULE_SPAN = 5               # 長線至少跨寬（高）度的 1 / RULE_SPAN
+THIN_LINE = 3               # 細線的最大粗細（縮圖像素）
+TINY_SIDE = 40
+TINY_AREA = 64 * 64
+BLANK_STD = 3.0
+BLANK_EDGE = 0.002
+DEFAULT_THRESHOLD = 0.9
+LOCAL_CATEGORIES = ("generic",)     # 本機結果即完整結果（沒有 text_blocks 要擷取）的類別
+WORKERS = min(8, os.cpu_count() or 4)
+
+
+@dataclass
+class CropFeatures:
+    width: int
+    height: int
+    white: float            # 白色像素比例
+    saturated: float        # 有彩度像素比例
+    std: float              # 灰階標準差
+    edge_density: float     # Canny 邊緣像素比例
+    thin_rules: int         # 細水平長線數
+    v_lines: int            # 垂直長線數
+    text_ratio: float       # looks_like_text 判定為文字的水平帶比例
+
+
+@dataclass
+class LocalLabel:
+    category: str
+    confidence: float
+    reason: str
+
+    def result(self) -> Dict[str, Any]:
+        """與 AI 回傳相同格式的單張結果"""
+        return {"category": self.category,
+                "summary": f"本機判定：{self.reason}（信心 {self.confidence:.2f}）",
+                "text_blocks": []}
+
+
+# ───────────────────────────── 特徵
+
+def _clip(x: float) -> float:
+    return float(min(1.0, max(0.0, x)))
+
+
+def extract_features(path: Path) -> Optional[CropFeatures]:
+    """讀圖並計算特徵；讀不到時回 None"""
+    img = cv2.imread(str(path), cv2.IMREAD_COLOR)
+    if img is None:
+        return None
+    h, w = img.shape[:2]
+    scale = min(1.0, THUMB_SIDE / max(h, w))
+    if scale < 1.0:
+        img = cv2.resize(img, (max(1, round(w * scale)), max(1, round(h * scale))), interpolation=cv2.INTER_AREA)
+    gray = to_gray(img)
+    H, W = gray.shape
+    sat = cv2.cvtColor(img, cv2.COLOR_BGR2HSV)[..., 1]
+    edges = cv2.Canny(gray, 50, 150)
+
+    ink = ((gray < INK_LEVEL) * 255).astype(np.uint8)
+    h_lines = cv2.morphologyEx(ink, cv2.MORPH_OPEN,
+                               cv2.getStructuringElement(cv2.MORPH_RECT, (max(8, W // RULE_SPAN), 1)))
+    v_lines = cv2.morphologyEx(ink, cv2.MORPH_OPEN,
+                               cv2.getStructuringElement(cv2.MORPH_RECT, (1, max(8, H // RULE_SPAN))))
+    rules = runs(h_lines.any(axis=1))
+    bands = [gray[y:y + BAND] for y in range(0, max(1, H - BAND + 1), BAND // 2)]
+
+    return CropFeatures(
+        width=w, height=h,
+        white=float(np.count_nonzero(gray > WHITE_LEVEL)) / gray.size,
+        saturated=float(np.count_nonzero(sat > SAT_LEVEL)) / sat.size,
+        std=float(gray.std()),
+        edge_density=float(np.count_nonzero(edges)) / edges.size,
+        thin_rules=sum(1 for y0, y1 in rules if y1 - y0 <= THIN_LINE),
+        v_lines=len(runs(v_lines.any(axis=0))),
+        text_ratio=sum(looks_like_text(b, gray=b) for b in bands) / len(bands),
+    )
+
+
+# ───────────────────────────── 規則
+
+def classify(f: CropFeatures) -> Optional[LocalLabel]:
+    """回傳信心最高的本機標籤；完全不像任何規則時回 None"""
+    if min(f.width, f.height) < TINY_SIDE or f.width * f.height < TINY_AREA:
+        return LocalLabel("generic", 1.0, f"過小的碎片 {f.width}×{f.height}")
+
+    candidates: List[LocalLabel] = []
+    blank = min(_clip(2 - f.std / BLANK_STD), _clip(2 - f.edge_density / BLANK_EDGE))
+    if blank > 0:
+        candidates.append(LocalLabel("generic", blank, "空白裁片"))
+
+    spec = min(_clip((f.white - 0.85) / 0.08),             # ≥ 93% 白底
+               _clip(1 - f.saturated / 0.02),              # 幾乎無彩度
+               _clip((f.thin_rules - f.v_lines) / 3),      # 細橫線比直線多三條以上
+               _clip(f.text_ratio / 0.05))                 # 有文字帶
+    if spec > 0:
+        candidates.append(LocalLabel("spec_image", spec, f"白底規格表（{f.thin_rules} 條細橫線）"))
+    return max(candidates, key=lambda c: c.confidence, default=None)
+
+
+class LocalClassifier:
+    """
+    以 thread pool 計算特徵（OpenCV 會釋放 GIL），信心 ≥ threshold 且類別在 categories 內的
+    裁片在本機標註；其他類別即使有把握也送 AI（需要 AI 擷取文字）。
+    """
+
+    def __init__(self, threshold: float = DEFAULT_THRESHOLD, workers: int = WORKERS,
+                 categories: Sequence[str] = LOCAL_CATEGORIES):
+        self.threshold = threshold
+        self.workers = max(1, workers)
+        self.categories = frozenset(categories)
+        self.stats = Counter()
+
+    def label(self, path: Path) -> Optional[LocalLabel]:
+        try:
+            features = extract_features(path)
+        except cv2.error as e:
+            log.debug(f"無法計算特徵 {path}: {e}")
+            features = None
+        return classify(features) if features else None
+
+    def classify_paths(self, paths: Sequence[Path]) -> Tuple[Dict[str, Dict[str, Any]], List[Path]]:
+        """回傳 (本機標註的 {檔名: 結果}, 仍需送 AI 的路徑)；路徑順序保持不變"""
+        paths = list(paths)
+        if len(paths) > 1 and self.workers > 1:
+            with ThreadPoolExecutor(min(self.workers, len(paths))) as pool:
+                labels = list(pool.map(self.label, paths))
+        else:
+            labels = [self.label(p) for p in paths]
+        labelled, ambiguous = {}, []
+        for path, lab in zip(paths, labels):
+            self.stats["images"] += 1
+            confident = lab is not None and lab.confidence >= self.threshold
+            if confident and lab.category in self.categories:
+                labelled[path.name] = lab.result()
+                self.stats[lab.category] += 1
+                continue
+            ambiguous.append(path)
+            self.stats["ambiguous"] += 1
+            if confident:
+                self.stats[f"{lab.category}_sent"] += 1     # 有把握但需要 AI 擷取文字
+        return labelled, ambiguous
+
+    def describe(self) -> str:
+        s = self.stats
+        local = s["images"] - s["ambiguous"]
+        detail = "、".join(f"{k} {v}" for k, v in sorted(s.items())
+                          if k not in ("images", "ambiguous") and not k.endswith("_sent"))
+        sent = sum(v for k, v in s.items() if k.endswith("_sent"))
+        return (f"{s['images']} 張裁片中 {local} 張由本機判定"
+                f"{f'（{detail}）' if detail else ''}，{s['ambiguous']} 張送 AI（門檻 {self.threshold:.2f}"
+                f"{f'，其中 {sent} 張本機有把握但需要 AI 擷取文字' if sent else ''}）")
+
+# ───────────────────────────── CLI
+
+def _ai_labels(root: Path) -> Dict[Path, str]:
+    """既有 analysis.json 中的 AI 分類：{裁片路徑: category}"""
+    names = {"selling_points": "selling_point", "use_cases": "use_case",
+             "spec_images": "spec_image", "generic_images": "generic"}
+    labels = {}
+    for analysis in sorted(root.glob("product_*/analysis.json")):
+        try:
+            with open(analysis, encoding="utf-8") as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            continue
+        for img in data.get("images", []):
+            for key, category in names.items():
+                for crop in img.get(key) or []:
+                    if "local_path" in crop:
+                        labels[root / crop["local_path"]] = category
+    return labels
+
+
+def main():
+    from image_inventory import BASE_DIR, scan
+
+    ap = argparse.ArgumentParser(description="以本機特徵預分類裁片，或與既有 AI 分類比對以調整門檻")
+    ap.add_argument("root", type=Path, nargs="?", default=BASE_DIR / "products" / "WWW_Collection")
+    ap.add_argument("--threshold", type=float, default=DEFAULT_THRESHOLD,
+                    help=f"本機標註所需的最低信心 (預設: {DEFAULT_THRESHOLD})")
+    ap.add_argument("--evaluate", action="store_true", help="只看已有 AI 分類的裁片，列出一致率")
+    args = ap.parse_args()
+    logging.basicConfig(level=logging.INFO, format="%(levelname)s %(message)s")
+
+    clf = LocalClassifier(args.threshold)
+    if not args.evaluate:
+        paths = scan(args.root, exts=(".jpg",), crops=True)
+        labelled, _ = clf.classify_paths(paths)
+        for name, result in sorted(labelled.items()):
+            log.info(f"{name}: {result['category']} — {result['summary']}")
+        log.info(clf.describe())
+        return
+
+    truth = {p: c for p, c in _ai_labels(args.root).items() if p.exists()}
+    paths = sorted(truth)
+    with ThreadPoolExecutor(clf.workers) as pool:
+        labels = list(pool.map(clf.label, paths))
+    confusion = Counter()
+    for path, lab in zip(paths, labels):
+        if lab is not None and lab.confidence >= args.threshold:
+            confusion[(lab.category, truth[path])] += 1
+            if lab.category != truth[path]:
+                log.info(f"不一致 {path.name}: 本機 {lab.category} ({lab.confidence:.2f}) / AI {truth[path]}")
+    local = sum(confusion.values())
+    agree = sum(n for (mine, ai), n in confusion.items() if mine == ai)
+    log.info(f"{len(paths)} 張有 AI 分類的裁片：本機判定 {local} 張，與 AI 一致 {agree} 張"
+             f"{f'（{agree / local:.0%}）' if local else ''}，門檻 {args.threshold:.2f}")
+
+
+if __name__ == "__main__":
+    main()
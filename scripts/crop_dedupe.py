@@ -0,0 +1,194 @@
+#!/usr/bin/env python3
+"""
+裁片近似重複偵測（感知雜湊）
+============================
+
+出貨須知橫幅、品牌頁尾、同一張規格表……在不同產品與顏色款之間幾乎一模一樣，
+update_json_with_crops 卻每張都送一次 AI。本模組為每張裁片計算 DCT 感知雜湊（pHash），
+把漢明距離在門檻內、長寬比相近的裁片歸為一組，每組只送代表那一張：
+
+* 「領頭者」分組：新裁片只和各組代表比較，組員與代表的距離一定不超過門檻，
+  不會因為 A≈B≈C 的鏈結把差很多的 A 與 C 併在一起；
+* 雜湊為 HASH_SIZE² 位元，預設 16×16 = 256 位元，比常見的 64 位元更能分辨
+  版面相同、數字不同的規格表；長寬比差超過 ASPECT_TOLERANCE 的一律不同組；
+* 雜湊依 (路徑, 大小, mtime) 記憶，同一輪內重複查詢不會重讀圖檔。
+
+門檻取捨：同一張圖在不同產品間只差幾個像素的裁切邊界時，距離多在 0–24；
+只有數字不同的文字表格可能落在 15–25，換了顏色款的同構圖照片（例如 goalzero 與
+goalzero_BLACK）實測也在 14–24。合併錯了會把別張圖的分析（規格數字、色名）套過來，
+沒合併只是多送一次，因此預設門檻 DEFAULT_DISTANCE 取在這兩個區間之下，只合併
+幾乎一模一樣的裁片；確定沒有這類裁片時可用 --distance 放寬，先用 CLI 檢視分組再決定。
+
+使用範例
+--------
+>>> index = NearDuplicateIndex(max_distance=10)
+>>> index.prefetch(crop_paths)
+>>> rep = index.representative(crop_path)     # None：自成一組（要送出）；否則為代表的路徑
+
+$ python crop_dedupe.py products/WWW_Collection --distance 10 --show 20
+"""
+
+import argparse
+import logging
+import os
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Dict, Iterable, List, Optional, Tuple
+
+import numpy as np
+from PIL import Image
+
+log = logging.getLogger("crop_dedupe")
+
+HASH_SIZE = 16              # 取 DCT 左上 HASH_SIZE × HASH_SIZE 個低頻係數
+OVERSAMPLE = 4              # 先縮到 (HASH_SIZE × OVERSAMPLE)² 灰階再做 DCT
+DEFAULT_DISTANCE = 10       # 256 位元中允許不同的位元數（約 4%，低於文字表格與顏色款的 14–25）
+ASPECT_TOLERANCE = 0.08     # 長寬比（取對數）相差超過約 8% 視為不同圖
+HASH_WORKERS = min(8, os.cpu_count() or 4)
+
+_POPCOUNT = np.array([bin(i).count("1") for i in range(256)], dtype=np.uint8)
+
+
+@dataclass
+class PHash:
+    bits: np.ndarray        # packbits 後的 uint8 陣列
+    aspect: float           # log(寬 / 高)
+
+
+# ───────────────────────────── 雜湊
+
+def _dct_matrix(n: int) -> np.ndarray:
+    k = np.arange(n)[:, None]
+    i = np.arange(n)[None, :]
+    return np.cos(np.pi * (2 * i + 1) * k / (2 * n)).astype(np.float32)
+
+
+_DCT = {}
+
+
+def phash(path: Path, hash_size: int = HASH_SIZE) -> PHash:
+    """計算 DCT 感知雜湊：灰階縮圖 → 2D DCT → 低頻係數與中位數比較"""
+    size = hash_size * OVERSAMPLE
+    with Image.open(path) as img:
+        w, h = img.size
+        gray = np.asarray(img.convert("L").resize((size, size), Image.BOX), dtype=np.float32)
+    m = _DCT.get(size)
+    if m is None:
+        m = _DCT[size] = _dct_matrix(size)
+    low = (m @ gray @ m.T)[:hash_size, :hash_size]
+    bits = np.packbits((low > np.median(low)).ravel())
+    return PHash(bits, float(np.log(max(w, 1) / max(h, 1))))
+
+
+def hamming(a: PHash, b: PHash) -> int:
+    return int(_POPCOUNT[np.bitwise_xor(a.bits, b.bits)].sum())
+
+
+# ───────────────────────────── 分組
+
+class NearDuplicateIndex:
+    """依序登記裁片；與既有代表夠接近的歸入該組，否則自成新組的代表"""
+
+    def __init__(self, max_distance: int = DEFAULT_DISTANCE,
+                 aspect_tolerance: float = ASPECT_TOLERANCE, hash_size: int = HASH_SIZE):
+        self.max_distance = max_distance
+        self.aspect_tolerance = aspect_tolerance
+        self.hash_size = hash_size
+        self.groups: Dict[str, List[Path]] = {}     # 代表路徑 -> 組員（不含代表）
+        self.stats = Counter()
+        self._memo: Dict[str, Tuple[int, int, Optional[PHash]]] = {}
+        self._reps: List[Path] = []
+        self._aspects = np.empty(0, dtype=np.float64)
+        self._bits = np.empty((0, hash_size * hash_size // 8), dtype=np.uint8)
+
+    def hash_of(self, path: Path) -> Optional[PHash]:
+        """依 (路徑, 大小, mtime) 記憶的 pHash；讀不到圖時回 None"""
+        try:
+            st = os.stat(path)
+        except OSError:
+            return None
+        key = str(path)
+        memo = self._memo.get(key)
+        if memo and memo[:2] == (st.st_size, st.st_mtime_ns):
+            return memo[2]
+        try:
+            value = phash(path, self.hash_size)
+        except Exception as e:
+            log.debug(f"無法計算 pHash {path}: {e}")
+            value = None
+        self._memo[key] = (st.st_size, st.st_mtime_ns, value)
+        return value
+
+    def prefetch(self, paths: Iterable[Path], workers: int = HASH_WORKERS) -> None:
+        """以 thread pool 預先算好雜湊（PIL 解碼時會釋放 GIL）"""
+        paths = list(paths)
+        if len(paths) < 2 or workers <= 1:
+            return
+        with ThreadPoolExecutor(workers) as pool:
+            list(pool.map(self.hash_of, paths))
+
+    def representative(self, path: Path) -> Optional[Path]:
+        """
+        登記一張裁片：與某組代表的距離在門檻內就歸入該組並回傳代表路徑；
+        否則（或讀不到圖）成為新組的代表，回傳 None。
+        """
+        h = self.hash_of(path)
+        self.stats["images"] += 1
+        if h is None:
+            self.stats["unreadable"] += 1
+            return None
+        if self._reps:
+            near = np.abs(self._aspects - h.aspect) <= self.aspect_tolerance
+            if near.any():
+                candidates = np.flatnonzero(near)
+                dist = _POPCOUNT[np.bitwise_xor(self._bits[candidates], h.bits)].sum(axis=1)
+                best = int(np.argmin(dist))
+                if dist[best] <= self.max_distance:
+                    rep = self._reps[candidates[best]]
+                    self.groups[str(rep)].append(Path(path))
+                    self.stats["duplicates"] += 1
+                    return rep
+        self._reps.append(Path(path))
+        self._aspects = np.append(self._aspects, h.aspect)
+        self._bits = np.vstack([self._bits, h.bits[None, :]])
+        self.groups[str(path)] = []
+        self.stats["groups"] += 1
+        return None
+
+    def describe(self) -> str:
+        s = self.stats
+        grouped = sum(1 for members in self.groups.values() if members)
+        return (f"{s['images']} 張裁片 → {s['groups']} 組（{grouped} 組有近似重複），"
+                f"{s['duplicates']} 張不必送出（門檻 {self.max_distance}/{self.hash_size ** 2} 位元）")
+
+# ───────────────────────────── CLI
+
+def main():
+    from image_inventory import BASE_DIR, scan
+
+    ap = argparse.ArgumentParser(description="列出裁片的近似重複分組，用來調整漢明距離門檻")
+    ap.add_argument("root", type=Path, nargs="?", default=BASE_DIR / "products" / "WWW_Collection")
+    ap.add_argument("--distance", type=int, default=DEFAULT_DISTANCE,
+                    help=f"漢明距離門檻 (預設: {DEFAULT_DISTANCE}，共 {HASH_SIZE ** 2} 位元)")
+    ap.add_argument("--aspect", type=float, default=ASPECT_TOLERANCE, help="長寬比容許差 (對數)")
+    ap.add_argument("--show", type=int, default=10, help="列出最大的幾組")
+    args = ap.parse_args()
+    logging.basicConfig(level=logging.INFO, format="%(levelname)s %(message)s")
+
+    paths = scan(args.root, exts=(".jpg",), crops=True)
+    index = NearDuplicateIndex(args.distance, args.aspect)
+    index.prefetch(paths)
+    for p in paths:
+        index.representative(p)
+    log.info(index.describe())
+    biggest = sorted(((rep, m) for rep, m in index.groups.items() if m), key=lambda x: -len(x[1]))
+    for rep, members in biggest[:args.show]:
+        log.info(f"{len(members) + 1} 張：{rep}")
+        for m in members[:5]:
+            log.info(f"    ≈ {m}")
+
+
+if __name__ == "__main__":
+    main()
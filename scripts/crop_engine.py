@@ -0,0 +1,639 @@
+#!/usr/bin/env python3
+"""
+統一裁切引擎
+============
+
+原本四支裁切程式各有一套門檻與重複的工具函式：
+
+* batch_runner.smart_crop
+* smart_crop_v2.crop_image
+* cropper.smart_crop
+* product_516.find_h_splits / merge_text_blocks
+
+本模組把它們收斂成一條共用的路徑：
+
+    去邊 → RowProfile（列統計只算一次、快取共用）
+         → 偵測器（plugin，各自回傳候選切線）
+         → 組裝器（plugin，把切線變成裁片區間）
+         → CropPlan
+
+每支舊程式對應一個具名 preset，重現原本的行為；舊函式改為呼叫本引擎，
+之後的最佳化只需做在這裡。
+
+使用範例
+--------
+>>> plan = CropEngine("batch_runner").plan(img, source=path)
+>>> plan = CropEngine(get_preset("smart_crop_v2", min_gap_ratio=0.05)).plan(img)
+
+自訂偵測器
+----------
+>>> @register_detector("my_lines")
+... def my_lines(p: RowProfile, thresh: int = 10) -> List[int]:
+...     return [...]
+>>> preset = Preset("custom", detectors=[("my_lines", {"thresh": 5})], assembler="merge_close")
+"""
+
+from dataclasses import dataclass, field, replace
+from pathlib import Path
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+import cv2
+import numpy as np
+
+from crop_plan import CropPlan, CropSpec
+from jpeg_lossless import snap, snap_down
+
+Segment = Tuple[int, int]          # (y0, y1)，去邊後座標
+
+ROW_CHUNK = 1024                   # 逐列計數時每塊的列數（限制 bool 暫存大小）
+
+# ───────────────────────────── 共用工具
+
+def to_gray(img: np.ndarray) -> np.ndarray:
+    """BGR / BGRA / 灰階 → 灰階"""
+    if img.ndim == 2:
+        return img
+    if img.shape[2] == 4:
+        return cv2.cvtColor(img, cv2.COLOR_BGRA2GRAY)
+    return cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
+
+
+def trim_border(img: np.ndarray, bg_thresh: int = 245, consec: int = 15,
+                gray: Optional[np.ndarray] = None) -> Tuple[int, int, int, int]:
+    """
+    偵測四周純白邊框，回傳 (top, bottom, left, right) 應裁掉的像素數。
+    consec 僅為相容舊介面保留（原本的掃描迴圈並未使用它）。
+    """
+    if gray is None:
+        gray = to_gray(img)
+    # 列/欄最小值 > 門檻 ⇔ 整列/欄皆白；uint8 reduction 不需整張 bool 暫存
+    rows = gray.min(axis=1) > bg_thresh
+    cols = gray.min(axis=0) > bg_thresh
+
+    def _lead(mask: np.ndarray) -> int:
+        # 開頭連續 True 的數量
+        return int(mask.argmin()) if not mask.all() else len(mask)
+
+    return _lead(rows), _lead(rows[::-1]), _lead(cols), _lead(cols[::-1])
+
+
+def merge_close(lines: List[int], min_gap: int) -> List[int]:
+    """合併太近的切線：依序保留與上一條保留切線距離 ≥ min_gap 者"""
+    merged: List[int] = []
+    for y in sorted(lines):
+        if not merged or y - merged[-1] >= min_gap:
+            merged.append(y)
+    return merged
+
+
+def looks_like_text(seg: np.ndarray, edge_ratio: float = 0.05, std_th: float = 15,
+                    gray: Optional[np.ndarray] = None) -> bool:
+    """判斷是否為文字區塊：高邊緣密度 + 低背景雜訊"""
+    if gray is None:
+        gray = to_gray(seg)
+    edges = cv2.Canny(gray, 50, 150)
+    ratio = cv2.countNonZero(edges) * 255 / edges.size   # Canny 輸出只有 0 / 255
+    return ratio > edge_ratio and cv2.meanStdDev(gray)[1][0, 0] < std_th
+
+
+def row_count(gray: np.ndarray, thresh: int, above: bool = True) -> np.ndarray:
+    """
+    每列 > thresh（above=False 時為 < thresh）的像素數。
+    分塊計算，bool 暫存只有 ROW_CHUNK 列大小。
+    """
+    out = np.empty(gray.shape[0], dtype=np.int64)
+    for y in range(0, gray.shape[0], ROW_CHUNK):
+        block = gray[y:y + ROW_CHUNK]
+        out[y:y + ROW_CHUNK] = np.count_nonzero(block > thresh if above else block < thresh, axis=1)
+    return out
+
+
+def runs(mask: np.ndarray, tail: bool = True) -> List[Segment]:
+    """回傳 mask 中連續 True 的 (start, end)；tail=False 時忽略延伸到結尾的 run"""
+    m = np.concatenate(([False], np.asarray(mask, dtype=bool), [False]))
+    edges = np.flatnonzero(m[1:] != m[:-1])
+    pairs = list(zip(edges[::2].tolist(), edges[1::2].tolist()))
+    if not tail and pairs and pairs[-1][1] == len(mask):
+        pairs.pop()
+    return pairs
+
+# ───────────────────────────── 列統計（每張圖只算一次）
+
+class RowProfile:
+    """
+    一張（去邊後）影像的灰階與逐列統計，所有偵測器共用並延遲計算。
+
+    另有逐列統計的前綴和索引（列和、列平方和、列暗像素數、列 std），
+    任意 y 區間 [y0, y1) 的平均、std、暗像素比例都是 O(1) 查表；
+    y0 / y1 也可以是 numpy 陣列，一次查詢多個區間。
+    """
+
+    def __init__(self, img: np.ndarray, gray: Optional[np.ndarray] = None):
+        self.img = img
+        self.gray = to_gray(img) if gray is None else gray
+        self.h, self.w = self.gray.shape
+        self._cache: Dict[Any, Any] = {}
+
+    def _cached(self, key: Any, fn: Callable[[], Any]) -> Any:
+        if key not in self._cache:
+            self._cache[key] = fn()
+        return self._cache[key]
+
+    @property
+    def row_sum(self) -> np.ndarray:
+        return self._cached("sum", lambda: self.gray.sum(axis=1, dtype=np.int64))
+
+    @property
+    def row_sq(self) -> np.ndarray:
+        """每列像素平方和（int64，精確）"""
+        return self._cached("sq", lambda: np.einsum("ij,ij->i", self.gray, self.gray, dtype=np.int64))
+
+    @property
+    def row_mean(self) -> np.ndarray:
+        return self._cached("mean", lambda: self.row_sum / self.w)
+
+    @property
+    def row_std(self) -> np.ndarray:
+        """由整數列和/平方和算出，不需 gray.std() 的整張 float64 暫存"""
+        def build() -> np.ndarray:
+            s = self.row_sum
+            var = self.w * self.row_sq - s * s          # int64，精確
+            return np.sqrt(var / (self.w * self.w))
+        return self._cached("std", build)
+
+    def white_ratio(self, thresh: int) -> np.ndarray:
+        """每列 > thresh 的像素比例"""
+        return self._cached(("white", thresh), lambda: row_count(self.gray, thresh) / self.w)
+
+    def dark_count(self, thresh: int) -> np.ndarray:
+        """每列 < thresh 的像素數"""
+        return self._cached(("dark_n", thresh), lambda: row_count(self.gray, thresh, above=False))
+
+    def dark_ratio(self, thresh: int) -> np.ndarray:
+        """每列 < thresh 的像素比例"""
+        return self._cached(("dark", thresh), lambda: self.dark_count(thresh) / self.w)
+
+    # ───────────────────────────── 區間查詢（前綴和）
+
+    def _prefix(self, key: Any, rows: Callable[[], np.ndarray]) -> np.ndarray:
+        """逐列數值的前綴和，P[y] = rows[:y].sum()"""
+        def build() -> np.ndarray:
+            r = rows()
+            p = np.zeros(len(r) + 1, dtype=np.int64 if r.dtype.kind in "iu" else np.float64)
+            np.cumsum(r, out=p[1:])
+            return p
+        return self._cached(("prefix", key), build)
+
+    def band_mean(self, y0: Any, y1: Any) -> Any:
+        """[y0, y1) 所有像素的平均"""
+        p = self._prefix("sum", lambda: self.row_sum)
+        return (p[y1] - p[y0]) / ((np.asarray(y1) - y0) * self.w)
+
+    def band_std(self, y0: Any, y1: Any) -> Any:
+        """[y0, y1) 所有像素的 std（由整數和與平方和算出）"""
+        n = (np.asarray(y1) - y0) * self.w
+        ps = self._prefix("sum", lambda: self.row_sum)
+        pq = self._prefix("sq", lambda: self.row_sq)
+        mean = (ps[y1] - ps[y0]) / n
+        return np.sqrt(np.maximum((pq[y1] - pq[y0]) / n - mean * mean, 0.0))
+
+    def band_dark_ratio(self, y0: Any, y1: Any, thresh: int) -> Any:
+        """[y0, y1) 內 < thresh 的像素比例"""
+        p = self._prefix(("dark", thresh), lambda: self.dark_count(thresh))
+        return (p[y1] - p[y0]) / ((np.asarray(y1) - y0) * self.w)
+
+    def band_row_std_mean(self, y0: Any, y1: Any) -> Any:
+        """[y0, y1) 內各列 std 的平均"""
+        p = self._prefix("std", lambda: self.row_std)
+        return (p[y1] - p[y0]) / (np.asarray(y1) - y0)
+
+    @property
+    def edges(self) -> np.ndarray:
+        return self._cached("edges", lambda: cv2.Canny(self.gray, 50, 150))
+
+    @property
+    def edge_profile(self) -> np.ndarray:
+        """每列 Canny 邊緣總和 / 寬度"""
+        return self._cached("edge_profile", lambda: self.edges.sum(axis=1) / self.w)
+
+    def is_text(self, y0: int, y1: int, edge_ratio: float = 0.05, std_th: float = 15) -> bool:
+        return self._cached(("text", y0, y1, edge_ratio, std_th), lambda: looks_like_text(
+            self.img[y0:y1], edge_ratio, std_th, gray=self.gray[y0:y1]))
+
+# ───────────────────────────── plugin 註冊
+
+Detector = Callable[..., List[int]]
+Assembler = Callable[..., List[List[Segment]]]
+
+DETECTORS: Dict[str, Detector] = {}
+ASSEMBLERS: Dict[str, Assembler] = {}
+
+
+def register_detector(name: str) -> Callable[[Detector], Detector]:
+    """註冊偵測器：fn(profile, **params) -> 候選切線 y 列表"""
+    def deco(fn: Detector) -> Detector:
+        DETECTORS[name] = fn
+        return fn
+    return deco
+
+
+def register_assembler(name: str) -> Callable[[Assembler], Assembler]:
+    """註冊組裝器：fn(profile, lines_by_detector, **params) -> 每個裁片的 Segment 列表"""
+    def deco(fn: Assembler) -> Assembler:
+        ASSEMBLERS[name] = fn
+        return fn
+    return deco
+
+# ───────────────────────────── 偵測器
+
+@register_detector("white_gaps")
+def white_gaps(p: RowProfile, row_mu_th: int = 250, row_std_th: float = 3,
+               min_run: int = 18, run_std_th: float = 1.5) -> List[int]:
+    """純白帶：列平均高且列內 std 低，整段 std < run_std_th（batch_runner.find_white_gaps）"""
+    white = (p.row_mean > row_mu_th) & (p.row_std < row_std_th)
+    return [(s + e - 1) // 2 for s, e in runs(white)
+            if e - s >= min_run and p.band_std(s, e) < run_std_th]
+
+
+@register_detector("uniform_gaps")
+def uniform_gaps(p: RowProfile, std_th: float = 2.5, mu_hi: int = 235, mu_lo: int = 25,
+                 min_run: int = 4, min_height: int = 0) -> List[int]:
+    """整列平坦且極亮/極暗的分隔帶（batch_runner.uniform_gaps）"""
+    if p.h <= min_height:
+        return []
+    flat = (p.row_std < std_th) & ((p.row_mean > mu_hi) | (p.row_mean < mu_lo))
+    return [(s + e - 1) // 2 for s, e in runs(flat) if e - s >= min_run]
+
+
+@register_detector("sparse_edges")
+def sparse_edges(p: RowProfile, long_side: int = 2000, rel_thresh: float = 0.3,
+                 min_run: int = 10) -> List[int]:
+    """長圖邊緣密度低於平均 rel_thresh 倍的帶（batch_runner.long_edge_projection）"""
+    if p.h <= long_side:
+        return []
+    density = p.edge_profile
+    sparse = density < density.mean() * rel_thresh
+    return [(s + e - 1) // 2 for s, e in runs(sparse) if e - s >= min_run]
+
+
+@register_detector("blank_projection")
+def blank_projection(p: RowProfile, bg_thresh: int = 245, min_white_ratio: float = 0.92,
+                     min_band_mean: int = 250, min_run: Optional[int] = None) -> List[int]:
+    """純白帶，連續列數門檻依寬度調整（smart_crop_v2.blank_projection）"""
+    if min_run is None:
+        min_run = 6 if p.w <= 800 else 8 if p.w <= 1600 else 10
+    blank = (p.white_ratio(bg_thresh) > min_white_ratio) & (p.row_mean > min_band_mean)
+    return [(s + e - 1) // 2 for s, e in runs(blank) if e - s >= min_run]
+
+
+@register_detector("edge_bands")
+def edge_bands(p: RowProfile, long_side: int = 2000, edge_ratio: float = 0.05,
+               band_height: int = 40) -> List[int]:
+    """長圖低邊緣帶，閉運算後取中點，只留 10%~90% 高度內（smart_crop_v2 / cropper.find_cut_lines）"""
+    if p.h <= long_side:
+        return []
+    low = (p.edge_profile < edge_ratio * 255).astype(np.uint8)
+    kernel = np.ones((band_height, 1), np.uint8)
+    band = cv2.morphologyEx(low[:, None], cv2.MORPH_CLOSE, kernel)[:, 0]
+    return [mid for s, e in runs(band, tail=False)
+            if 0.1 * p.h < (mid := (s + e) // 2) < 0.9 * p.h]
+
+
+@register_detector("dark_ratio_blank")
+def dark_ratio_blank(p: RowProfile, dark_thresh: int = 245, ratio: Optional[float] = None,
+                     min_run: Optional[int] = None, min_gap_ratio: float = 0.06,
+                     band_fallback_h: int = 3500, band_h: int = 40, band_step: int = 20,
+                     band_mu: float = 245, band_std: float = 3) -> List[int]:
+    """
+    非白像素比例低的空白帶；找不到且圖夠長時改用滑動視窗找平坦亮帶
+    （cropper.detect_cut_lines + find_candidate_bands）
+    """
+    if ratio is None:
+        ratio = 0.02 if p.w < 1200 else 0.015
+    if min_run is None:
+        min_run = 10 if p.w < 1200 else 15
+    blank = p.dark_ratio(dark_thresh) < ratio
+    lines = [e - (e - s) // 2 for s, e in runs(blank, tail=False) if e - s >= min_run]
+    min_gap = max(120, int(min_gap_ratio * p.h))
+    lines = merge_close(lines, min_gap)
+    if len(lines) < 1 and p.h >= band_fallback_h:
+        lines = merge_close(lines + candidate_bands(p, band_h, band_step, band_mu, band_std), min_gap)
+    return lines
+
+
+def candidate_bands(p: RowProfile, band_h: int = 40, step: int = 20,
+                    mu_th: float = 245, std_th: float = 3) -> List[int]:
+    """每 step 列取 band_h 高的視窗，平均夠亮且 std 夠低者為候選（cropper.find_candidate_bands）"""
+    ys = np.arange(0, max(p.h - band_h, 0), step)
+    ok = (p.band_mean(ys, ys + band_h) > mu_th) & (p.band_std(ys, ys + band_h) < std_th)
+    return ys[ok].tolist()
+
+
+@register_detector("white_ratio_split")
+def white_ratio_split(p: RowProfile, bg_thresh: int = 245, min_pct: float = 0.96,
+                      min_run: int = 6) -> List[int]:
+    """一列 ≥ min_pct 像素近白即為分隔帶，取帶中心（product_516.find_h_splits）"""
+    mask = p.white_ratio(bg_thresh) >= min_pct
+    return [(s + e - 1) // 2 for s, e in runs(mask, tail=False) if e - s >= min_run]
+
+# ───────────────────────────── 組裝器
+
+def _union(lines_by_detector: Dict[str, List[int]]) -> List[int]:
+    return sorted({y for lines in lines_by_detector.values() for y in lines})
+
+
+def _segments_from_lines(lines: List[int], h: int) -> List[Segment]:
+    bounds = [0] + lines + [h]
+    return [(bounds[i], bounds[i + 1]) for i in range(len(bounds) - 1)]
+
+
+def _even_slices(h: int, n_slices: int, align: int = 1) -> List[Segment]:
+    """強制等分（對齊時 slice 高度取 align 的倍數）"""
+    slice_h = h // n_slices
+    if align > 1:
+        slice_h = max(align, int(round(slice_h / align)) * align)
+    return [(i, min(i + slice_h, h)) for i in range(0, h, slice_h)]
+
+
+@register_assembler("batch_runner")
+def assemble_batch_runner(p: RowProfile, lines_by_detector: Dict[str, List[int]],
+                          short_h: int = 2000, min_crop_h: int = 200,
+                          coverage_min: float = 0.8, merge_below: int = 350,
+                          dense_avg_h: float = 950, align: int = 1) -> List[List[Segment]]:
+    """batch_runner 的策略：併線、丟碎片、覆蓋率回退、過碎時等分、合併過小片段"""
+    h, w = p.h, p.w
+    whole = [[(0, h)]]
+    if h <= short_h:  # 短圖：直接保留
+        return whole
+
+    raw_lines = _union(lines_by_detector)
+    min_gap = 180 if h > 4000 else max(120, int(0.025 * h))
+    cut_lines = merge_close(raw_lines, min_gap)
+    if not cut_lines:
+        return whole
+
+    def _small(y0: int, y1: int) -> bool:
+        seg_h = y1 - y0
+        abs_min = 320 if w > seg_h else 400  # 橫幅圖放寬到 320px
+        min_keep = max(int(0.10 * h), int(0.30 * w), abs_min)
+        return seg_h < max(min_keep, abs_min, 0.10 * h) and not p.is_text(y0, y1)
+
+    def _cut(lines: List[int]) -> List[Segment]:
+        segs, y0 = [], 0
+        for y in lines + [h]:
+            if y - y0 >= min_crop_h and not _small(y0, y):
+                segs.append((y0, y))
+            y0 = y  # 無論是否裁切，都更新 y0
+        return segs
+
+    segs = _cut(cut_lines)
+    if not segs:
+        return whole
+
+    # 覆蓋率太低：改用原始切線（不併線），仍不足則強制三等分
+    if sum(y1 - y0 for y0, y1 in segs) / h < coverage_min:
+        segs = _cut(raw_lines)
+        if sum(y1 - y0 for y0, y1 in segs) / h < coverage_min:
+            segs = _even_slices(h, 3, align)
+
+    # 裁切過碎：中圖鎖 2 片、長圖 3 片
+    if len(segs) > 3 and sum(y1 - y0 for y0, y1 in segs) / len(segs) < dense_avg_h:
+        segs = _even_slices(h, 2 if h < 3500 else 3, align)
+
+    # 合併過小的相鄰片段（相鄰時合成單一區間）
+    merged, i = [], 0
+    while i < len(segs):
+        y0, y1 = segs[i]
+        if i < len(segs) - 1 and y1 - y0 < merge_below:
+            ny0, ny1 = segs[i + 1]
+            merged.append([(y0, ny1)] if y1 == ny0 else [(y0, y1), (ny0, ny1)])
+            i += 2
+        else:
+            merged.append([(y0, y1)])
+            i += 1
+    return merged
+
+
+@register_assembler("merge_close")
+def assemble_merge_close(p: RowProfile, lines_by_detector: Dict[str, List[int]],
+                         min_gap_ratio: float = 0.06, min_crop_h: int = 120,
+                         keep_h_ratio: float = 0.08, keep_w_ratio: float = 0.25,
+                         align: int = 1) -> List[List[Segment]]:
+    """smart_crop_v2 的策略：併線後依序切，丟掉不是文字的過小片段"""
+    h, w = p.h, p.w
+    lines = merge_close(_union(lines_by_detector), max(120, int(min_gap_ratio * h)))
+    min_keep = max(int(keep_h_ratio * h), int(keep_w_ratio * w), min_crop_h)
+    return [[(y0, y1)] for y0, y1 in _segments_from_lines(lines, h)
+            if y1 - y0 >= min_keep or p.is_text(y0, y1)]
+
+
+@register_assembler("drop_small")
+def assemble_drop_small(p: RowProfile, lines_by_detector: Dict[str, List[int]],
+                        keep_w_ratio: float = 0.30, keep_h_ratio: float = 0.05,
+                        abs_min: int = 300, align: int = 1) -> List[List[Segment]]:
+    """cropper 的策略：無切線時整張輸出，否則丟掉不是文字的過小片段"""
+    h, w = p.h, p.w
+    lines = _union(lines_by_detector)
+    if not lines:
+        return [[(0, h)]]
+    min_keep = max(int(keep_w_ratio * w), int(keep_h_ratio * h), abs_min)
+    return [[(y0, y1)] for y0, y1 in _segments_from_lines(lines, h)
+            if y1 - y0 >= min_keep or p.is_text(y0, y1)]
+
+
+def is_text_block(p: RowProfile, y0: int, y1: int, max_h: int = 150,
+                  stddev_max: float = 25, black_ratio: float = 0.02) -> bool:
+    """矮、背景白、又有些深色像素的區塊視為文字（product_516.is_text_block）"""
+    if y1 - y0 > max_h or y1 <= y0:
+        return False
+    if p.band_row_std_mean(y0, y1) > stddev_max:
+        return False
+    return p.band_dark_ratio(y0, y1, 200) > black_ratio
+
+
+@register_assembler("text_merge")
+def assemble_text_merge(p: RowProfile, lines_by_detector: Dict[str, List[int]],
+                        merge_gap: int = 40, min_h: int = 40, txt_max_h: int = 150,
+                        txt_stddev_max: float = 25, txt_black_ratio: float = 0.02,
+                        align: int = 1) -> List[List[Segment]]:
+    """product_516 的策略：連續的文字區塊併成一片，再丟掉太薄的分段"""
+    ys = [0] + _union(lines_by_detector) + [p.h]
+    return [[seg] for seg in merge_text_blocks(p, ys, merge_gap, txt_max_h,
+                                               txt_stddev_max, txt_black_ratio)
+            if seg[1] - seg[0] >= min_h]
+
+
+def merge_text_blocks(p: RowProfile, ys: List[int], merge_gap: int = 40, max_h: int = 150,
+                      stddev_max: float = 25, black_ratio: float = 0.02) -> List[Segment]:
+    """合併連續的文字區塊（product_516.merge_text_blocks）"""
+    def _text(a: int, b: int) -> bool:
+        return is_text_block(p, a, b, max_h, stddev_max, black_ratio)
+
+    merged = []
+    i = 0
+    while i < len(ys) - 1:
+        y1, y2 = ys[i], ys[i + 1]
+        if _text(y1, y2):
+            # 一直往後併，直到遇到「圖片」或「空白 > merge_gap」
+            j = i + 1
+            while j < len(ys) - 1:
+                if ys[j] - ys[j - 1] > merge_gap or not _text(ys[j], ys[j + 1]):
+                    break
+                j += 1
+            merged.append((y1, ys[j]))
+            i = j
+        else:
+            merged.append((y1, y2))
+            i += 1
+    return merged
+
+# ───────────────────────────── preset
+
+@dataclass
+class Preset:
+    """一組偵測器 + 組裝器 + 去邊/小圖規則"""
+    name: str
+    detectors: List[Tuple[str, Dict[str, Any]]]
+    assembler: str
+    assembler_params: Dict[str, Any] = field(default_factory=dict)
+    trim: bool = True
+    bg_thresh: int = 245
+    icon_max_side: int = 0          # max(h, w) < 此值視為 icon（0 = 不檢查）
+    icon_min_side: int = 0          # min(h, w) < 此值視為 icon（0 = 不檢查）
+    icon_before_trim: bool = True
+    icon_skip: bool = False         # True：icon 不輸出裁片；False：整張保留
+
+    def with_params(self, **overrides: Any) -> "Preset":
+        """
+        回傳覆寫參數後的副本。key 為 `偵測器名.參數`（例如 white_gaps.min_run）、
+        Preset 本身的欄位（例如 bg_thresh）或組裝器參數名。
+        """
+        detectors = [(n, dict(p)) for n, p in self.detectors]
+        assembler_params = dict(self.assembler_params)
+        fields = {}
+        for key, val in overrides.items():
+            if "." in key:
+                det, param = key.split(".", 1)
+                for n, params in detectors:
+                    if n == det:
+                        params[param] = val
+            elif key in _PRESET_FIELDS:
+                fields[key] = val
+            else:
+                assembler_params[key] = val
+        return replace(self, detectors=detectors, assembler_params=assembler_params, **fields)
+
+
+_PRESET_FIELDS = {"trim", "bg_thresh", "icon_max_side", "icon_min_side",
+                  "icon_before_trim", "icon_skip"}
+
+PRESETS: Dict[str, Preset] = {
+    "batch_runner": Preset(
+        "batch_runner",
+        detectors=[("white_gaps", {}),
+                   ("uniform_gaps", {"min_height": 2800}),
+                   ("sparse_edges", {})],
+        assembler="batch_runner",
+        icon_max_side=120, icon_min_side=80,
+    ),
+    "smart_crop_v2": Preset(
+        "smart_crop_v2",
+        detectors=[("blank_projection", {}), ("edge_bands", {})],
+        assembler="merge_close",
+        trim=False,   # smart_crop_v2.process_dir 在呼叫前自行去邊
+    ),
+    "cropper": Preset(
+        "cropper",
+        detectors=[("edge_bands", {}), ("dark_ratio_blank", {})],
+        assembler="drop_small",
+        icon_min_side=120, icon_before_trim=False, icon_skip=True,
+    ),
+    "product_516": Preset(
+        "product_516",
+        detectors=[("white_ratio_split", {})],
+        assembler="text_merge",
+        trim=False,
+    ),
+}
+
+
+def get_preset(name: str, **overrides: Any) -> Preset:
+    preset = PRESETS[name]
+    return preset.with_params(**overrides) if overrides else preset
+
+# ───────────────────────────── 引擎
+
+class CropEngine:
+    """依 preset 產生 CropPlan"""
+
+    def __init__(self, preset: Any = "batch_runner"):
+        self.preset = get_preset(preset) if isinstance(preset, str) else preset
+
+    def detect(self, profile: RowProfile) -> Dict[str, List[int]]:
+        """執行所有偵測器，回傳 {偵測器名: 切線}"""
+        return {name: DETECTORS[name](profile, **params)
+                for name, params in self.preset.detectors}
+
+    def plan(self, img: np.ndarray, source: Optional[Path] = None,
+             align: int = 1, align_x: int = 1,
+             cache: Optional[Dict[Any, Any]] = None) -> CropPlan:
+        """
+        偵測並組裝裁切計畫。align / align_x > 1 時，切線與去邊起點
+        對齊到該倍數（JPEG MCU），計畫區間可直接無損裁切。
+
+        cache 為「同一張圖」專用的 dict：灰階、去邊結果與 RowProfile 會存在裡面，
+        以不同 preset / 參數重複呼叫時不必重算（例如參數調校）。
+        """
+        cache = {} if cache is None else cache
+        pr = self.preset
+        orig_h, orig_w = img.shape[:2]
+        params: Dict[str, Any] = {"preset": pr.name, "align": align, "align_x": align_x,
+                                  "trim": [0, 0, 0, 0]}
+
+        def _plan(segs: List[List[Segment]], top: int = 0, left: int = 0, w: int = orig_w) -> CropPlan:
+            crops = [CropSpec([(top + y0, top + y1, left, left + w) for y0, y1 in parts])
+                     for parts in segs]
+            detector = f"crop_engine.{pr.name}"
+            if source is None:
+                return CropPlan("", orig_h, orig_w, crops, detector, params)
+            return CropPlan.for_source(source, orig_h, orig_w, crops=crops,
+                                       detector=detector, params=params)
+
+        def _icon(h: int, w: int) -> bool:
+            return ((pr.icon_max_side and max(h, w) < pr.icon_max_side)
+                    or (pr.icon_min_side and min(h, w) < pr.icon_min_side))
+
+        if pr.icon_before_trim and _icon(orig_h, orig_w):
+            params["skipped"] = "tiny_icon"
+            return _plan([] if pr.icon_skip else [[(0, orig_h)]])
+
+        gray = cache.get("gray")
+        if gray is None:
+            gray = cache["gray"] = to_gray(img)
+        t = b = l = r = 0
+        if pr.trim:
+            key = ("trim", pr.bg_thresh)
+            if key not in cache:
+                cache[key] = trim_border(img, pr.bg_thresh, gray=gray)
+            t, b, l, r = cache[key]
+            t, l = snap_down(t, align), snap_down(l, align_x)
+            if any((t, b, l, r)):
+                img = img[t:orig_h - b, l:orig_w - r]
+                gray = gray[t:orig_h - b, l:orig_w - r]
+                params["trim"] = [t, b, l, r]
+        h, w = gray.shape
+
+        if not pr.icon_before_trim and _icon(h, w):
+            params["skipped"] = "tiny_icon"
+            return _plan([] if pr.icon_skip else [[(0, h)]], t, l, w)
+
+        key = ("profile", t, b, l, r)
+        profile = cache.get(key)
+        if profile is None:
+            profile = cache[key] = RowProfile(img, gray)
+        lines = self.detect(profile)
+        if align > 1:
+            lines = {n: sorted({snap(y, align) for y in ys} - {0, h}) for n, ys in lines.items()}
+        segs = ASSEMBLERS[pr.assembler](profile, lines, align=align, **pr.assembler_params)
+        params["lines"] = lines
+        return _plan(segs, t, l, w)
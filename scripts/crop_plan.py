@@ -0,0 +1,125 @@
+#!/usr/bin/env python3
+"""
+裁切計畫（Crop Plan）
+=====================
+
+偵測階段只輸出「要切哪裡」：每個裁片是一組 (y0, y1, x0, x1) 區間，
+加上來源檔與偵測器等出處資訊。計畫可序列化成 JSON 儲存、檢視，
+需要像素時再以 `materialize()` 取得原圖的零複製 view；
+寫檔則成為獨立、可平行化的階段。
+
+使用範例
+--------
+>>> plan = batch_runner.plan_crop(img, source=path)
+>>> plan.save(Path("plan.json"))
+>>> for crop in plan.iter_crops(img):   # numpy view，不複製像素
+...     ...
+"""
+
+import json
+import os
+from dataclasses import asdict, dataclass, field
+from datetime import datetime
+from pathlib import Path
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+import numpy as np
+
+Box = Tuple[int, int, int, int]   # (y0, y1, x0, x1)，原圖座標
+
+
+@dataclass
+class CropSpec:
+    """單一裁片：通常只有一個區間；被合併但不相鄰的片段會有多個"""
+    parts: List[Box]
+
+    @property
+    def contiguous(self) -> bool:
+        return len(self.parts) == 1
+
+    @property
+    def height(self) -> int:
+        return sum(y1 - y0 for y0, y1, _, _ in self.parts)
+
+    @property
+    def width(self) -> int:
+        y0, y1, x0, x1 = self.parts[0]
+        return x1 - x0
+
+
+@dataclass
+class CropPlan:
+    """一張圖的裁切計畫"""
+    source: str
+    height: int                      # 原圖高
+    width: int                       # 原圖寬
+    crops: List[CropSpec] = field(default_factory=list)
+    detector: str = ""               # 產生此計畫的偵測器
+    params: Dict[str, Any] = field(default_factory=dict)
+    source_size: Optional[int] = None
+    source_mtime: Optional[float] = None
+    created: str = field(default_factory=lambda: datetime.now().isoformat())
+
+    # ───────────────────────────── 像素
+
+    def materialize(self, img: np.ndarray, index: int) -> np.ndarray:
+        """取出第 index 個裁片；單一區間時回傳零複製 view"""
+        parts = self.crops[index].parts
+        views = [img[y0:y1, x0:x1] for y0, y1, x0, x1 in parts]
+        return views[0] if len(views) == 1 else np.vstack(views)
+
+    def iter_crops(self, img: np.ndarray) -> Iterator[np.ndarray]:
+        for i in range(len(self.crops)):
+            yield self.materialize(img, i)
+
+    # ───────────────────────────── 序列化
+
+    def intervals(self) -> List[Box]:
+        """攤平成 (y0, y1, x0, x1) 列表"""
+        return [tuple(b) for spec in self.crops for b in spec.parts]
+
+    def to_dict(self) -> Dict[str, Any]:
+        d = asdict(self)
+        d["crops"] = [[list(b) for b in spec.parts] for spec in self.crops]
+        return d
+
+    @classmethod
+    def from_dict(cls, d: Dict[str, Any]) -> "CropPlan":
+        d = dict(d)
+        d["crops"] = [CropSpec([tuple(b) for b in parts]) for parts in d.get("crops", [])]
+        return cls(**d)
+
+    def save(self, path: Path) -> None:
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump(self.to_dict(), f, ensure_ascii=False, indent=2)
+
+    @classmethod
+    def load(cls, path: Path) -> "CropPlan":
+        with open(path, "r", encoding="utf-8") as f:
+            return cls.from_dict(json.load(f))
+
+    def is_stale(self) -> bool:
+        """來源檔的大小或修改時間與計畫記錄不同時回傳 True"""
+        try:
+            st = os.stat(self.source)
+        except OSError:
+            return True
+        return st.st_size != self.source_size or st.st_mtime != self.source_mtime
+
+    @classmethod
+    def for_source(cls, source: Path, height: int, width: int, **kwargs) -> "CropPlan":
+        """建立計畫並記錄來源檔的 size / mtime"""
+        try:
+            st = os.stat(source)
+            kwargs.setdefault("source_size", st.st_size)
+            kwargs.setdefault("source_mtime", st.st_mtime)
+        except OSError:
+            pass
+        return cls(source=str(source), height=height, width=width, **kwargs)
+
+
+def load_plans(meta_file: Path) -> Dict[str, CropPlan]:
+    """從 batch_runner 的 crop_meta.json 讀出 {來源路徑: CropPlan}，不需開啟任何圖片"""
+    with open(meta_file, "r", encoding="utf-8") as f:
+        records = json.load(f)
+    return {r["path"]: CropPlan.from_dict(r["plan"]) for r in records if "plan" in r}
@@ -0,0 +1,182 @@
+#!/usr/bin/env python3
+"""
+裁片編碼/寫檔階段
+=================
+
+偵測 worker 只負責找切線，裁片交給 `CropWriter` 的獨立 worker pool 編碼與寫檔。
+佇列有上限：編碼跟不上時 `submit()` 會阻塞，避免待寫的裁片把記憶體吃光。
+排入的 numpy view（例如 `CropPlan.materialize` 的結果）會先複製成獨立陣列，
+否則每個待寫裁片都會讓整張解碼後的原圖留在記憶體，直到它編碼完為止。
+
+使用範例
+--------
+>>> with CropWriter(workers=4, settings=parse_encode_settings(["webp:quality=90,method=6"])) as writer:
+...     writer.submit(out_path, crop_bgr)          # numpy (BGR) → cv2 編碼
+...     writer.submit(out_path, pil_image)         # PIL.Image → PIL 編碼
+>>> log.info(writer.report())
+
+編碼參數（依副檔名）
+--------------------
+quality   JPEG / WebP 品質
+method    WebP 壓縮速度 0-6（僅 PIL）
+level     PNG 壓縮等級 0-9
+未設定的項目使用各函式庫預設值，與原本 cv2.imwrite / Image.save 的輸出一致。
+"""
+
+import logging
+import os
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from pathlib import Path
+from typing import Any, Callable, Dict, List, Optional, Sequence
+
+import cv2
+import numpy as np
+
+log = logging.getLogger("crop_writer")
+
+_FORMATS = {".jpg": "jpeg", ".jpeg": "jpeg", ".webp": "webp", ".png": "png"}
+
+
+def parse_encode_settings(specs: Optional[Sequence[str]]) -> Dict[str, Dict[str, int]]:
+    """解析 CLI 的 `fmt:key=val,key=val` 設定，例如 `webp:quality=90,method=6`"""
+    settings: Dict[str, Dict[str, int]] = {}
+    for spec in specs or []:
+        fmt, _, opts = spec.partition(":")
+        fmt = _FORMATS.get(f".{fmt.lower().lstrip('.')}", fmt.lower())
+        entry = settings.setdefault(fmt, {})
+        for kv in filter(None, opts.split(",")):
+            key, _, val = kv.partition("=")
+            entry[key.strip()] = int(val)
+    return settings
+
+
+def _cv2_params(fmt: str, opts: Dict[str, int]) -> List[int]:
+    params = []
+    if fmt == "jpeg" and "quality" in opts:
+        params += [cv2.IMWRITE_JPEG_QUALITY, opts["quality"]]
+    elif fmt == "webp" and "quality" in opts:
+        params += [cv2.IMWRITE_WEBP_QUALITY, opts["quality"]]
+    elif fmt == "png" and "level" in opts:
+        params += [cv2.IMWRITE_PNG_COMPRESSION, opts["level"]]
+    return params
+
+
+def _pil_params(fmt: str, opts: Dict[str, int]) -> Dict[str, int]:
+    params = {}
+    if "quality" in opts:
+        params["quality"] = opts["quality"]
+    if fmt == "webp" and "method" in opts:
+        params["method"] = opts["method"]
+    if fmt == "png" and "level" in opts:
+        params["compress_level"] = opts["level"]
+    return params
+
+
+def _detach(value: Any) -> Any:
+    """numpy view 複製成只含裁片像素的獨立陣列，不再參照原圖的緩衝區"""
+    if isinstance(value, np.ndarray) and value.base is not None:
+        return value.copy(order="C")
+    return value
+
+
+class CropWriter:
+    """有上限佇列的編碼/寫檔 worker pool，並統計編碼吞吐量"""
+
+    def __init__(self, workers: Optional[int] = None, queue_size: int = 64,
+                 settings: Optional[Dict[str, Dict[str, int]]] = None):
+        self.workers = workers or min(8, os.cpu_count() or 4)
+        self.settings = settings or {}
+        self._pool = ThreadPoolExecutor(self.workers, thread_name_prefix="encode")
+        self._slots = threading.BoundedSemaphore(max(1, queue_size))
+        self._lock = threading.Lock()
+        self._futures: List[Future] = []
+        self._t0 = time.perf_counter()
+        self.stats: Dict[str, Any] = {
+            "files": 0,
+            "bytes": 0,
+            "encode_seconds": 0.0,   # 所有 worker 的編碼時間總和
+            "wait_seconds": 0.0,     # 偵測端因佇列滿而阻塞的時間
+            "failed": [],
+        }
+
+    # ───────────────────────────── 提交
+
+    def submit(self, dst: Path, image: Any, settings: Optional[Dict[str, int]] = None) -> Future:
+        """排入一個裁片；image 可為 BGR numpy 陣列或 PIL.Image"""
+        return self.submit_call(dst, self._encode, dst, image, settings)
+
+    def submit_call(self, dst: Path, fn: Callable[..., Any], *args) -> Future:
+        """排入自訂的寫檔函式（例如無損 JPEG 裁切），fn 需自行寫出 dst"""
+        t = time.perf_counter()
+        self._slots.acquire()
+        waited = time.perf_counter() - t
+        args = tuple(_detach(a) for a in args)
+        fut = self._pool.submit(self._run, dst, fn, *args)
+        with self._lock:
+            self.stats["wait_seconds"] += waited
+            self._futures.append(fut)
+        return fut
+
+    def _run(self, dst: Path, fn: Callable[..., Any], *args) -> Any:
+        t = time.perf_counter()
+        try:
+            result = fn(*args)
+            size = os.path.getsize(dst)
+            with self._lock:
+                self.stats["files"] += 1
+                self.stats["bytes"] += size
+                self.stats["encode_seconds"] += time.perf_counter() - t
+            return result
+        except Exception as e:
+            log.error(f"寫出裁片失敗: {dst} - {e}")
+            with self._lock:
+                self.stats["failed"].append({"path": str(dst), "error": str(e)})
+            raise
+        finally:
+            self._slots.release()
+
+    def _encode(self, dst: Path, image: Any, settings: Optional[Dict[str, int]]) -> None:
+        fmt = _FORMATS.get(Path(dst).suffix.lower(), "")
+        opts = settings if settings is not None else self.settings.get(fmt, {})
+        if isinstance(image, np.ndarray):
+            ok, buf = cv2.imencode(Path(dst).suffix, image, _cv2_params(fmt, opts))
+            if not ok:
+                raise ValueError(f"cv2 無法編碼 {dst}")
+            buf.tofile(str(dst))
+        else:
+            image.save(dst, fmt.upper() if fmt else None, **_pil_params(fmt, opts))
+
+    # ───────────────────────────── 收尾
+
+    def wait(self) -> None:
+        """等待目前所有已提交的裁片寫完"""
+        with self._lock:
+            futures, self._futures = self._futures, []
+        for fut in futures:
+            try:
+                fut.result()
+            except Exception:
+                pass  # 已記錄在 stats["failed"]
+
+    def close(self) -> Dict[str, Any]:
+        self.wait()
+        self._pool.shutdown(wait=True)
+        self.stats["wall_seconds"] = time.perf_counter() - self._t0
+        return self.stats
+
+    def report(self) -> str:
+        s = self.stats
+        wall = s.get("wall_seconds") or (time.perf_counter() - self._t0)
+        per_file = s["encode_seconds"] / s["files"] if s["files"] else 0.0
+        return (f"編碼: {s['files']} 檔 / {s['bytes'] / 2**20:.1f} MB，"
+                f"{s['files'] / wall if wall else 0:.1f} 檔/秒（{self.workers} workers），"
+                f"平均 {per_file * 1000:.0f} ms/檔，偵測端等待 {s['wait_seconds']:.1f} 秒，"
+                f"失敗 {len(s['failed'])}")
+
+    def __enter__(self) -> "CropWriter":
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.close()
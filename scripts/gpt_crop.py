@@ -12,11 +12,9 @@ $ python gpt_crop.py
 """
 
 import argparse
-import base64
 import json
 import logging
 import os
-from io import BytesIO
 from pathlib import Path
 from typing import Dict, List, Any, Optional
 from concurrent.futures import ThreadPoolExecutor
@@ -28,6 +26,10 @@ from openai import OpenAI
 from PIL import Image
 from dotenv import load_dotenv
 
+import ai_cache
+import ai_payload
+import image_inventory
+
 # 載入環境變數
 load_dotenv()
 
@@ -44,88 +46,87 @@ logging.basicConfig(
     ]
 )
 
-def get_image_base64(image_path: str) -> str:
-    """將圖片轉換為 base64 字串"""
-    try:
-        # 讀取圖片
-        with Image.open(image_path) as img:
-            # 轉換為 RGB 模式（如果是 RGBA）
-            if img.mode == 'RGBA':
-                img = img.convert('RGB')
-            
-            # 調整圖片大小，避免超過 API 限制
-            max_size = 2048
-            if max(img.size) > max_size:
-                ratio = max_size / max(img.size)
-                new_size = tuple(int(dim * ratio) for dim in img.size)
-                img = img.resize(new_size, Image.Resampling.LANCZOS)
-            
-            # 轉換為 JPEG 格式的 bytes
-            buffer = BytesIO()
-            img.save(buffer, format='JPEG', quality=95)
-            buffer.seek(0)
-            
-            # 轉換為 base64
-            return base64.b64encode(buffer.getvalue()).decode('utf-8')
-    except Exception as e:
-        logging.error(f"圖片轉換失敗: {e}")
-        raise
+# GPT 段落分析的模型、參數與 prompt（也是 AI 回應快取鍵的一部分）
+GPT_MODEL = "gpt-4o"  # 使用新的模型名稱
+GPT_PARAMS = {"max_tokens": 500, "temperature": 0.3}  # 降低隨機性
+# 快取裡的座標已換回原圖尺寸；加進快取鍵，讓以上傳尺寸存下的舊結果不再命中
+GPT_CACHE_PARAMS = {**GPT_PARAMS, "coords": "source"}
+GPT_SYSTEM_PROMPT = """你是圖像內容分析助手。請分析圖片內容，找出自然的段落分界點。
+請注意：
+1. 找出內容的自然分界點，如標題、段落間距等
+2. 避免切到文字或重要內容
+3. 必須返回有效的 JSON 格式
+4. 每個段落的高度建議在 800-1200 像素之間
+5. 直接返回 JSON，不要加任何說明文字"""
+GPT_USER_PROMPT = """請分析這張圖，並依內容段落返回 Y 軸裁切座標。
+直接返回以下格式的 JSON，不要加任何說明文字：
+{
+    "segments": [
+        {"top": 0, "bottom": 1200},
+        {"top": 1200, "bottom": 2400},
+        ...
+    ]
+}"""
 
-def analyze_image_with_gpt(image_path: str, client: OpenAI) -> Dict[str, Any]:
+def analyze_image_with_gpt(image_path: str, client: OpenAI,
+                           cache: Optional[ai_cache.AICache] = None) -> Dict[str, Any]:
     """
-    使用 GPT 分析圖片內容段落
+    使用 GPT 分析圖片內容段落；同內容、同 prompt 的圖片直接取用 AI 回應快取
     
     Args:
         image_path: 圖片路徑
         client: OpenAI 客戶端
+        cache: AI 回應快取（預設為 ai_cache.default_cache()）
     
     Returns:
         包含裁切段落的字典
     """
+    cache = cache or ai_cache.default_cache()
+    key = cache.key(Path(image_path), GPT_SYSTEM_PROMPT + "\n" + GPT_USER_PROMPT, GPT_MODEL, GPT_CACHE_PARAMS)
+    cached = cache.get(key)
+    if cached is not None:
+        logging.info(f"AI 快取命中，不再送出: {image_path}")
+        return cached
+
+    result = _request_segments(image_path, client)
+    if result.get("segments") and "error" not in result:
+        cache.put(key, result, source=Path(image_path).name)
+    return result
+
+def _request_segments(image_path: str, client: OpenAI) -> Dict[str, Any]:
+    """
+    送出 GPT 段落分析請求並驗證回應格式；失敗時 segments 為空並附上 error。
+    模型看到的是縮小後的上傳圖，回傳的 top/bottom 依上傳高度換算回原圖座標（crop_image 裁的是原圖）。
+    """
     try:
-        # 將圖片轉為 base64
-        base64_image = get_image_base64(image_path)
+        # 縮到 OpenAI 的有效解析度（編碼結果跨重試、跨腳本共用）
+        payload = ai_payload.prepare(image_path, "openai")
         
         # 使用 chat.completions.create 分析圖片
         response = client.chat.completions.create(
-            model="gpt-4o",  # 使用新的模型名稱
+            model=GPT_MODEL,
             messages=[
                 {
                     "role": "system",
-                    "content": """你是圖像內容分析助手。請分析圖片內容，找出自然的段落分界點。
-請注意：
-1. 找出內容的自然分界點，如標題、段落間距等
-2. 避免切到文字或重要內容
-3. 必須返回有效的 JSON 格式
-4. 每個段落的高度建議在 800-1200 像素之間
-5. 直接返回 JSON，不要加任何說明文字"""
+                    "content": GPT_SYSTEM_PROMPT
                 },
                 {
                     "role": "user",
                     "content": [
                         {
                             "type": "text",
-                            "text": """請分析這張圖，並依內容段落返回 Y 軸裁切座標。
-直接返回以下格式的 JSON，不要加任何說明文字：
-{
-    "segments": [
-        {"top": 0, "bottom": 1200},
-        {"top": 1200, "bottom": 2400},
-        ...
-    ]
-}"""
+                            "text": GPT_USER_PROMPT
                         },
                         {
                             "type": "image_url",
                             "image_url": {
-                                "url": f"data:image/jpeg;base64,{base64_image}"
+                                "url": payload.data_url()
                             }
                         }
                     ]
                 }
             ],
-            max_tokens=500,
-            temperature=0.3  # 降低隨機性
+            **GPT_PARAMS
         )
         
         # 記錄完整回應
@@ -162,6 +163,12 @@ def analyze_image_with_gpt(image_path: str, client: OpenAI) -> Dict[str, Any]:
                     if not isinstance(seg["top"], (int, float)) or not isinstance(seg["bottom"], (int, float)):
                         raise ValueError("top/bottom 必須是數字")
                 
+                # 上傳圖 → 原圖座標
+                scale = payload.source_size[1] / payload.size[1]
+                for seg in segments:
+                    seg["top"] = round(seg["top"] * scale)
+                    seg["bottom"] = round(seg["bottom"] * scale)
+                
                 logging.info(f"解析後的結果:\n{json.dumps(result, indent=2, ensure_ascii=False)}")
                 return result
             else:
@@ -291,9 +298,7 @@ def main():
     
     # 獲取所有圖片
     base_dir = Path("WWW_Collection")
-    image_paths = []
-    for ext in [".jpg", ".jpeg", ".png"]:
-        image_paths.extend(base_dir.rglob(f"*{ext}"))
+    image_paths = image_inventory.scan(base_dir, (".jpg", ".jpeg", ".png"))
     
     # 過濾掉 cropped 目錄下的圖片
     image_paths = [p for p in image_paths if "cropped" not in p.parts]
@@ -0,0 +1,357 @@
+#!/usr/bin/env python3
+"""
+圖片庫存索引
+============
+
+batch_runner / smart_crop_v2 / gpt_crop / analyze_images / update_json_with_crops /
+check_ai_analysis_progress 原本各自以 glob / rglob / os.walk 重走整棵目錄，
+部分還為了讀尺寸再開一次圖檔。本模組把這些資訊集中存在一個 SQLite 檔：
+
+* 每張圖的路徑、大小、mtime、寬高、格式、內容雜湊；
+* 裁片與原圖的關係（`<原圖>-cropNN.*` 同目錄，或 `cropped/<原圖>_crop_N.*`）。
+
+`refresh(root)` 以 os.scandir 走訪，只有 (inode, size, mtime) 改變的檔案
+才重讀檔頭與重算雜湊；消失的檔案會從索引移除。
+
+使用範例
+--------
+>>> paths = image_inventory.scan(WWW_DIR / "product_321" / "images", crops=False)
+>>> with Inventory() as inv:
+...     inv.refresh(WWW_DIR)
+...     inv.crops_of(WWW_DIR / "product_321/images/F1985_F513_carabiner-detail.jpg")
+
+$ python image_inventory.py products/WWW_Collection --stats
+"""
+
+import argparse
+import hashlib
+import logging
+import os
+import re
+import sqlite3
+import time
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Dict, Iterable, Iterator, List, Optional, Sequence, Tuple
+
+from PIL import Image
+
+log = logging.getLogger("image_inventory")
+
+BASE_DIR = Path(__file__).resolve().parent.parent
+DB_PATH = BASE_DIR / "results" / "inventory.sqlite"
+IMG_EXTS = (".jpg", ".jpeg", ".png", ".gif", ".bmp", ".webp")
+HASH_CHUNK = 1 << 20          # 雜湊時每次讀取的 bytes
+HASH_WORKERS = min(8, os.cpu_count() or 4)
+
+# <原圖>-cropNN（手動/批次裁片，同目錄）或 <原圖>_crop_N（cropped/ 子目錄）
+CROP_RE = re.compile(r"^(?P<parent>.+?)(?:-crop(?P<a>\d+)|_crop_(?P<b>\d+))$")
+# 舊腳本以 glob 找手動裁片的範圍（不含 _crop_N 與大寫副檔名），AI 分析流程沿用此範圍
+LEGACY_CROP_GLOB = "*-crop*.jpg"
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS images (
+    path        TEXT PRIMARY KEY,   -- 絕對路徑
+    dir         TEXT NOT NULL,
+    stem_path   TEXT NOT NULL,      -- 去掉副檔名的絕對路徑，用來對應裁片的原圖
+    ext         TEXT NOT NULL,      -- 小寫副檔名（含點）
+    product     TEXT,               -- 路徑中的 product_* 目錄名
+    inode       INTEGER,
+    size        INTEGER,
+    mtime_ns    INTEGER,
+    width       INTEGER,
+    height      INTEGER,
+    format      TEXT,
+    hash        TEXT,
+    parent_stem TEXT,               -- 裁片的原圖 stem_path；原圖為 NULL
+    crop_index  INTEGER
+);
+CREATE INDEX IF NOT EXISTS images_dir ON images(dir);
+CREATE INDEX IF NOT EXISTS images_parent ON images(parent_stem);
+CREATE INDEX IF NOT EXISTS images_product ON images(product);
+CREATE INDEX IF NOT EXISTS images_hash ON images(hash);
+"""
+
+_COLUMNS = ("path", "dir", "stem_path", "ext", "product", "inode", "size", "mtime_ns",
+            "width", "height", "format", "hash", "parent_stem", "crop_index")
+
+# ───────────────────────────── 紀錄
+
+@dataclass
+class ImageRecord:
+    path: Path
+    size: int
+    mtime_ns: int
+    width: Optional[int]
+    height: Optional[int]
+    format: Optional[str]
+    hash: Optional[str]
+    product: Optional[str]
+    parent_stem: Optional[str]
+    crop_index: Optional[int]
+
+    @property
+    def is_crop(self) -> bool:
+        return self.parent_stem is not None
+
+    @classmethod
+    def from_row(cls, row: sqlite3.Row) -> "ImageRecord":
+        return cls(Path(row["path"]), row["size"], row["mtime_ns"], row["width"], row["height"],
+                   row["format"], row["hash"], row["product"], row["parent_stem"], row["crop_index"])
+
+# ───────────────────────────── 檔案層工具
+
+def file_hash(path: Path) -> str:
+    """串流計算內容雜湊（blake2b-128）"""
+    h = hashlib.blake2b(digest_size=16)
+    with open(path, "rb") as f:
+        while chunk := f.read(HASH_CHUNK):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def crop_relation(path: Path) -> Tuple[Optional[str], Optional[int]]:
+    """由檔名推出 (原圖 stem_path, 裁片序號)；不是裁片時回傳 (None, None)"""
+    m = CROP_RE.match(path.stem)
+    if not m:
+        return None, None
+    parent_dir = path.parent
+    if m["b"] is not None and parent_dir.name == "cropped":
+        parent_dir = parent_dir.parent
+    return str(parent_dir / m["parent"]), int(m["a"] or m["b"])
+
+
+def _product_of(path: Path) -> Optional[str]:
+    for part in reversed(path.parts[:-1]):
+        if part.startswith("product_"):
+            return part
+    return None
+
+
+def _walk(root: Path, exts: Tuple[str, ...]) -> Iterator[Tuple[str, os.stat_result]]:
+    """os.scandir 遞迴走訪，yield (絕對路徑, stat)；stat 直接取自目錄項目"""
+    stack = [str(root)]
+    while stack:
+        try:
+            it = os.scandir(stack.pop())
+        except OSError as e:
+            log.warning(f"無法讀取目錄: {e}")
+            continue
+        with it:
+            for entry in it:
+                try:
+                    if entry.is_dir(follow_symlinks=False):
+                        stack.append(entry.path)
+                    elif os.path.splitext(entry.name)[1].lower() in exts and entry.is_file():
+                        yield entry.path, entry.stat()
+                except OSError:
+                    continue
+
+
+def _probe(path: str) -> Tuple[Optional[int], Optional[int], Optional[str], Optional[str]]:
+    """只讀檔頭取得 (寬, 高, 格式)，並計算內容雜湊"""
+    w = h = fmt = None
+    try:
+        with Image.open(path) as img:
+            (w, h), fmt = img.size, img.format
+    except Exception as e:
+        log.debug(f"無法讀取檔頭 {path}: {e}")
+    try:
+        digest = file_hash(Path(path))
+    except OSError as e:
+        log.warning(f"無法計算雜湊 {path}: {e}")
+        digest = None
+    return w, h, fmt, digest
+
+# ───────────────────────────── 索引
+
+class Inventory:
+    """SQLite 圖片索引；多個腳本/行程可共用同一個檔案（WAL 模式）"""
+
+    def __init__(self, db_path: Path = DB_PATH):
+        self.db_path = Path(db_path)
+        self.db_path.parent.mkdir(parents=True, exist_ok=True)
+        self.conn = sqlite3.connect(str(self.db_path), timeout=30)
+        self.conn.row_factory = sqlite3.Row
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.executescript(SCHEMA)
+
+    def close(self) -> None:
+        self.conn.close()
+
+    def __enter__(self) -> "Inventory":
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.close()
+
+    # ── 更新
+
+    def refresh(self, root: Path, exts: Sequence[str] = IMG_EXTS,
+                workers: int = HASH_WORKERS) -> Dict[str, int]:
+        """
+        增量更新 root 底下的索引：(inode, size, mtime) 未變的檔案直接沿用，
+        新增/變更的檔案以 thread pool 讀檔頭與算雜湊，已消失的檔案移除。
+        回傳 {"scanned", "updated", "removed", "seconds"}。
+        """
+        t0 = time.perf_counter()
+        root = Path(root).resolve()
+        exts = tuple(e.lower() for e in exts)
+        if not root.exists():
+            files = []
+        elif root.is_file():
+            files = [(str(root), root.stat())] if root.suffix.lower() in exts else []
+        else:
+            files = list(_walk(root, exts))
+
+        known = {row["path"]: (row["inode"], row["size"], row["mtime_ns"])
+                 for row in self._rows_under(root, "path, inode, size, mtime_ns")}
+        changed = [(p, st) for p, st in files
+                   if known.get(p) != (st.st_ino, st.st_size, st.st_mtime_ns)]
+
+        rows = []
+        with ThreadPoolExecutor(max(1, workers)) as pool:
+            for (p, st), (w, h, fmt, digest) in zip(changed, pool.map(_probe, (p for p, _ in changed))):
+                path = Path(p)
+                parent_stem, crop_index = crop_relation(path)
+                rows.append((p, str(path.parent), str(path.with_suffix("")), path.suffix.lower(),
+                             _product_of(path), st.st_ino, st.st_size, st.st_mtime_ns,
+                             w, h, fmt, digest, parent_stem, crop_index))
+
+        seen = {p for p, _ in files}
+        gone = [(p,) for p in known if p not in seen and Path(p).suffix.lower() in exts]
+        with self.conn:
+            self.conn.executemany(
+                f"INSERT OR REPLACE INTO images ({', '.join(_COLUMNS)}) "
+                f"VALUES ({', '.join('?' * len(_COLUMNS))})", rows)
+            self.conn.executemany("DELETE FROM images WHERE path = ?", gone)
+
+        stats = {"scanned": len(files), "updated": len(rows), "removed": len(gone),
+                 "seconds": round(time.perf_counter() - t0, 3)}
+        log.debug(f"索引更新 {root}: {stats}")
+        return stats
+
+    # ── 查詢
+
+    def _rows_under(self, root: Path, cols: str = "*", where: str = "",
+                    params: Sequence = ()) -> List[sqlite3.Row]:
+        root = str(Path(root).resolve())
+        sql = (f"SELECT {cols} FROM images WHERE (path = ? OR substr(path, 1, ?) = ?)"
+               f"{' AND ' + where if where else ''} ORDER BY path")
+        return self.conn.execute(sql, (root, len(root) + 1, root + os.sep, *params)).fetchall()
+
+    def images(self, root: Path, exts: Optional[Sequence[str]] = None,
+               crops: Optional[bool] = None, recursive: bool = True,
+               product: Optional[str] = None) -> List[ImageRecord]:
+        """
+        查詢 root 底下的圖片（依路徑排序）。
+        crops=True 只回傳裁片、False 只回傳非裁片、None 全部；recursive=False 只看 root 本層。
+        """
+        where, params = [], []
+        if exts is not None:
+            exts = [e.lower() for e in exts]
+            where.append(f"ext IN ({', '.join('?' * len(exts))})")
+            params += exts
+        if crops is not None:
+            where.append("parent_stem IS NOT NULL" if crops else "parent_stem IS NULL")
+        if not recursive:
+            where.append("dir = ?")
+            params.append(str(Path(root).resolve()))
+        if product is not None:
+            where.append("product = ?")
+            params.append(product)
+        return [ImageRecord.from_row(r) for r in self._rows_under(root, "*", " AND ".join(where), params)]
+
+    def get(self, path: Path) -> Optional[ImageRecord]:
+        row = self.conn.execute("SELECT * FROM images WHERE path = ?",
+                                (str(Path(path).resolve()),)).fetchone()
+        return ImageRecord.from_row(row) if row else None
+
+    def crops_of(self, parent: Path, exts: Optional[Sequence[str]] = None) -> List[ImageRecord]:
+        """
+        原圖的所有裁片，依裁片序號排序（原圖本身不必仍存在）。
+        parent 為原圖的檔案路徑（含副檔名）；stem 本身含 "." 時不能只傳 stem。
+        """
+        stem = str(Path(parent).resolve().with_suffix(""))
+        rows = self.conn.execute(
+            "SELECT * FROM images WHERE parent_stem = ? ORDER BY crop_index, path", (stem,)).fetchall()
+        recs = [ImageRecord.from_row(r) for r in rows]
+        if exts is not None:
+            exts = {e.lower() for e in exts}
+            recs = [r for r in recs if r.path.suffix.lower() in exts]
+        return recs
+
+    def parent_of(self, crop: Path) -> Optional[ImageRecord]:
+        """裁片對應的原圖（同 stem 的第一個非裁片）"""
+        parent_stem, _ = crop_relation(Path(crop).resolve())
+        if parent_stem is None:
+            return None
+        row = self.conn.execute(
+            "SELECT * FROM images WHERE stem_path = ? AND parent_stem IS NULL ORDER BY path LIMIT 1",
+            (parent_stem,)).fetchone()
+        return ImageRecord.from_row(row) if row else None
+
+    def by_hash(self, digest: str) -> List[ImageRecord]:
+        rows = self.conn.execute("SELECT * FROM images WHERE hash = ? ORDER BY path", (digest,)).fetchall()
+        return [ImageRecord.from_row(r) for r in rows]
+
+    def dimensions(self, paths: Iterable[Path]) -> Dict[Path, Tuple[int, int]]:
+        """批次取得 (寬, 高)，不必重開圖檔；沒有索引或讀不到檔頭的路徑不會出現在結果中"""
+        out: Dict[Path, Tuple[int, int]] = {}
+        for p in paths:
+            row = self.conn.execute("SELECT width, height FROM images WHERE path = ?",
+                                    (str(Path(p).resolve()),)).fetchone()
+            if row and row["width"] is not None:
+                out[p] = (row["width"], row["height"])
+        return out
+
+# ───────────────────────────── 便利函式
+
+def scan(root: Path, exts: Sequence[str] = IMG_EXTS, crops: Optional[bool] = None,
+         recursive: bool = True, db_path: Path = DB_PATH) -> List[Path]:
+    """
+    更新 root 的索引後回傳符合條件的圖片路徑（各腳本的探索步驟用）。
+    路徑沿用呼叫端給的 root 形式（相對路徑仍是相對路徑），與原本的 glob 結果一致。
+    """
+    root = Path(root)
+    resolved = root.resolve()
+    with Inventory(db_path) as inv:
+        inv.refresh(root, exts)
+        recs = inv.images(root, exts, crops, recursive)
+    if root.is_file():
+        return [root for _ in recs]
+    return [root / r.path.relative_to(resolved) for r in recs]
+
+# ───────────────────────────── CLI
+
+def main():
+    ap = argparse.ArgumentParser(description="更新並查詢圖片庫存索引")
+    ap.add_argument("root", type=Path, nargs="?", default=BASE_DIR / "products" / "WWW_Collection")
+    ap.add_argument("--db", type=Path, default=DB_PATH)
+    ap.add_argument("--workers", type=int, default=HASH_WORKERS, help="讀檔頭/算雜湊的 thread 數")
+    ap.add_argument("--stats", action="store_true", help="列出各產品的原圖/裁片數量與重複內容")
+    args = ap.parse_args()
+    logging.basicConfig(level=logging.INFO, format="%(levelname)s %(message)s")
+
+    with Inventory(args.db) as inv:
+        res = inv.refresh(args.root, workers=args.workers)
+        log.info(f"掃描 {res['scanned']} 張，更新 {res['updated']}，移除 {res['removed']}，"
+                 f"耗時 {res['seconds']:.2f} 秒 → {args.db}")
+        if not args.stats:
+            return
+        per_product: Dict[Optional[str], List[int]] = {}
+        hashes: Dict[str, int] = {}
+        for rec in inv.images(args.root):
+            counts = per_product.setdefault(rec.product, [0, 0])
+            counts[rec.is_crop] += 1
+            if rec.hash:
+                hashes[rec.hash] = hashes.get(rec.hash, 0) + 1
+        for product, (n_src, n_crop) in sorted(per_product.items(), key=lambda kv: str(kv[0])):
+            log.info(f"{product or '(無產品)'}: 原圖 {n_src}，裁片 {n_crop}")
+        dup = sum(n - 1 for n in hashes.values() if n > 1)
+        log.info(f"內容重複的檔案: {dup}")
+
+
+if __name__ == "__main__":
+    main()
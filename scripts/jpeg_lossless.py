@@ -0,0 +1,157 @@
+#!/usr/bin/env python3
+"""
+JPEG 無損裁切工具
+=================
+
+長圖裁出的都是整寬水平條，若來源是 JPEG，可直接在 DCT 係數層級裁切，
+不必 decode → cv2.imwrite 重新壓縮（省 CPU、也不會多一代壓縮損失）。
+
+限制：JPEG 只能在 MCU（iMCU）邊界起始裁切，因此切線需先對齊
+`read_mcu_size()` 回傳的 MCU 高度；右/下緣則可以是任意位置。
+
+後端（依序嘗試）
+----------------
+1. PyTurboJPEG（`pip install PyTurboJPEG`）
+2. 系統的 `jpegtran`（libjpeg-turbo）
+都沒有時 `lossless_crop()` 回傳 False，由呼叫端改用重新編碼。
+
+EXIF Orientation ≠ 1 的 JPEG 一律不走無損路徑：cv2.imread 會先依標籤轉正，
+切線座標是轉正後的，但 DCT 係數仍是未旋轉的原始方向（`-copy all` 也會保留標籤）。
+"""
+
+import logging
+import shutil
+import struct
+import subprocess
+from pathlib import Path
+from typing import Optional, Tuple
+
+from PIL import Image
+
+try:
+    from turbojpeg import TurboJPEG
+except ImportError:  # 選用相依
+    TurboJPEG = None
+
+JPEG_EXTS = (".jpg", ".jpeg")
+ORIENTATION_TAG = 0x0112
+
+# SOF0..SOF15，扣除 DHT(C4)、JPG(C8)、DAC(CC)
+_SOF_MARKERS = {0xC0, 0xC1, 0xC2, 0xC3, 0xC5, 0xC6, 0xC7,
+                0xC9, 0xCA, 0xCB, 0xCD, 0xCE, 0xCF}
+
+_turbo = None
+
+# ───────────────────────────── 檔頭解析
+
+def read_mcu_size(path: Path) -> Optional[Tuple[int, int]]:
+    """讀取 JPEG 檔頭，回傳 (mcu_w, mcu_h)；非 JPEG 或解析失敗回傳 None"""
+    try:
+        with open(path, "rb") as f:
+            if f.read(2) != b"\xff\xd8":
+                return None
+            while True:
+                byte = f.read(1)
+                if not byte:
+                    return None
+                if byte != b"\xff":
+                    continue
+                marker = f.read(1)
+                while marker == b"\xff":          # 填充位元組
+                    marker = f.read(1)
+                if not marker:
+                    return None
+                code = marker[0]
+                if code in (0xD8, 0x01) or 0xD0 <= code <= 0xD7:
+                    continue                      # 無長度欄位的 marker
+                if code == 0xD9 or code == 0xDA:  # EOI / SOS 之前都沒看到 SOF
+                    return None
+                (length,) = struct.unpack(">H", f.read(2))
+                if code in _SOF_MARKERS:
+                    data = f.read(length - 2)
+                    n_comp = data[5]
+                    h_max = v_max = 1
+                    for i in range(n_comp):
+                        sampling = data[6 + i * 3 + 1]
+                        h_max = max(h_max, sampling >> 4)
+                        v_max = max(v_max, sampling & 0x0F)
+                    # 單一分量（灰階）時 MCU 固定為 8×8
+                    if n_comp == 1:
+                        return 8, 8
+                    return 8 * h_max, 8 * v_max
+                f.seek(length - 2, 1)
+    except (OSError, struct.error, IndexError):
+        return None
+
+
+def exif_orientation(path: Path) -> int:
+    """EXIF Orientation 標籤值（1 = 不需旋轉）；沒有標籤時回傳 1，讀取失敗回傳 0"""
+    try:
+        with Image.open(path) as img:
+            return int(img.getexif().get(ORIENTATION_TAG, 1))
+    except (OSError, ValueError, TypeError):
+        return 0
+
+
+def snap(v: int, step: int) -> int:
+    """將座標對齊到最近的 step 倍數"""
+    if step <= 1:
+        return v
+    return int(round(v / step)) * step
+
+
+def snap_down(v: int, step: int) -> int:
+    """將座標向下對齊到 step 倍數（用於裁切起點）"""
+    if step <= 1:
+        return v
+    return (v // step) * step
+
+# ───────────────────────────── 無損裁切
+
+def backend() -> Optional[str]:
+    """回傳可用的無損裁切後端名稱"""
+    if TurboJPEG is not None:
+        return "turbojpeg"
+    if shutil.which("jpegtran"):
+        return "jpegtran"
+    return None
+
+
+def _get_turbo():
+    global _turbo
+    if _turbo is None:
+        _turbo = TurboJPEG()
+    return _turbo
+
+
+def lossless_crop(src: Path, dst: Path, box: Tuple[int, int, int, int]) -> bool:
+    """
+    以 DCT 係數層級裁切 JPEG。box 為 (y0, y1, x0, x1)，
+    y0/x0 必須已對齊 MCU。成功回傳 True，無可用後端、來源帶旋轉標籤或失敗回傳 False。
+    """
+    y0, y1, x0, x1 = box
+    w, h = x1 - x0, y1 - y0
+    if w <= 0 or h <= 0:
+        return False
+    if exif_orientation(src) != 1:
+        return False
+
+    name = backend()
+    try:
+        if name == "turbojpeg":
+            with open(src, "rb") as f:
+                buf = f.read()
+            out = _get_turbo().crop(buf, x0, y0, w, h)
+            with open(dst, "wb") as f:
+                f.write(out)
+            return True
+        if name == "jpegtran":
+            subprocess.run(
+                ["jpegtran", "-copy", "all", "-crop", f"{w}x{h}+{x0}+{y0}",
+                 "-outfile", str(dst), str(src)],
+                check=True, capture_output=True,
+            )
+            return True
+    except Exception as e:
+        logging.warning(f"無損裁切失敗，改用重新編碼: {src} - {e}")
+    return False
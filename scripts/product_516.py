@@ -5,6 +5,9 @@ import logging
 import json
 from datetime import datetime
 
+import crop_engine
+from crop_engine import RowProfile
+
 # ── 設定 logging ───────────────────────────
 def setup_logging(product_dir: Path):
     """為每個產品建立獨立的 log 檔案"""
@@ -47,60 +50,17 @@ OUT_DIR.mkdir(parents=True, exist_ok=True)
 # ── 工具函式 ────────────────────────
 def find_h_splits(img: np.ndarray) -> list[int]:
     """傳回需要切的 y 座標清單（不含 0 / h）。"""
-    h, w = img.shape[:2]
-    gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
-    # 每列計算「白色比例」
-    white_ratio = (gray > 245).mean(axis=1)
-    # 找到連續高於門檻的區段
-    splits, run = [], []
-    for y, r in enumerate(white_ratio):
-        if r >= MIN_GAP_PCT:
-            run.append(y)
-        elif run:
-            if len(run) >= MIN_GAP_H:
-                splits.append(int(np.mean(run)))  # 分隔帶中心
-            run.clear()
-    return splits
+    return crop_engine.white_ratio_split(RowProfile(img), 245, MIN_GAP_PCT, MIN_GAP_H)
 
 def is_text_block(img_piece: np.ndarray) -> bool:
     """判斷是否為文字區塊"""
-    h, w = img_piece.shape[:2]
-    if h > TXT_MAX_H:
-        return False                      # 太高，直接當圖
-    gray = cv2.cvtColor(img_piece, cv2.COLOR_BGR2GRAY)
-
-    # ① 背景是否幾乎全白
-    row_std = gray.std(axis=1).mean()     # 整塊平均「行標準差」
-    if row_std > TXT_STDDEV_MAX:
-        return False
-
-    # ② 至少要有一些「黑/灰文字」
-    black_ratio = (gray < 200).mean()
-    return black_ratio > TXT_BLACK_RATIO
+    return crop_engine.is_text_block(RowProfile(img_piece), 0, img_piece.shape[0],
+                                     TXT_MAX_H, TXT_STDDEV_MAX, TXT_BLACK_RATIO)
 
 def merge_text_blocks(img_bgr: np.ndarray, ys: list[int]) -> list[tuple[int, int]]:
     """合併連續的文字區塊"""
-    merged = []
-    i = 0
-    while i < len(ys)-1:
-        y1, y2 = ys[i], ys[i+1]
-        piece = img_bgr[y1:y2]
-
-        if is_text_block(piece):
-            # 一直往後併，直到遇到「圖片」或「空白 > MERGE_GAP_PX」
-            j = i + 1
-            while j < len(ys)-1:
-                gap = ys[j] - ys[j-1]
-                nxt = img_bgr[ys[j]:ys[j+1]]
-                if gap > MERGE_GAP_PX or not is_text_block(nxt):
-                    break
-                j += 1
-            merged.append((y1, ys[j]))   # ys[j] 是最後文字塊下緣
-            i = j
-        else:
-            merged.append((y1, y2))
-            i += 1
-    return merged
+    return crop_engine.merge_text_blocks(RowProfile(img_bgr), ys, MERGE_GAP_PX,
+                                         TXT_MAX_H, TXT_STDDEV_MAX, TXT_BLACK_RATIO)
 
 def trim_white(pil: Image.Image) -> Image.Image:
     """把四周接近純白(>TRIM_TOL)的邊緣裁掉。"""
@@ -172,12 +132,14 @@ def main():
         h, w = img_bgr.shape[:2]
         product_logger.info(f"圖片尺寸：{w}x{h}")
 
-        # 1. 先用原本的邏輯找切點
-        ys = [0] + find_h_splits(img_bgr) + [h]
+        # 1. 先用原本的邏輯找切點（灰階與列統計只算一次，供後續判斷共用）
+        profile = RowProfile(img_bgr)
+        ys = [0] + crop_engine.white_ratio_split(profile, 245, MIN_GAP_PCT, MIN_GAP_H) + [h]
         product_logger.info(f"找到 {len(ys)-1} 個切點")
         
         # 2. 合併文字區塊
-        merged = merge_text_blocks(img_bgr, ys)
+        merged = crop_engine.merge_text_blocks(profile, ys, MERGE_GAP_PX,
+                                              TXT_MAX_H, TXT_STDDEV_MAX, TXT_BLACK_RATIO)
         product_logger.info(f"合併後剩 {len(merged)} 個區塊")
 
         # 3. 處理每個區塊
@@ -199,7 +161,8 @@ def main():
                 "file": str(out_file),
                 "size": f"{piece.size[0]}x{piece.size[1]}",
                 "position": f"{y1}-{y2}",
-                "is_text": is_text_block(img_bgr[y1:y2])
+                "is_text": crop_engine.is_text_block(profile, y1, y2, TXT_MAX_H,
+                                                     TXT_STDDEV_MAX, TXT_BLACK_RATIO)
             })
             
             process_summary["total_saved"] += 1
@@ -0,0 +1,202 @@
+#!/usr/bin/env python3
+"""
+記憶體預算排程器
+================
+
+批次裁切時，每張圖解碼後連同 gray / Canny 等衍生陣列大約佔
+`寬 × 高 × FOOTPRINT_BYTES_PER_PX` bytes。幾張 900×30000 的長圖同時解碼就會吃光 RAM，
+小圖卻又讓 CPU 閒著。本排程器：
+
+1. 只讀檔頭（PIL lazy open）估計每個 job 的解碼足跡；
+2. 在設定的記憶體預算內才放行 job（first-fit，放不下的大圖讓小圖先走；
+   沒有 job 在跑時一定放行，避免單張超大圖卡死）；
+3. 依實測的 RSS、CPU 使用率與吞吐量動態調整並行數，並在結束時記錄這些指標：
+   RSS 逼近預算就降；CPU 有閒置就加；CPU 滿載是目標狀態，本身不觸發降速，
+   只有加了並行數後吞吐量（每秒完成的足跡 bytes）反而下降時才退回並不再往上加。
+
+使用範例
+--------
+>>> sched = MemoryBudgetScheduler(budget_mb=4096, max_workers=32)
+>>> for path, fut in sched.run(process_image, paths):
+...     result = fut.result()
+>>> sched.metrics   # 每次執行的 CPU / RSS / 並行數統計
+"""
+
+import logging
+import os
+import time
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from collections import deque
+from pathlib import Path
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Optional, Tuple
+
+from PIL import Image
+
+try:
+    import psutil
+except ImportError:  # 選用相依：沒有時改讀 /proc
+    psutil = None
+
+log = logging.getLogger("scheduler")
+
+FOOTPRINT_BYTES_PER_PX = 8   # BGR(3) + gray(1) + Canny 輸出與暫存(~3) + 裁片餘裕(1)
+SAMPLE_INTERVAL = 1.0        # 秒：量測 CPU / RSS 並調整並行數的間隔
+CPU_LOW = 0.70               # CPU 使用率低於此值且記憶體有餘裕就加並行數
+RSS_HIGH = 0.90              # RSS 超過預算此比例就降低並行數
+THROUGHPUT_DROP = 0.15       # 吞吐量比少一個 worker 時低這麼多就退回
+SETTLE_SAMPLES = 3           # 每個並行數至少量測幾次才拿來比較吞吐量
+
+# ───────────────────────────── 量測工具
+
+def estimate_footprint(path: Path, bytes_per_px: int = FOOTPRINT_BYTES_PER_PX) -> int:
+    """只讀檔頭估計解碼後的記憶體足跡（bytes）；讀不到時以檔案大小 ×10 估算"""
+    try:
+        with Image.open(path) as img:
+            w, h = img.size
+        return w * h * bytes_per_px
+    except Exception:
+        try:
+            return os.path.getsize(path) * 10
+        except OSError:
+            return 0
+
+
+def total_memory() -> int:
+    """系統實體記憶體（bytes）"""
+    if psutil is not None:
+        return psutil.virtual_memory().total
+    try:
+        return os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES")
+    except (ValueError, OSError, AttributeError):
+        return 8 * 2**30
+
+
+def current_rss() -> int:
+    """目前行程的 RSS（bytes）"""
+    if psutil is not None:
+        return psutil.Process().memory_info().rss
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError):
+        return 0
+
+
+def _cpu_seconds() -> float:
+    t = os.times()
+    return t.user + t.system
+
+# ───────────────────────────── 排程器
+
+class MemoryBudgetScheduler:
+    """依記憶體預算放行 job，並依 CPU / RSS 調整並行數"""
+
+    def __init__(self, budget_mb: Optional[int] = None, max_workers: Optional[int] = None,
+                 min_workers: int = 1, bytes_per_px: int = FOOTPRINT_BYTES_PER_PX):
+        self.budget = (budget_mb * 2**20) if budget_mb else total_memory() // 2
+        self.max_workers = max_workers or min(32, (os.cpu_count() or 4) * 4)
+        self.min_workers = max(1, min(min_workers, self.max_workers))
+        self.bytes_per_px = bytes_per_px
+        self.limit = min(self.max_workers, os.cpu_count() or 4)
+        self.ceiling = self.max_workers     # 吞吐量不再隨並行數成長時的上限
+        self.metrics: Dict[str, Any] = {}
+        self._rates: Dict[int, deque] = {}  # 並行數 -> 最近的吞吐量樣本（bytes/秒）
+
+    def run(self, fn: Callable[..., Any], items: Iterable[Any], *args,
+            estimate: Optional[Callable[[Any], int]] = None, **kwargs) -> Iterator[Tuple[Any, Future]]:
+        """
+        執行 fn(item, *args, **kwargs)，依完成順序 yield (item, future)。
+        estimate(item) 可覆寫預設的檔頭足跡估計（例如串流模式只需 strip 大小）。
+        """
+        estimate = estimate or (lambda item: estimate_footprint(item, self.bytes_per_px))
+        pending: List[Tuple[Any, int]] = [(item, estimate(item)) for item in items]
+        running: Dict[Future, Tuple[Any, int]] = {}
+        in_flight = 0
+        finished = 0                        # 本次量測區間完成的足跡 bytes
+        n_cpu = os.cpu_count() or 1
+        samples: List[Dict[str, float]] = []
+        peak_in_flight = 0
+
+        t0 = last_t = time.perf_counter()
+        cpu0 = last_cpu = _cpu_seconds()
+
+        with ThreadPoolExecutor(self.max_workers) as pool:
+            while pending or running:
+                # 放行：並行數未滿且預算足夠（沒有 job 在跑時一定放行）
+                i = 0
+                while i < len(pending) and len(running) < self.limit:
+                    item, cost = pending[i]
+                    if running and in_flight + cost > self.budget:
+                        i += 1
+                        continue
+                    pending.pop(i)
+                    running[pool.submit(fn, item, *args, **kwargs)] = (item, cost)
+                    in_flight += cost
+                peak_in_flight = max(peak_in_flight, in_flight)
+
+                done, _ = wait(list(running), timeout=SAMPLE_INTERVAL, return_when=FIRST_COMPLETED)
+                for fut in done:
+                    item, cost = running.pop(fut)
+                    in_flight -= cost
+                    finished += cost
+                    yield item, fut
+
+                # 量測並調整並行數
+                now = time.perf_counter()
+                if now - last_t >= SAMPLE_INTERVAL:
+                    cpu = _cpu_seconds()
+                    util = (cpu - last_cpu) / ((now - last_t) * n_cpu)
+                    rss = current_rss()
+                    rate = finished / (now - last_t)
+                    samples.append({"t": round(now - t0, 2), "cpu": round(util, 3),
+                                    "rss_mb": round(rss / 2**20, 1), "workers": self.limit,
+                                    "in_flight_mb": round(in_flight / 2**20, 1),
+                                    "rate_mb_s": round(rate / 2**20, 1)})
+                    # 尾段已沒有待放行的 job，吞吐量自然下降，不拿來比較
+                    self._adjust(util, rss, rate if pending else None)
+                    last_t, last_cpu, finished = now, cpu, 0
+
+        wall = time.perf_counter() - t0
+        self.metrics = {
+            "wall_seconds": round(wall, 2),
+            "cpu_util_avg": round((_cpu_seconds() - cpu0) / (wall * n_cpu), 3) if wall else 0.0,
+            "rss_peak_mb": round(max([s["rss_mb"] for s in samples] + [current_rss() / 2**20]), 1),
+            "budget_mb": round(self.budget / 2**20, 1),
+            "peak_in_flight_mb": round(peak_in_flight / 2**20, 1),
+            "workers_final": self.limit,
+            "workers_max_used": max([s["workers"] for s in samples] + [self.limit]),
+            "samples": samples,
+        }
+        log.info(
+            f"排程統計: CPU 平均 {self.metrics['cpu_util_avg']:.0%}，RSS 峰值 "
+            f"{self.metrics['rss_peak_mb']:.0f} MB / 預算 {self.metrics['budget_mb']:.0f} MB，"
+            f"估計足跡峰值 {self.metrics['peak_in_flight_mb']:.0f} MB，"
+            f"並行數 {self.metrics['workers_final']}（最高 {self.metrics['workers_max_used']}）"
+        )
+
+    def _mean_rate(self, limit: int) -> Optional[float]:
+        rates = self._rates.get(limit)
+        if not rates or len(rates) < SETTLE_SAMPLES:
+            return None
+        return sum(rates) / len(rates)
+
+    def _adjust(self, cpu_util: float, rss: int, rate: Optional[float] = None) -> None:
+        """
+        RSS 過高就降並行數；多一個 worker 反而讓吞吐量下降就退回並設上限；
+        CPU 閒置且記憶體有餘裕就加。CPU 滿載本身不降（那正是要達到的狀態）。
+        """
+        old = self.limit
+        if rate is not None:
+            self._rates.setdefault(self.limit, deque(maxlen=2 * SETTLE_SAMPLES)).append(rate)
+        current, fewer = self._mean_rate(self.limit), self._mean_rate(self.limit - 1)
+        if rss > RSS_HIGH * self.budget:
+            self.limit = max(self.min_workers, self.limit - 1)
+        elif current is not None and fewer is not None and current < (1 - THROUGHPUT_DROP) * fewer:
+            self.ceiling = self.limit - 1
+            self.limit = max(self.min_workers, self.limit - 1)
+        elif (cpu_util < CPU_LOW and rss < 0.7 * self.budget and self.limit < self.ceiling
+              and (rate is None or current is not None)):
+            self.limit = min(self.max_workers, self.limit + 1)
+        if self.limit != old:
+            log.debug(f"並行數 {old} → {self.limit}（CPU {cpu_util:.0%}，RSS {rss / 2**20:.0f} MB"
+                      f"{f'，吞吐量 {rate / 2**20:.1f} MB/s' if rate is not None else ''}）")
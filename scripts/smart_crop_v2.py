@@ -11,6 +11,7 @@ $ python smart_crop_v2.py /path/to/product_383
 可選參數：
   --out   指定輸出根資料夾（預設為 <input>/split）
   --ext   逗號分隔的副檔名列表（預設 jpg,jpeg,png,webp,bmp,tif,tiff）
+  --encode-workers / --encode-queue / --encode  編碼階段的 worker 數、佇列上限與各格式參數
 
 程式特色
 --------
@@ -30,12 +31,17 @@ import os
 from datetime import datetime
 from itertools import chain
 from pathlib import Path
-from typing import List, Tuple
+from typing import List, Optional, Tuple
 
 import cv2
 import numpy as np
 from PIL import Image
 
+import crop_engine
+import image_inventory
+from crop_engine import CropEngine, RowProfile, get_preset, looks_like_text
+from crop_writer import CropWriter, parse_encode_settings
+
 # ───────────────────────────── 常數 及 logging
 LONG_SIDE_THRESHOLD = 2_000       # h > 此值視為長圖，啟用 edge‑projection
 MIN_CROP_HEIGHT = 120             # 裁片最小高度（px）
@@ -52,95 +58,30 @@ logging.basicConfig(
 log = logging.getLogger("smart_crop")
 
 # ───────────────────────────── 基本工具
+# 偵測邏輯已收斂到 crop_engine（preset "smart_crop_v2"）；以下保留舊介面
+
+ENGINE = CropEngine(get_preset("smart_crop_v2", min_crop_h=MIN_CROP_HEIGHT))
 
 def trim_border(img: np.ndarray, bg_thresh: int = BG_THRESH, consec: int = CONSEC_BORDER) -> Tuple[int, int, int, int]:
     """偵測四周純白邊框，回傳 (top, bottom, left, right) 應裁掉的像素數"""
-    gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
-    h, w = gray.shape
-
-    def _scan(indices, axis: str):
-        run = 0
-        for idx in indices:
-            line = gray[idx] if axis == "row" else gray[:, idx]
-            if (line > bg_thresh).all():
-                run += 1
-                if run >= consec:
-                    continue
-            else:
-                break
-        return run
-
-    top = _scan(range(h), "row")
-    bottom = _scan(range(h - 1, -1, -1), "row")
-    left = _scan(range(w), "col")
-    right = _scan(range(w - 1, -1, -1), "col")
-    return top, bottom, left, right
+    return crop_engine.trim_border(img, bg_thresh, consec)
 
 
 def merge_close(lines: List[int], orig_h: int, ratio: float = 0.06) -> List[int]:
     """合併彼此距離過近的 cut‑lines"""
-    if not lines:
-        return []
-    min_gap = max(120, int(ratio * orig_h))
-    merged = [lines[0]]
-    for y in lines[1:]:
-        if y - merged[-1] >= min_gap:
-            merged.append(y)
-    return merged
+    return crop_engine.merge_close(lines, max(120, int(ratio * orig_h)))
 
 
 # ───────────────────────────── cut‑line 偵測
 
 def blank_projection(gray: np.ndarray) -> List[int]:
     """依純白帶偵測 cut‑lines（動態門檻）"""
-    h, w = gray.shape
-    if w <= 800:
-        min_blank_run = 6
-    elif w <= 1600:
-        min_blank_run = 8
-    else:
-        min_blank_run = 10
-
-    # 算每列 "真白"(>245) 的比例 & 平均亮度
-    white_ratio = (gray > BG_THRESH).mean(axis=1)
-    row_mean = gray.mean(axis=1)
-
-    blank_mask = (white_ratio > MIN_WHITE_RATIO) & (row_mean > MIN_BAND_MEAN)
-
-    lines, run = [], None
-    for y, blank in enumerate(blank_mask):
-        if blank and run is None:
-            run = y
-        elif not blank and run is not None:
-            if y - run >= min_blank_run:
-                lines.append((run + y - 1) // 2)
-            run = None
-    if run is not None and h - run >= min_blank_run:
-        lines.append((run + h - 1) // 2)
-    return lines
+    return crop_engine.blank_projection(RowProfile(gray), BG_THRESH, MIN_WHITE_RATIO, MIN_BAND_MEAN)
 
 
 def long_edge_projection(gray: np.ndarray) -> List[int]:
     """長圖才啟用：找邊緣稀疏帶"""
-    h, w = gray.shape
-    if h <= LONG_SIDE_THRESHOLD:
-        return []
-    edges = cv2.Canny(gray, 50, 150)
-    profile = edges.sum(axis=1) / w
-    low = profile < 0.05 * 255
-    kernel = np.ones((40, 1), np.uint8)
-    band = cv2.morphologyEx(low.astype(np.uint8)[:, None], cv2.MORPH_CLOSE, kernel)[:, 0]
-
-    lines = []
-    start = None
-    for y, val in enumerate(band):
-        if val and start is None:
-            start = y
-        elif not val and start is not None:
-            if 0.1 * h < (mid := (start + y) // 2) < 0.9 * h:
-                lines.append(mid)
-            start = None
-    return lines
+    return crop_engine.edge_bands(RowProfile(gray), LONG_SIDE_THRESHOLD)
 
 
 # ───────────────────────────── 保留/捨棄邏輯
@@ -151,22 +92,12 @@ def small_fragment(h_seg: int, width: int, orig_h: int, is_text: bool = False) -
     return (h_seg < min_keep) and (not is_text)
 
 
-def looks_like_text(seg: np.ndarray) -> bool:
-    gray = cv2.cvtColor(seg, cv2.COLOR_BGR2GRAY)
-    edges = cv2.Canny(gray, 50, 150)
-    ratio = edges.sum() / edges.size
-    return ratio > 0.05 and gray.std() < 15
-
-
 # ───────────────────────────── 主裁切
 
-def crop_image(img: np.ndarray, image_path: Path, out_root: Path) -> List[dict]:
-    h, w = img.shape[:2]
-    gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
-
-    lines = merge_close(sorted(set(blank_projection(gray) + long_edge_projection(gray))), h)
-    # 若無切點 → 不裁但仍輸出 1 張
-    lines = [0] + lines + [h]
+def crop_image(img: np.ndarray, image_path: Path, out_root: Path,
+               writer: Optional[CropWriter] = None) -> List[dict]:
+    """偵測切線並輸出裁片；有 writer 時交給編碼階段非同步寫出"""
+    plan = ENGINE.plan(img, source=image_path)
 
     # 處理相對路徑
     try:
@@ -178,32 +109,29 @@ def crop_image(img: np.ndarray, image_path: Path, out_root: Path) -> List[dict]:
     out_dir.mkdir(parents=True, exist_ok=True)
 
     crops = []
-    crop_idx = 0  # 連續編號計數器
-    for idx in range(len(lines) - 1):
-        y1, y2 = lines[idx], lines[idx + 1]
-        seg_h = y2 - y1
-        seg = img[y1:y2]
-        if small_fragment(seg_h, w, h, looks_like_text(seg)):
-            continue
-            
+    for crop_idx, (y1, y2, x0, x1) in enumerate(plan.intervals()):  # 連續編號
+        seg = img[y1:y2, x0:x1]
         dst = out_dir / f"{image_path.stem}_crop_{crop_idx}.webp"
-        cv2.imwrite(str(dst), seg)
+        if writer is None:
+            cv2.imwrite(str(dst), seg)
+        else:
+            writer.submit(dst, seg)
         crops.append(
             {
                 "path": str(dst),
-                "height": seg_h,
-                "width": w,
+                "height": y2 - y1,
+                "width": x1 - x0,
                 "y_start": y1,
                 "y_end": y2,
             }
         )
-        crop_idx += 1  # 只有成功儲存才增加編號
     return crops
 
 
 # ───────────────────────────── 批次處理
 
-def process_dir(input_dir: Path, out_root: Path, exts: Tuple[str, ...]):
+def process_dir(input_dir: Path, out_root: Path, exts: Tuple[str, ...],
+                writer: Optional[CropWriter] = None):
     summary = {
         "input_dir": str(input_dir),
         "output_dir": str(out_root),
@@ -217,8 +145,7 @@ def process_dir(input_dir: Path, out_root: Path, exts: Tuple[str, ...]):
     if input_dir.is_file():
         paths = [input_dir]
     else:
-        paths = sorted(p for p in input_dir.rglob("*") 
-                      if p.suffix.lower().lstrip(".") in exts)
+        paths = image_inventory.scan(input_dir, tuple(f".{e}" for e in exts))
     
     for path in paths:
         try:
@@ -232,7 +159,7 @@ def process_dir(input_dir: Path, out_root: Path, exts: Tuple[str, ...]):
             if any((t, b, l, r)):
                 img = img[t : img.shape[0] - b, l : img.shape[1] - r]
                 
-            crops = crop_image(img, path, out_root)
+            crops = crop_image(img, path, out_root, writer)
             summary["total_images"] += 1
             summary["total_crops"] += len(crops)
             summary["files"][str(path)] = crops
@@ -240,6 +167,14 @@ def process_dir(input_dir: Path, out_root: Path, exts: Tuple[str, ...]):
         except Exception as e:
             log.error(f"處理 {path} 失敗: {e}")
             
+    detect_secs = (datetime.now() - datetime.fromisoformat(summary["start"])).total_seconds()
+    if writer is not None:
+        writer.close()
+        summary["encode"] = {k: v for k, v in writer.stats.items() if k != "failed"}
+        summary["encode_failed"] = writer.stats["failed"]
+        log.info(writer.report())
+    summary["detect_seconds"] = detect_secs
+    log.info(f"偵測: {summary['total_images']} 張 / {detect_secs:.2f} 秒")
     summary["end"] = datetime.now().isoformat()
     with open(out_root / "process_summary.json", "w", encoding="utf-8") as f:
         json.dump(summary, f, ensure_ascii=False, indent=2)
@@ -257,6 +192,11 @@ def parse_args():
         default="jpg,jpeg,png,webp,bmp,tif,tiff",
         help="要處理的副檔名 (逗號分隔)"
     )
+    p.add_argument("--encode-workers", type=int, default=min(8, os.cpu_count() or 4),
+                   help="編碼/寫檔 worker 數（0 = 在偵測迴圈內直接寫檔）")
+    p.add_argument("--encode-queue", type=int, default=64, help="待編碼裁片的佇列上限")
+    p.add_argument("--encode", action="append", default=[], metavar="FMT:K=V,...",
+                   help="各格式編碼參數，例如 webp:quality=90")
     return p.parse_args()
 
 
@@ -270,7 +210,10 @@ def main():
     log.info(f"📂 來源: {input_dir}")
     log.info(f"📦 輸出: {out_root}")
     log.info(f"🔍 副檔名: {exts}")
-    process_dir(input_dir, out_root, exts)
+    writer = None
+    if args.encode_workers > 0:
+        writer = CropWriter(args.encode_workers, args.encode_queue, parse_encode_settings(args.encode))
+    process_dir(input_dir, out_root, exts, writer)
 
 
 if __name__ == "__main__":
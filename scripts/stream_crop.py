@@ -0,0 +1,255 @@
+#!/usr/bin/env python3
+"""
+長圖串流裁切
+============
+
+數萬 px 高的詳情頁若整張解碼，再加上 gray / Canny 與列統計，
+記憶體會隨圖片高度線性成長。串流模式把圖片切成互相重疊的水平 strip：
+
+* 逐 strip 計算列統計（與 batch_runner.find_white_gaps / uniform_gaps /
+  long_edge_projection 相同的判斷），跨 strip 延續 run 狀態；
+* Canny 以上下各 `overlap` 列為上下文，避免邊界產生假邊緣：每個 strip 的最後
+  `overlap` 列延到下一個 strip 到了才分析，因此 strip 接縫兩側的判斷與整張模式相同；
+* 圖片結尾仍未結束的白帶 / 平坦帶 / 稀疏帶與整張模式一樣在結尾收尾成切線；
+* 一旦切線確定、片段夠高，就立即 yield 裁片並釋放緩衝。
+
+峰值記憶體約為 strip 高 + 最長片段（以 `max_segment` 強制切開）。
+
+解碼後端
+--------
+有 pyvips 時以 sequential access 逐 strip 解碼，真正不需要整張圖；
+否則退回 cv2.imread 一次解碼（衍生陣列仍只有 strip 大小）。
+
+與整張模式的差異
+----------------
+* 不做左右去邊；上下純白邊由第一/最後一段白帶吸收。
+* 稀疏邊緣帶的門檻用「目前為止」的平均邊緣密度，而非全圖平均。
+* 不做整張的覆蓋率回退與等分重切。
+"""
+
+import itertools
+import logging
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Callable, Iterator, List, Optional, Set, Tuple
+
+import cv2
+import numpy as np
+from PIL import Image
+
+try:
+    import pyvips
+except ImportError:  # 選用相依
+    pyvips = None
+
+log = logging.getLogger("stream_crop")
+
+STRIP_HEIGHT = 1024     # 每次解碼/分析的列數
+CANNY_OVERLAP = 32      # Canny 的上 / 下方上下文列數（分析延後的列數）
+MAX_SEGMENT = 4000      # 片段超過此高度就強制切開，限制緩衝大小
+
+# ───────────────────────────── strip 來源
+
+def image_size(path: Path) -> Tuple[int, int]:
+    """只讀檔頭取得 (寬, 高)"""
+    with Image.open(path) as img:
+        return img.size
+
+
+def iter_strips(path: Path, strip_h: int = STRIP_HEIGHT) -> Iterator[Tuple[int, np.ndarray]]:
+    """由上而下 yield (y0, BGR strip)"""
+    if pyvips is not None:
+        vimg = pyvips.Image.new_from_file(str(path), access="sequential")
+        if vimg.hasalpha():
+            vimg = vimg.flatten(background=255)
+        if vimg.bands == 1:
+            vimg = vimg.bandjoin([vimg, vimg])
+        w, h = vimg.width, vimg.height
+        for y0 in range(0, h, strip_h):
+            rgb = vimg.crop(0, y0, w, min(strip_h, h - y0)).numpy()
+            yield y0, np.ascontiguousarray(rgb[:, :, 2::-1])
+        return
+
+    img = cv2.imread(str(path))
+    if img is None:
+        raise ValueError(f"無法讀取圖片: {path}")
+    for y0 in range(0, img.shape[0], strip_h):
+        yield y0, img[y0:y0 + strip_h]
+
+# ───────────────────────────── run 狀態
+
+@dataclass
+class _Run:
+    """跨 strip 延續的連續列 run；累計像素和/平方和以計算整段 std"""
+    start: Optional[int] = None
+    total: float = 0.0
+    total_sq: float = 0.0
+    count: int = 0
+
+    def add(self, y: int, row_sum: float, row_sq: float, n: int) -> None:
+        if self.start is None:
+            self.start = y
+        self.total += row_sum
+        self.total_sq += row_sq
+        self.count += n
+
+    def std(self) -> float:
+        if not self.count:
+            return 0.0
+        mean = self.total / self.count
+        return float(np.sqrt(max(self.total_sq / self.count - mean * mean, 0.0)))
+
+    def reset(self) -> None:
+        self.start, self.total, self.total_sq, self.count = None, 0.0, 0.0, 0
+
+
+@dataclass
+class StreamState:
+    """串流分析的所有跨 strip 狀態"""
+    white: _Run = field(default_factory=_Run)
+    flat_start: Optional[int] = None
+    sparse_start: Optional[int] = None
+    edge_sum: float = 0.0
+    edge_rows: int = 0
+    tail: Optional[np.ndarray] = None   # 已分析的最後 overlap 列（gray），作為上方上下文
+    pending: Optional[np.ndarray] = None    # 已解碼、等下方上下文才分析的列（gray）
+    analyzed: int = 0                   # 已分析到的 y（不含）
+
+# ───────────────────────────── 主流程
+
+def stream_crop(path: Path,
+                strip_h: int = STRIP_HEIGHT,
+                overlap: int = CANNY_OVERLAP,
+                max_segment: int = MAX_SEGMENT,
+                min_crop_h: int = 200,
+                keep: Optional[Callable[[np.ndarray, int], bool]] = None,
+                row_mu_th: int = 250, row_std_th: int = 3, min_run: int = 18,
+                std_th: float = 2.5, mu_hi: int = 235, mu_lo: int = 25, flat_run: int = 4,
+                sparse_run: int = 10) -> Iterator[Tuple[int, int, np.ndarray]]:
+    """
+    串流裁切，依序 yield (y0, y1, crop)。
+
+    keep(crop, orig_h) 回傳 False 的片段會被丟棄（例如 batch_runner.small_fragment 的反向）。
+    """
+    w, h = image_size(path)
+    min_gap = 180 if h > 4000 else max(120, int(0.025 * h))
+    state = StreamState()
+    buf: List[np.ndarray] = []      # 上一條切線之後的 BGR 列
+    buf_start = 0                   # buf 第一列在原圖的 y
+    last_cut = 0
+    held: Set[int] = set()          # 尚未套用的切線
+
+    def _emit(cut: int) -> Iterator[Tuple[int, int, np.ndarray]]:
+        nonlocal buf, buf_start, last_cut
+        rows = np.vstack(buf) if len(buf) > 1 else buf[0]
+        seg = rows[last_cut - buf_start:cut - buf_start]
+        rest = rows[cut - buf_start:]
+        buf = [rest] if len(rest) else []
+        buf_start = cut
+        y0, last_cut = last_cut, cut
+        if keep is None or keep(seg, h):
+            yield y0, cut, seg
+
+    def _candidate(cut: int) -> Iterator[Tuple[int, int, np.ndarray]]:
+        # 與 merge_close 相同：距離上一條切線太近就忽略
+        if cut - last_cut >= max(min_gap, min_crop_h):
+            yield from _emit(cut)
+
+    def _scan(a0: int, gray: np.ndarray, density: np.ndarray) -> List[int]:
+        """逐列更新跨 strip 的 run 狀態，回傳 run 結束時產生的切線"""
+        n = gray.shape[0]
+        row_sum = gray.sum(axis=1, dtype=np.int64)
+        row_sq = np.einsum("ij,ij->i", gray, gray, dtype=np.int64)
+        row_mu = row_sum / w
+        row_std = np.sqrt((w * row_sq - row_sum * row_sum) / (w * w))   # 整數變異數，精確且非負
+        white = (row_mu > row_mu_th) & (row_std < row_std_th)
+        flat = (row_std < std_th) & ((row_mu > mu_hi) | (row_mu < mu_lo))
+
+        cuts: List[int] = []
+        for i in range(n):
+            y = a0 + i
+            # ① 純白帶（整段 std < 1.5 才算）
+            if white[i]:
+                state.white.add(y, row_sum[i], row_sq[i], w)
+            elif state.white.start is not None:
+                if y - state.white.start >= min_run and state.white.std() < 1.5:
+                    cuts.append((state.white.start + y - 1) // 2)
+                state.white.reset()
+            # ② 低變異度極亮/極暗帶
+            if flat[i]:
+                if state.flat_start is None:
+                    state.flat_start = y
+            elif state.flat_start is not None:
+                if y - state.flat_start >= flat_run:
+                    cuts.append((state.flat_start + y - 1) // 2)
+                state.flat_start = None
+            # ③ 稀疏邊緣帶（以目前為止的平均密度為基準）
+            state.edge_sum += density[i]
+            state.edge_rows += 1
+            sparse = density[i] < 0.3 * state.edge_sum / state.edge_rows
+            if sparse:
+                if state.sparse_start is None:
+                    state.sparse_start = y
+            elif state.sparse_start is not None:
+                if y - state.sparse_start >= sparse_run:
+                    cuts.append((state.sparse_start + y - 1) // 2)
+                state.sparse_start = None
+        return cuts
+
+    # 最後補一個 None 代表圖片結束：剩下等待下方上下文的列直接分析
+    for y0, strip in itertools.chain(iter_strips(path, strip_h), [(h, None)]):
+        final = strip is None
+        if final:
+            if state.pending is None or not len(state.pending):
+                break
+            window = state.pending
+        else:
+            if strip.ndim == 3 and strip.shape[2] == 4:
+                strip = cv2.cvtColor(strip, cv2.COLOR_BGRA2BGR)
+            buf.append(strip)
+            gray = cv2.cvtColor(strip, cv2.COLOR_BGR2GRAY)
+            window = gray if state.pending is None else np.vstack((state.pending, gray))
+
+        # 本輪只分析到 window 倒數 overlap 列之前，其餘留作下方上下文、下一輪再分析
+        n = len(window) if final else max(0, len(window) - overlap)
+        a0 = state.analyzed
+        above = 0 if state.tail is None else len(state.tail)
+        ctx = window if state.tail is None else np.vstack((state.tail, window))
+        edges = cv2.Canny(ctx, 50, 150)[above:above + n]
+        density = edges.sum(axis=1, dtype=np.float64) / w
+        rows = window[:n]
+        state.pending = None if final else window[n:].copy()
+        if n and overlap:
+            tail = rows if state.tail is None else np.vstack((state.tail, rows))
+            state.tail = tail[-overlap:].copy()
+        state.analyzed = a0 + n
+
+        # 切線依位置順序套用 min_gap：仍開著的 run 將來可能在更前面產生切線，
+        # 先保留到它們不可能再更前面為止（與整張一次排序的結果相同）
+        held.update(_scan(a0, rows, density))
+        open_starts = [y for y in (state.white.start, state.flat_start, state.sparse_start) if y is not None]
+        bound = min(((y + state.analyzed - 1) // 2 for y in open_starts), default=state.analyzed)
+        for cut in sorted(c for c in held if c <= bound):
+            held.discard(cut)
+            yield from _candidate(cut)
+
+        # 片段過長時強制切開，限制緩衝
+        while state.analyzed - last_cut > max_segment:
+            yield from _emit(last_cut + max_segment)
+
+    # 收尾：延伸到圖片底部的 run 與整張模式一樣成為切線
+    cuts = list(held)
+    if state.white.start is not None and h - state.white.start >= min_run and state.white.std() < 1.5:
+        cuts.append((state.white.start + h - 1) // 2)
+    if state.flat_start is not None and h - state.flat_start >= flat_run:
+        cuts.append((state.flat_start + h - 1) // 2)
+    if state.sparse_start is not None and h - state.sparse_start >= sparse_run:
+        cuts.append((state.sparse_start + h - 1) // 2)
+    for cut in sorted(set(cuts)):
+        yield from _candidate(cut)
+
+    # 最後一段
+    if buf and h - last_cut >= min_crop_h:
+        yield from _emit(h)
+    elif buf and last_cut > 0:
+        log.debug(f"捨棄最後過矮的片段 {last_cut}-{h}: {path}")
@@ -0,0 +1,415 @@
+#!/usr/bin/env python3
+"""
+裁切門檻自動調校
+================
+
+產品資料夾裡已有手動裁好的 `<原圖>-crop01.jpg … cropNN.jpg`。本工具：
+
+1. 以 template matching 把每個手動裁片對回原圖，還原出 ground-truth 區間
+   （結果快取在 results/tuning/ground_truth.json，原圖變動才重算）；
+2. 對指定 preset 的偵測器參數做 grid / random / Bayes（需 optuna）搜尋；
+3. 依 CPU 核心把圖片分片給常駐 worker process，每個 worker 只載入自己那片的灰階圖，
+   並為每張圖保留 CropEngine 的 cache（去邊結果 + RowProfile 列統計），
+   數千組參數只需計算一次共用的中間結果；
+4. 報告每組參數的切線 precision / recall / F1、裁片 IoU 與冷啟動偵測時間，
+   並標出「準確度 vs 執行時間」的 Pareto 前緣。
+
+評分方式
+--------
+相鄰兩個 ground-truth 裁片之間的空隙（± tolerance）是一個「切線區」；
+預測計畫中相鄰裁片之間的中點若落在尚未配對的切線區內即為命中。
+precision / recall / F1 以所有圖片的命中數合計（micro）。
+
+使用範例
+--------
+$ python tune_crop.py --preset batch_runner --search grid
+$ python tune_crop.py --preset cropper --search bayes --trials 300 --workers 8
+$ python tune_crop.py --preset batch_runner --space my_space.json   # {"white_gaps.min_run": [8, 12, 18]}
+"""
+
+import argparse
+import itertools
+import json
+import logging
+import os
+import random
+import re
+import time
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Tuple
+
+import cv2
+import numpy as np
+
+from crop_engine import PRESETS, CropEngine, get_preset
+
+try:
+    import optuna
+except ImportError:  # 選用相依：沒有時 --search bayes 改用 random
+    optuna = None
+
+log = logging.getLogger("tune_crop")
+
+BASE_DIR = Path(__file__).parent.parent
+CORPUS_DIR = BASE_DIR / "products" / "WWW_Collection"
+TUNE_DIR = BASE_DIR / "results" / "tuning"
+GT_CACHE = TUNE_DIR / "ground_truth.json"
+
+CROP_FILE_RE = re.compile(r"^(?P<parent>.+)-crop(?P<idx>\d+)$", re.IGNORECASE)
+MATCH_SCALE = 4          # 粗配對時的縮小倍率
+MATCH_MAX_SCORE = 0.05   # TM_SQDIFF_NORMED 超過此值視為對不回原圖
+CUT_TOLERANCE = 24       # px：切線區左右放寬
+TIME_SAMPLE = 2          # 每個 worker 以前幾張圖量測冷啟動偵測時間
+
+# 各 preset 預設的搜尋空間（key 規則同 Preset.with_params）
+DEFAULT_SPACES: Dict[str, Dict[str, List[Any]]] = {
+    "batch_runner": {
+        "bg_thresh": [240, 245, 250],
+        "white_gaps.row_mu_th": [240, 245, 250],
+        "white_gaps.row_std_th": [2, 3, 5],
+        "white_gaps.min_run": [8, 12, 18, 24],
+        "uniform_gaps.std_th": [1.5, 2.5, 4.0],
+        "sparse_edges.rel_thresh": [0.2, 0.3, 0.4],
+        "min_crop_h": [120, 200, 300],
+    },
+    "smart_crop_v2": {
+        "blank_projection.bg_thresh": [240, 245, 250],
+        "blank_projection.min_white_ratio": [0.88, 0.92, 0.96],
+        "blank_projection.min_run": [None, 4, 8, 12],
+        "edge_bands.edge_ratio": [0.03, 0.05, 0.08],
+        "min_gap_ratio": [0.03, 0.06, 0.09],
+        "min_crop_h": [80, 120, 200],
+    },
+    "cropper": {
+        "bg_thresh": [240, 245, 250],
+        "dark_ratio_blank.dark_thresh": [240, 245, 250],
+        "dark_ratio_blank.min_run": [None, 6, 10, 15],
+        "dark_ratio_blank.min_gap_ratio": [0.03, 0.06, 0.09],
+        "edge_bands.edge_ratio": [0.03, 0.05, 0.08],
+        "abs_min": [200, 300, 400],
+    },
+    "product_516": {
+        "white_ratio_split.bg_thresh": [240, 245, 250],
+        "white_ratio_split.min_pct": [0.92, 0.96, 0.99],
+        "white_ratio_split.min_run": [4, 6, 10, 16],
+        "merge_gap": [20, 40, 80],
+        "min_h": [20, 40, 80],
+    },
+}
+
+Interval = Tuple[int, int]   # (y0, y1)
+
+# ───────────────────────────── ground truth
+
+def match_crop(parent_gray: np.ndarray, crop_gray: np.ndarray,
+               scale: int = MATCH_SCALE) -> Optional[Tuple[int, int, int, int, float]]:
+    """
+    找出裁片在原圖中的位置，回傳 (y0, y1, x0, x1, score)；對不回去時回傳 None。
+    先在縮小圖上粗配對，再於原尺寸的小視窗內精修。
+    """
+    ph, pw = parent_gray.shape
+    ch, cw = crop_gray.shape
+    if ch > ph or cw > pw:
+        return None
+    y, x = 0, 0
+    if ch >= 4 * scale and cw >= 4 * scale:
+        small_p = cv2.resize(parent_gray, (pw // scale, ph // scale), interpolation=cv2.INTER_AREA)
+        small_c = cv2.resize(crop_gray, (cw // scale, ch // scale), interpolation=cv2.INTER_AREA)
+        res = cv2.matchTemplate(small_p, small_c, cv2.TM_SQDIFF_NORMED)
+        _, _, loc, _ = cv2.minMaxLoc(res)
+        y, x = loc[1] * scale, loc[0] * scale
+    # 精修：原尺寸、±scale px 視窗
+    ya, yb = max(0, y - scale), min(ph, y + ch + scale)
+    xa, xb = max(0, x - scale), min(pw, x + cw + scale)
+    res = cv2.matchTemplate(parent_gray[ya:yb, xa:xb], crop_gray, cv2.TM_SQDIFF_NORMED)
+    score, _, loc, _ = cv2.minMaxLoc(res)
+    if score > MATCH_MAX_SCORE:
+        return None
+    y0, x0 = ya + loc[1], xa + loc[0]
+    return y0, y0 + ch, x0, x0 + cw, float(score)
+
+
+def _crop_groups(root: Path) -> Dict[Path, List[Path]]:
+    """{原圖: [手動裁片...]}，找不到原圖的裁片略過"""
+    groups: Dict[Path, List[Path]] = defaultdict(list)
+    for crop in sorted(root.rglob("*-crop*.*")):
+        m = CROP_FILE_RE.match(crop.stem)
+        if not m:
+            continue
+        parent = crop.with_name(m.group("parent") + crop.suffix)
+        if parent.exists():
+            groups[parent].append(crop)
+    return groups
+
+
+def load_ground_truth(root: Path = CORPUS_DIR, cache_path: Path = GT_CACHE,
+                      refresh: bool = False) -> Dict[str, Dict[str, Any]]:
+    """
+    回傳 {原圖路徑: {"height", "width", "mtime", "crops": [[y0, y1, x0, x1, score], ...]}}。
+    快取中 mtime 相同的原圖直接沿用。
+    """
+    cached: Dict[str, Dict[str, Any]] = {}
+    if cache_path.exists() and not refresh:
+        with open(cache_path, "r", encoding="utf-8") as f:
+            cached = json.load(f)
+
+    gt: Dict[str, Dict[str, Any]] = {}
+    missed = 0
+    for parent, crops in _crop_groups(root).items():
+        key, mtime = str(parent), parent.stat().st_mtime
+        if key in cached and cached[key]["mtime"] == mtime and len(cached[key]["files"]) == len(crops):
+            gt[key] = cached[key]
+            continue
+        parent_gray = cv2.imread(key, cv2.IMREAD_GRAYSCALE)
+        if parent_gray is None:
+            continue
+        boxes = []
+        for crop in crops:
+            crop_gray = cv2.imread(str(crop), cv2.IMREAD_GRAYSCALE)
+            box = match_crop(parent_gray, crop_gray) if crop_gray is not None else None
+            if box is None:
+                missed += 1
+                log.debug(f"裁片對不回原圖: {crop}")
+                continue
+            boxes.append(list(box))
+        if boxes:
+            gt[key] = {"height": parent_gray.shape[0], "width": parent_gray.shape[1], "mtime": mtime,
+                       "files": [c.name for c in crops], "crops": sorted(boxes)}
+
+    cache_path.parent.mkdir(parents=True, exist_ok=True)
+    with open(cache_path, "w", encoding="utf-8") as f:
+        json.dump(gt, f, ensure_ascii=False, indent=2)
+    log.info(f"ground truth: {len(gt)} 張原圖 / {sum(len(g['crops']) for g in gt.values())} 個裁片"
+             f"（{missed} 個對不回原圖）")
+    return gt
+
+# ───────────────────────────── 評分
+
+def _cut_zones(intervals: List[Interval]) -> List[Interval]:
+    """相鄰區間之間的空隙（重疊時為重疊段）"""
+    iv = sorted(intervals)
+    return [(min(a[1], b[0]), max(a[1], b[0])) for a, b in zip(iv, iv[1:])]
+
+
+def score_plan(pred: List[Interval], truth: List[Interval], tol: int = CUT_TOLERANCE) -> Dict[str, float]:
+    """單張圖的切線命中數與裁片 IoU 合計"""
+    zones = _cut_zones(truth)
+    cuts = [(a + b) // 2 for a, b in _cut_zones(pred)]
+    used = [False] * len(zones)
+    tp = 0
+    for y in cuts:
+        for i, (a, b) in enumerate(zones):
+            if not used[i] and a - tol <= y <= b + tol:
+                used[i] = True
+                tp += 1
+                break
+
+    iou = 0.0
+    for t0, t1 in truth:
+        best = 0.0
+        for p0, p1 in pred:
+            inter = min(t1, p1) - max(t0, p0)
+            if inter > 0:
+                best = max(best, inter / (max(t1, p1) - min(t0, p0)))
+        iou += best
+    return {"tp": tp, "fp": len(cuts) - tp, "fn": len(zones) - tp, "iou_sum": iou, "n_truth": len(truth)}
+
+
+def summarize(acc: Dict[str, float]) -> Dict[str, float]:
+    tp, fp, fn = acc["tp"], acc["fp"], acc["fn"]
+    precision = tp / (tp + fp) if tp + fp else 1.0
+    recall = tp / (tp + fn) if tp + fn else 1.0
+    f1 = 2 * precision * recall / (precision + recall) if precision + recall else 0.0
+    return {
+        "f1": round(f1, 4),
+        "precision": round(precision, 4),
+        "recall": round(recall, 4),
+        "crop_iou": round(acc["iou_sum"] / acc["n_truth"], 4) if acc["n_truth"] else 0.0,
+        "ms_per_image": round(acc["ms"] / acc["timed"], 2) if acc["timed"] else 0.0,
+    }
+
+# ───────────────────────────── 分片 worker
+
+_SHARD: List[Dict[str, Any]] = []
+_PRESET = ""
+
+
+def _init_shard(items: List[Tuple[str, List[Interval]]], preset: str) -> None:
+    """worker 啟動時載入自己那片圖片（只留灰階，RowProfile 與去邊都只需灰階）"""
+    global _PRESET
+    _PRESET = preset
+    for path, truth in items:
+        gray = cv2.imread(path, cv2.IMREAD_GRAYSCALE)
+        if gray is not None:
+            _SHARD.append({"path": path, "gray": gray, "truth": truth, "cache": {}})
+
+
+def _eval_configs(configs: List[Dict[str, Any]], time_sample: int) -> List[Dict[str, float]]:
+    """評估一批參數組合，回傳各組在本分片的累計值"""
+    out = []
+    for params in configs:
+        engine = CropEngine(get_preset(_PRESET, **params))
+        acc = {"tp": 0, "fp": 0, "fn": 0, "iou_sum": 0.0, "n_truth": 0, "ms": 0.0, "timed": 0}
+        for i, item in enumerate(_SHARD):
+            plan = engine.plan(item["gray"], cache=item["cache"])
+            pred = [(b[0], b[1]) for b in plan.intervals()]
+            for k, v in score_plan(pred, item["truth"]).items():
+                acc[k] += v
+            if i < time_sample:
+                # 冷啟動時間：不使用 cache，反映實際單張偵測成本
+                t = time.perf_counter()
+                engine.plan(item["gray"])
+                acc["ms"] += (time.perf_counter() - t) * 1000
+                acc["timed"] += 1
+        out.append(acc)
+    return out
+
+
+class ShardPool:
+    """每個分片一個常駐 process，分片的圖片與 cache 在整個搜尋期間保留"""
+
+    def __init__(self, gt: Dict[str, Dict[str, Any]], preset: str, workers: int,
+                 time_sample: int = TIME_SAMPLE):
+        items = [(path, [(c[0], c[1]) for c in g["crops"]]) for path, g in gt.items()]
+        # 依像素量輪流分配，讓各分片負載接近
+        items.sort(key=lambda it: -gt[it[0]]["height"] * gt[it[0]]["width"])
+        workers = max(1, min(workers, len(items)))
+        shards = [items[i::workers] for i in range(workers)]
+        self.time_sample = time_sample
+        self.pools = [ProcessPoolExecutor(1, initializer=_init_shard, initargs=(shard, preset))
+                      for shard in shards]
+
+    def evaluate(self, configs: List[Dict[str, Any]]) -> List[Dict[str, float]]:
+        futures = [pool.submit(_eval_configs, configs, self.time_sample) for pool in self.pools]
+        totals = [defaultdict(float) for _ in configs]
+        for fut in futures:
+            for total, acc in zip(totals, fut.result()):
+                for k, v in acc.items():
+                    total[k] += v
+        return [summarize(t) for t in totals]
+
+    def close(self) -> None:
+        for pool in self.pools:
+            pool.shutdown()
+
+# ───────────────────────────── 搜尋
+
+def grid(space: Dict[str, List[Any]]) -> List[Dict[str, Any]]:
+    keys = list(space)
+    return [dict(zip(keys, combo)) for combo in itertools.product(*(space[k] for k in keys))]
+
+
+def search(pool: ShardPool, space: Dict[str, List[Any]], method: str = "grid",
+           trials: int = 200, batch: int = 64, seed: int = 0) -> List[Dict[str, Any]]:
+    """回傳 [{"params", "f1", ...}, ...]；第一筆永遠是 preset 預設值"""
+    results = [{"params": {}, **pool.evaluate([{}])[0]}]
+    log.info(f"預設參數: F1 {results[0]['f1']:.3f}，{results[0]['ms_per_image']:.1f} ms/張")
+
+    if method == "bayes" and optuna is None:
+        log.warning("未安裝 optuna，改用 random search")
+        method = "random"
+
+    if method == "bayes":
+        optuna.logging.set_verbosity(optuna.logging.WARNING)
+        study = optuna.create_study(direction="maximize", sampler=optuna.samplers.TPESampler(seed=seed))
+        done = 0
+        while done < trials:
+            n = min(batch, trials - done)
+            asked = [study.ask() for _ in range(n)]
+            configs = [{k: t.suggest_categorical(k, v) for k, v in space.items()} for t in asked]
+            for t, params, r in zip(asked, configs, pool.evaluate(configs)):
+                study.tell(t, r["f1"])
+                results.append({"params": params, **r})
+            done += n
+            log.info(f"bayes {done}/{trials}，目前最佳 F1 {study.best_value:.3f}")
+        return results
+
+    configs = grid(space)
+    if method == "random" and trials < len(configs):
+        configs = random.Random(seed).sample(configs, trials)
+    for i in range(0, len(configs), batch):
+        chunk = configs[i:i + batch]
+        results += [{"params": p, **r} for p, r in zip(chunk, pool.evaluate(chunk))]
+        log.info(f"{method} {min(i + batch, len(configs))}/{len(configs)}，"
+                 f"目前最佳 F1 {max(r['f1'] for r in results):.3f}")
+    return results
+
+
+def pareto_front(results: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """F1 越高、ms/張 越低越好；回傳不被任何其他組合同時勝過的組合"""
+    front, best_f1 = [], -1.0
+    for r in sorted(results, key=lambda r: (r["ms_per_image"], -r["f1"])):
+        if r["f1"] > best_f1:
+            front.append(r)
+            best_f1 = r["f1"]
+    return front
+
+
+def report(results: List[Dict[str, Any]], top: int = 15) -> str:
+    front = {id(r) for r in pareto_front(results)}
+    lines = [f"{'F1':>7}{'prec':>7}{'rec':>7}{'IoU':>7}{'ms/張':>9}  P  參數"]
+    for r in sorted(results, key=lambda r: (-r["f1"], r["ms_per_image"]))[:top]:
+        params = json.dumps(r["params"], ensure_ascii=False) if r["params"] else "(預設)"
+        lines.append(f"{r['f1']:>7.3f}{r['precision']:>7.3f}{r['recall']:>7.3f}{r['crop_iou']:>7.3f}"
+                     f"{r['ms_per_image']:>9.1f}  {'*' if id(r) in front else ' '}  {params}")
+    return "\n".join(lines)
+
+# ───────────────────────────── CLI
+
+def cli() -> argparse.Namespace:
+    p = argparse.ArgumentParser(description="以手動裁片為 ground truth 調校裁切門檻")
+    p.add_argument("--preset", choices=sorted(PRESETS), default="batch_runner", help="要調校的 preset")
+    p.add_argument("--search", choices=("grid", "random", "bayes"), default="grid",
+                   help="搜尋方式（bayes 需要 optuna）")
+    p.add_argument("--trials", type=int, default=200, help="random / bayes 的組合數")
+    p.add_argument("--batch", type=int, default=64, help="每批送給 worker 的組合數")
+    p.add_argument("--space", type=Path, default=None, help="自訂搜尋空間 JSON（{參數: [候選值...]}）")
+    p.add_argument("--workers", type=int, default=os.cpu_count() or 4, help="分片 worker 數")
+    p.add_argument("--time-sample", type=int, default=TIME_SAMPLE,
+                   help=f"每個 worker 量測冷啟動時間的圖片數（預設 {TIME_SAMPLE}）")
+    p.add_argument("--root", type=Path, default=CORPUS_DIR, help="含手動裁片的產品根目錄")
+    p.add_argument("--refresh-gt", action="store_true", help="忽略 ground truth 快取重新配對")
+    p.add_argument("--seed", type=int, default=0)
+    p.add_argument("--top", type=int, default=15, help="報表列出前幾名")
+    p.add_argument("--out", type=Path, default=None, help="結果 JSON（預設 results/tuning/<preset>_<時間>.json）")
+    return p.parse_args()
+
+
+def main():
+    args = cli()
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
+
+    gt = load_ground_truth(args.root, refresh=args.refresh_gt)
+    if not gt:
+        log.warning("找不到任何可對回原圖的手動裁片")
+        return
+    if args.space:
+        with open(args.space, "r", encoding="utf-8") as f:
+            space = json.load(f)
+    else:
+        space = DEFAULT_SPACES[args.preset]
+
+    t0 = time.perf_counter()
+    pool = ShardPool(gt, args.preset, args.workers, args.time_sample)
+    try:
+        results = search(pool, space, args.search, args.trials, args.batch, args.seed)
+    finally:
+        pool.close()
+    elapsed = time.perf_counter() - t0
+
+    out = args.out or TUNE_DIR / f"{args.preset}_{datetime.now():%Y%m%d_%H%M%S}.json"
+    out.parent.mkdir(parents=True, exist_ok=True)
+    with open(out, "w", encoding="utf-8") as f:
+        json.dump({"preset": args.preset, "search": args.search, "space": space,
+                   "images": len(gt), "elapsed_seconds": round(elapsed, 1),
+                   "pareto": pareto_front(results), "results": results}, f, ensure_ascii=False, indent=2)
+
+    print(report(results, args.top))
+    log.info(f"共評估 {len(results)} 組參數 / {elapsed:.1f} 秒，結果已儲存: {out}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,15 +1,29 @@
 import os
 import json
-import time
+import asyncio
 import logging
 import argparse
-import base64
+import copy
+import fnmatch
+import urllib.error
+import urllib.request
+from dataclasses import dataclass, field
 from pathlib import Path
-from PIL import Image
 from dotenv import load_dotenv
 import google.generativeai as genai
+from google.api_core import exceptions as google_exceptions
 import openai
 
+import ai_batcher
+import ai_cache
+import ai_dispatch
+import ai_journal
+import ai_payload
+import ai_router
+import crop_classifier
+import crop_dedupe
+import image_inventory
+
 # --- 設定 ---
 # 載入 .env 檔案中的環境變數 (例如 .env 檔案在 scripts/ 底下)
 load_dotenv(Path(__file__).parent / '.env')
@@ -29,6 +43,24 @@ BASE_DIR = Path(__file__).resolve().parent.parent
 # 根據 crawl_www.py 的定義，確保路徑一致性
 WWW_DIR = BASE_DIR / "products" / "WWW_Collection"
 
+BATCH_SIZE = 6
+CHECKPOINT_BATCHES = 10     # 每個產品每回來幾批就合併一次 analysis.json
+# TPM 估算：prompt、每張圖與回應上限（OpenAI 以 max_tokens 預扣額度）
+PROMPT_TOKENS = 1500
+IMAGE_TOKENS = 800
+MAX_OUTPUT_TOKENS = 4096
+
+# 各供應商的模型與呼叫參數；也是 AI 回應快取鍵的一部分
+PROVIDER_MODELS = {
+    "google": ("gemini-1.5-flash", {}),
+    "openai": ("gpt-4-turbo", {"max_tokens": MAX_OUTPUT_TOKENS}),
+    "standin": ("standin", {"max_tokens": MAX_OUTPUT_TOKENS}),
+}
+
+# 本機替身 API（ai_standin.py），--model standin 時使用
+STANDIN_URL = os.getenv("AI_STANDIN_URL", "http://127.0.0.1:8765/v1")
+STANDIN_TIMEOUT = 120
+
 # --- API 金鑰與客戶端初始化 ---
 GOOGLE_API_KEY = os.getenv("GOOGLE_API_KEY")
 OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
@@ -44,7 +76,7 @@ if not OPENAI_API_KEY:
     logging.warning("未在 .env 檔案中找到 OPENAI_API_KEY。")
 
 def batch_images(image_list, batch_size=6):
-    """將圖片列表切分為指定大小的批次。"""
+    """將圖片列表切分為指定大小的批次（固定張數；自適應裝箱見 ai_batcher）。"""
     for i in range(0, len(image_list), batch_size):
         yield image_list[i:i + batch_size]
 
@@ -85,132 +117,300 @@ AI_PROMPT_TEMPLATE = """
 最後，將所有圖片的分析結果，打包成一個以**圖片檔名**為鍵 (key) 的單一 JSON 物件回傳。不要包含任何額外的 markdown 語法。
 """
 
-def analyze_batch_with_google(product_name, image_batch):
+def _parse_reply(text, provider_label, hit_limit=False, headers=None):
+    """
+    去掉 markdown 圍欄並解析模型回傳的 JSON。
+    只有停在輸出上限（hit_limit）才拋出 ai_batcher.TruncatedReply，讓批次器調高輸出估計；
+    正常結束卻解析失敗是模型格式錯誤，拋出 json.JSONDecodeError，由呼叫端當一般失敗處理。
+    """
+    cleaned_text = (text or "").strip().lstrip('```json').rstrip('```')
+    logging.info(f"{provider_label} 回應內容:\n{cleaned_text}")
+    if hit_limit:
+        raise ai_batcher.TruncatedReply(f"{provider_label} 回應停在輸出上限", headers=headers)
+    return json.loads(cleaned_text)
+
+# 供應商呼叫：回傳 (分析結果, 回應標頭)；限流時拋出 ai_dispatch.RateLimited 交給派送器重試，
+# 回應停在輸出上限時拋出 ai_batcher.TruncatedReply（由批次器記錄後轉成失敗），
+# 其他錯誤（含 JSON 格式錯誤）記錄後回傳 (None, 標頭)。
+
+def request_batch_google(product_name, image_batch):
     """使用 Google Gemini 對一個批次的圖片進行分類與分析。"""
-    if not image_batch: return None
+    if not image_batch: return None, {}
     if not GOOGLE_API_KEY:
         logging.error("未設定 GOOGLE_API_KEY，無法使用 Google Gemini。")
-        return None
+        return None, {}
 
     try:
         logging.info(f"送出新批次至 Google Gemini (共 {len(image_batch)} 張圖)...")
-        model = genai.GenerativeModel('gemini-1.5-flash')
+        model = genai.GenerativeModel(PROVIDER_MODELS["google"][0])
         
         prompt = AI_PROMPT_TEMPLATE.format(product_name=product_name)
         prompt_parts = [prompt]
 
         for image_path in image_batch:
             try:
-                img = Image.open(image_path)
+                # 縮到 Gemini 的有效解析度並以正確 MIME 內嵌，編碼結果跨重試共用
+                part = ai_payload.prepare(image_path, "google").gemini_part()
                 prompt_parts.append(f"檔名: {image_path.name}")
-                prompt_parts.append(img)
+                prompt_parts.append(part)
             except Exception as e:
                 logging.warning(f"無法讀取圖片 {image_path.name}，已跳過。錯誤: {e}")
                 continue
         
         response = model.generate_content(prompt_parts, stream=False)
         response.resolve()
-        
-        cleaned_text = response.text.strip().lstrip('```json').rstrip('```')
-        logging.info(f"Google Gemini 回應內容:\n{cleaned_text}")
-        analysis_result = json.loads(cleaned_text)
-        
+
+        finish = response.candidates[0].finish_reason if response.candidates else None
+        hit_limit = getattr(finish, "name", str(finish)) == "MAX_TOKENS"
+        analysis_result = _parse_reply(response.text, "Google Gemini", hit_limit)
         logging.info(f"Google Gemini 批次分析成功。")
-        return analysis_result
+        # Gemini SDK 不提供回應標頭，只能靠 429 與本地 RPM / TPM 節流
+        return analysis_result, {}
 
+    except google_exceptions.ResourceExhausted as e:
+        raise ai_dispatch.RateLimited(str(e))
+    except ai_batcher.TruncatedReply:
+        raise
     except Exception as e:
         logging.error(f"Google Gemini 批次分析失敗: {e}")
-        return None
-
-def encode_image_to_base64(image_path):
-    """將圖片檔案編碼為 Base64 字串"""
-    with open(image_path, "rb") as image_file:
-        return base64.b64encode(image_file.read()).decode('utf-8')
+        return None, {}
 
-def analyze_batch_with_openai(product_name, image_batch):
+def build_openai_content(product_name, image_batch, provider="openai"):
+    """組出 OpenAI 格式的 content：第一個元素是文字 prompt，之後每張圖接著它的檔名。"""
+    content_parts = [{"type": "text", "text": AI_PROMPT_TEMPLATE.format(product_name=product_name)}]
+    for image_path in image_batch:
+        try:
+            payload = ai_payload.prepare(image_path, provider)
+            # 每個圖片是一個獨立的 dict 元素
+            content_parts.append({
+                "type": "image_url",
+                "image_url": {
+                    "url": payload.data_url()
+                }
+            })
+            # 附上檔名讓 AI 知道對應關係
+            content_parts.append({"type": "text", "text": f"檔名: {image_path.name}"})
+        except Exception as e:
+            logging.warning(f"無法讀取或編碼圖片 {image_path.name}，已跳過。錯誤: {e}")
+    return content_parts
+
+def request_batch_openai(product_name, image_batch):
     """使用 OpenAI GPT-4V 對一個批次的圖片進行分類與分析。"""
-    if not image_batch: return None
+    if not image_batch: return None, {}
     if not openai_client:
         logging.error("未設定 OPENAI_API_KEY，無法使用 OpenAI。")
-        return None
+        return None, {}
 
+    headers = {}
     try:
         logging.info(f"送出新批次至 OpenAI GPT-4V (共 {len(image_batch)} 張圖)...")
-        
-        prompt = AI_PROMPT_TEMPLATE.format(product_name=product_name)
-        # OpenAI 的 content 是一個 list，第一個元素是文字 prompt
-        content_parts = [{"type": "text", "text": prompt}]
+        content_parts = build_openai_content(product_name, image_batch)
 
-        for image_path in image_batch:
-            try:
-                base64_image = encode_image_to_base64(image_path)
-                # 每個圖片是一個獨立的 dict 元素
-                content_parts.append({
-                    "type": "image_url",
-                    "image_url": {
-                        "url": f"data:image/jpeg;base64,{base64_image}"
-                    }
-                })
-                # 附上檔名讓 AI 知道對應關係
-                content_parts.append({"type": "text", "text": f"檔名: {image_path.name}"})
-                
-            except Exception as e:
-                logging.warning(f"無法讀取或編碼圖片 {image_path.name}，已跳過。錯誤: {e}")
-                continue
-        
-        response = openai_client.chat.completions.create(
-            model="gpt-4-turbo",
+        # with_raw_response 才拿得到 x-ratelimit-* 標頭
+        raw = openai_client.chat.completions.with_raw_response.create(
+            model=PROVIDER_MODELS["openai"][0],
             messages=[{"role": "user", "content": content_parts}],
-            max_tokens=4096 # 增加 token 數量以容納多張圖片的回應
+            **PROVIDER_MODELS["openai"][1]  # max_tokens 加大以容納多張圖片的回應
         )
+        headers = raw.headers
+        response = raw.parse()
 
-        cleaned_text = response.choices[0].message.content.strip().lstrip('```json').rstrip('```')
-        logging.info(f"OpenAI GPT-4V 回應內容:\n{cleaned_text}")
-        analysis_result = json.loads(cleaned_text)
-        
+        choice = response.choices[0]
+        analysis_result = _parse_reply(choice.message.content, "OpenAI GPT-4V",
+                                       choice.finish_reason == "length", headers)
         logging.info("OpenAI GPT-4V 批次分析成功。")
-        return analysis_result
+        return analysis_result, headers
         
+    except openai.RateLimitError as e:
+        raise ai_dispatch.RateLimited(str(e), headers=e.response.headers)
+    except ai_batcher.TruncatedReply:
+        raise
     except Exception as e:
         logging.error(f"OpenAI GPT-4V 批次分析失敗: {e}")
-        return None
+        return None, headers
 
+def request_batch_standin(product_name, image_batch):
+    """送到本機替身 API（OpenAI 相容，見 ai_standin.py），用於不花費額度地演練整輪流程。"""
+    if not image_batch: return None, {}
 
-def update_product_json(product_path, model_provider="google"):
+    headers = {}
+    try:
+        logging.info(f"送出新批次至替身 API (共 {len(image_batch)} 張圖)...")
+        payload = {
+            "model": PROVIDER_MODELS["standin"][0],
+            "messages": [{"role": "user", "content": build_openai_content(product_name, image_batch, "standin")}],
+            **PROVIDER_MODELS["standin"][1],
+        }
+        request = urllib.request.Request(
+            f"{STANDIN_URL.rstrip('/')}/chat/completions",
+            data=json.dumps(payload).encode('utf-8'),
+            headers={"Content-Type": "application/json"},
+        )
+        with urllib.request.urlopen(request, timeout=STANDIN_TIMEOUT) as resp:
+            headers = dict(resp.headers)
+            body = json.load(resp)
+
+        choice = body["choices"][0]
+        analysis_result = _parse_reply(choice["message"]["content"], "替身 API",
+                                       choice.get("finish_reason") == "length", headers)
+        return analysis_result, headers
+
+    except urllib.error.HTTPError as e:
+        if e.code == 429:
+            raise ai_dispatch.RateLimited(f"HTTP 429", headers=dict(e.headers))
+        logging.error(f"替身 API 批次分析失敗: HTTP {e.code}")
+        return None, dict(e.headers)
+    except ai_batcher.TruncatedReply:
+        raise
+    except Exception as e:
+        logging.error(f"替身 API 批次分析失敗: {e}")
+        return None, headers
+
+PROVIDERS = {
+    "google": request_batch_google,
+    "openai": request_batch_openai,
+    "standin": request_batch_standin,
+}
+
+def cache_lookup(cache, model_provider, product_name, image_batch):
+    """回傳 (快取命中的 {檔名: 結果}, 仍需送出的圖片)；model_provider 可為供應商清單，依序查詢。"""
+    prompt = AI_PROMPT_TEMPLATE.format(product_name=product_name)
+    providers = [model_provider] if isinstance(model_provider, str) else model_provider
+    hits, misses = {}, list(image_batch)
+    for provider in providers:
+        if not misses:
+            break
+        model, params = PROVIDER_MODELS[provider]
+        found, misses = cache.lookup(misses, prompt, model, params)
+        hits.update(found)
+    return hits, misses
+
+def cache_store(cache, model_provider, product_name, image_batch, batch_result):
+    """把一個批次的 AI 結果逐張寫入快取。"""
+    model, params = PROVIDER_MODELS[model_provider]
+    cache.store(image_batch, batch_result, AI_PROMPT_TEMPLATE.format(product_name=product_name), model, params)
+
+def analyze_batch(model_provider, product_name, image_batch, cache=None):
     """
-    掃描手動裁切的圖片，以「增量更新」的方式，智慧地只分析新的或被遺漏的圖片，
-    並將結果補充寫入 analysis.json。
+    同步分析一個批次（不經派送器）：先查 AI 回應快取，只把未命中的圖片送出，
+    限流時視為失敗。回傳 {檔名: 結果}，全部失敗時回傳 None。
+    """
+    cache = cache or ai_cache.default_cache()
+    hits, misses = cache_lookup(cache, model_provider, product_name, image_batch)
+    batch_result = dict(hits)
+    if misses:
+        try:
+            fresh = PROVIDERS[model_provider](product_name, misses)[0]
+        except ai_dispatch.RateLimited as e:
+            logging.error(f"{model_provider} 批次分析失敗: {e}")
+            fresh = None
+        if fresh:
+            cache_store(cache, model_provider, product_name, misses, fresh)
+            batch_result.update(fresh)
+    return batch_result or None
+
+def analyze_batch_with_google(product_name, image_batch, cache=None):
+    """使用 Google Gemini 對一個批次的圖片進行分類與分析（經快取）。"""
+    return analyze_batch("google", product_name, image_batch, cache)
+
+def analyze_batch_with_openai(product_name, image_batch, cache=None):
+    """使用 OpenAI GPT-4V 對一個批次的圖片進行分類與分析（經快取）。"""
+    return analyze_batch("openai", product_name, image_batch, cache)
+
+def estimate_tokens(image_batch, batcher=None):
+    """估算一個批次佔用的 TPM 額度（OpenAI 會把 max_tokens 一併計入）。"""
+    if batcher is not None:
+        image_tokens = batcher.input_tokens(image_batch)
+    else:
+        image_tokens = IMAGE_TOKENS * len(image_batch)
+    return PROMPT_TOKENS + image_tokens + MAX_OUTPUT_TOKENS
+
+# --- 產品工作規劃與派送 ---
+
+CATEGORY_KEYS = ["selling_points", "use_cases", "spec_images", "generic_images"]
+
+@dataclass
+class ProductJob:
+    """一個產品的待分析工作：analysis.json 內容、待送批次與已回來的結果。"""
+    product_path: Path
+    analysis_path: Path
+    data: dict
+    product_name: str
+    journal: ai_journal.BatchJournal
+    batches: list = field(default_factory=list)     # [(img_info, [裁片路徑])]
+    results: dict = field(default_factory=dict)     # 批次序號 -> AI 回傳結果（日誌/快取命中的批次在規劃時就填好）
+    derived: dict = field(default_factory=dict)     # 批次序號 -> 代表裁片路徑（近似重複，不送出，沿用代表的結果）
+    pending: int = 0                                # 尚未有結果的批次數（含等待代表的近似重複）
+    since_checkpoint: int = 0                       # 上次寫回 analysis.json 後新回來的批次數
+
+    def to_send(self):
+        """需要送出的 (批次序號, 裁片路徑)。"""
+        return [(index, batch) for index, (_, batch) in enumerate(self.batches)
+                if index not in self.results and index not in self.derived]
+
+    def add_done(self, img_info, images_dir, results):
+        """把已有結果（日誌恢復或快取命中）的裁片登記為一個已完成的批次。"""
+        self.results[len(self.batches)] = results
+        self.batches.append((img_info, [images_dir / name for name in sorted(results)]))
+
+@dataclass
+class DedupePlan:
+    """跨產品的近似重複分組：代表裁片送出，結果回來後套用到等待它的裁片。"""
+    index: crop_dedupe.NearDuplicateIndex
+    followers: dict = field(default_factory=dict)   # str(代表路徑) -> [(job, 批次序號, 裁片路徑)]
+    calls_saved: int = 0                            # 與不去重相比少送的批次數（規劃時估算）
+
+    def follow(self, rep, job, index, crop_path):
+        self.followers.setdefault(str(rep), []).append((job, index, crop_path))
+
+def plan_product_job(product_path, inventory, model_provider="google", cache=None, batcher=None, dedupe=None,
+                     classifier=None):
+    """
+    掃描手動裁切的圖片，以「增量更新」的方式，智慧地只挑出新的或被遺漏的圖片，
+    切成批次；讀不到 analysis.json 時回傳 None。上次中斷留下的批次日誌與 AI 快取中
+    已有結果的圖片直接成為已完成的批次，有 classifier 時本機有把握的裁片也是；
+    有 dedupe 時，與先前（可跨產品）待送裁片
+    近似重複的圖片不送出，等代表的結果回來再套用。只有其餘的才送出：有 batcher 時
+    依 token / 像素預算裝箱，否則固定 BATCH_SIZE 張一批。
     """
     analysis_path = product_path / "analysis.json"
     images_dir = product_path / "images"
 
     if not analysis_path.exists() or not images_dir.is_dir():
         logging.warning(f"跳過 {product_path.name}：找不到 analysis.json 或 images 資料夾。")
-        return
+        return None
 
     try:
         with open(analysis_path, 'r', encoding='utf-8') as f:
             data = json.load(f)
     except (IOError, json.JSONDecodeError) as e:
         logging.error(f"無法讀取或解析 {analysis_path.name}: {e}")
-        return
+        return None
+
+    journal = ai_journal.BatchJournal(product_path / ai_journal.JOURNAL_NAME)
+    job = ProductJob(product_path, analysis_path, data, data.get("product_name", "未知產品"), journal)
+    journaled = journal.replay_results()
 
-    product_name = data.get("product_name", "未知產品")
-    has_updates = False
+    def pack(paths):
+        if batcher is not None:
+            return batcher.pack(paths, inventory.dimensions(paths))
+        return list(batch_images(paths, batch_size=BATCH_SIZE))
+
+    def disk_crops(parent_name):
+        # 與原本的 glob(f"{stem}-crop*.jpg") 範圍相同：同目錄、-cropN、小寫 .jpg
+        return {r.path.name for r in inventory.crops_of(images_dir / parent_name, exts=('.jpg',))
+                if r.path.parent == images_dir.resolve()
+                and fnmatch.fnmatchcase(r.path.name, image_inventory.LEGACY_CROP_GLOB)}
 
     # 1. 掃描現有成果，建立已分析圖片的集合
     analyzed_crops = set()
     for img_info in data.get("images", []):
-        # 修正：確保所有裁切圖都有一個紀錄，而不僅僅是已分析的
-        parent_name_stem = Path(img_info.get("local_path", "")).stem
-        all_disk_crops_for_parent = {p.name for p in images_dir.glob(f"{parent_name_stem}-crop*.jpg")}
-        
         # 確保分類列表存在
-        for key in ["selling_points", "use_cases", "spec_images", "generic_images"]:
+        for key in CATEGORY_KEYS:
             img_info.setdefault(key, [])
         
         # 收集已分析的檔名
-        for category_key in ["selling_points", "use_cases", "spec_images", "generic_images"]:
+        for category_key in CATEGORY_KEYS:
             for crop_analysis in img_info.get(category_key, []):
                 if "local_path" in crop_analysis:
                     analyzed_crops.add(Path(crop_analysis["local_path"]).name)
@@ -221,81 +421,298 @@ def update_product_json(product_path, model_provider="google"):
         if not parent_local_path: continue
         parent_name_stem = Path(parent_local_path).stem
         
-        all_disk_crops = {p.name for p in images_dir.glob(f"{parent_name_stem}-crop*.jpg")}
+        all_disk_crops = disk_crops(Path(parent_local_path).name)
         crops_to_analyze_paths = [images_dir / name for name in sorted(list(all_disk_crops - analyzed_crops))]
         
         if not crops_to_analyze_paths:
             continue  # 這個父圖片的所有裁切圖都已被分析
 
         logging.info(f"為父圖片 '{parent_name_stem}.jpg' 找到 {len(crops_to_analyze_paths)} 張需要分析的新圖片。")
-        has_updates = True
+        resumed = {p.name: journaled[p.name] for p in crops_to_analyze_paths if journaled.get(p.name)}
+        if resumed:
+            logging.info(f"其中 {len(resumed)} 張已在上次中斷前完成，由批次日誌恢復。")
+            job.add_done(img_info, images_dir, resumed)
+            crops_to_analyze_paths = [p for p in crops_to_analyze_paths if p.name not in resumed]
+        if cache is not None and crops_to_analyze_paths:
+            hits, crops_to_analyze_paths = cache_lookup(cache, model_provider, job.product_name, crops_to_analyze_paths)
+            if hits:
+                logging.info(f"其中 {len(hits)} 張命中 AI 回應快取，不再送出。")
+                job.add_done(img_info, images_dir, hits)
+        if classifier is not None and crops_to_analyze_paths:
+            labelled, crops_to_analyze_paths = classifier.classify_paths(crops_to_analyze_paths)
+            if labelled:
+                logging.info(f"其中 {len(labelled)} 張由本機預分類判定，不送 AI。")
+                job.add_done(img_info, images_dir, labelled)
+        if dedupe is not None and crops_to_analyze_paths:
+            dedupe.index.prefetch(crops_to_analyze_paths)
+            unique = []
+            for crop_path in crops_to_analyze_paths:
+                rep = dedupe.index.representative(crop_path)
+                if rep is None:
+                    unique.append(crop_path)
+                    continue
+                dedupe.follow(rep, job, len(job.batches), crop_path)
+                job.derived[len(job.batches)] = rep
+                job.batches.append((img_info, [crop_path]))
+            if len(unique) < len(crops_to_analyze_paths):
+                logging.info(f"其中 {len(crops_to_analyze_paths) - len(unique)} 張與其他待送裁片近似重複，沿用代表的結果。")
+                dedupe.calls_saved += len(pack(crops_to_analyze_paths)) - len(pack(unique))
+                crops_to_analyze_paths = unique
+        for batch in pack(crops_to_analyze_paths):
+            job.batches.append((img_info, batch))
+
+    job.pending = len(job.to_send()) + len(job.derived)
+    return job
+
+def apply_batch_result(job, img_info, batch, batch_result):
+    """把一個批次的 AI 結果依分類補進父圖片的紀錄（沒有結果的裁片略過）。"""
+    for crop_path in batch:
+        result = batch_result.get(crop_path.name)
+        if not result:
+            continue
+
+        full_crop_info = {
+            "local_path": f"{job.product_path.name}/images/{crop_path.name}",
+            "summary": result.get("summary"),
+            "text_blocks": result.get("text_blocks", [])
+        }
         
-        is_first_batch = True
-        for batch in batch_images(crops_to_analyze_paths, batch_size=6):
-            if not is_first_batch:
-                logging.info("等待 10 秒後處理下一批...")
-                time.sleep(10)
-
-            if model_provider == "openai":
-                batch_result = analyze_batch_with_openai(product_name, batch)
-            else:
-                batch_result = analyze_batch_with_google(product_name, batch)
-
-            if batch_result:
-                for crop_path in batch:
-                    result = batch_result.get(crop_path.name)
-                    if not result:
-                        logging.warning(f"AI 未對 {crop_path.name} 提供分析結果。")
-                        continue
-
-                    full_crop_info = {
-                        "local_path": f"{product_path.name}/images/{crop_path.name}",
-                        "summary": result.get("summary"),
-                        "text_blocks": result.get("text_blocks", [])
-                    }
-                    
-                    # 修正：統一分類鍵名 (e.g., selling_point -> selling_points)
-                    category = result.get("category", "generic")
-                    target_list_name = f"{category}s" if category in ["selling_point", "use_case"] else "spec_images" if category == "spec_image" else "generic_images"
-                    
-                    img_info.setdefault(target_list_name, []).append(full_crop_info)
-            
-            is_first_batch = False
-
-    # 3. 如果有任何更新，則在最後將 data 物件完整寫回檔案
-    if has_updates:
-        try:
-            with open(analysis_path, 'w', encoding='utf-8') as f:
-                json.dump(data, f, ensure_ascii=False, indent=2)
-            logging.info(f"成功將新的分析結果補充寫入 '{analysis_path.name}'")
-        except IOError as e:
-            logging.error(f"寫入檔案失敗 {analysis_path.name}: {e}")
+        # 修正：統一分類鍵名 (e.g., selling_point -> selling_points)
+        category = result.get("category", "generic")
+        target_list_name = f"{category}s" if category in ["selling_point", "use_case"] else "spec_images" if category == "spec_image" else "generic_images"
+        
+        img_info.setdefault(target_list_name, []).append(full_crop_info)
+
+def render_product_data(job):
+    """回傳套用目前所有結果後的 analysis.json 內容（不改動 job.data，可重複呼叫）。"""
+    data = copy.deepcopy(job.data)
+    img_infos = {id(img_info): copied for img_info, copied in zip(job.data.get("images", []), data.get("images", []))}
+    # 同一父圖片可能拆成日誌、快取命中與數個送出批次，合併後依檔名排序，結果與一次送完相同
+    merged = {}
+    for index, (img_info, batch) in enumerate(job.batches):
+        batch_result = job.results.get(index)
+        if batch_result:
+            paths, results = merged.setdefault(id(img_info), (img_infos[id(img_info)], [], {}))[1:]
+            paths.extend(batch)
+            results.update(batch_result)
+    for img_info, paths, results in merged.values():
+        apply_batch_result(job, img_info, sorted(paths, key=lambda p: p.name), results)
+    return data
+
+def checkpoint_product_job(job, final=False):
+    """把目前所有結果原子地寫入 analysis.json；寫入成功後清空批次日誌。"""
+    try:
+        ai_journal.atomic_write_json(job.analysis_path, render_product_data(job), ensure_ascii=False, indent=2)
+    except OSError as e:
+        # 日誌保留，下次執行仍可恢復
+        logging.error(f"寫入檔案失敗 {job.analysis_path.name}: {e}")
+        return
+    job.journal.reset()
+    job.since_checkpoint = 0
+    if final:
+        logging.info(f"成功將新的分析結果補充寫入 '{job.analysis_path.name}'")
     else:
-        logging.info(f"產品 {product_path.name} 無需更新，所有圖片均已分析。")
+        logging.info(f"checkpoint：已將目前結果寫入 '{job.analysis_path.name}' ({job.product_path.name}，尚有 {job.pending} 批)")
+
+async def dispatch_products(product_paths, dispatcher, inventory, model_provider="google", cache=None,
+                            batcher=None, dedupe=None, classifier=None):
+    """
+    規劃所有產品的批次後一次交給派送器：最多 concurrency 個請求同時在途（跨產品）。
+    每個批次結果一回來就寫入該產品的批次日誌並 fsync，每 CHECKPOINT_BATCHES 批與產品
+    完成時原子地合併進 analysis.json。成功的結果也逐張寫入 AI 回應快取。
+    有 dedupe 時，代表裁片的結果回來後一併套用到（可能在其他產品的）近似重複裁片；
+    有 classifier 時，本機預分類有把握的裁片在規劃時就完成，不送出。
+
+    dispatcher 可以是單一 ai_dispatch.Dispatcher，或多供應商的 ai_router.Router
+    （此時 model_provider 為供應商清單，快取與日誌記錄實際回應的供應商）。
+    """
+    jobs = []
+    for product_path in product_paths:
+        logging.info(f"處理產品：{product_path.name}")
+        job = plan_product_job(product_path, inventory, model_provider, cache, batcher, dedupe, classifier)
+        if job is None:
+            continue
+        if not job.batches:
+            job.journal.reset()         # 殘留的日誌內容都已在 analysis.json 中
+            logging.info(f"產品 {product_path.name} 無需更新，所有圖片均已分析。")
+            continue
+        if job.pending == 0:
+            checkpoint_product_job(job, final=True)     # 全部由日誌或快取取得
+            continue
+        jobs.append(job)
+
+    if classifier is not None:
+        logging.info(f"本機預分類：{classifier.describe()}")
+    if dedupe is not None:
+        logging.info(f"近似重複：{dedupe.index.describe()}，估計省下 {dedupe.calls_saved} 次 AI 呼叫")
+
+    def finish_batch(job, index, results, **extra):
+        if results is not None:
+            # 先落盤再更新記憶體狀態：此後當機也不必重送這一批
+            job.journal.append(job.batches[index][0].get("local_path", ""), results, **extra)
+            job.results[index] = results
+            job.since_checkpoint += 1
+        job.pending -= 1
+        if job.pending == 0:
+            checkpoint_product_job(job, final=True)
+        elif job.since_checkpoint >= CHECKPOINT_BATCHES:
+            checkpoint_product_job(job)
+
+    def fan_out(crop_path, result, provider):
+        """把代表裁片的結果套用到等待它的近似重複裁片（不寫入快取：快取只存模型對該內容的回答）"""
+        for follower_job, follower_index, follower_path in dedupe.followers.pop(str(crop_path), []):
+            if result:
+                finish_batch(follower_job, follower_index, {follower_path.name: result}, provider=provider,
+                             near_duplicate_of=f"{crop_path.parent.parent.name}/images/{crop_path.name}")
+            else:
+                logging.warning(f"{follower_path.name} 的代表 {crop_path.name} 沒有結果，下次執行再分析。")
+                finish_batch(follower_job, follower_index, None)
+
+    async def run_batch(job, index, batch):
+        provider, batch_result = await dispatcher.submit_routed(job.product_name, batch,
+                                                                tokens=estimate_tokens(batch, batcher))
+        results = None
+        if batch_result:
+            results = {}
+            for crop_path in batch:
+                if batch_result.get(crop_path.name):
+                    results[crop_path.name] = batch_result[crop_path.name]
+                else:
+                    logging.warning(f"AI 未對 {crop_path.name} 提供分析結果。")
+            if cache is not None:
+                cache_store(cache, provider, job.product_name, batch, results)
+        finish_batch(job, index, results, provider=provider)
+        if dedupe is not None:
+            for crop_path in batch:
+                fan_out(crop_path, (results or {}).get(crop_path.name), provider)
+
+    # 依產品順序建立工作；派送器的號誌是 FIFO，前面的產品會先完成、先寫回
+    try:
+        await asyncio.gather(*(run_batch(job, index, batch)
+                               for job in jobs
+                               for index, batch in job.to_send()))
+    finally:
+        for job in jobs:
+            job.journal.close()
+    return jobs
+
+def update_product_json(product_path, model_provider="google", inventory=None,
+                        concurrency=ai_dispatch.DEFAULT_CONCURRENCY, cache=None, batcher=None, dedupe=None,
+                        classifier=None):
+    """
+    掃描手動裁切的圖片，以「增量更新」的方式，智慧地只分析新的或被遺漏的圖片，
+    並將結果補充寫入 analysis.json。單一產品版本；整批處理請用 dispatch_products。
+    """
+    # 裁片清單由庫存索引查詢；未傳入時只更新本產品的 images 目錄
+    own_inventory = inventory is None
+    if own_inventory:
+        inventory = image_inventory.Inventory()
+        inventory.refresh(product_path / "images")
+
+    batcher = batcher or ai_batcher.AdaptiveBatcher(model_provider)
+    try:
+        with ai_dispatch.Dispatcher(batcher.wrap(PROVIDERS[model_provider]), concurrency=concurrency,
+                                    name=model_provider) as dispatcher:
+            asyncio.run(dispatch_products([product_path], dispatcher, inventory, model_provider,
+                                          cache or ai_cache.default_cache(), batcher, dedupe, classifier))
+    finally:
+        batcher.save()
+        if own_inventory:
+            inventory.close()
 
 def main():
     """主函式，增加命令行參數來選擇 AI 模型"""
+    global STANDIN_URL
+
     parser = argparse.ArgumentParser(description="使用 AI 分析商品圖片並更新 JSON 檔案。")
     parser.add_argument(
         '--model', 
         type=str, 
-        choices=['google', 'openai'], 
+        choices=sorted(PROVIDERS), 
         default='google', 
-        help='選擇使用的 AI 模型供應商 (預設: google)'
+        help='選擇使用的 AI 模型供應商 (預設: google；standin 為本機替身 API)'
     )
+    parser.add_argument('--fallback', nargs='+', choices=sorted(PROVIDERS), default=[],
+                        help='備援供應商 (依序)；指定後每批依健康狀態路由，失敗時轉送下一家')
+    parser.add_argument('--hedge', action='store_true',
+                        help='請求超過該供應商 p95 耗時仍未回應時，同批次另送下一家，先回來的有效結果勝出 (需 --fallback)')
+    parser.add_argument('--concurrency', type=int, default=ai_dispatch.DEFAULT_CONCURRENCY,
+                        help=f'同時在途的請求數 (預設: {ai_dispatch.DEFAULT_CONCURRENCY})')
+    parser.add_argument('--rpm', type=int, default=None, help='本地每分鐘請求上限 (預設: 只依供應商標頭與 429)')
+    parser.add_argument('--tpm', type=int, default=None, help='本地每分鐘 token 上限')
+    parser.add_argument('--fixed-batch', action='store_true',
+                        help=f'固定每 {BATCH_SIZE} 張一批 (預設依 token / 像素預算自適應裝箱)')
+    parser.add_argument('--max-images', type=int, default=ai_batcher.BatchBudget.max_images,
+                        help=f'自適應批次的每批張數上限 (預設: {ai_batcher.BatchBudget.max_images})')
+    parser.add_argument('--max-output-tokens', type=int, default=ai_batcher.BatchBudget.max_output_tokens,
+                        help=f'自適應批次的預期輸出上限 (預設: {ai_batcher.BatchBudget.max_output_tokens}，'
+                             f'須低於 max_tokens={MAX_OUTPUT_TOKENS})')
+    parser.add_argument('--target-latency', type=float, default=ai_batcher.BatchBudget.target_latency,
+                        help=f'自適應批次的單次請求目標耗時秒數 (預設: {ai_batcher.BatchBudget.target_latency})')
+    parser.add_argument('--no-cache', action='store_true', help='不讀寫 AI 回應快取 (一律重新送出)')
+    parser.add_argument('--dedupe-distance', type=int, default=crop_dedupe.DEFAULT_DISTANCE,
+                        help=f'近似重複裁片的感知雜湊漢明距離門檻 (預設: {crop_dedupe.DEFAULT_DISTANCE}，'
+                             f'共 {crop_dedupe.HASH_SIZE ** 2} 位元)；每組只送一張')
+    parser.add_argument('--no-dedupe', action='store_true', help='不合併近似重複的裁片 (每張都送出)')
+    parser.add_argument('--local-threshold', type=float, default=crop_classifier.DEFAULT_THRESHOLD,
+                        help=f'本機預分類的信心門檻 (預設: {crop_classifier.DEFAULT_THRESHOLD})；'
+                             f'達門檻的空白與碎片不送 AI（規格表需要擷取文字，仍送 AI）')
+    parser.add_argument('--no-local', action='store_true', help='不做本機預分類 (每張都送 AI)')
+    parser.add_argument('--standin-url', type=str, default=STANDIN_URL,
+                        help=f'替身 API 的 base URL (預設: {STANDIN_URL})')
     args = parser.parse_args()
+    STANDIN_URL = args.standin_url
     
     if not WWW_DIR.is_dir():
         logging.error(f"錯誤：找不到目標資料夾 '{WWW_DIR}'")
         return
 
-    logging.info(f"--- 開始使用 {args.model.upper()} 進行敘事設計與分類 (批次模式) ---")
-    for product_path in sorted(WWW_DIR.glob('product_*')):
-        if product_path.is_dir():
-            logging.info(f"處理產品：{product_path.name}")
-            update_product_json(product_path, model_provider=args.model)
+    providers = [args.model] + [p for p in args.fallback if p != args.model]
+    logging.info(f"--- 開始使用 {' → '.join(p.upper() for p in providers)} 進行敘事設計與分類 (並行 {args.concurrency}) ---")
+    cache = None if args.no_cache else ai_cache.default_cache()
+    dedupe = None if args.no_dedupe else DedupePlan(crop_dedupe.NearDuplicateIndex(args.dedupe_distance))
+    classifier = None if args.no_local else crop_classifier.LocalClassifier(args.local_threshold)
+
+    # 每個供應商各有自己的派送器（並行數與限流狀態）與批次器（延遲學習）；
+    # 裝箱以主要供應商的批次器為準，其餘共用它記下的裁片尺寸
+    budget = ai_batcher.BatchBudget(max_images=args.max_images, max_output_tokens=args.max_output_tokens,
+                                    target_latency=args.target_latency)
+    batchers = {}
+    dispatchers = {}
+    for name in providers:
+        call = PROVIDERS[name]
+        if not args.fixed_batch:
+            shared_sizes = batchers[args.model].sizes if batchers else None
+            batchers[name] = ai_batcher.AdaptiveBatcher(name, budget, sizes=shared_sizes)
+            call = batchers[name].wrap(call)
+            logging.info(f"自適應批次：{batchers[name].describe()}")
+        dispatchers[name] = ai_dispatch.Dispatcher(call, concurrency=args.concurrency,
+                                                   rpm=args.rpm, tpm=args.tpm, name=name)
+    if len(providers) > 1:
+        dispatcher = ai_router.Router(dispatchers, hedge=args.hedge)
+    else:
+        dispatcher = dispatchers[args.model]
+        if args.hedge:
+            logging.warning("--hedge 需要搭配 --fallback，已忽略。")
+
+    with image_inventory.Inventory() as inventory, dispatcher:
+        inventory.refresh(WWW_DIR)
+        product_paths = [p for p in sorted(WWW_DIR.glob('product_*')) if p.is_dir()]
+        try:
+            asyncio.run(dispatch_products(product_paths, dispatcher, inventory, providers, cache,
+                                          batchers.get(args.model), dedupe, classifier))
+        finally:
+            for batcher in batchers.values():
+                batcher.save()
+                logging.info(f"自適應批次：{batcher.describe()}")
+        logging.info(f"派送統計：{dict(dispatcher.stats)}")
+        if len(providers) > 1:
+            logging.info(f"供應商健康狀態：{dispatcher.describe()}")
+        if cache is not None:
+            logging.info(f"AI 快取：{dict(cache.stats)}")
+        logging.info(f"上傳內容：{ai_payload.default_payloads().describe()}")
     
     logging.info("✅ 處理完畢。")
 
 if __name__ == "__main__":
-    main() 
\ No newline at end of file
+    main()
@@ -0,0 +1,20 @@
+"""讓測試以與腳本相同的方式匯入 scripts/ 底下的模組（腳本之間以檔名互相 import）"""
+
+import importlib.util
+import sys
+from pathlib import Path
+
+SCRIPTS_DIR = Path(__file__).resolve().parent.parent / "scripts"
+if str(SCRIPTS_DIR) not in sys.path:
+    sys.path.insert(0, str(SCRIPTS_DIR))
+
+
+def load_script(module_name: str, filename: str):
+    """載入檔名不是合法模組名稱的腳本（如 Layout-Parser.py）；註冊到 sys.modules 讓其中的類別能 pickle"""
+    if module_name in sys.modules:
+        return sys.modules[module_name]
+    spec = importlib.util.spec_from_file_location(module_name, SCRIPTS_DIR / filename)
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[module_name] = module
+    spec.loader.exec_module(module)
+    return module
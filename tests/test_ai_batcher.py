@@ -0,0 +1,43 @@
+"""AdaptiveBatcher：只有真正被截斷的回應才調高輸出估計"""
+
+from pathlib import Path
+
+import pytest
+
+from ai_batcher import TRUNCATION_PENALTY, AdaptiveBatcher, TruncatedReply
+
+BATCH = [Path(f"p-crop{i:02d}.jpg") for i in range(3)]
+
+
+@pytest.fixture
+def batcher():
+    b = AdaptiveBatcher("standin", stats_path=None)
+    b.pack(BATCH, {p: (750, 1000) for p in BATCH})
+    return b
+
+
+def test_truncated_reply_raises_output_scale(batcher):
+    def request(product_name, image_batch):
+        raise TruncatedReply("停在輸出上限", headers={"x-request-id": "1"})
+
+    assert batcher.wrap(request)("p", BATCH) == (None, {"x-request-id": "1"})
+    assert batcher.stats.output_scale == pytest.approx(TRUNCATION_PENALTY)
+    assert batcher.stats.failures == 1
+
+
+def test_other_failures_do_not_touch_output_scale(batcher):
+    call = batcher.wrap(lambda product_name, image_batch: (None, {}))
+    for _ in range(5):
+        assert call("p", BATCH) == (None, {})
+    assert batcher.stats.output_scale == 1.0
+    assert batcher.stats.failures == 5
+    assert batcher.stats.latency.n == 0
+
+
+def test_successful_reply_updates_scale_and_latency(batcher):
+    reply = {p.name: {"category": "use_case", "summary": "短", "text_blocks": []} for p in BATCH}
+    call = batcher.wrap(lambda product_name, image_batch: (reply, {"h": "v"}))
+    assert call("p", BATCH) == (reply, {"h": "v"})
+    assert batcher.stats.output_scale < 1.0      # 實際輸出比預估少
+    assert batcher.stats.latency.n == 1
+    assert batcher.stats.failures == 0
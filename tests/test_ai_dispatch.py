@@ -0,0 +1,166 @@
+"""Dispatcher 對本機替身 API（ai_standin，背景執行緒）的在途上限、配額節流、429 退避與放棄"""
+
+import asyncio
+import json
+import time
+import urllib.error
+import urllib.request
+
+import pytest
+
+import ai_dispatch
+import ai_standin
+from ai_dispatch import Dispatcher, RateLimited
+
+
+@pytest.fixture
+def standin(monkeypatch):
+    """啟動替身伺服器；回傳 factory(**kwargs) -> (url, state)，視窗縮成 1 秒讓配額很快重置"""
+    monkeypatch.setattr(ai_standin, "WINDOW", 1.0)
+    servers = []
+
+    def start(**kwargs):
+        server = ai_standin.serve(port=0, **kwargs)
+        servers.append(server)
+        host, port = server.server_address[:2]
+        return f"http://{host}:{port}/v1", server.state
+
+    yield start
+    for server in servers:
+        server.shutdown()
+        server.server_close()
+
+
+def standin_call(url):
+    """與 update_json_with_crops.request_batch_standin 相同的協定，只送檔名不送圖"""
+
+    def call(names):
+        payload = {"model": "standin", "max_tokens": 10,
+                   "messages": [{"role": "user", "content": [
+                       {"type": "text", "text": f"檔名: {name}"} for name in names]}]}
+        request = urllib.request.Request(f"{url}/chat/completions", data=json.dumps(payload).encode("utf-8"),
+                                         headers={"Content-Type": "application/json"})
+        try:
+            with urllib.request.urlopen(request, timeout=30) as resp:
+                headers = dict(resp.headers)
+                body = json.load(resp)
+        except urllib.error.HTTPError as e:
+            if e.code == 429:
+                raise RateLimited("HTTP 429", headers=dict(e.headers))
+            raise
+        return json.loads(body["choices"][0]["message"]["content"]), headers
+
+    return call
+
+
+def run_all(dispatcher, batches, **kwargs):
+    async def main():
+        return await asyncio.gather(*(dispatcher.submit(batch, **kwargs) for batch in batches))
+    try:
+        return asyncio.run(main())
+    finally:
+        dispatcher.close()
+
+
+BATCHES = [[f"p{i}-crop{j:02d}.jpg" for j in range(3)] for i in range(12)]
+
+
+def test_in_flight_requests_are_capped(standin):
+    url, state = standin(latency=0.2)
+    results = run_all(Dispatcher(standin_call(url), concurrency=3), BATCHES)
+    assert all(results)
+    assert state.snapshot()["max_in_flight"] == 3
+    assert state.snapshot()["requests"] == len(BATCHES)
+
+
+def test_ratelimit_headers_throttle_before_429(standin):
+    url, state = standin(rpm=3)
+    dispatcher = Dispatcher(standin_call(url), concurrency=1)
+    t0 = time.monotonic()
+    results = run_all(dispatcher, BATCHES[:7])
+    elapsed = time.monotonic() - t0
+    assert all(results)
+    # 每 3 個請求用完額度後，等 x-ratelimit-reset-requests 再送，伺服器不必回 429
+    assert state.snapshot()["rate_limited"] == 0
+    assert dispatcher.stats["throttled"] >= 2
+    assert elapsed >= 1.8
+
+
+def test_429_waits_for_retry_after_then_succeeds(standin):
+    url, state = standin(error_rate=1.0)
+    starts = []
+
+    def on_start():
+        starts.append(time.monotonic())
+        if len(starts) == 2:
+            state.error_rate = 0.0      # 只有第一次送出被插入 429
+
+    dispatcher = Dispatcher(standin_call(url), concurrency=1, backoff_base=0.01)
+    [result] = run_all(dispatcher, BATCHES[:1], on_start=on_start)
+    assert set(result) == set(BATCHES[0])
+    assert dispatcher.stats["rate_limited"] == 1 and dispatcher.stats["ok"] == 1
+    # 替身的 retry-after 為 1 秒，退避至少等那麼久
+    assert starts[1] - starts[0] >= 1.0
+    assert state.snapshot()["rate_limited"] == 1
+
+
+def test_429_pauses_all_workers(standin):
+    url, state = standin(error_rate=1.0)
+    starts = []
+
+    def on_start():
+        starts.append(time.monotonic())
+        if len(starts) == 2:
+            state.error_rate = 0.0
+
+    dispatcher = Dispatcher(standin_call(url), concurrency=2, backoff_base=0.01)
+
+    async def main():
+        first = asyncio.create_task(dispatcher.submit(BATCHES[0], on_start=on_start))
+        await asyncio.sleep(0.3)        # 第一個請求已收到 429、進入暫停期
+        second = await dispatcher.submit(BATCHES[1], on_start=on_start)
+        return await first, second
+
+    try:
+        first, second = asyncio.run(main())
+    finally:
+        dispatcher.close()
+    assert first and second
+    # 第二個請求雖有空的工作者，仍等到暫停期結束才送出
+    assert starts[1] - starts[0] >= 1.0
+
+
+def test_backoff_bounds():
+    dispatcher = Dispatcher(lambda: (None, {}), backoff_base=1.0, backoff_cap=5.0)
+    try:
+        for attempt in range(8):
+            assert 0 <= dispatcher.backoff(attempt) <= min(5.0, 2 ** attempt)
+            delay = dispatcher.backoff(attempt, retry_after=3.0)
+            assert 3.0 <= delay <= max(4.0, min(5.0, 2 ** attempt))
+    finally:
+        dispatcher.close()
+
+
+@pytest.fixture
+def fast_backoff(monkeypatch):
+    """429 後不必真的等 retry-after"""
+    monkeypatch.setattr(Dispatcher, "backoff", lambda self, attempt, retry_after=None: 0.01)
+
+
+def test_gives_up_after_max_retries(standin, fast_backoff):
+    url, state = standin(error_rate=1.0)
+    dispatcher = Dispatcher(standin_call(url), concurrency=1)
+    assert run_all(dispatcher, BATCHES[:1]) == [None]
+    assert dispatcher.stats["gave_up"] == 1
+    assert dispatcher.stats["rate_limited"] == ai_dispatch.MAX_RETRIES + 1
+    assert state.snapshot()["requests"] == ai_dispatch.MAX_RETRIES + 1
+
+
+def test_concurrent_output_matches_sequential(standin, fast_backoff):
+    url, state = standin(latency=0.05, error_rate=0.2, seed=7)
+    call = standin_call(url)
+    sequential = run_all(Dispatcher(call, concurrency=1), BATCHES)
+    concurrent = run_all(Dispatcher(call, concurrency=4), BATCHES)
+    assert all(sequential)
+    assert state.snapshot()["rate_limited"] > 0        # 中途的 429 重試不影響結果
+    assert concurrent == sequential
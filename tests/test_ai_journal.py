@@ -0,0 +1,55 @@
+"""BatchJournal：寫到一半的最後一行不能吃掉之後附加的紀錄"""
+
+import json
+
+from ai_journal import BatchJournal, atomic_write_json
+
+
+def test_append_and_replay(tmp_path):
+    journal = BatchJournal(tmp_path / "analysis.journal.jsonl")
+    journal.append("a.jpg", {"a-crop01.jpg": {"category": "use_case"}})
+    journal.append("b.jpg", {"b-crop01.jpg": {"category": "spec_image"}}, model="standin")
+    journal.close()
+    records = BatchJournal(journal.path).replay()
+    assert [r["parent"] for r in records] == ["a.jpg", "b.jpg"]
+    assert records[1]["model"] == "standin"
+
+
+def test_torn_last_line_is_dropped_before_appending(tmp_path):
+    path = tmp_path / "analysis.journal.jsonl"
+    journal = BatchJournal(path)
+    journal.append("a.jpg", {"a-crop01.jpg": {"category": "use_case"}})
+    journal.close()
+    with open(path, "a", encoding="utf-8") as f:       # 模擬寫到一半當機
+        f.write('{"ts": 1, "parent": "b.jpg", "resu')
+
+    journal = BatchJournal(path)
+    journal.append("c.jpg", {"c-crop01.jpg": {"category": "selling_point"}})
+    journal.close()
+    assert [r["parent"] for r in BatchJournal(path).replay()] == ["a.jpg", "c.jpg"]
+    assert set(BatchJournal(path).replay_results()) == {"a-crop01.jpg", "c-crop01.jpg"}
+
+
+def test_torn_only_line(tmp_path):
+    path = tmp_path / "analysis.journal.jsonl"
+    path.write_text('{"ts": 1, "par', encoding="utf-8")
+    journal = BatchJournal(path)
+    journal.append("a.jpg", {"a-crop01.jpg": {}})
+    journal.close()
+    assert [r["parent"] for r in journal.replay()] == ["a.jpg"]
+
+
+def test_reset_removes_journal(tmp_path):
+    journal = BatchJournal(tmp_path / "analysis.journal.jsonl")
+    journal.append("a.jpg", {"a-crop01.jpg": {}})
+    journal.reset()
+    assert not journal.path.exists()
+    assert journal.replay() == []
+
+
+def test_atomic_write_json_leaves_no_temp_file(tmp_path):
+    target = tmp_path / "analysis.json"
+    atomic_write_json(target, {"x": 1})
+    atomic_write_json(target, {"x": 2})
+    assert json.loads(target.read_text(encoding="utf-8")) == {"x": 2}
+    assert [p.name for p in tmp_path.iterdir()] == ["analysis.json"]
@@ -0,0 +1,69 @@
+"""Router 對沖：落敗者的耗時要記進健康統計，遺棄的呼叫跑完前仍佔用並行名額"""
+
+import asyncio
+import threading
+import time
+
+from ai_dispatch import Dispatcher
+from ai_router import MIN_SAMPLES, Router
+
+
+def sleeper(seconds, log=None):
+    def call(batch):
+        if log is not None:
+            log.append((threading.current_thread().name, time.monotonic()))
+        time.sleep(seconds)
+        return {"batch": batch, "slept": seconds}, {}
+    return call
+
+
+def make_router(slow=0.6, fast=0.05):
+    calls = []
+    router = Router({"slow": Dispatcher(sleeper(slow, calls), concurrency=1, name="slow"),
+                     "fast": Dispatcher(sleeper(fast), concurrency=1, name="fast")},
+                    hedge=True, hedge_min_delay=0.05)
+    for _ in range(MIN_SAMPLES):
+        router.health["slow"].record(0.05, True)     # slow 看起來比較健康、p95 很短
+    return router, calls
+
+
+def test_hedge_loser_is_recorded_as_slow_sample():
+    router, _ = make_router()
+
+    async def main():
+        provider, result = await router.submit_routed("b1")
+        await asyncio.sleep(0)          # 讓被取消的工作跑完清理
+        return provider, result
+
+    try:
+        provider, result = asyncio.run(main())
+    finally:
+        router.close()
+    assert provider == "fast" and result["batch"] == "b1"
+    assert router.stats["hedge_won"] == 1
+    assert router.stats["cancelled_slow"] == 1
+    slow = router.health["slow"]
+    assert slow.samples == MIN_SAMPLES + 1
+    assert max(s for s, _ in slow.calls) >= 0.05
+    assert slow.consecutive_failures == 0
+
+
+def test_orphaned_call_keeps_its_concurrency_slot():
+    router, calls = make_router(slow=0.6)
+    slow = router.dispatchers["slow"]
+
+    sent = []
+
+    async def main():
+        await router.submit_routed("b1")                  # slow 落敗，執行緒裡的呼叫仍在跑
+        return await slow.submit("b2", on_start=lambda: sent.append(time.monotonic()))
+
+    try:
+        result = asyncio.run(main())
+    finally:
+        router.close()
+    assert result["batch"] == "b2"
+    assert slow.stats["orphaned"] == 1
+    # 第二個請求要等遺棄的呼叫結束（約 0.6 秒）才放行，不會與它同時在途
+    (_, first), _ = calls
+    assert sent[0] - first >= 0.55
@@ -0,0 +1,47 @@
+"""LocalClassifier：只有空白與碎片在本機標註，規格表要送 AI 擷取文字"""
+
+import cv2
+import numpy as np
+import pytest
+
+from crop_classifier import LocalClassifier, classify, extract_features
+
+
+@pytest.fixture
+def crops(tmp_path):
+    blank = np.full((400, 600, 3), 255, np.uint8)
+    tiny = np.full((30, 200, 3), 120, np.uint8)
+    spec = np.full((600, 800, 3), 255, np.uint8)
+    for i in range(8):                         # 白底規格表：細橫線 + 每列淺灰小字
+        y = 40 + i * 65
+        cv2.line(spec, (20, y), (780, y), (0, 0, 0), 1)
+        cv2.putText(spec, f"SIZE {i * 12 + 30} x {i * 7 + 18} mm  WEIGHT {i + 1}.2 kg", (30, y + 35),
+                    cv2.FONT_HERSHEY_SIMPLEX, 0.5, (170, 170, 170), 1)
+    paths = {}
+    for name, img in (("blank", blank), ("tiny", tiny), ("spec", spec)):
+        paths[name] = tmp_path / f"p-crop-{name}.jpg"
+        cv2.imwrite(str(paths[name]), img)
+    return paths
+
+
+def test_spec_rule_still_fires(crops):
+    label = classify(extract_features(crops["spec"]))
+    assert label.category == "spec_image" and label.confidence >= 0.9
+
+
+def test_only_text_free_categories_are_labelled_locally(crops):
+    clf = LocalClassifier(workers=1)
+    labelled, ambiguous = clf.classify_paths([crops["blank"], crops["spec"], crops["tiny"]])
+    assert {name: r["category"] for name, r in labelled.items()} == {
+        crops["blank"].name: "generic", crops["tiny"].name: "generic"}
+    assert ambiguous == [crops["spec"]]
+    assert clf.stats["spec_image_sent"] == 1
+    assert "需要 AI 擷取文字" in clf.describe()
+
+
+def test_categories_can_be_widened(crops):
+    clf = LocalClassifier(workers=1, categories=("generic", "spec_image"))
+    labelled, ambiguous = clf.classify_paths([crops["spec"]])
+    assert labelled[crops["spec"].name]["category"] == "spec_image"
+    assert ambiguous == []
+
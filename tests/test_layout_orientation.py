@@ -0,0 +1,99 @@
+"""方向預判：只有明確的直排文字行才比較 90° 方向，照片紋理不能讓圖被轉走"""
+
+import cv2
+import numpy as np
+
+from conftest import load_script
+
+lp_mod = load_script("layout_parser", "Layout-Parser.py")
+Block = lp_mod.Block
+estimate_orientation = lp_mod.estimate_orientation
+
+BOTH_90 = (cv2.ROTATE_90_CLOCKWISE, cv2.ROTATE_90_COUNTERCLOCKWISE)
+
+
+def _text_page(lines=12):
+    """白底上多行橫排文字"""
+    rng = np.random.default_rng(0)
+    img = np.full((900, 700, 3), 255, np.uint8)
+    for i in range(lines):
+        text = "".join(rng.choice(list("ABCDEFGHKLMNPRSTUVWXYZ0123456789"), 22))
+        cv2.putText(img, text, (30, 60 + i * 65), cv2.FONT_HERSHEY_SIMPLEX, 1.0, (0, 0, 0), 2)
+    return img
+
+
+def _stripes():
+    """直條紋理上散落小點（像布紋、木紋）：字元大小的元件很多，但沒有成行的文字"""
+    rng = np.random.default_rng(1)
+    img = np.full((900, 700, 3), 200, np.uint8)
+    for x in range(20, 700, 45):
+        img[:, x:x + 3] = 40
+    for _ in range(300):
+        y, x = rng.integers(0, 890), rng.integers(0, 690)
+        img[y:y + 6, x:x + 6] = 0
+    return img
+
+
+class ProbeAnalyzer(lp_mod.LayoutAnalyzer):
+    """偵測結果依方向給定：scores 為 {（旋轉後）圖片形狀: [框分數, ...]}"""
+
+    def __init__(self, scores):
+        self.model = object()
+        self.scores = scores
+        self.calls = []
+
+    def detect(self, image, score_thresh=lp_mod.SCORE_THRESH):
+        self.calls.append(image.shape[:2])
+        h, w = image.shape[:2]
+        return [Block(0, 0, w / 2, h / 2, "Text", s) for s in self.scores.get(image.shape[:2], [])]
+
+
+def test_horizontal_text_is_not_rotated():
+    rotations, score = estimate_orientation(_text_page())
+    assert rotations == ()
+    assert score > 0.5
+
+
+def test_vertical_text_lines_offer_both_directions():
+    rotations, score = estimate_orientation(cv2.rotate(_text_page(), cv2.ROTATE_90_CLOCKWISE))
+    assert rotations == BOTH_90
+    assert score < -0.5
+
+
+def test_texture_without_text_lines_is_not_rotated():
+    assert estimate_orientation(_stripes())[0] == ()
+
+
+def test_few_vertical_lines_are_not_enough():
+    page = cv2.rotate(_text_page(lines=2), cv2.ROTATE_90_CLOCKWISE)
+    assert estimate_orientation(page)[0] == ()
+
+
+def test_rotation_needs_clearly_better_detections():
+    page = cv2.rotate(_text_page(), cv2.ROTATE_90_CLOCKWISE)     # 900×700 直排 → 700×900
+    h, w = page.shape[:2]
+    # 旋轉後只比原方向好一點：維持原方向
+    analyzer = ProbeAnalyzer({(h, w): [0.5], (w, h): [0.6]})
+    blocks = analyzer.analyze_image(page)
+    assert blocks == [Block(0, 0, w / 2, h / 2, "Text", 0.5)]
+    assert len(analyzer.calls) == 3
+    # 明顯較好：採用旋轉後的結果，框轉回原圖座標
+    analyzer = ProbeAnalyzer({(h, w): [0.3], (w, h): [0.9, 0.8]})
+    blocks = analyzer.analyze_image(page)
+    assert [b.score for b in blocks] == [0.9, 0.8]
+    assert all(0 <= b.x1 < b.x2 <= w and 0 <= b.y1 < b.y2 <= h for b in blocks)
+
+
+def test_upright_page_runs_detector_once():
+    page = _text_page()
+    analyzer = ProbeAnalyzer({page.shape[:2]: [0.7]})
+    assert [b.score for b in analyzer.analyze_image(page)] == [0.7]
+    assert analyzer.calls == [page.shape[:2]]
+
+
+def test_no_boxes_falls_back_to_other_directions():
+    page = np.full((300, 500, 3), 255, np.uint8)
+    analyzer = ProbeAnalyzer({(500, 300): [0.4]})
+    blocks = analyzer.analyze_image(page)
+    assert len(analyzer.calls) == 4
+    assert [b.score for b in blocks] == [0.4]
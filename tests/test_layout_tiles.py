@@ -0,0 +1,53 @@
+"""長圖切 tile：跨切邊的框要接回完整區塊，不能被上一個 tile 的截斷碎片吃掉"""
+
+from conftest import load_script
+
+lp_mod = load_script("layout_parser", "Layout-Parser.py")
+Block = lp_mod.Block
+merge_tiles = lp_mod.merge_tiles
+tile_spans = lp_mod.tile_spans
+
+SPANS = tile_spans(5000, 900)       # tile 高 1350、步長 1080：(0, 1350), (1080, 2430), (2160, 3510), ...
+
+
+def _local(i, y1, y2, score, type="text"):
+    """以原圖座標描述、換成第 i 個 tile 的區域座標"""
+    y0 = SPANS[i][0]
+    return Block(100, y1 - y0, 800, y2 - y0, type, score)
+
+
+def _tiles(**boxes):
+    tiles = [[] for _ in SPANS]
+    for name, (i, *box) in boxes.items():
+        tiles[i].append(_local(i, *box))
+    return tiles
+
+
+def test_block_starting_in_overlap_band():
+    # 區塊在 1200–1500：tile 0 只看到 1200–1350（下緣被切、分數較高），tile 1 看到完整的框
+    tiles = _tiles(fragment=(0, 1200, 1350, 0.9), full=(1, 1200, 1500, 0.8))
+    [block] = merge_tiles(tiles, SPANS)
+    assert (block.y1, block.y2) == (1200, 1500)
+    assert block.score == 0.9
+
+
+def test_block_ending_in_overlap_band():
+    # 區塊在 1000–1300：tile 0 看到完整的框，tile 1 只看到 1080–1300（上緣被切、分數較高）
+    tiles = _tiles(full=(0, 1000, 1300, 0.7), fragment=(1, 1080, 1300, 0.9))
+    [block] = merge_tiles(tiles, SPANS)
+    assert (block.y1, block.y2) == (1000, 1300)
+
+
+def test_block_spanning_three_tiles():
+    # 區塊在 1200–2600：tile 0、1 各被切一段，tile 2 從重疊帶內看到它的下半部
+    tiles = _tiles(top=(0, 1200, 1350, 0.95), middle=(1, 1200, 2430, 0.6), bottom=(2, 2160, 2600, 0.8))
+    [block] = merge_tiles(tiles, SPANS)
+    assert (block.y1, block.y2) == (1200, 2600)
+
+
+def test_separate_blocks_across_seam_stay_apart():
+    # 重疊帶內上下相鄰、互不相交的兩個區塊不能被接成一個
+    tiles = _tiles(upper=(0, 900, 1150, 0.9), lower=(1, 1200, 1500, 0.9),
+                   upper_again=(1, 1080, 1150, 0.5))
+    blocks = sorted(merge_tiles(tiles, SPANS), key=lambda b: b.y1)
+    assert [(b.y1, b.y2) for b in blocks] == [(900, 1150), (1200, 1500)]
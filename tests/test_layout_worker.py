@@ -0,0 +1,141 @@
+"""LayoutWorker 以 StubBackend（與測試用的小型替身後端）驗證啟動、湊批次、各請求門檻與關閉"""
+
+import multiprocessing as mp
+import os
+import time
+
+import numpy as np
+import pytest
+
+from conftest import load_script
+
+lp_mod = load_script("layout_parser", "Layout-Parser.py")
+
+Block = lp_mod.Block
+BackendSpec = lp_mod.BackendSpec
+LayoutWorker = lp_mod.LayoutWorker
+
+pytestmark = pytest.mark.skipif(mp.get_start_method() != "fork",
+                                reason="測試後端在 fork 時才會被 worker 行程繼承")
+
+MARK_CRASH = 7          # 左上角像素為此值時，替身後端讓 worker 行程直接結束
+MARK_UNPICKLABLE = 8    # 回傳無法 pickle 的結果
+MARK_RAISE = 9          # detect 拋出例外
+
+
+class ProbeBackend:
+    """回報收到的批次大小與門檻；分數固定為 0.05 / 0.2 / 0.6 三個框"""
+
+    def __init__(self, spec=None):
+        pass
+
+    def detect(self, images, score_thresh=lp_mod.SCORE_THRESH):
+        marks = {int(img[0, 0, 0]) for img in images}
+        if MARK_CRASH in marks:
+            os._exit(3)
+        if MARK_RAISE in marks:
+            raise ValueError("boom")
+        results = []
+        for img in images:
+            tag = f"batch={len(images)};thresh={score_thresh}"
+            blocks = [Block(0, 0, 10, 10, tag, s) for s in (0.05, 0.2, 0.6)]
+            if int(img[0, 0, 0]) == MARK_UNPICKLABLE:
+                blocks[-1].type = lambda: None
+            results.append(blocks)
+        return results
+
+
+lp_mod.BACKENDS["probe"] = ProbeBackend
+
+
+def _image(mark=255, h=120, w=80):
+    img = np.full((h, w, 3), 255, np.uint8)
+    img[0, 0] = mark
+    return img
+
+
+def _text_page():
+    """白底上幾行粗黑條，StubBackend 會把它們當成 Text 區塊"""
+    img = np.full((400, 300, 3), 255, np.uint8)
+    for y in (40, 120, 200, 280):
+        img[y:y + 12, 30:270] = 0
+    return img
+
+
+@pytest.fixture
+def probe_worker():
+    worker = LayoutWorker(BackendSpec("probe"), batch_size=4, batch_wait=0.5, start_timeout=30,
+                          request_timeout=30)
+    yield worker
+    worker.close()
+
+
+def test_stub_worker_matches_in_process_backend():
+    page = _text_page()
+    expected = lp_mod.StubBackend().detect([page])[0]
+    with LayoutWorker(BackendSpec("stub"), batch_size=2, batch_wait=0.01, start_timeout=30) as worker:
+        assert worker.process.is_alive()
+        got = worker.detect([page, page])
+    assert expected, "替身後端應偵測到文字列"
+    assert got == [expected, expected]
+
+
+def test_startup_failure_raises():
+    with pytest.raises(RuntimeError, match="啟動失敗"):
+        LayoutWorker(BackendSpec("no-such-backend"), start_timeout=30)
+
+
+def test_requests_are_batched(probe_worker):
+    results = probe_worker.detect([_image() for _ in range(4)])
+    assert {b.type.split(";")[0] for blocks in results for b in blocks} == {"batch=4"}
+
+
+def test_batch_size_caps_the_batch(probe_worker):
+    results = probe_worker.detect([_image() for _ in range(6)])
+    sizes = sorted(int(blocks[0].type.split(";")[0].split("=")[1]) for blocks in results)
+    assert max(sizes) <= 4
+    assert len(results) == 6
+
+
+def test_per_request_thresholds_in_one_batch(probe_worker):
+    low = probe_worker.submit(_image(), score_thresh=0.1)
+    high = probe_worker.submit(_image(), score_thresh=0.5)
+    low_blocks, high_blocks = low.result(timeout=30), high.result(timeout=30)
+    # 同一批以最低門檻推論一次，再依各自的門檻過濾
+    assert {b.type for b in low_blocks + high_blocks} == {"batch=2;thresh=0.1"}
+    assert [b.score for b in low_blocks] == [0.2, 0.6]
+    assert [b.score for b in high_blocks] == [0.6]
+
+
+def test_backend_error_fails_only_that_batch(probe_worker):
+    with pytest.raises(RuntimeError, match="boom"):
+        probe_worker.detect([_image(MARK_RAISE)])
+    assert len(probe_worker.detect([_image()])[0]) == 2
+
+
+def test_unpicklable_result_becomes_error(probe_worker):
+    with pytest.raises(RuntimeError, match="無法序列化"):
+        probe_worker.detect([_image(MARK_UNPICKLABLE)])
+    assert len(probe_worker.detect([_image()])[0]) == 2
+
+
+def test_close_stops_worker_and_rejects_new_requests():
+    worker = LayoutWorker(BackendSpec("probe"), batch_wait=0.01, start_timeout=30)
+    worker.close()
+    assert not worker.process.is_alive()
+    assert worker.process.exitcode == 0
+    with pytest.raises(RuntimeError, match="已停止"):
+        worker.submit(_image()).result(timeout=5)
+
+
+def test_worker_crash_fails_pending_requests_instead_of_hanging(probe_worker):
+    pending = probe_worker.submit(_image())
+    t0 = time.monotonic()
+    with pytest.raises(RuntimeError, match="意外結束"):
+        probe_worker.detect([_image(MARK_CRASH)])
+    assert time.monotonic() - t0 < 10
+    # 同批的其他請求也一起失敗，之後的請求立即失敗
+    with pytest.raises(RuntimeError):
+        pending.result(timeout=5)
+    with pytest.raises(RuntimeError, match="意外結束"):
+        probe_worker.submit(_image()).result(timeout=5)